@@ -0,0 +1,120 @@
+import argparse
+import pickle
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from scipy.sparse import coo_matrix
+
+from sm.engine.annotation.fdr import FDR
+from sm.engine.annotation.image_slab import ImageSlab
+from sm.engine.annotation_lithops.io import (
+    serialize,
+    deserialize,
+    deserialize_from_file,
+)
+
+
+def make_objects(n_rows):
+    """Makes objects with similar contents to each type of object saved with save_cobj"""
+    rng = np.random.default_rng(42)
+    ds_segm_df = pd.DataFrame(
+        {
+            'mz': np.sort(rng.uniform(100, 1000, n_rows)),
+            'int': rng.uniform(0, 1000, n_rows).astype(np.float32),
+            'sp_i': rng.integers(0, 100000, n_rows).astype(np.uint32),
+        }
+    )
+    n_formulas = n_rows // 4
+    centr_segm_df = pd.DataFrame(
+        {
+            'formula_i': np.repeat(np.arange(n_formulas), 4),
+            'peak_i': np.tile(np.arange(4), n_formulas),
+            'mz': np.sort(rng.uniform(100, 1000, n_formulas * 4)),
+            'int': rng.uniform(0, 100, n_formulas * 4),
+        }
+    ).set_index('formula_i')
+
+    nrows, ncols, n_slab_formulas = 200, 200, 100
+    images = [
+        [
+            coo_matrix(np.where(rng.uniform(size=(nrows, ncols)) < 0.1, 1, 0).astype(np.float32))
+            for _ in range(4)
+        ]
+        for _ in range(n_slab_formulas)
+    ]
+    image_slab = ImageSlab.from_images(
+        range(n_slab_formulas), rng.uniform(size=(n_slab_formulas, 4)), images, nrows, ncols
+    )
+
+    fdr = FDR({'decoy_sample_size': 20}, [], [], ['+H', '+Na', '+K'], 1)
+    formulas = [f'C{c}H{h}O{o}' for c, h, o in rng.integers(1, 50, (n_rows // 100, 3))]
+    fdr.decoy_adducts_selection(formulas)
+    formula_map_df = pd.DataFrame(fdr.ion_tuples(), columns=['formula', 'modifier'])
+    formula_map_df['target'] = formula_map_df.modifier.isin(fdr.target_modifiers())
+    formula_map_df['formula_i'] = np.arange(len(formula_map_df))
+    db_data = {'id': 1, 'targeted': False, 'fdr': fdr, 'formula_map_df': formula_map_df}
+
+    return {
+        'ds segment': ds_segm_df,
+        'centroids segment': centr_segm_df,
+        'image slab': image_slab,
+        'DbFDRData': db_data,
+    }
+
+
+def serialize_legacy(obj):
+    try:
+        return pa.serialize(obj).to_buffer().to_pybytes()
+    except pa.lib.SerializationCallbackError:
+        return pickle.dumps(obj)
+
+
+def benchmark(name, obj, serialize_func, tmp_dir, n_repeats):
+    start = time.perf_counter()
+    for _ in range(n_repeats):
+        data = serialize_func(obj)
+    ser_time = (time.perf_counter() - start) / n_repeats
+
+    start = time.perf_counter()
+    for _ in range(n_repeats):
+        deserialize(data)
+    deser_time = (time.perf_counter() - start) / n_repeats
+
+    path = Path(tmp_dir) / 'cobj'
+    path.write_bytes(data)
+    start = time.perf_counter()
+    for _ in range(n_repeats):
+        deserialize_from_file(path)
+    mmap_time = (time.perf_counter() - start) / n_repeats
+
+    print(
+        f'{name:<16} {len(data) / 2 ** 20:9.2f} MiB {ser_time * 1000:9.2f} ms '
+        f'{deser_time * 1000:9.2f} ms {mmap_time * 1000:9.2f} ms'
+    )
+
+
+def main(n_rows, n_repeats):
+    codecs = {
+        'legacy': serialize_legacy,
+        'typed': serialize,
+        'typed lz4': lambda obj: serialize(obj, 'lz4'),
+        'typed zstd': lambda obj: serialize(obj, 'zstd'),
+    }
+    with TemporaryDirectory() as tmp_dir:
+        for obj_name, obj in make_objects(n_rows).items():
+            print(f'{obj_name}: size, serialize, deserialize, deserialize from mmap')
+            for codec_name, serialize_func in codecs.items():
+                benchmark(codec_name, obj, serialize_func, tmp_dir, n_repeats)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare cloud object serialization formats')
+    parser.add_argument('--n-rows', type=int, default=1000000, help='Rows in each DataFrame')
+    parser.add_argument('--n-repeats', type=int, default=5, help='Repetitions of each operation')
+    args = parser.parse_args()
+
+    main(args.n_rows, args.n_repeats)
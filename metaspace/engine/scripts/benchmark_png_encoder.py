@@ -0,0 +1,61 @@
+import argparse
+import time
+from io import BytesIO
+
+import numpy as np
+import png
+
+from sm.engine.annotation.png_encoder import encode_png, FILTER_ADAPTIVE
+
+
+def make_images(size, n_images):
+    """Makes 16-bit greyscale+alpha ion images similar to those made by PngGenerator"""
+    rng = np.random.default_rng(42)
+    yy, xx = np.mgrid[:size, :size] / size
+    mask = ((xx - 0.5) ** 2 + (yy - 0.5) ** 2 < 0.2).astype(np.uint16) * 65535
+    dense, sparse = [], []
+    for _ in range(n_images):
+        cx, cy = rng.uniform(0.2, 0.8, 2)
+        blob = np.exp(-((xx - cx) ** 2 + (yy - cy) ** 2) * 20) * rng.uniform(0.5, 1, xx.shape)
+        dense.append(np.dstack([(blob / blob.max() * 65535).astype(np.uint16), mask]))
+        spots = np.where(rng.uniform(size=xx.shape) < 0.05, blob, 0)
+        sparse.append(np.dstack([(spots / spots.max() * 65535).astype(np.uint16), mask]))
+    return {'dense': dense, 'sparse': sparse}
+
+
+def encode_pypng(img):
+    h, w, depth = img.shape
+    fp = BytesIO()
+    png_writer = png.Writer(width=w, height=h, alpha=True, greyscale=True, bitdepth=16)
+    png_writer.write(fp, img.reshape(h, w * depth).tolist())
+    return fp.getvalue()
+
+
+def benchmark(name, encode, images):
+    start = time.perf_counter()
+    sizes = [len(encode(img)) for img in images]
+    elapsed = time.perf_counter() - start
+    mpix_per_s = sum(img.shape[0] * img.shape[1] for img in images) / elapsed / 1e6
+    print(f'{name:<28} {mpix_per_s:8.2f} Mpix/s {np.mean(sizes) / 1024:10.1f} KiB/image')
+
+
+def main(size, n_images):
+    for kind, images in make_images(size, n_images).items():
+        print(f'{kind} {size}x{size} images')
+        benchmark('pypng', encode_pypng, images)
+        for level in [1, 6]:
+            for filter_type in [0, 1, 2, 4, FILTER_ADAPTIVE]:
+                benchmark(
+                    f'encode_png level={level} filter={filter_type}',
+                    lambda img: encode_png(img, 16, level, filter_type),
+                    images,
+                )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare PNG encoding throughput')
+    parser.add_argument('--size', type=int, default=1000, help='Width and height of images')
+    parser.add_argument('--n-images', type=int, default=5, help='Number of images of each kind')
+    args = parser.parse_args()
+
+    main(args.size, args.n_images)
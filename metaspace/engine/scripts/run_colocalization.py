@@ -1,5 +1,6 @@
 import argparse
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 from sm.engine.annotation_lithops.executor import Executor
 from sm.engine.postprocessing.colocalization import Colocalization
@@ -71,7 +72,14 @@ ORDER BY j.ds_id DESC;
 
 
 def run_coloc_jobs(
-    sm_config, ds_id_str, sql_where, fix_missing, fix_corrupt, skip_existing, use_lithops
+    sm_config,
+    ds_id_str,
+    sql_where,
+    fix_missing,
+    fix_corrupt,
+    skip_existing,
+    use_lithops,
+    workers=1,
 ):
     assert (
         len(
@@ -127,11 +135,14 @@ def run_coloc_jobs(
     if use_lithops:
         executor = Executor(sm_config['lithops'])
 
-    for i, ds_id in enumerate(ds_ids):
+    def run_coloc_job(i, ds_id):
         try:
             logger.info(f'Running colocalization on {i+1} out of {len(ds_ids)}')
-            ds = Dataset.load(db, ds_id)
-            coloc = Colocalization(db)
+            # DB instances keep their current cursor as an attribute, so they can't be shared
+            # between threads
+            task_db = DB()
+            ds = Dataset.load(task_db, ds_id)
+            coloc = Colocalization(task_db)
             if use_lithops:
                 # noinspection PyUnboundLocalVariable
                 coloc.run_coloc_job_lithops(executor, ds, reprocess=not skip_existing)
@@ -140,6 +151,11 @@ def run_coloc_jobs(
         except Exception:
             logger.error(f'Failed to run colocalization on {ds_id}', exc_info=True)
 
+    # The number of workers should stay below the DB connection pool size
+    with ThreadPoolExecutor(workers) as pool:
+        for _ in pool.map(run_coloc_job, range(len(ds_ids)), ds_ids):
+            pass
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Run colocalization jobs')
@@ -174,6 +190,12 @@ if __name__ == '__main__':
         action='store_true',
         help='Use Lithops implementation',
     )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='Number of datasets to process in parallel',
+    )
     args = parser.parse_args()
     logger = logging.getLogger('engine')
 
@@ -186,4 +208,5 @@ if __name__ == '__main__':
             fix_corrupt=args.fix_corrupt,
             skip_existing=args.skip_existing,
             use_lithops=args.lithops,
+            workers=args.workers,
         )
@@ -0,0 +1,223 @@
+"""
+Chunked storage for the first-isotope ion images of all annotations of a job, so that
+post-processing can read them as floats instead of downloading and decoding each PNG
+"""
+from __future__ import annotations
+
+import json
+from concurrent.futures.thread import ThreadPoolExecutor
+from typing import BinaryIO, Callable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pyarrow as pa
+
+# Analysis cube format: compressed chunks of consecutive rows of a float32 matrix with one row per
+# image and one column per pixel in the sample area, followed by a directory and a fixed-size
+# footer. The directory contains the flattened pixel index (row * ncols + col) of each column,
+# the byte offsets and the first row of each chunk, and the key of each row, so that a few rows
+# can be loaded with ranged reads of the footer, the directory and their chunks. The bytes of the
+# floats in each chunk are shuffled so that the similar high-order bytes are adjacent.
+# The footer is at the end so that the cube can be written in a single pass. Chunks can have
+# different numbers of rows, so that chunks of cubes with the same pixels can be copied between
+# them without recompressing. Rows with a null key can't be looked up.
+CUBE_MAGIC = b'SMCUBE02'
+CUBE_CHUNK_SIZE = 4 * 2 ** 20
+CUBE_CODEC = 'zstd'
+CUBE_FOOTER = np.dtype(
+    [
+        ('n_rows', '<u8'),
+        ('n_pixels', '<u8'),
+        ('nrows', '<u8'),
+        ('ncols', '<u8'),
+        ('n_chunks', '<u8'),
+        ('codec', 'S8'),
+        ('directory_offset', '<u8'),
+        ('keys_size', '<u8'),
+        ('magic', 'S8'),
+    ]
+)
+CUBE_VALUE_DTYPE = np.dtype('<f4')
+CUBE_PIXEL_DTYPE = np.dtype('<u4')
+
+# Returns the bytes in [start, end) of a cube, or its last -start bytes if start is negative
+ReadRange = Callable[[int, Optional[int]], bytes]
+
+
+class AnalysisCubeWriter:
+    """Writes an analysis cube to `fp` one row at a time, keeping only one chunk in memory.
+
+    Args
+    ----------
+    fp : BinaryIO
+    pixel_inds : numpy.array
+        Flattened pixel indexes of the sample area, i.e. of the columns of the cube
+    nrows : int
+    ncols : int
+    chunk_size : int
+        Approximate uncompressed size of each chunk, in bytes
+    """
+
+    def __init__(self, fp: BinaryIO, pixel_inds, nrows, ncols, chunk_size=CUBE_CHUNK_SIZE):
+        self._fp = fp
+        self.pixel_inds = np.asarray(pixel_inds, dtype=CUBE_PIXEL_DTYPE)
+        self.nrows = nrows
+        self.ncols = ncols
+        row_size = max(len(self.pixel_inds), 1) * CUBE_VALUE_DTYPE.itemsize
+        self.chunk_rows = max(chunk_size // row_size, 1)
+        self.keys: List[Optional[str]] = []
+        self._chunk = np.zeros((self.chunk_rows, len(self.pixel_inds)), dtype=CUBE_VALUE_DTYPE)
+        self._n_chunk_rows = 0
+        self._chunk_offsets = [0]
+        self._chunk_row_offsets = [0]
+
+    def append(self, key: str, values: np.ndarray):
+        """Adds a row with the values of an image at `pixel_inds`"""
+        self._chunk[self._n_chunk_rows] = values
+        self._n_chunk_rows += 1
+        self.keys.append(key)
+        if self._n_chunk_rows == self.chunk_rows:
+            self._flush_chunk()
+
+    def _flush_chunk(self):
+        if self._n_chunk_rows == 0:
+            return
+        values = self._chunk[: self._n_chunk_rows]
+        # Shuffle the bytes of the values by transposing them
+        value_bytes = values.view(np.uint8).reshape(-1, CUBE_VALUE_DTYPE.itemsize).T
+        data = pa.compress(np.ascontiguousarray(value_bytes), codec=CUBE_CODEC, asbytes=True)
+        self._write_chunk(data, self._n_chunk_rows)
+        self._n_chunk_rows = 0
+
+    def _write_chunk(self, data: bytes, n_rows: int):
+        self._fp.write(data)
+        self._chunk_offsets.append(self._chunk_offsets[-1] + len(data))
+        self._chunk_row_offsets.append(self._chunk_row_offsets[-1] + n_rows)
+
+    def append_chunk(self, data: bytes, keys: Sequence[Optional[str]]):
+        """Adds the rows of a compressed chunk from `AnalysisCubeReader.read_chunk` of a cube with
+        the same pixels, without decompressing it. Rows that aren't needed can get a None key."""
+        self._flush_chunk()
+        self._write_chunk(data, len(keys))
+        self.keys.extend(keys)
+
+    def finish(self):
+        """Writes the remaining rows, the directory and the footer"""
+        self._flush_chunk()
+        keys_data = json.dumps(self.keys).encode()
+        footer = np.array(
+            [
+                (
+                    len(self.keys),
+                    len(self.pixel_inds),
+                    self.nrows,
+                    self.ncols,
+                    len(self._chunk_offsets) - 1,
+                    CUBE_CODEC.encode(),
+                    self._chunk_offsets[-1],
+                    len(keys_data),
+                    CUBE_MAGIC,
+                )
+            ],
+            dtype=CUBE_FOOTER,
+        )
+        self._fp.write(self.pixel_inds.tobytes())
+        self._fp.write(np.array(self._chunk_offsets, dtype='<u8').tobytes())
+        self._fp.write(np.array(self._chunk_row_offsets, dtype='<u8').tobytes())
+        self._fp.write(keys_data)
+        self._fp.write(footer.tobytes())
+
+
+class AnalysisCubeReader:
+    """Reads rows of an analysis cube with ranged reads.
+    The footer and the directory are read on creation."""
+
+    def __init__(self, read_range: ReadRange):
+        self._read_range = read_range
+        footer_data = read_range(-int(CUBE_FOOTER.itemsize), None)
+        if (
+            len(footer_data) != CUBE_FOOTER.itemsize
+            or footer_data[-len(CUBE_MAGIC) :] != CUBE_MAGIC
+        ):
+            raise ValueError('Not an analysis cube')
+        footer = np.frombuffer(footer_data, CUBE_FOOTER, 1)[0]
+        self.nrows = int(footer['nrows'])
+        self.ncols = int(footer['ncols'])
+        self._codec = footer['codec'].decode()
+        n_pixels, n_chunks = int(footer['n_pixels']), int(footer['n_chunks'])
+
+        dir_start = int(footer['directory_offset'])
+        offsets_start = n_pixels * CUBE_PIXEL_DTYPE.itemsize
+        row_offsets_start = offsets_start + (n_chunks + 1) * 8
+        keys_start = row_offsets_start + (n_chunks + 1) * 8
+        dir_data = read_range(dir_start, dir_start + keys_start + int(footer['keys_size']))
+        self.pixel_inds = np.frombuffer(dir_data, CUBE_PIXEL_DTYPE, n_pixels)
+        self._chunk_offsets = np.frombuffer(dir_data, '<u8', n_chunks + 1, offsets_start)
+        self._chunk_row_offsets = np.frombuffer(
+            dir_data, '<u8', n_chunks + 1, row_offsets_start
+        ).astype(np.int64)
+        self.keys: List[Optional[str]] = json.loads(bytes(dir_data[keys_start:]))
+        self._key_rows = {key: row for row, key in enumerate(self.keys) if key is not None}
+
+    @property
+    def n_rows(self) -> int:
+        return len(self.keys)
+
+    @property
+    def n_pixels(self) -> int:
+        return len(self.pixel_inds)
+
+    @property
+    def n_chunks(self) -> int:
+        return len(self._chunk_row_offsets) - 1
+
+    def chunk_keys(self, chunk_i: int) -> List[Optional[str]]:
+        """Keys of the rows in a chunk"""
+        return self.keys[self._chunk_row_offsets[chunk_i] : self._chunk_row_offsets[chunk_i + 1]]
+
+    def mask(self) -> np.ndarray:
+        """Boolean sample area mask, shape (nrows, ncols)"""
+        mask = np.zeros(self.nrows * self.ncols, dtype=bool)
+        mask[self.pixel_inds] = True
+        return mask.reshape(self.nrows, self.ncols)
+
+    def to_image(self, values: np.ndarray) -> np.ndarray:
+        """Scatters the values of a row into a float32 image, shape (nrows, ncols)"""
+        img = np.zeros(self.nrows * self.ncols, dtype=np.float32)
+        img[self.pixel_inds] = values
+        return img.reshape(self.nrows, self.ncols)
+
+    def read_chunk(self, chunk_i: int) -> bytes:
+        """Reads a chunk without decompressing it, see `AnalysisCubeWriter.append_chunk`"""
+        start, end = self._chunk_offsets[chunk_i : chunk_i + 2]
+        return self._read_range(int(start), int(end))
+
+    def _load_chunk(self, chunk_i: int) -> np.ndarray:
+        n_rows = len(self.chunk_keys(chunk_i))
+        n_bytes = n_rows * self.n_pixels * CUBE_VALUE_DTYPE.itemsize
+        raw = pa.decompress(self.read_chunk(chunk_i), decompressed_size=n_bytes, codec=self._codec)
+        value_bytes = np.frombuffer(raw, np.uint8).reshape(CUBE_VALUE_DTYPE.itemsize, -1)
+        values = value_bytes.T.copy().view(CUBE_VALUE_DTYPE)
+        return values.reshape(n_rows, self.n_pixels).astype(np.float32, copy=False)
+
+    def iter_chunks(self, keys: Sequence[str]) -> Iterator[Tuple[List[str], np.ndarray]]:
+        """Yields the rows of the cube with the given keys as (chunk_keys, values) tuples,
+        where `values` has shape (len(chunk_keys), n_pixels). Keys that aren't in the cube are
+        skipped. Each chunk is read with one ranged read, prefetching the next chunk."""
+        rows = np.unique(
+            np.array([self._key_rows[key] for key in keys if key in self._key_rows], dtype=np.int64)
+        )
+        row_chunks = np.searchsorted(self._chunk_row_offsets, rows, side='right') - 1
+        chunk_idxs, chunk_starts = np.unique(row_chunks, return_index=True)
+        chunk_bounds = np.append(chunk_starts, len(rows))
+
+        with ThreadPoolExecutor(1) as executor:
+            future = None
+            for i, chunk_i in enumerate(chunk_idxs.tolist()):
+                values = (future or executor.submit(self._load_chunk, chunk_i)).result()
+                if i + 1 < len(chunk_idxs):
+                    future = executor.submit(self._load_chunk, int(chunk_idxs[i + 1]))
+                chunk_rows = rows[chunk_bounds[i] : chunk_bounds[i + 1]]
+                yield (
+                    [self.keys[row] for row in chunk_rows],
+                    values[chunk_rows - self._chunk_row_offsets[chunk_i]],
+                )
@@ -4,6 +4,7 @@ from itertools import product
 import numpy as np
 import pandas as pd
 
+from sm.engine.annotation.image_slab import gather_ranges
 from sm.engine.formula_parser import format_modifiers
 
 logger = logging.getLogger('engine')
@@ -111,6 +112,15 @@ def _make_target_modifiers_df(chem_mods, neutral_losses, target_adducts):
     return df
 
 
+def _recode(values: pd.Series, uniques) -> np.ndarray:
+    """Returns the index of each of `values` in `uniques`, or -1 if it isn't present.
+    Only the distinct values are looked up, which is much faster for categorical Series."""
+    values = values.astype('category')
+    category_codes = pd.Index(uniques).get_indexer(values.cat.categories)
+    # Missing values have code -1, which selects the appended -1
+    return np.append(category_codes, -1)[values.cat.codes.values]
+
+
 class FDR:
     fdr_levels = [0.05, 0.1, 0.2, 0.5]
 
@@ -126,24 +136,60 @@ class FDR:
             chem_mods, neutral_losses, target_adducts
         )
 
-    def _choose_decoys(self, decoys):
-        copy = decoys.copy()
-        np.random.shuffle(copy)
-        return copy[: self.decoy_sample_size]
+    def _sample_decoy_adducts(self, n_groups, n_cand):
+        """Samples `decoy_sample_size` distinct decoy adduct indexes out of `n_cand` candidates
+        for each of `n_groups` (formula, target modifier) groups.
 
-    def _decoy_adduct_gen(self, target_formulas, decoy_adducts_cand):
-        np.random.seed(self.random_seed)
-        target_modifiers = list(self.target_modifiers_df.decoy_modifier_prefix.items())
-        # pylint: disable=invalid-name
-        for formula, (tm, dm_prefix) in product(target_formulas, target_modifiers):
-            for da in self._choose_decoys(decoy_adducts_cand):
-                yield (formula, tm, dm_prefix + da)
+        Runs the first `decoy_sample_size` steps of a Fisher-Yates shuffle on all groups at once,
+        drawing all random numbers in a single call, so that the result only depends on
+        `random_seed`. Returns an array of shape (n_groups, min(decoy_sample_size, n_cand))"""
+        n_samples = min(self.decoy_sample_size, n_cand)
+        rng = np.random.default_rng(self.random_seed)
+        offsets = rng.integers(
+            0, n_cand - np.arange(n_samples), size=(n_groups, n_samples), dtype=np.uint8
+        )
+        perms = np.tile(np.arange(n_cand, dtype=np.uint8), (n_groups, 1))
+        rows = np.arange(n_groups)
+        for i in range(n_samples):
+            swap_idxs = i + offsets[:, i]
+            perms[rows, i], perms[rows, swap_idxs] = perms[rows, swap_idxs], perms[rows, i]
+        return perms[:, :n_samples]
 
     def decoy_adducts_selection(self, target_formulas):
+        """Builds `td_df`, which contains `decoy_sample_size` randomly chosen decoy modifiers for
+        each (formula, target modifier) combination. Rows are ordered by formula, then target
+        modifier, so decoy sample `i` of each target modifier is its `i::decoy_sample_size` rows.
+        To save memory, all columns are categorical."""
         decoy_adduct_cand = [add for add in DECOY_ADDUCTS if add not in self.target_adducts]
+        assert len(decoy_adduct_cand) <= 256, 'Decoy adduct indexes must fit in uint8'
+        formula_codes, formulas = pd.factorize(pd.Series(target_formulas, dtype='O'))
+        tm_codes, tms = pd.factorize(self.target_modifiers_df.index)
+        dm_prefix_codes, dm_prefixes = pd.factorize(self.target_modifiers_df.decoy_modifier_prefix)
+
+        n_groups = len(formula_codes) * len(tm_codes)
+        decoy_adduct_idxs = self._sample_decoy_adducts(n_groups, len(decoy_adduct_cand))
+        n_samples = decoy_adduct_idxs.shape[1]
+        group_tm_idxs = np.tile(np.arange(len(tm_codes)), len(formula_codes))
+
+        # Different (prefix, adduct) pairs could produce the same decoy modifier string, so
+        # factorize the strings to get valid categories
+        dm_codes, dms = pd.factorize(
+            [prefix + da for prefix in dm_prefixes for da in decoy_adduct_cand]
+        )
+        dm_pair_codes = (
+            np.repeat(dm_prefix_codes[group_tm_idxs], n_samples) * len(decoy_adduct_cand)
+            + decoy_adduct_idxs.ravel()
+        )
         self.td_df = pd.DataFrame(
-            self._decoy_adduct_gen(target_formulas, decoy_adduct_cand),
-            columns=['formula', 'tm', 'dm'],
+            {
+                'formula': pd.Categorical.from_codes(
+                    np.repeat(formula_codes, len(tm_codes) * n_samples), categories=formulas
+                ),
+                'tm': pd.Categorical.from_codes(
+                    np.repeat(tm_codes[group_tm_idxs], n_samples), categories=tms
+                ),
+                'dm': pd.Categorical.from_codes(dm_codes[dm_pair_codes], categories=dms),
+            }
         )
 
     def ion_tuples(self):
@@ -152,9 +198,24 @@ class FDR:
         All ions needed for FDR calculation as a list of (formula, modifier),
         where modifier is a combination of chemical modification, neutral loss and adduct
         """
-        d_ions = self.td_df[['formula', 'dm']].drop_duplicates().values.tolist()
-        t_ions = self.td_df[['formula', 'tm']].drop_duplicates().values.tolist()
-        return list(map(tuple, t_ions + d_ions))
+        formulas = self.td_df.formula.astype('category')
+        ions = []
+        for modifier_col in ['tm', 'dm']:
+            modifiers = self.td_df[modifier_col].astype('category')
+            # Deduplicate by the categorical codes, keeping the first occurrence of each ion
+            ion_codes = (
+                formulas.cat.codes.values.astype(np.int64) * len(modifiers.cat.categories)
+                + modifiers.cat.codes.values
+            )
+            _, first_idxs = np.unique(ion_codes, return_index=True)
+            first_idxs.sort()
+            ions.extend(
+                zip(
+                    formulas.cat.categories.values[formulas.cat.codes.values[first_idxs]],
+                    modifiers.cat.categories.values[modifiers.cat.codes.values[first_idxs]],
+                )
+            )
+        return ions
 
     def target_modifiers(self):
         """ List of possible modifier values for target ions """
@@ -167,19 +228,69 @@ class FDR:
                 return level
         return 1.0
 
-    @staticmethod
-    def _msm_fdr_map(target_msm, decoy_msm):
-        target_msm_hits = pd.Series(target_msm.msm.value_counts(), name='target')
-        decoy_msm_hits = pd.Series(decoy_msm.msm.value_counts(), name='decoy')
-        msm_df = (
-            pd.concat([target_msm_hits, decoy_msm_hits], axis=1)
-            .fillna(0)
-            .sort_index(ascending=False)
+    def _median_fdrs(self, formula_msm, block_size=2 ** 16):  # pylint: disable=too-many-locals
+        """Calculates the median FDR of each target ion across all decoy samples.
+        The FDR of a target ion with MSM `m` against a decoy sample is
+        `(number of decoy ions with MSM >= m) / (number of target ions with MSM >= m)`, where only
+        ions with the same target modifier are counted. Decoy sample `i` for a target modifier
+        consists of its `i::decoy_sample_size` rows in `td_df`.
+
+        Instead of merging tables for every (target modifier, decoy sample) combination, this
+        maps ions, modifiers and MSMs to integer codes so that the counts for all target ions
+        can be found by sorting the codes once and using `searchsorted`.
+
+        Returns an array with one FDR per row of `formula_msm`. Rows of `formula_msm` that
+        aren't target ions have NaN FDRs."""
+        n_samples = self.decoy_sample_size
+        target_modifiers = self.target_modifiers_df.index.drop_duplicates()
+        td_df = self.td_df[self.td_df.tm.isin(target_modifiers)]
+
+        # Map (formula, modifier) pairs to integers to find the MSMs of decoy ions
+        msm_formula_codes, formulas = pd.factorize(formula_msm.formula)
+        msm_modifier_codes, modifiers = pd.factorize(formula_msm.modifier)
+        decoy_formula_codes = _recode(td_df.formula, formulas)
+        decoy_modifier_codes = _recode(td_df.dm, modifiers)
+        msm_ion_codes = msm_formula_codes.astype(np.int64) * len(modifiers) + msm_modifier_codes
+        decoy_ion_codes = np.where(
+            (decoy_formula_codes >= 0) & (decoy_modifier_codes >= 0),
+            decoy_formula_codes.astype(np.int64) * len(modifiers) + decoy_modifier_codes,
+            -1,
         )
-        msm_df['target_cum'] = msm_df.target.cumsum()
-        msm_df['decoy_cum'] = msm_df.decoy.cumsum()
-        msm_df['fdr'] = msm_df.decoy_cum / msm_df.target_cum
-        return msm_df.fdr
+        # Rank MSMs, so that they can be combined with other integer keys
+        msm_values, msm_ranks = np.unique(formula_msm.msm.values, return_inverse=True)
+        n_ranks = len(msm_values)
+
+        # Find all rows matching each decoy ion, same as an inner join
+        by_ion = np.argsort(msm_ion_codes, kind='stable')
+        match_starts = np.searchsorted(msm_ion_codes[by_ion], decoy_ion_codes, 'left')
+        match_ends = np.searchsorted(msm_ion_codes[by_ion], decoy_ion_codes, 'right')
+        n_matches = match_ends - match_starts
+        decoy_ranks = msm_ranks[by_ion[gather_ranges(match_starts, n_matches)]]
+        decoy_tm_codes = _recode(td_df.tm, target_modifiers)
+        decoy_samples = pd.Series(decoy_tm_codes).groupby(decoy_tm_codes).cumcount().values
+        decoy_samples %= n_samples
+        decoy_groups = np.repeat(decoy_tm_codes * n_samples + decoy_samples, n_matches)
+        decoy_keys = np.sort(decoy_groups.astype(np.int64) * n_ranks + decoy_ranks)
+
+        target_tm_codes = target_modifiers.get_indexer(formula_msm.modifier)
+        target_idxs = np.flatnonzero(target_tm_codes >= 0)
+        target_tm_codes = target_tm_codes[target_idxs].astype(np.int64)
+        target_ranks = msm_ranks[target_idxs]
+        target_keys = np.sort(target_tm_codes * n_ranks + target_ranks)
+
+        def count_greater_equal(sorted_keys, groups, ranks):
+            group_ends = np.searchsorted(sorted_keys, (groups + 1) * n_ranks, 'left')
+            return group_ends - np.searchsorted(sorted_keys, groups * n_ranks + ranks, 'left')
+
+        n_targets = count_greater_equal(target_keys, target_tm_codes, target_ranks)
+        fdrs = np.full(len(formula_msm), np.nan)
+        # Process targets in blocks to limit the size of the (n_samples, n_targets) arrays
+        for start in range(0, len(target_idxs), block_size):
+            block = slice(start, start + block_size)
+            decoy_groups = target_tm_codes[block] * n_samples + np.arange(n_samples)[:, None]
+            n_decoys = count_greater_equal(decoy_keys, decoy_groups, target_ranks[block])
+            fdrs[target_idxs[block]] = np.median(n_decoys / n_targets[block], axis=0)
+        return fdrs
 
     def _digitize_fdr(self, fdr_df):
         if self.analysis_version < 2:
@@ -199,27 +310,12 @@ class FDR:
     def estimate_fdr(self, formula_msm):
         logger.info('Estimating FDR')
 
-        td_df = self.td_df.set_index('tm')
+        fdrs = self._median_fdrs(formula_msm)
 
         target_fdr_df_list = []
         for tm in self.target_modifiers_df.index.drop_duplicates():  # pylint: disable=invalid-name
-            target_msm = formula_msm[formula_msm.modifier == tm]
-            full_decoy_df = td_df.loc[tm, ['formula', 'dm']]
-
-            msm_fdr_list = []
-            for i in range(self.decoy_sample_size):
-                decoy_subset_df = full_decoy_df[i :: self.decoy_sample_size]
-                decoy_msm = pd.merge(
-                    formula_msm,
-                    decoy_subset_df,
-                    left_on=['formula', 'modifier'],
-                    right_on=['formula', 'dm'],
-                )
-                msm_fdr = self._msm_fdr_map(target_msm, decoy_msm)
-                msm_fdr_list.append(msm_fdr)
-
-            msm_fdr_avg = pd.Series(pd.concat(msm_fdr_list, axis=1).median(axis=1), name='fdr')
-            target_fdr = self._digitize_fdr(target_msm.join(msm_fdr_avg, on='msm'))
+            target_mask = (formula_msm.modifier == tm).values
+            target_fdr = self._digitize_fdr(formula_msm[target_mask].assign(fdr=fdrs[target_mask]))
             target_fdr_df_list.append(target_fdr.drop('msm', axis=1))
 
         return pd.concat(target_fdr_df_list, axis=0)
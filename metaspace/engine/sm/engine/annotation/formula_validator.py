@@ -18,8 +18,10 @@ import numpy as np
 import pandas as pd
 from pyImagingMSpec.image_measures import isotope_image_correlation, isotope_pattern_match
 from cpyImagingMSpec import measure_of_chaos
-from scipy.sparse import coo_matrix
+from scipy.sparse import coo_matrix, csr_matrix
+from scipy.sparse.csgraph import minimum_spanning_tree
 
+from sm.engine.annotation.image_slab import ImageSlab
 from sm.engine.ds_config import DSConfigImageGeneration
 
 METRICS = OrderedDict(
@@ -33,6 +35,10 @@ METRICS = OrderedDict(
         ('max_iso_ints', [0.0, 0.0, 0.0, 0.0]),
     ]
 )
+# The sparse measure of chaos takes about as long as the dense one on an image with this many
+# pixels per non-zero pixel, plus a fixed overhead of this many pixels
+CHAOS_SPARSE_PIXEL_COST = 10
+CHAOS_SPARSE_OVERHEAD = 60000
 
 
 class MetricsDict(TypedDict):
@@ -54,6 +60,7 @@ FormulaImageSet = Tuple[int, List[float], List[Optional[coo_matrix]]]
 FormulaMetricSet = Tuple[int, MetricsDict, Optional[List[Optional[coo_matrix]]]]
 
 ComputeMetricsFunc = Callable[[List[Optional[coo_matrix]], List[float]], MetricsDict]
+ComputeMetricsBatchFunc = Callable[[ImageSlab], List[MetricsDict]]
 
 
 def replace_nan(val, default=0):
@@ -110,16 +117,378 @@ def make_compute_image_metrics(
                 doc['spatial'] = isotope_image_correlation(iso_imgs_flat, weights=formula_ints[1:])
                 if doc['spatial'] > 0:
 
-                    moc = measure_of_chaos(iso_imgs[0], img_gen_config.get('n_levels', 30))
+                    moc = _measure_of_chaos(
+                        *_coo_pixels(iso_images_sparse[0]),
+                        nrows,
+                        ncols,
+                        img_gen_config.get('n_levels', 30),
+                    )
                     doc['chaos'] = 0 if np.isclose(moc, 1.0) else moc
                     if doc['chaos'] > 0:
 
                         doc['msm'] = doc['chaos'] * doc['spatial'] * doc['spectral']
-        return OrderedDict((k, replace_nan(v)) for k, v in doc.items())
+        return _replace_nans(doc)
 
     return compute_metrics
 
 
+def _row_reduce(ufunc: np.ufunc, indptr: np.ndarray, data: np.ndarray, empty_value=0) -> np.ndarray:
+    """Reduces the values of each row of a CSR matrix (given as `indptr` and `data`) with `ufunc`.
+    Rows without any stored values get `empty_value`."""
+    result = np.full(len(indptr) - 1, empty_value, dtype=data.dtype)
+    non_empty = indptr[1:] > indptr[:-1]
+    if non_empty.any():
+        result[non_empty] = ufunc.reduceat(data, indptr[:-1][non_empty])
+    return result
+
+
+def _replace_nans(doc) -> MetricsDict:
+    return OrderedDict((k, replace_nan(v)) for k, v in doc.items())
+
+
+def _sum_duplicates(keys: np.ndarray, data: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Sorts `keys` and sums the `data` of duplicate keys sequentially in their original order,
+    so that the sums are identical to those produced by coo_matrix.toarray"""
+    if len(keys) == 0:
+        return keys, data
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    sorted_data = data[order]
+    starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+    n_dups = np.diff(np.append(starts, len(keys)))
+    data = sorted_data[starts]
+    for dup_i in range(1, n_dups.max(initial=0)):
+        has_dup = n_dups > dup_i
+        data[has_dup] += sorted_data[starts[has_dup] + dup_i]
+    return keys[starts], data
+
+
+def _dense_sums(  # pylint: disable=too-many-locals
+    rows: np.ndarray, positions: np.ndarray, values: np.ndarray, lengths: np.ndarray
+) -> np.ndarray:
+    """Sums sparse vectors, rounding exactly as `np.sum` rounds when summing the dense vectors.
+
+    Vector `r` has length `lengths[r]` and `values[rows == r]` at `positions[rows == r]`,
+    which must be unique within each vector. Returns the sums in the dtype of `values`.
+
+    `np.sum` adds up consecutive chunks of `np.getbufsize()` elements one after another and sums
+    each chunk pairwise: a chunk is halved (at multiples of 8) until the blocks have at most 128
+    elements, and each block is summed with 8 interleaved accumulators, followed by its last
+    `len % 8` elements. As adding zeros doesn't change a sum, only the stored values have to be
+    added up, grouped in the same way.
+    """
+    sums = np.zeros(len(lengths), dtype=values.dtype)
+    if len(values) == 0:
+        return sums
+    order = np.lexsort((positions, rows))
+    rows = np.asarray(rows, dtype=np.int64)[order]
+    chunks, idxs = np.divmod(np.asarray(positions, dtype=np.int64)[order], np.getbufsize())
+    values = values[order]
+    sizes = np.minimum(
+        np.asarray(lengths, dtype=np.int64)[rows] - chunks * np.getbufsize(), np.getbufsize()
+    )
+
+    # Find the block of each value, identified by the path from the root of its chunk's summation
+    # tree (a leading 1 followed by a bit per halving, set for the right half)
+    paths = np.ones_like(idxs)
+    to_split = np.flatnonzero(sizes > 128)
+    while len(to_split):
+        halves = sizes[to_split] // 2
+        halves -= halves % 8
+        is_right = idxs[to_split] >= halves
+        paths[to_split] = paths[to_split] * 2 + is_right
+        idxs[to_split] -= np.where(is_right, halves, 0)
+        sizes[to_split] = np.where(is_right, sizes[to_split] - halves, halves)
+        to_split = to_split[sizes[to_split] > 128]
+
+    n_chunks = int(chunks.max()) + 1
+    path_range = 1 << int(paths.max()).bit_length()
+    block_keys = (rows * n_chunks + chunks) * path_range + paths
+
+    # Sum the blocks
+    interleaved = (sizes >= 8) & (idxs < sizes - sizes % 8)
+    lane_keys, lane_sums = _sum_duplicates(
+        block_keys[interleaved] * 8 + idxs[interleaved] % 8, values[interleaved]
+    )
+    acc_keys, acc_idxs = np.unique(lane_keys // 8, return_inverse=True)
+    accs = np.zeros((len(acc_keys), 8), dtype=values.dtype)
+    accs[acc_idxs, lane_keys % 8] = lane_sums
+    acc_sums = ((accs[:, 0] + accs[:, 1]) + (accs[:, 2] + accs[:, 3])) + (
+        (accs[:, 4] + accs[:, 5]) + (accs[:, 6] + accs[:, 7])
+    )
+    # The other values are added to the accumulators' sum one after another
+    keys, data = _sum_duplicates(
+        np.concatenate([acc_keys, block_keys[~interleaved]]),
+        np.concatenate([acc_sums, values[~interleaved]]),
+    )
+
+    # Add up sibling blocks from the deepest ones up to the root of each chunk's tree
+    depths = np.frexp(keys % path_range)[1] - 1
+    for depth in range(depths.max(), 0, -1):
+        keys = np.where(
+            depths == depth, (keys // path_range) * path_range + keys % path_range // 2, keys
+        )
+        keys, data = _sum_duplicates(keys, data)
+        depths = np.frexp(keys % path_range)[1] - 1
+
+    # Add up the chunks of each vector one after another
+    row_keys, row_sums = _sum_duplicates(keys // path_range // n_chunks, data)
+    sums[row_keys] = row_sums
+    return sums
+
+
+def _shift_csr(mat: csr_matrix, row_offset: int, col_offset: int) -> csr_matrix:
+    """Returns `out` such that out[r, c] == mat[r + row_offset, c + col_offset],
+    without any values where that lies outside `mat`"""
+    nrows, ncols = mat.shape
+    indptr, indices, data = mat.indptr, mat.indices, mat.data
+    if row_offset > 0:
+        counts = np.append(np.diff(indptr)[row_offset:], np.zeros(row_offset, dtype=indptr.dtype))
+        indices, data = indices[indptr[row_offset] :], data[indptr[row_offset] :]
+        indptr = np.append(0, np.cumsum(counts))
+    elif row_offset < 0:
+        counts = np.append(np.zeros(-row_offset, dtype=indptr.dtype), np.diff(indptr)[:row_offset])
+        indices, data = indices[: indptr[nrows + row_offset]], data[: indptr[nrows + row_offset]]
+        indptr = np.append(0, np.cumsum(counts))
+    if col_offset:
+        indices = indices - col_offset
+        in_matrix = (indices >= 0) & (indices < ncols)
+        indptr = np.append(0, np.cumsum(in_matrix))[indptr]
+        indices, data = indices[in_matrix], data[in_matrix]
+    return csr_matrix((data, indices, indptr), shape=mat.shape)
+
+
+def _measure_of_chaos_flat(  # pylint: disable=too-many-locals
+    pixel_idxs: np.ndarray, values: np.ndarray, nrows: int, ncols: int, n_levels: int
+) -> float:
+    """Sparse implementation of cpyImagingMSpec.measure_of_chaos.
+
+    `pixel_idxs` must be unique flattened (row * ncols + col) pixel indexes.
+
+    The image is thresholded at each level, the level sets are dilated (4-connectivity),
+    eroded (8-connectivity, pixels outside the image count as set) and their 4-connected
+    components are counted. As the level sets are nested, each pixel is assigned the number of
+    levels it stays set in, so that the dilation and erosion become element-wise max/min
+    of shifted sparse matrices, which only visit the non-zero pixels and their neighbours.
+    The component counts summed over all levels are then the sum of these numbers minus the merges
+    found by a maximum spanning forest of the pixel adjacency graph, where each edge is weighted
+    by the number of levels both its pixels are set in.
+    """
+    # Same precision as the C implementation
+    values = np.asarray(values, dtype=np.float32)
+    if len(values) == 0 or values.sum() <= 0:
+        return np.nan
+    n_not_null = np.count_nonzero(values > 0)
+
+    levels = np.linspace(0, 1, n_levels + 1)[:-1].astype(np.float32)
+    set_levels = np.searchsorted(levels, values / values.max(), side='left')
+    rows, cols = np.divmod(np.asarray(pixel_idxs, dtype=np.int64)[set_levels > 0], ncols)
+    # Pad the image by one pixel on each side, for the border to be handled by the erosion
+    shape = (nrows + 2, ncols + 2)
+    set_mat = csr_matrix((set_levels[set_levels > 0], (rows + 1, cols + 1)), shape=shape)
+
+    # Dilation: a pixel is set while it or any of its 4 neighbours is set
+    dilated = set_mat
+    for row_offset, col_offset in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
+        dilated = dilated.maximum(_shift_csr(set_mat, row_offset, col_offset))
+
+    # Erosion: a pixel stays set while all of its 8 neighbours inside the image are set
+    last_row, last_col = shape[0] - 1, shape[1] - 1
+    inner_rows, all_cols = np.arange(1, last_row), np.arange(shape[1])
+    border_rows = np.concatenate(
+        [np.zeros_like(all_cols), np.full_like(all_cols, last_row), inner_rows, inner_rows]
+    )
+    border_cols = np.concatenate(
+        [all_cols, all_cols, np.zeros_like(inner_rows), np.full_like(inner_rows, last_col)]
+    )
+    border = csr_matrix(
+        (np.full(len(border_rows), n_levels), (border_rows, border_cols)), shape=shape
+    )
+    dilated = dilated.maximum(border)
+    eroded = dilated
+    for row_offset in (-1, 0, 1):
+        for col_offset in (-1, 0, 1):
+            if row_offset or col_offset:
+                eroded = eroded.minimum(_shift_csr(dilated, row_offset, col_offset))
+    eroded.sort_indices()
+
+    # Connected components: every edge of the maximum spanning forest merges two components
+    # in all levels both of its pixels are set in
+    n_objects = eroded.data.sum()
+    node_ids = csr_matrix((np.arange(1, eroded.nnz + 1), eroded.indices, eroded.indptr), shape)
+    edges_from, edges_to, edge_levels = [], [], []
+    for row_offset, col_offset in [(0, 1), (1, 0)]:
+        edges = eroded.minimum(_shift_csr(eroded, row_offset, col_offset))
+        edges_from.append(node_ids.multiply(edges > 0).tocsr().data - 1)
+        edges_to.append(
+            _shift_csr(node_ids, row_offset, col_offset).multiply(edges > 0).tocsr().data - 1
+        )
+        edge_levels.append(edges.data)
+    edge_levels = np.concatenate(edge_levels)
+    if len(edge_levels):
+        graph = csr_matrix(
+            (n_levels + 1 - edge_levels, (np.concatenate(edges_from), np.concatenate(edges_to))),
+            shape=(eroded.nnz, eroded.nnz),
+        )
+        forest = minimum_spanning_tree(graph)
+        n_objects -= np.sum(n_levels + 1 - forest.data)
+
+    return 1 - (n_objects / n_levels) / n_not_null
+
+
+def _measure_of_chaos(
+    pixel_idxs: np.ndarray, values: np.ndarray, nrows: int, ncols: int, n_levels: int
+) -> float:
+    """Measure of chaos of an image given by its unique flattened pixel indexes and values.
+    The dense C implementation is only used for small images and images filling a large part
+    of the frame, where it's faster and densifying doesn't take much more memory."""
+    sparse_cost = len(values) * CHAOS_SPARSE_PIXEL_COST + CHAOS_SPARSE_OVERHEAD
+    if sparse_cost < nrows * ncols:
+        return _measure_of_chaos_flat(pixel_idxs, values, nrows, ncols, n_levels)
+
+    img = np.zeros(nrows * ncols, dtype=np.float32)
+    img[pixel_idxs] = values
+    return measure_of_chaos(img.reshape(nrows, ncols), n_levels)
+
+
+def _coo_pixels(img: coo_matrix) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the unique flattened pixel indexes of a coo_matrix and their summed values"""
+    return _sum_duplicates(img.row.astype(np.int64) * img.shape[1] + img.col, img.data)
+
+
+def measure_of_chaos_sparse(img: coo_matrix, n_levels: int) -> float:
+    """Computes the measure of chaos of an image without densifying it.
+
+    Returns the same values as cpyImagingMSpec.measure_of_chaos(img.toarray(), n_levels)
+    for images without negative or NaN values.
+    """
+    return _measure_of_chaos_flat(*_coo_pixels(img), img.shape[0], img.shape[1], n_levels)
+
+
+def make_compute_image_metrics_batch(  # pylint: disable=too-many-statements
+    sample_area_mask: np.ndarray, nrows: int, ncols: int, img_gen_config: DSConfigImageGeneration
+) -> ComputeMetricsBatchFunc:
+    """Returns a function for computing metrics for all formulas of an ImageSlab at once,
+    straight from its pixel index and intensity arrays, without building an image per ion.
+
+    The results are identical to those of the function returned by `make_compute_image_metrics`:
+    intensities are summed with `_dense_sums`, which rounds like `np.sum` of the dense images,
+    and the spatial metric, which is only computed for formulas that pass the spectral metric,
+    gets the same dense sample area matrix as in `isotope_image_correlation`.
+
+    Args
+    -----
+    sample_area_mask: ndarray[bool]
+        mask for separating sampled pixels (True) from non-sampled (False)
+
+    img_gen_config : dict
+        isotope_generation section of the dataset config
+    Returns
+    -----
+        function
+    """
+    n_levels = img_gen_config.get('n_levels', 30)
+    n_pixels = nrows * ncols
+    sample_area_mask_flat = np.asarray(sample_area_mask, dtype=bool).ravel()
+    n_sample_pixels = np.count_nonzero(sample_area_mask_flat)
+    # Position of each pixel within the sample area
+    sample_area_pos = np.cumsum(sample_area_mask_flat) - 1
+
+    def isotope_pattern_match_from_ints(image_ints, theor_ints):
+        # Same as isotope_pattern_match, given the summed intensities of the images
+        pattern_match = 1 - np.mean(
+            abs(theor_ints / np.linalg.norm(theor_ints) - image_ints / np.linalg.norm(image_ints))
+        )
+        return 0 if pattern_match == 1.0 else pattern_match
+
+    def compute_metrics_batch(  # pylint: disable=too-many-locals
+        image_slab: ImageSlab,
+    ) -> List[MetricsDict]:
+        n_formulas, n_peaks = image_slab.n_formulas, image_slab.n_peaks
+        n_imgs = n_formulas * n_peaks
+        img_sizes = np.diff(image_slab.offsets)
+        keys, ints = _sum_duplicates(
+            np.repeat(np.arange(n_imgs, dtype=np.int64), img_sizes) * n_pixels
+            + image_slab.pixel_inds.astype(np.int64),
+            image_slab.ints,
+        )
+        img_idxs, pixel_idxs = np.divmod(keys, n_pixels)
+        formula_pos, peak_idxs = np.divmod(img_idxs, n_peaks)
+        img_starts = np.searchsorted(img_idxs, np.arange(n_imgs + 1))
+        # The reference metrics use float64 zeros for missing images
+        is_missing = (img_sizes == 0).reshape(n_formulas, n_peaks)
+
+        totals = _dense_sums(img_idxs, pixel_idxs, ints, np.full(n_imgs, n_pixels))
+        mins = _row_reduce(np.minimum, img_starts, ints)
+        maxs = _row_reduce(np.maximum, img_starts, ints)
+        # Images that don't populate every pixel also contain zeros
+        has_zeros = np.diff(img_starts) < n_pixels
+        mins[has_zeros] = np.minimum(mins[has_zeros], 0)
+        maxs[has_zeros] = np.maximum(maxs[has_zeros], 0)
+
+        # Sum each image over the sample area pixels where the first image is non-zero
+        in_sample = sample_area_mask_flat[pixel_idxs]
+        formula_keys = formula_pos * n_pixels + pixel_idxs
+        not_null_keys = formula_keys[in_sample & (peak_idxs == 0) & (ints > 0)]
+        n_not_null = np.bincount(not_null_keys // n_pixels, minlength=n_formulas)
+        in_not_null = np.isin(formula_keys, not_null_keys)
+        # Position of each pixel among the not-null pixels of its formula
+        ranks = np.searchsorted(not_null_keys, formula_keys)
+        ranks -= np.append(0, np.cumsum(n_not_null))[formula_pos]
+        image_ints = _dense_sums(
+            img_idxs[in_not_null],
+            ranks[in_not_null],
+            ints[in_not_null],
+            np.repeat(n_not_null, n_peaks),
+        ).reshape(n_formulas, n_peaks)
+
+        results = []
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for pos in range(n_formulas):
+                doc = METRICS.copy()
+                img_slice = slice(pos * n_peaks, (pos + 1) * n_peaks)
+                doc['total_iso_ints'] = totals[img_slice].tolist()
+                doc['min_iso_ints'] = mins[img_slice].tolist()
+                doc['max_iso_ints'] = maxs[img_slice].tolist()
+
+                theor_ints = image_slab.centr_ints[pos]
+                f_image_ints = image_ints[pos]
+                if is_missing[pos].any():
+                    f_image_ints = f_image_ints.astype(np.float64)
+                doc['spectral'] = isotope_pattern_match_from_ints(f_image_ints, theor_ints)
+                if doc['spectral'] > 0:
+
+                    start, end = img_starts[img_slice.start], img_starts[img_slice.stop]
+                    f_in_sample = np.flatnonzero(in_sample[start:end]) + start
+                    iso_imgs_flat = np.zeros(
+                        (n_peaks, n_sample_pixels),
+                        dtype=np.float64 if is_missing[pos].any() else ints.dtype,
+                    )
+                    iso_imgs_flat[
+                        peak_idxs[f_in_sample], sample_area_pos[pixel_idxs[f_in_sample]]
+                    ] = ints[f_in_sample]
+                    doc['spatial'] = isotope_image_correlation(
+                        iso_imgs_flat, weights=theor_ints[1:]
+                    )
+                    if doc['spatial'] > 0:
+
+                        first_img = slice(
+                            img_starts[img_slice.start], img_starts[img_slice.start + 1]
+                        )
+                        moc = _measure_of_chaos(
+                            pixel_idxs[first_img], ints[first_img], nrows, ncols, n_levels
+                        )
+                        doc['chaos'] = 0 if np.isclose(moc, 1.0) else moc
+                        if doc['chaos'] > 0:
+
+                            doc['msm'] = doc['chaos'] * doc['spatial'] * doc['spectral']
+                results.append(_replace_nans(doc))
+
+        return results
+
+    return compute_metrics_batch
+
+
 def iter_images_in_sets(
     formula_images_it: Iterable[FormulaImageItem], n_peaks: int
 ) -> Iterator[FormulaImageSet]:
@@ -168,6 +537,20 @@ def nullify_images_with_too_few_pixels(f_images, min_px):
     return [img if (img is not None and img.nnz >= min_px) else None for img in f_images]
 
 
+def _iter_formulas_to_compute(
+    formula_image_set_it: Iterable[FormulaImageSet],
+    targeted_database_formula_inds: Set[int],
+    min_px: int,
+) -> Iterator[Tuple[int, List[float], List[Optional[coo_matrix]], bool]]:
+    """Yields (formula index, formula intensities, images, is targeted) for the formulas
+    with enough images to compute metrics for"""
+    for f_i, f_ints, f_images in formula_image_set_it:
+        f_images = nullify_images_with_too_few_pixels(f_images, min_px)
+        is_targeted = f_i in targeted_database_formula_inds
+        if complete_image_list(f_images, require_first=not is_targeted):
+            yield f_i, f_ints, f_images, is_targeted
+
+
 def compute_and_filter_metrics(
     formula_image_set_it: Iterable[FormulaImageSet],
     compute_metrics: Callable,
@@ -186,16 +569,55 @@ def compute_and_filter_metrics(
             that correspond to targeted databases.
         min_px: Minimum number of pixels each image should have.
     """
-    for f_i, f_ints, f_images in formula_image_set_it:
-        f_images = nullify_images_with_too_few_pixels(f_images, min_px)
-        is_targeted = f_i in targeted_database_formula_inds
-        if complete_image_list(f_images, require_first=not is_targeted):
-            f_metrics = compute_metrics(f_images, f_ints)
-            if f_metrics['msm'] > 0 or is_targeted:
-                if f_i in target_formula_inds:
-                    yield f_i, f_metrics, f_images
-                else:
-                    yield f_i, f_metrics, None
+    for f_i, f_ints, f_images, is_targeted in _iter_formulas_to_compute(
+        formula_image_set_it, targeted_database_formula_inds, min_px
+    ):
+        f_metrics = compute_metrics(f_images, f_ints)
+        if f_metrics['msm'] > 0 or is_targeted:
+            if f_i in target_formula_inds:
+                yield f_i, f_metrics, f_images
+            else:
+                yield f_i, f_metrics, None
+
+
+def compute_and_filter_metrics_batch(
+    image_slabs: Iterable[ImageSlab],
+    compute_metrics_batch: ComputeMetricsBatchFunc,
+    target_formula_inds: Set[int],
+    targeted_database_formula_inds: Set[int],
+    min_px: int,
+) -> Iterator[Tuple[List[Tuple[int, MetricsDict]], ImageSlab]]:
+    """Same as `compute_and_filter_metrics`, but computes the metrics of all formulas of each
+    ImageSlab at once with a batch metrics function from `make_compute_image_metrics_batch`.
+
+    Yields:
+        (formula index, metrics) of the formulas that passed the filters, and an ImageSlab with
+        the images of those of them that are targets.
+    """
+    target_formula_inds_arr = np.array(sorted(target_formula_inds), dtype=np.int64)
+    targeted_formula_inds_arr = np.array(sorted(targeted_database_formula_inds), dtype=np.int64)
+
+    for image_slab in image_slabs:
+        # Same filters as in nullify_images_with_too_few_pixels and complete_image_list
+        image_sizes = image_slab.image_sizes()
+        has_image = (image_sizes > 0) & (image_sizes >= min_px)
+        is_targeted = np.isin(image_slab.formula_is, targeted_formula_inds_arr)
+        to_compute = has_image.any(axis=1) & (has_image[:, 0] | is_targeted)
+        if not to_compute.any():
+            continue
+
+        image_slab = image_slab.take(np.flatnonzero(to_compute), has_image[to_compute])
+        metrics = compute_metrics_batch(image_slab)
+
+        msm = np.array([f_metrics['msm'] for f_metrics in metrics])
+        passed = (msm > 0) | is_targeted[to_compute]
+        formula_metrics = [
+            (f_i, f_metrics)
+            for f_i, f_metrics, f_passed in zip(image_slab.formula_is.tolist(), metrics, passed)
+            if f_passed
+        ]
+        is_target = np.isin(image_slab.formula_is, target_formula_inds_arr)
+        yield formula_metrics, image_slab.take(np.flatnonzero(passed & is_target))
 
 
 def collect_metrics_as_df(
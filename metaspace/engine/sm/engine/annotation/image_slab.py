@@ -0,0 +1,157 @@
+"""
+Compact storage for the ion images of many formulas
+"""
+from __future__ import annotations
+
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from scipy.sparse import coo_matrix
+
+
+def gather_ranges(starts: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    """Returns the concatenation of `np.arange(start, start + size)` for all `starts` and `sizes`"""
+    ends = np.cumsum(sizes)
+    return np.arange(ends[-1] if len(ends) else 0) + np.repeat(starts - ends + sizes, sizes)
+
+
+class ImageSlab:
+    """Ion images of a set of formulas, stored in a few contiguous arrays instead of
+    as one sparse matrix per image.
+
+    The image of peak `peak_i` of the formula at position `pos` in `formula_is` consists of
+    the values `ints[start:end]` at the flattened pixel indexes (row * ncols + col)
+    `pixel_inds[start:end]`, where `start = offsets[pos * n_peaks + peak_i]` and
+    `end = offsets[pos * n_peaks + peak_i + 1]`. Same as in coo_matrix, a pixel may be present
+    more than once in an image, in which case its values are summed. Empty images are missing.
+
+    Args
+    ----------
+    formula_is : numpy.array
+        Formula indexes, shape (n_formulas,)
+    centr_ints : numpy.array
+        Theoretical isotopic peak intensities, shape (n_formulas, n_peaks)
+    offsets : numpy.array
+        Image boundaries in `pixel_inds` and `ints`, shape (n_formulas * n_peaks + 1,)
+    pixel_inds : numpy.array
+        Flattened pixel indexes of all images
+    ints : numpy.array
+        Pixel intensities of all images
+    nrows : int
+    ncols : int
+    """
+
+    def __init__(self, formula_is, centr_ints, offsets, pixel_inds, ints, nrows, ncols):
+        self.formula_is = formula_is
+        self.centr_ints = centr_ints
+        self.offsets = offsets
+        self.pixel_inds = pixel_inds
+        self.ints = ints
+        self.nrows = nrows
+        self.ncols = ncols
+
+    @property
+    def n_formulas(self) -> int:
+        return self.centr_ints.shape[0]
+
+    @property
+    def n_peaks(self) -> int:
+        return self.centr_ints.shape[1]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(
+            arr.nbytes
+            for arr in [self.formula_is, self.centr_ints, self.offsets, self.pixel_inds, self.ints]
+        )
+
+    def image_sizes(self) -> np.ndarray:
+        """Number of values in each image, including repeated pixels (same as coo_matrix.nnz),
+        shape (n_formulas, n_peaks)"""
+        return np.diff(self.offsets).reshape(self.n_formulas, self.n_peaks)
+
+    def positions(self, formula_is: Sequence[int]) -> np.ndarray:
+        """Positions of the given formula indexes in the slab"""
+        order = np.argsort(self.formula_is, kind='stable')
+        return order[np.searchsorted(self.formula_is, formula_is, sorter=order)]
+
+    def take(self, positions: np.ndarray, image_mask: np.ndarray = None) -> ImageSlab:
+        """Returns a new slab with the formulas at `positions`.
+        Images where `image_mask` (shape (len(positions), n_peaks)) is False are left out."""
+        positions = np.asarray(positions, dtype=np.int64)
+        image_idxs = (positions[:, None] * self.n_peaks + np.arange(self.n_peaks)).ravel()
+        sizes = np.diff(self.offsets)[image_idxs]
+        if image_mask is not None:
+            sizes = sizes * np.asarray(image_mask).ravel()
+        value_idxs = gather_ranges(self.offsets[image_idxs], sizes)
+        return ImageSlab(
+            formula_is=self.formula_is[positions],
+            centr_ints=self.centr_ints[positions],
+            offsets=np.append(0, np.cumsum(sizes)),
+            pixel_inds=self.pixel_inds[value_idxs],
+            ints=self.ints[value_idxs],
+            nrows=self.nrows,
+            ncols=self.ncols,
+        )
+
+    def image(self, pos: int, peak_i: int) -> Optional[coo_matrix]:
+        start, end = self.offsets[pos * self.n_peaks + peak_i : pos * self.n_peaks + peak_i + 2]
+        if start == end:
+            return None
+        row_inds, col_inds = np.divmod(self.pixel_inds[start:end], self.ncols)
+        return coo_matrix((self.ints[start:end], (row_inds, col_inds)), (self.nrows, self.ncols))
+
+    def sparse_image(self, pos: int, peak_i: int) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Flattened pixel indexes and intensities of an image, without creating a coo_matrix"""
+        start, end = self.offsets[pos * self.n_peaks + peak_i : pos * self.n_peaks + peak_i + 2]
+        if start == end:
+            return None
+        return self.pixel_inds[start:end], self.ints[start:end]
+
+    def dense_image(self, pos: int, peak_i: int) -> Optional[np.ndarray]:
+        """Same as `image(pos, peak_i).toarray()`, without creating the coo_matrix"""
+        sparse_image = self.sparse_image(pos, peak_i)
+        if sparse_image is None:
+            return None
+        img = np.zeros(self.nrows * self.ncols, dtype=self.ints.dtype)
+        np.add.at(img, *sparse_image)
+        return img.reshape(self.nrows, self.ncols)
+
+    @classmethod
+    def concat(cls, slabs: List[ImageSlab]) -> ImageSlab:
+        sizes = np.concatenate([np.diff(slab.offsets) for slab in slabs])
+        return cls(
+            formula_is=np.concatenate([slab.formula_is for slab in slabs]),
+            centr_ints=np.concatenate([slab.centr_ints for slab in slabs]),
+            offsets=np.append(0, np.cumsum(sizes)),
+            pixel_inds=np.concatenate([slab.pixel_inds for slab in slabs]),
+            ints=np.concatenate([slab.ints for slab in slabs]),
+            nrows=slabs[0].nrows,
+            ncols=slabs[0].ncols,
+        )
+
+    @classmethod
+    def from_images(
+        cls,
+        formula_is: Sequence[int],
+        centr_ints: Sequence[Sequence[float]],
+        images: Sequence[Sequence[Optional[coo_matrix]]],
+        nrows: int,
+        ncols: int,
+    ) -> ImageSlab:
+        """Builds a slab from lists of sparse images, one list of `n_peaks` images per formula"""
+        flat_images = [img for f_images in images for img in f_images]
+        non_empty = [img for img in flat_images if img is not None]
+        sizes = [img.nnz if img is not None else 0 for img in flat_images]
+        return cls(
+            formula_is=np.array(formula_is, dtype=np.int64),
+            centr_ints=np.array(centr_ints, dtype=np.float64).reshape(len(images), -1),
+            offsets=np.append(0, np.cumsum(sizes, dtype=np.int64)),
+            pixel_inds=np.concatenate(
+                [img.row.astype(np.uint32) * ncols + img.col for img in non_empty]
+                or [np.zeros(0, dtype=np.uint32)]
+            ),
+            ints=np.concatenate([img.data for img in non_empty] or [np.zeros(0, dtype=np.float32)]),
+            nrows=nrows,
+            ncols=ncols,
+        )
@@ -56,6 +56,12 @@ def del_jobs(ds: Dataset, moldb_ids: Optional[Iterable[int]] = None):
             ):
                 pass
 
+            job_ids = db.select_onecol(
+                'SELECT id FROM job WHERE ds_id = %s AND moldb_id = %s', (ds.id, moldb.id)
+            )
+            for job_id in job_ids:
+                image_storage.delete_analysis_cube(ds.id, job_id)
+
             logger.info(f"Deleting job results: ds_id={ds.id} ds_name={ds.name} moldb={moldb}")
             db.alter('DELETE FROM job WHERE ds_id = %s and moldb_id = %s', (ds.id, moldb.id))
             es.delete_ds(ds.id, moldb)
@@ -0,0 +1,98 @@
+import struct
+import zlib
+
+import numpy as np
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# PNG color types by number of channels: greyscale, greyscale+alpha, RGB, RGBA
+COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+
+FILTER_NONE = 0
+FILTER_SUB = 1
+FILTER_UP = 2
+FILTER_AVERAGE = 3
+FILTER_PAETH = 4
+# Choose the filter per row that minimizes the sum of absolute differences, as libpng does
+FILTER_ADAPTIVE = 'adaptive'
+
+
+def _chunk(chunk_type: bytes, data: bytes) -> bytes:
+    crc = zlib.crc32(data, zlib.crc32(chunk_type))
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', crc)
+
+
+def _filter_rows(raw: np.ndarray, bpp: int, filter_type: int) -> np.ndarray:
+    """Applies a PNG filter to all rows of `raw` (a 2D uint8 array of unfiltered scanlines).
+    Filters only depend on the unfiltered bytes, so all rows can be filtered at once."""
+    if filter_type == FILTER_NONE:
+        return raw
+    left = np.zeros_like(raw)
+    left[:, bpp:] = raw[:, :-bpp]
+    if filter_type == FILTER_SUB:
+        return raw - left
+    above = np.zeros_like(raw)
+    above[1:] = raw[:-1]
+    if filter_type == FILTER_UP:
+        return raw - above
+    if filter_type == FILTER_AVERAGE:
+        return raw - ((left.astype(np.uint16) + above) >> 1).astype(np.uint8)
+    if filter_type == FILTER_PAETH:
+        above_left = np.zeros_like(raw)
+        above_left[1:, bpp:] = raw[:-1, :-bpp]
+        left16, above16, above_left16 = (a.astype(np.int16) for a in (left, above, above_left))
+        dist_left = np.abs(above16 - above_left16)
+        dist_above = np.abs(left16 - above_left16)
+        dist_above_left = np.abs(left16 + above16 - 2 * above_left16)
+        predictor = np.where(
+            (dist_left <= dist_above) & (dist_left <= dist_above_left),
+            left,
+            np.where(dist_above <= dist_above_left, above, above_left),
+        )
+        return raw - predictor
+    raise ValueError(f'Invalid PNG filter type: {filter_type}')
+
+
+def encode_png(
+    pixels: np.ndarray, bitdepth=8, compression_level=6, filter_type=FILTER_NONE
+) -> bytes:
+    """Encodes an image as a non-interlaced PNG directly from a numpy array.
+
+    Args:
+        pixels: (height, width) or (height, width, channels) array of integer pixel values.
+            1, 2, 3 or 4 channels are written as greyscale, greyscale+alpha, RGB and RGBA.
+        bitdepth: 8 or 16
+        compression_level: zlib compression level, 0-9
+        filter_type: one of the FILTER_* constants
+    Returns:
+        PNG file contents
+    """
+    if pixels.ndim == 2:
+        pixels = pixels[:, :, np.newaxis]
+    height, width, n_channels = pixels.shape
+    assert bitdepth in (8, 16), 'Only 8 and 16 bit images are supported'
+    # PNG stores 16-bit values big-endian
+    dtype = np.dtype('>u2') if bitdepth == 16 else np.dtype('u1')
+    bpp = n_channels * dtype.itemsize
+    raw = np.ascontiguousarray(pixels, dtype=dtype).view(np.uint8).reshape(height, width * bpp)
+
+    scanlines = np.empty((height, 1 + width * bpp), dtype=np.uint8)
+    if filter_type == FILTER_ADAPTIVE:
+        filtered = np.stack([_filter_rows(raw, bpp, ft) for ft in range(5)])
+        # Heuristic from the PNG spec: minimize the sum of the filtered bytes as signed values
+        costs = np.abs(filtered.view(np.int8).astype(np.int32)).sum(axis=2)
+        row_filters = costs.argmin(axis=0)
+        scanlines[:, 0] = row_filters
+        scanlines[:, 1:] = filtered[row_filters, np.arange(height)]
+    else:
+        scanlines[:, 0] = filter_type
+        scanlines[:, 1:] = _filter_rows(raw, bpp, filter_type)
+
+    header = struct.pack('>IIBBBBB', width, height, bitdepth, COLOR_TYPES[n_channels], 0, 0, 0)
+    return b''.join(
+        [
+            PNG_SIGNATURE,
+            _chunk(b'IHDR', header),
+            _chunk(b'IDAT', zlib.compress(scanlines.data, compression_level)),
+            _chunk(b'IEND', b''),
+        ]
+    )
@@ -1,11 +1,27 @@
 import logging
-from io import BytesIO
+from typing import Dict
 
 import numpy as np
-import png
+
+from sm.engine.annotation.png_encoder import encode_png, FILTER_NONE
 
 logger = logging.getLogger('engine')
 
+# zlib's default level. Lower levels encode faster, but make larger files
+DEFAULT_COMPRESSION_LEVEL = 6
+
+
+def get_png_options(sm_config: Dict) -> Dict:
+    """PngGenerator arguments from the optional `png_compression_level` and `png_filter` keys of
+    sm_config['image_storage'], e.g. to trade storage size for encoding speed"""
+    image_storage_config = sm_config.get('image_storage', {})
+    return {
+        'compression_level': image_storage_config.get(
+            'png_compression_level', DEFAULT_COMPRESSION_LEVEL
+        ),
+        'filter_type': image_storage_config.get('png_filter', FILTER_NONE),
+    }
+
 
 class PngGenerator:
     """Generator of isotopic images as png files
@@ -14,13 +30,31 @@ class PngGenerator:
     ----------
     mask : numpy.array
         Alpha channel (2D, 0..1)
+    compression_level : int
+        zlib compression level of the png files, 0..9
+    filter_type : int | str
+        PNG row filter, one of the FILTER_* constants in sm.engine.annotation.png_encoder
     """
 
-    def __init__(self, mask, greyscale=True):
+    def __init__(
+        self,
+        mask,
+        greyscale=True,
+        compression_level=DEFAULT_COMPRESSION_LEVEL,
+        filter_type=FILTER_NONE,
+    ):
         self._greyscale = greyscale
+        self._compression_level = compression_level
+        self._filter_type = filter_type
         self._bitdepth = 16 if self._greyscale else 8
         self._mask = mask
         self._shape = mask.shape
+        # The alpha channel is the same for all images of a dataset, so it's only calculated once
+        self._alpha = (mask * (2 ** self._bitdepth - 1)).astype(np.uint16)
+        # Reusable buffer for generate_sparse_png, allocated on first use so that it isn't
+        # serialized with the generator when it's sent to workers
+        self._sparse_buffer = None
+        self._sparse_buffer_pixel_inds = None
 
         colors = np.array(
             [
@@ -290,25 +324,62 @@ class PngGenerator:
         if self._greyscale:
             grey = np.empty(shape=image.shape + (2,), dtype=np.uint16)
             grey[:, :, 0] = image.astype(np.uint16)
-            grey[:, :, 1] = (self._mask * (2 ** self._bitdepth - 1)).astype(np.uint16)
+            grey[:, :, 1] = self._alpha
             image = grey
         else:
             rgba = np.empty(shape=image.shape + (4,), dtype=self._colors.dtype)
             self._colors.take(image.astype(np.uint8), axis=0, mode='clip', out=rgba)
-            rgba[:, :, 3] = self._mask * (2 ** self._bitdepth - 1)
+            rgba[:, :, 3] = self._alpha
             image = rgba
         return image
 
     def generate_png(self, array: np.array) -> bytes:
         img = self._to_image(array)
-        fp = BytesIO()
-        png_writer = png.Writer(
-            width=self._shape[1],
-            height=self._shape[0],
-            alpha=True,
-            greyscale=self._greyscale,
-            bitdepth=self._bitdepth,
-        )
-        png_writer.write(fp, img.reshape(img.shape[0], img.shape[1] * img.shape[2]).tolist())
-        fp.seek(0)
-        return fp.read()
+        return encode_png(img, self._bitdepth, self._compression_level, self._filter_type)
+
+    def generate_sparse_png(self, pixel_inds: np.ndarray, values: np.ndarray) -> bytes:
+        """Same as `generate_png`, but for a sparse image given as flattened pixel indexes
+        (row * width + col) and values. Same as in coo_matrix, values of repeated pixels are summed.
+
+        Avoids making a dense copy of the image: the normalization range is found from the
+        non-empty pixels and they are written into a reusable buffer, in which only the pixels
+        that were set by the previous image need to be cleared."""
+        if not self._greyscale:
+            dense = np.zeros(self._shape[0] * self._shape[1], dtype=values.dtype)
+            np.add.at(dense, pixel_inds, values)
+            return self.generate_png(dense.reshape(self._shape))
+
+        if len(pixel_inds) > 1 and not (np.diff(pixel_inds.astype(np.int64)) > 0).all():
+            pixel_inds, inverse = np.unique(pixel_inds, return_inverse=True)
+            summed_values = np.zeros(len(pixel_inds), dtype=values.dtype)
+            np.add.at(summed_values, inverse, values)
+            values = summed_values
+
+        # Normalize exactly the same way as _to_image, so that the pixel values are identical
+        background = np.zeros(1, dtype=values.dtype)
+        if len(pixel_inds) < self._shape[0] * self._shape[1]:
+            values = np.concatenate([values, background])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            grey_values = ((values - values.min()) / (values.max() - values.min())) * (
+                2 ** self._bitdepth - 1
+            )
+        grey_values = grey_values.astype(np.uint16)
+        background_grey = grey_values[-1] if len(grey_values) > len(pixel_inds) else 0
+
+        buffer = self._get_sparse_buffer()
+        grey = buffer.reshape(-1, 2)[:, 0]
+        if background_grey == 0 and self._sparse_buffer_pixel_inds is not None:
+            grey[self._sparse_buffer_pixel_inds] = 0
+        else:
+            grey[:] = background_grey
+        grey[pixel_inds] = grey_values[: len(pixel_inds)]
+        self._sparse_buffer_pixel_inds = pixel_inds if background_grey == 0 else None
+
+        return encode_png(buffer, self._bitdepth, self._compression_level, self._filter_type)
+
+    def _get_sparse_buffer(self):
+        if self._sparse_buffer is None:
+            # Stored big-endian, as expected by encode_png, so that it doesn't need to be copied
+            self._sparse_buffer = np.zeros(self._shape + (2,), dtype='>u2')
+            self._sparse_buffer[:, :, 1] = self._alpha
+        return self._sparse_buffer
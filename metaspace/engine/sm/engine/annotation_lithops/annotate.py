@@ -1,37 +1,39 @@
 from __future__ import annotations
 
 import logging
-from typing import List, Dict, Tuple, Optional
+from typing import List, Dict, Tuple
 
 import numpy as np
 import pandas as pd
 from lithops.storage import Storage
 from pyimzml.ImzMLParser import PortableSpectrumReader
-from scipy.sparse import coo_matrix
 
 from sm.engine.annotation.formula_validator import (
-    compute_and_filter_metrics,
-    make_compute_image_metrics,
+    compute_and_filter_metrics_batch,
+    make_compute_image_metrics_batch,
     MetricsDict,
     METRICS,
 )
+from sm.engine.annotation.image_slab import ImageSlab, gather_ranges
 from sm.engine.annotation_lithops.executor import Executor
-from sm.engine.annotation_lithops.io import save_cobj, load_cobj, CObj, load_cobjs
+from sm.engine.annotation_lithops.io import load_cobj, save_image_slab, CObj, load_ds_segms
 from sm.engine.annotation_lithops.utils import ds_dims, get_pixel_indices
 from sm.engine.ds_config import DSConfig
 from sm.engine.annotation.isocalc_wrapper import IsocalcWrapper
 from sm.engine.utils.perf_profile import Profiler
 
 ISOTOPIC_PEAK_N = 4
+# Max number of formulas and of pixel values per ImageSlab, to limit the memory used for metrics
+SLAB_MAX_FORMULAS = 1000
+SLAB_MAX_VALUES = 16 * 1024 ** 2
 
-ImagesRow = Tuple[int, int, List[coo_matrix]]
 logger = logging.getLogger('annotation-pipeline')
 
 
 class ImagesManager:
     """
-    Collects ion images (in sparse coo_matrix format) and formula metrics.
-    Images are progressively saved to COS in chunks specified by `max_formula_images_size` to
+    Collects ion images (in ImageSlab format) and formula metrics.
+    Images are progressively saved to COS in chunks specified by `chunk_size` to
     prevent using too much memory.
     """
 
@@ -40,42 +42,30 @@ class ImagesManager:
     def __init__(self, storage: Storage):
 
         self._formula_metrics: Dict[int, MetricsDict] = {}
-        self._images_buffer: List[ImagesRow] = []
+        self._images_buffer: List[ImageSlab] = []
         self._images_dfs: List[pd.DataFrame] = []
 
         self._formula_images_size = 0
         self._storage = storage
 
-    def append(self, f_i: int, f_metrics: MetricsDict, f_images: Optional[List[coo_matrix]]):
-        self._formula_metrics[f_i] = f_metrics
+    def append(self, formula_metrics: List[Tuple[int, MetricsDict]], image_slab: ImageSlab):
+        self._formula_metrics.update(formula_metrics)
 
-        if f_images:
-            size = ImagesManager.images_size(f_images)
-            n_pixels = ImagesManager.n_pixels(f_images)
-            if self._formula_images_size + size > self.chunk_size:
+        if image_slab.n_formulas > 0:
+            if self._formula_images_size + image_slab.nbytes > self.chunk_size:
                 self._flush_images()
-            self._images_buffer.append((f_i, n_pixels, f_images))
-            self._formula_images_size += size
-
-    @staticmethod
-    def images_size(f_images):
-        return sum(
-            img.data.nbytes + img.row.nbytes + img.col.nbytes for img in f_images if img is not None
-        )
-
-    @staticmethod
-    def n_pixels(f_images):
-        return sum(img.nnz for img in f_images if img is not None)
+            self._images_buffer.append(image_slab)
+            self._formula_images_size += image_slab.nbytes
 
     def _flush_images(self):
         if self._images_buffer:
-            print(f'Saving {len(self._images_buffer)} images')
-            cobj_data = dict((f_i, f_images) for f_i, size, f_images in self._images_buffer)
-            cloud_obj = save_cobj(self._storage, cobj_data)
+            image_slab = ImageSlab.concat(self._images_buffer)
+            print(f'Saving {image_slab.n_formulas} images')
+            cloud_obj = save_image_slab(self._storage, image_slab)
             images_df = pd.DataFrame(
                 {
-                    'formula_i': [f_i for f_i, n_pixels, f_images in self._images_buffer],
-                    'n_pixels': [n_pixels for f_i, n_pixels, f_images in self._images_buffer],
+                    'formula_i': image_slab.formula_is,
+                    'n_pixels': image_slab.image_sizes().sum(axis=1),
                     'cobj': cloud_obj,
                 }
             ).set_index('formula_i')
@@ -104,95 +94,74 @@ class ImagesManager:
         return formula_metrics_df, images_df
 
 
-def gen_iso_image_sets(sp_inds, sp_mzs, sp_ints, centr_df, nrows, ncols, isocalc_wrapper):
+def gen_iso_image_slabs(
+    sp_inds,
+    sp_mzs,
+    sp_ints,
+    centr_df,
+    nrows,
+    ncols,
+    isocalc_wrapper,
+    max_formulas=SLAB_MAX_FORMULAS,
+    max_values=SLAB_MAX_VALUES,
+):
     # pylint: disable=too-many-locals
     # assume sp data is sorted by mz order ascending
-
-    def yield_buffer(buffer):
-        while len(buffer) < ISOTOPIC_PEAK_N:
-            buffer.append((buffer[0][0], len(buffer) - 1, 0, None))
-        buffer = np.array(buffer)
-        buffer = buffer[buffer[:, 1].argsort()]  # sort order by peak ascending
-        buffer = pd.DataFrame(buffer, columns=['formula_i', 'peak_i', 'centr_ints', 'image'])
-        buffer.sort_values('peak_i', inplace=True)
-        return buffer.formula_i[0], buffer.centr_ints, buffer.image
-
-    if len(sp_inds) > 0:
-        centr_df = centr_df.sort_values(['formula_i', 'peak_i'])
-        lower_mz, upper_mz = isocalc_wrapper.mass_accuracy_bounds(centr_df.mz.values)
-        centr_df = centr_df.assign(
-            lower_idx=np.searchsorted(sp_mzs, lower_mz, 'l'),
-            upper_idx=np.searchsorted(sp_mzs, upper_mz, 'r'),
-        )[['formula_i', 'peak_i', 'int', 'lower_idx', 'upper_idx']]
-
-        buffer = []
-        for formula_i, peak_i, ints, lower_i, upper_i in centr_df.itertuples(False, None):
-            if len(buffer) != 0 and buffer[0][0] != formula_i:
-                yield yield_buffer(buffer)
-                buffer = []
-
-            m = None
-            if upper_i > lower_i:
-                data = sp_ints[lower_i:upper_i]
-                inds = sp_inds[lower_i:upper_i]
-                row_inds, col_inds = np.divmod(inds, ncols)
-                row_inds = row_inds.astype(np.uint16)
-                col_inds = col_inds.astype(np.uint16)
-                m = coo_matrix((data, (row_inds, col_inds)), shape=(nrows, ncols), copy=True)
-            buffer.append((formula_i, peak_i, ints, m))
-
-        if len(buffer) != 0:
-            yield yield_buffer(buffer)
+    if len(sp_inds) == 0 or len(centr_df) == 0:
+        return
+
+    lower_mz, upper_mz = isocalc_wrapper.mass_accuracy_bounds(centr_df.mz.values)
+    lower_idxs = np.searchsorted(sp_mzs, lower_mz, 'l')
+    upper_idxs = np.searchsorted(sp_mzs, upper_mz, 'r')
+
+    # Lay out the images of each formula in a (formula, peak) grid, empty for missing peaks
+    formula_is, formula_pos = np.unique(centr_df.formula_i.values, return_inverse=True)
+    peak_is = centr_df.peak_i.values
+    n_peaks = max(ISOTOPIC_PEAK_N, peak_is.max() + 1)
+    image_idxs = formula_pos * n_peaks + peak_is
+    image_starts = np.zeros(len(formula_is) * n_peaks, dtype=np.int64)
+    image_starts[image_idxs] = lower_idxs
+    image_sizes = np.zeros(len(formula_is) * n_peaks, dtype=np.int64)
+    image_sizes[image_idxs] = np.maximum(upper_idxs - lower_idxs, 0)
+    centr_ints = np.zeros((len(formula_is), n_peaks))
+    centr_ints[formula_pos, peak_is] = centr_df.int.values
+
+    # Split formulas into slabs of at most max_formulas formulas and max_values values,
+    # though each slab has at least one formula
+    values_cumsum = np.append(0, np.cumsum(image_sizes.reshape(-1, n_peaks).sum(axis=1)))
+    start = 0
+    while start < len(formula_is):
+        end = np.searchsorted(values_cumsum, values_cumsum[start] + max_values, 'right') - 1
+        end = min(max(end, start + 1), start + max_formulas)
+        image_slice = slice(start * n_peaks, end * n_peaks)
+        value_idxs = gather_ranges(image_starts[image_slice], image_sizes[image_slice])
+        yield ImageSlab(
+            formula_is=formula_is[start:end],
+            centr_ints=centr_ints[start:end],
+            offsets=np.append(0, np.cumsum(image_sizes[image_slice])),
+            pixel_inds=sp_inds[value_idxs],
+            ints=sp_ints[value_idxs],
+            nrows=nrows,
+            ncols=ncols,
+        )
+        start = end
 
 
 def read_ds_segments(
-    ds_segms_cobjs,
-    ds_segm_lens,
-    pw_mem_mb,
-    ds_segm_size_mb,
-    ds_segm_dtype,
-    storage,
-):
-
-    ds_segms_mb = len(ds_segms_cobjs) * ds_segm_size_mb
-    safe_mb = 512
-
-    concat_memory_mb = ds_segms_mb * 3 + safe_mb
-    if concat_memory_mb > pw_mem_mb:
-        # Memory-conservative method for loading many segments. Instead of loading them all at once,
-        # pre-allocate a destination DataFrame and load them into that dataframe one-at-a-time
-        # to minimize the amount of temp data needed at any point in time.
-        segm_len = sum(ds_segm_lens)
-        print(f'Using pre-allocated concatenation (len {segm_len})')
-        sp_df = pd.DataFrame(
-            {
-                'mz': np.zeros(segm_len, dtype=ds_segm_dtype),
-                'int': np.zeros(segm_len, dtype=np.float32),
-                'sp_i': np.zeros(segm_len, dtype=np.uint32),
-            }
-        )
-        row_start, row_end = 0, 0
-        for segm_i, cobj in enumerate(ds_segms_cobjs):
-            sub_sp_df = load_cobj(storage, cobj)
-            assert sub_sp_df.mz.is_monotonic
-            assert len(sub_sp_df) == ds_segm_lens[segm_i], 'unexpected ds_segm length'
-            row_end = row_start + len(sub_sp_df)
-            print(
-                f'populating sp_df range {row_start}:{row_end} '
-                f'(m/z {sub_sp_df.mz.min():.6f}-{sub_sp_df.mz.max():.6f} from {cobj.key})'
-            )
-            # PANDAS! Why do you make it so hard to emplace values into a dataframe?
-            sp_df.iloc[row_start:row_end, sp_df.columns.get_loc('mz')] = sub_sp_df.mz.values
-            sp_df.iloc[row_start:row_end, sp_df.columns.get_loc('int')] = sub_sp_df.int.values
-            sp_df.iloc[row_start:row_end, sp_df.columns.get_loc('sp_i')] = sub_sp_df.sp_i.values
-            row_start = row_end
-        assert row_end == len(sp_df)
-    else:
-        sp_df = pd.concat(load_cobjs(storage, ds_segms_cobjs), ignore_index=True, sort=False)
+    ds_segms_cobjs, ds_segm_lens, ds_segm_dtype, mz_range, storage
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Segments are loaded directly into pre-allocated arrays, so that peak memory usage is
+    # the size of the loaded data instead of a multiple of it. Only the rows within `mz_range`
+    # are downloaded from the first and last segments.
+    segm_len = sum(ds_segm_lens)
+    print(f'Loading {len(ds_segms_cobjs)} ds segments (max len {segm_len})')
+    sp_mzs, sp_ints, sp_inds = load_ds_segms(
+        storage, ds_segms_cobjs, ds_segm_lens, ds_segm_dtype, mz_range
+    )
 
-    assert sp_df.mz.is_monotonic
+    assert (sp_mzs[:-1] <= sp_mzs[1:]).all(), 'ds segments are not sorted by m/z'
 
-    return sp_df
+    return sp_mzs, sp_ints, sp_inds
 
 
 def make_sample_area_mask(coordinates):
@@ -203,10 +172,16 @@ def make_sample_area_mask(coordinates):
     return sample_area_mask.reshape(nrows, ncols)
 
 
-def choose_ds_segments(ds_segments_bounds, centr_df, isocalc_wrapper):
+def get_centr_segm_mz_range(centr_df, isocalc_wrapper):
+    """The range of spectrum m/zs that can match any of the centroids in `centr_df`"""
     centr_segm_min_mz, centr_segm_max_mz = centr_df.mz.agg([np.min, np.max])
     centr_segm_min_mz, _ = isocalc_wrapper.mass_accuracy_bounds(centr_segm_min_mz)
     _, centr_segm_max_mz = isocalc_wrapper.mass_accuracy_bounds(centr_segm_max_mz)
+    return centr_segm_min_mz, centr_segm_max_mz
+
+
+def choose_ds_segments(ds_segments_bounds, centr_df, isocalc_wrapper):
+    centr_segm_min_mz, centr_segm_max_mz = get_centr_segm_mz_range(centr_df, isocalc_wrapper)
 
     ds_segm_n = len(ds_segments_bounds)
     first_ds_segm_i = np.searchsorted(ds_segments_bounds[:, 0], centr_segm_min_mz, side='right') - 1
@@ -218,15 +193,29 @@ def choose_ds_segments(ds_segments_bounds, centr_df, isocalc_wrapper):
     return first_ds_segm_i, last_ds_segm_i
 
 
+def estimate_ds_rows_in_mz_ranges(ds_segments_bounds, ds_segm_lens, mz_mins, mz_maxs):
+    """Estimates how many dataset rows have m/zs within each of the given ranges, assuming that
+    the rows of each ds segment are evenly spread between its bounds"""
+    segm_mins, segm_maxs = ds_segments_bounds[:, 0], ds_segments_bounds[:, 1]
+    mz_mins, mz_maxs = np.asarray(mz_mins)[:, None], np.asarray(mz_maxs)[:, None]
+    overlaps = np.minimum(segm_maxs, mz_maxs) - np.maximum(segm_mins, mz_mins)
+    widths = segm_maxs - segm_mins
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fractions = np.where(
+            widths > 0, np.clip(overlaps / widths, 0, 1), (overlaps >= 0).astype(float)
+        )
+    return fractions @ np.asarray(ds_segm_lens, dtype=float)
+
+
 def process_centr_segments(
     fexec: Executor,
     ds_segms_cobjs: List[CObj[pd.DataFrame]],
     ds_segments_bounds,
     ds_segm_lens: np.ndarray,
     db_segms_cobjs: List[CObj[pd.DataFrame]],
+    db_segms_df: pd.DataFrame,
     imzml_reader: PortableSpectrumReader,
     ds_config: DSConfig,
-    ds_segm_size_mb: float,
     is_intensive_dataset: bool,
 ) -> Tuple[pd.DataFrame, pd.DataFrame]:
     # pylint: disable=too-many-locals
@@ -235,7 +224,9 @@ def process_centr_segments(
     nrows, ncols = ds_dims(imzml_reader.coordinates)
     isocalc_wrapper = IsocalcWrapper(ds_config)
     image_gen_config = ds_config['image_generation']
-    compute_metrics = make_compute_image_metrics(sample_area_mask, nrows, ncols, image_gen_config)
+    compute_metrics_batch = make_compute_image_metrics_batch(
+        sample_area_mask, nrows, ncols, image_gen_config
+    )
     min_px = image_gen_config['min_px']
     # TODO: Get available memory from Lithops somehow so it updates if memory is increased on retry
     pw_mem_mb = 2048 if is_intensive_dataset else 1024
@@ -254,20 +245,19 @@ def process_centr_segments(
         )
         print(f'Reading dataset segments {first_ds_segm_i}-{last_ds_segm_i}')
         # read all segments in loop from COS
-        sp_arr = read_ds_segments(
+        sp_mzs, sp_ints, sp_inds = read_ds_segments(
             ds_segms_cobjs[first_ds_segm_i : last_ds_segm_i + 1],
             ds_segm_lens[first_ds_segm_i : last_ds_segm_i + 1],
-            pw_mem_mb,
-            ds_segm_size_mb,
             ds_segm_dtype,
+            get_centr_segm_mz_range(centr_df, isocalc_wrapper),
             storage,
         )
-        perf.record_entry('loaded ds segms', ds_segm_len=len(sp_arr))
+        perf.record_entry('loaded ds segms', ds_segm_len=len(sp_mzs))
 
-        formula_image_set_it = gen_iso_image_sets(
-            sp_inds=sp_arr.sp_i.values,
-            sp_mzs=sp_arr.mz.values,
-            sp_ints=sp_arr.int.values,
+        image_slabs = gen_iso_image_slabs(
+            sp_inds=sp_inds,
+            sp_mzs=sp_mzs,
+            sp_ints=sp_ints,
             centr_df=centr_df,
             nrows=nrows,
             ncols=ncols,
@@ -275,14 +265,14 @@ def process_centr_segments(
         )
 
         images_manager = ImagesManager(storage)
-        for f_i, f_metrics, f_images in compute_and_filter_metrics(
-            formula_image_set_it,
-            compute_metrics,
+        for formula_metrics, image_slab in compute_and_filter_metrics_batch(
+            image_slabs,
+            compute_metrics_batch,
             target_formula_inds=set(centr_df.formula_i[centr_df.target]),
             targeted_database_formula_inds=set(centr_df.formula_i[centr_df.targeted]),
             min_px=min_px,
         ):
-            images_manager.append(f_i, f_metrics, f_images)
+            images_manager.append(formula_metrics, image_slab)
         formula_metrics_df, image_lookups = images_manager.finish()
 
         perf.add_extra_data(metrics_n=len(formula_metrics_df), images_n=len(image_lookups))
@@ -291,8 +281,20 @@ def process_centr_segments(
         return formula_metrics_df, image_lookups
 
     logger.info('Annotating...')
+    cost_factors = pd.DataFrame(
+        {
+            'n_pixels': np.full(len(db_segms_cobjs), nrows * ncols),
+            'n_centroids': db_segms_df.n_centroids.values,
+            'ds_rows': estimate_ds_rows_in_mz_ranges(
+                ds_segments_bounds, ds_segm_lens, db_segms_df.mz_min, db_segms_df.mz_max
+            ),
+        }
+    )
     formula_metrics_list, image_lookups_list = fexec.map_unpack(
-        process_centr_segment, [(co,) for co in db_segms_cobjs], runtime_memory=pw_mem_mb
+        process_centr_segment,
+        [(co,) for co in db_segms_cobjs],
+        cost_factors=cost_factors,
+        runtime_memory=pw_mem_mb,
     )
     formula_metrics_df = pd.concat(formula_metrics_list)
     images_df = pd.concat(image_lookups_list)
@@ -3,7 +3,9 @@ from __future__ import annotations
 import logging
 from collections import defaultdict
 from concurrent.futures.thread import ThreadPoolExecutor
+from contextlib import ExitStack
 from pathlib import Path
+from tempfile import TemporaryFile
 from typing import Optional, Dict, List, Union
 
 import pandas as pd
@@ -13,9 +15,11 @@ from lithops.storage.utils import StorageNoSuchKeyError, CloudObject
 
 from sm.engine.annotation.formula_validator import METRICS
 from sm.engine.annotation.job import del_jobs, insert_running_job, update_finished_job, JobStatus
+from sm.engine.annotation.png_generator import get_png_options
 from sm.engine.annotation_lithops.executor import Executor
 from sm.engine.annotation_lithops.io import save_cobj, iter_cobjs_with_prefetch
 from sm.engine.annotation_lithops.pipeline import Pipeline
+from sm.engine.annotation_lithops.prepare_results import save_analysis_cubes
 from sm.engine.annotation_lithops.utils import jsonhash
 from sm.engine.annotation_spark.search_results import SearchResults
 from sm.engine.dataset import Dataset
@@ -195,7 +199,12 @@ class LocalAnnotationJob:
             cache_key = None
 
         self.pipe = Pipeline(
-            self.imzml_cobj, self.ibd_cobj, self.moldb_defs, self.ds_config, cache_key=cache_key
+            self.imzml_cobj,
+            self.ibd_cobj,
+            self.moldb_defs,
+            self.ds_config,
+            cache_key=cache_key,
+            png_options=get_png_options(sm_config),
         )
 
     def run(self, save=True, **kwargs):
@@ -268,6 +277,8 @@ class ServerAnnotationJob:
             self.ds.config,
             cache_key=cache_key,
             executor=executor,
+            perf=perf,
+            png_options=get_png_options(sm_config),
         )
 
         self.results_dfs = None
@@ -299,6 +310,37 @@ class ServerAnnotationJob:
 
         return db_formula_image_ids
 
+    def _store_analysis_cubes(self, moldb_to_job_map):
+        """Saves the first-isotope images of each job's annotations, so that post-processing
+        doesn't need to download and decode their PNGs. Post-processing falls back to the PNGs
+        if a job doesn't have a cube, so failures here don't fail the job."""
+        cube_row_keys = {}
+        for moldb_id, job_id in moldb_to_job_map.items():
+            formula_image_ids = self.db_formula_image_ids.get(moldb_id, {})
+            cube_row_keys[job_id] = {
+                formula_i: image_ids['iso_image_ids'][0]
+                for formula_i, image_ids in formula_image_ids.items()
+                if image_ids['iso_image_ids'] and image_ids['iso_image_ids'][0] is not None
+            }
+
+        try:
+            with ExitStack() as stack:
+                cube_fps = {
+                    job_id: stack.enter_context(TemporaryFile()) for job_id in cube_row_keys
+                }
+                save_analysis_cubes(
+                    self.storage,
+                    self.pipe.cube_cobjs,
+                    self.pipe.imzml_reader,
+                    cube_row_keys,
+                    cube_fps,
+                )
+                for job_id, fp in cube_fps.items():
+                    fp.seek(0)
+                    image_storage.post_analysis_cube(self.ds.id, job_id, fp)
+        except Exception:
+            logger.warning('Failed to save analysis cubes', exc_info=True)
+
     def run(self, **kwargs):
         # TODO: Only run missing moldbs
         del_jobs(self.ds)
@@ -313,6 +355,7 @@ class ServerAnnotationJob:
                 pd.concat(list(self.results_dfs.values())),
                 iter_cobjs_with_prefetch(self.storage, self.png_cobjs),
             )
+            self._store_analysis_cubes(moldb_to_job_map)
 
             for moldb_id, job_id in moldb_to_job_map.items():
                 results_df = self.results_dfs[moldb_id]
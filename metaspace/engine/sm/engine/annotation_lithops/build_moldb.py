@@ -18,7 +18,7 @@ from sm.engine.annotation_lithops.io import (
 )
 from sm.engine.ds_config import DSConfig
 from sm.engine.annotation.fdr import FDR
-from sm.engine.formula_parser import safe_generate_ion_formula
+from sm.engine.formula_parser import safe_generate_ion_formulas
 from sm.engine.utils.perf_profile import Profiler
 
 
@@ -47,14 +47,11 @@ def _get_db_fdr_and_formulas(ds_config: DSConfig, mols: List[str]):
         analysis_version=ds_config.get('analysis_version', 1),
     )
     fdr.decoy_adducts_selection(mols)
-    target_mods = fdr.target_modifiers()
-    formulas = [
-        (formula, modifier, safe_generate_ion_formula(formula, modifier), modifier in target_mods)
-        for formula, modifier in fdr.ion_tuples()
-    ]
-    formula_map_df = pd.DataFrame(
-        formulas, columns=['formula', 'modifier', 'ion_formula', 'target']
+    formula_map_df = pd.DataFrame(fdr.ion_tuples(), columns=['formula', 'modifier'])
+    formula_map_df['ion_formula'] = safe_generate_ion_formulas(
+        formula_map_df.formula, formula_map_df.modifier
     )
+    formula_map_df['target'] = formula_map_df.modifier.isin(fdr.target_modifiers())
 
     formula_map_df = formula_map_df[~formula_map_df.ion_formula.isna()]
 
@@ -1,7 +1,8 @@
 from __future__ import annotations
 
 import logging
-from functools import wraps
+import threading
+from functools import partial, wraps
 from typing import Optional
 
 from lithops.storage import Storage
@@ -10,6 +11,7 @@ from lithops.storage.utils import CloudObject, StorageNoSuchKeyError
 from sm.engine.annotation_lithops.io import serialize, deserialize, delete_objects_by_prefix
 
 logger = logging.getLogger('annotation-pipeline')
+_tracked = threading.local()  # pylint: disable=invalid-name
 
 
 class PipelineCacher:
@@ -61,14 +63,33 @@ class PipelineCacher:
         delete_objects_by_prefix(self.storage, self.bucket, prefix)
 
 
-def use_pipeline_cache(f):
+class TracksStageUpdates:
+    """Base class for classes with `use_pipeline_cache` stages. Records attribute assignments
+    made by the current thread while a stage is running, so that stages running concurrently in
+    other threads don't end up in each other's cache entries."""
+
+    def __setattr__(self, name, value):
+        updates = getattr(_tracked, 'updates', None)
+        if updates is not None:
+            updates[name] = value
+        super().__setattr__(name, value)
+
+
+def use_pipeline_cache(f=None, *, version=1):
     """Decorator to cache individual pipeline stages in the Pipeline class. It works by tracking
-    which class properties change during the first call to the wrapped method, and re-applying those
-    property changes instead of calling the wrapped function on subsequent calls.
+    which class properties are assigned during the first call to the wrapped method, and
+    re-applying those property changes instead of calling the wrapped function on subsequent calls.
+    The class must extend `TracksStageUpdates`.
 
     Pass the "use_cache=False" kwarg to force the function to be re-run.
+
+    Increment `version` (e.g. `@use_pipeline_cache(version=2)`) when a stage starts assigning
+    different properties, so that entries cached by the old version are ignored and recomputed.
     """
+    if f is None:
+        return partial(use_pipeline_cache, version=version)
     f_name = f.__name__
+    cache_key = f_name if version == 1 else f'{f_name}.v{version}'
 
     @wraps(f)
     def wrapper(self, *args, **kwargs):
@@ -80,20 +101,23 @@ def use_pipeline_cache(f):
         if not cacher:
             return f(self, *args, **kwargs)
 
-        if use_cache and cacher.exists(f_name):
-            updates, ret = cacher.load(f_name)
+        if use_cache and cacher.exists(cache_key):
+            updates, ret = cacher.load(cache_key)
             self.__dict__.update(updates)
             logger.debug(f'Loaded {f_name} from cache. Keys: {list(updates.keys())}')
             return ret
 
-        dict_before = self.__dict__.copy()
-        ret = f(self, *args, **kwargs)
-        updates = dict(
-            (k, v)
-            for k, v in self.__dict__.items()
-            if k not in dict_before or dict_before[k] is not v
-        )
-        cacher.save((updates, ret), f_name)
+        assert isinstance(self, TracksStageUpdates)
+        outer_updates = getattr(_tracked, 'updates', None)
+        _tracked.updates = updates = {}
+        try:
+            ret = f(self, *args, **kwargs)
+        finally:
+            _tracked.updates = outer_updates
+        if outer_updates is not None:
+            # Include nested stages' updates in the outer stage's cache entry
+            outer_updates.update(updates)
+        cacher.save((updates, ret), cache_key)
         logger.debug(f'Saved {f_name} to cache. Keys: {list(updates.keys())}')
         return ret
 
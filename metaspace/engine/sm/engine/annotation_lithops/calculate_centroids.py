@@ -2,22 +2,59 @@ from __future__ import annotations
 
 import logging
 from itertools import chain
-from typing import List
+from typing import List, Optional
 
 import numpy as np
 import pandas as pd
 from lithops.storage import Storage
 
 from sm.engine.annotation_lithops.executor import Executor
-from sm.engine.annotation_lithops.io import save_cobj, load_cobj, CObj, load_cobjs, save_cobjs
+from sm.engine.annotation_lithops.centroids_store import CentroidsStore, get_formula_shards
+from sm.engine.annotation_lithops.io import (
+    save_cobj,
+    load_cobj,
+    CObj,
+    load_cobjs,
+    save_cobjs,
+    iter_cobjs_with_prefetch,
+)
 from sm.engine.annotation.isocalc_wrapper import IsocalcWrapper
 
 logger = logging.getLogger('annotation-pipeline')
 
 
+PEAKS_DF_DTYPES = {
+    'formula_i': 'u4',
+    'peak_i': 'u1',
+    'mz': 'f8',
+    'int': 'f4',
+    'target': '?',
+    'targeted': '?',
+}
+
+
+def _split_peaks_df(df: pd.DataFrame):
+    """Splits peaks into chunks of approximately 64MB, ordered by the m/z of the first peak"""
+    first_peak_mz = df.mz[df.peak_i == 0].sort_values()
+
+    peaks_chunk_size = 64 * 2 ** 20
+    n_chunks = int(np.ceil(df.memory_usage().sum() / peaks_chunk_size))
+    cnt = len(first_peak_mz)
+    return (
+        df.loc[first_peak_mz.index[cnt * i // n_chunks : cnt * (i + 1) // n_chunks]]
+        for i in range(n_chunks)
+    )
+
+
 def calculate_centroids(
-    fexec: Executor, formula_cobjs: List[CObj[pd.DataFrame]], isocalc_wrapper: IsocalcWrapper
+    fexec: Executor,
+    formula_cobjs: List[CObj[pd.DataFrame]],
+    isocalc_wrapper: IsocalcWrapper,
+    centroids_store: Optional[CentroidsStore] = None,
 ) -> List[CObj[pd.DataFrame]]:
+    if centroids_store is not None:
+        return _calculate_centroids_with_store(fexec, formula_cobjs, centroids_store)
+
     def calculate_peaks_for_formula(args):
         formula_i, formula, target, targeted = args
         mzs, ints = isocalc_wrapper.centroids(formula)
@@ -36,16 +73,7 @@ def calculate_centroids(
         peaks_df = pd.DataFrame(
             peaks, columns=['formula_i', 'peak_i', 'mz', 'int', 'target', 'targeted']
         )
-        peaks_df = peaks_df.astype(
-            {
-                'formula_i': 'u4',
-                'peak_i': 'u1',
-                'mz': 'f8',
-                'int': 'f4',
-                'target': '?',
-                'targeted': '?',
-            }
-        )
+        peaks_df = peaks_df.astype(PEAKS_DF_DTYPES)
 
         peaks_df.set_index('formula_i', inplace=True)
 
@@ -65,17 +93,7 @@ def calculate_centroids(
 
     def _sort_peaks_cobjs(*, storage):
         df = pd.concat(load_cobjs(storage, peaks_cobjs))
-        first_peak_mz = df.mz[df.peak_i == 0].sort_values()
-
-        peaks_chunk_size = 64 * 2 ** 20
-        n_chunks = int(np.ceil(df.memory_usage().sum() / peaks_chunk_size))
-        cnt = len(first_peak_mz)
-        chunks = (
-            df.loc[first_peak_mz.index[cnt * i // n_chunks : cnt * (i + 1) // n_chunks]]
-            for i in range(n_chunks)
-        )
-
-        return save_cobjs(storage, chunks)
+        return save_cobjs(storage, _split_peaks_df(df))
 
     sorted_peaks_cobjs = fexec.call(
         _sort_peaks_cobjs,
@@ -88,6 +106,84 @@ def calculate_centroids(
     return sorted_peaks_cobjs
 
 
+def _make_peaks_df(
+    formulas_df: pd.DataFrame, centroids_df: pd.DataFrame, centroids_store: CentroidsStore
+) -> pd.DataFrame:
+    centroids_df = centroids_df.loc[formulas_df.ion_formula.values]
+    mzs = centroids_df[centroids_store.mz_cols].values
+    ints = centroids_df[centroids_store.int_cols].values
+    has_centroids = ~np.isnan(mzs[:, 0])
+    n_peaks = centroids_store.n_peaks
+    peaks_df = pd.DataFrame(
+        {
+            'formula_i': np.repeat(formulas_df.index.values[has_centroids], n_peaks),
+            'peak_i': np.tile(np.arange(n_peaks), np.count_nonzero(has_centroids)),
+            'mz': mzs[has_centroids].ravel(),
+            'int': ints[has_centroids].ravel(),
+            'target': np.repeat(formulas_df.target.values[has_centroids], n_peaks),
+            'targeted': np.repeat(formulas_df.targeted.values[has_centroids], n_peaks),
+        }
+    )
+    return peaks_df.astype(PEAKS_DF_DTYPES).set_index('formula_i')
+
+
+def _calculate_centroids_with_store(
+    fexec: Executor, formula_cobjs: List[CObj[pd.DataFrame]], centroids_store: CentroidsStore
+) -> List[CObj[pd.DataFrame]]:
+    """Same as `calculate_centroids`, but reuses centroids from `centroids_store` and only
+    calculates the centroids of ion formulas that are missing from the store."""
+
+    def get_chunk_ion_formulas(formula_cobj: CObj[pd.DataFrame], *, storage: Storage):
+        ion_formulas = load_cobj(storage, formula_cobj).ion_formula.values
+        return ion_formulas, get_formula_shards(ion_formulas)
+
+    ion_formulas, shards = fexec.map_unpack(
+        get_chunk_ion_formulas, [(co,) for co in formula_cobjs], runtime_memory=1024
+    )
+    ion_formulas, shards = np.concatenate(ion_formulas), np.concatenate(shards)
+    by_shard = np.argsort(shards, kind='stable')
+    shard_is, shard_starts = np.unique(shards[by_shard], return_index=True)
+    shard_formulas = np.split(ion_formulas[by_shard], shard_starts[1:])
+
+    def get_shard_centroids(shard_i: int, shard_ion_formulas, *, storage: Storage):
+        centroids_df, n_missing = centroids_store.get_centroids(
+            storage, shard_i, shard_ion_formulas
+        )
+        return save_cobj(storage, centroids_df), n_missing
+
+    centroids_cobjs, n_missing = fexec.map_unpack(
+        get_shard_centroids,
+        list(zip(shard_is.tolist(), shard_formulas)),
+        runtime_memory=1024,
+    )
+    logger.info(
+        f'Calculated {sum(n_missing)} of {len(ion_formulas)} ion formulas\' centroids, '
+        f'reused the rest from {centroids_store.prefix}'
+    )
+
+    def _build_and_sort_peaks(*, storage: Storage):
+        centroids_df = pd.concat(load_cobjs(storage, centroids_cobjs))
+        df = pd.concat(
+            [
+                _make_peaks_df(formulas_df, centroids_df, centroids_store)
+                for formulas_df in iter_cobjs_with_prefetch(storage, formula_cobjs)
+            ]
+        )
+        del centroids_df
+        return save_cobjs(storage, _split_peaks_df(df))
+
+    num_centroids = len(ion_formulas) * centroids_store.n_peaks
+    sorted_peaks_cobjs = fexec.call(
+        _build_and_sort_peaks,
+        (),
+        cost_factors={'num_centroids': num_centroids, 'num_formula_cobjects': len(formula_cobjs)},
+        runtime_memory=256 + 150 * num_centroids / 2 ** 20,
+    )
+
+    logger.info(f'Sorted centroids chunks into {len(sorted_peaks_cobjs)} chunks')
+    return sorted_peaks_cobjs
+
+
 def validate_centroids(fexec: Executor, peaks_cobjs: List[CObj[pd.DataFrame]]):
     # Ignore code duplicated with validate_centroid_segments as the duplicated parts of the code
     # are too entangled with non-duplicated parts of the code
@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import logging
+import zlib
+from typing import Dict, Tuple
+
+import numpy as np
+import pandas as pd
+from lithops.storage import Storage
+from lithops.storage.utils import StorageNoSuchKeyError
+
+from sm.engine.annotation.isocalc_wrapper import IsocalcWrapper
+from sm.engine.annotation_lithops.io import save_cobj, deserialize
+from sm.engine.annotation_lithops.utils import jsonhash
+
+logger = logging.getLogger('annotation-pipeline')
+
+N_SHARDS = 256
+
+
+def get_formula_shards(ion_formulas) -> np.ndarray:
+    # Use crc32 instead of `hash`, because `hash` of str values is randomized per-process
+    return np.array(
+        [zlib.crc32(ion_formula.encode()) % N_SHARDS for ion_formula in ion_formulas],
+        dtype=np.int32,
+    )
+
+
+class CentroidsStore:
+    """
+    Persistent store of the isotopic peak centroids of ion formulas, shared between datasets and
+    molecular databases so that centroids only need to be calculated for ion formulas that
+    haven't been seen before.
+
+    `IsocalcWrapper.centroids` only depends on the ion formula and the isotope generation
+    parameters, so a separate store is kept for each combination of parameters. Each store is
+    split into `N_SHARDS` shards by the hash of the ion formula. A shard is a DataFrame indexed by
+    ion formula with columns `mz_0..mz_{n_peaks-1}` and `int_0..int_{n_peaks-1}`. Ion formulas
+    that have no centroids (e.g. unparseable formulas) are stored as NaN rows, so that they also
+    aren't recalculated.
+
+    Shards are updated with read-modify-write without locking. If two pipelines update the same
+    shard at the same time, one update may be lost. As entries are never changed, the only
+    consequence is that the lost centroids will be calculated again the next time they're needed.
+    """
+
+    def __init__(self, sm_storage: Dict, isocalc_wrapper: IsocalcWrapper):
+        self.isocalc_wrapper = isocalc_wrapper
+        self.n_peaks = isocalc_wrapper.n_peaks
+        self.params = {
+            'charge': isocalc_wrapper.charge,
+            'sigma': isocalc_wrapper.sigma,
+            'instrument': isocalc_wrapper.instrument,
+            'n_peaks': isocalc_wrapper.n_peaks,
+            'analysis_version': isocalc_wrapper.analysis_version,
+        }
+        self.bucket, raw_prefix = sm_storage['centroids']
+        self.prefix = f'{raw_prefix}/isocalc/{jsonhash(self.params)}'
+        self.mz_cols = [f'mz_{i}' for i in range(self.n_peaks)]
+        self.int_cols = [f'int_{i}' for i in range(self.n_peaks)]
+
+    def _shard_key(self, shard_i: int):
+        return f'{self.prefix}/{shard_i:03}'
+
+    def load_shard(self, storage: Storage, shard_i: int) -> pd.DataFrame:
+        try:
+            return deserialize(storage.get_object(self.bucket, self._shard_key(shard_i)))
+        except StorageNoSuchKeyError:
+            return pd.DataFrame(
+                columns=[*self.mz_cols, *self.int_cols],
+                index=pd.Index([], name='ion_formula'),
+                dtype='f8',
+            )
+
+    def save_shard(self, storage: Storage, shard_i: int, shard_df: pd.DataFrame):
+        save_cobj(storage, shard_df, self.bucket, self._shard_key(shard_i))
+
+    def calculate_centroids(self, ion_formulas) -> pd.DataFrame:
+        centroids = np.full((len(ion_formulas), self.n_peaks * 2), np.nan)
+        for i, ion_formula in enumerate(ion_formulas):
+            mzs, ints = self.isocalc_wrapper.centroids(ion_formula)
+            if mzs is not None:
+                centroids[i, : self.n_peaks] = mzs
+                centroids[i, self.n_peaks :] = ints
+        return pd.DataFrame(
+            centroids,
+            columns=[*self.mz_cols, *self.int_cols],
+            index=pd.Index(ion_formulas, name='ion_formula'),
+        )
+
+    def get_centroids(
+        self, storage: Storage, shard_i: int, ion_formulas
+    ) -> Tuple[pd.DataFrame, int]:
+        """Gets the centroids of `ion_formulas`, which must all belong to shard `shard_i`.
+        Missing centroids are calculated and added to the shard.
+        Returns the centroids and the number of ion formulas that had to be calculated"""
+        shard_df = self.load_shard(storage, shard_i)
+        missing_formulas = pd.Index(ion_formulas).difference(shard_df.index)
+        if len(missing_formulas) > 0:
+            shard_df = pd.concat([shard_df, self.calculate_centroids(missing_formulas)])
+            self.save_shard(storage, shard_i, shard_df)
+        return shard_df.loc[ion_formulas], len(missing_formulas)
+
+    def clear(self, storage: Storage):
+        keys = storage.list_keys(self.bucket, self.prefix)
+        if keys:
+            logger.info(f'Clearing centroids store {self.prefix}')
+            storage.delete_objects(self.bucket, keys)
@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger('engine.lithops-wrapper')
+
+# Minimum number of recorded invocations before a model is trusted
+MIN_SAMPLES = 10
+# Predictions are multiplied by this to leave headroom for unseen variance
+MEMORY_SAFETY_FACTOR = 1.2
+MIN_RUNTIME_MEMORY = 256
+# Don't extrapolate to cost factors more than this many times bigger than any seen previously
+MAX_EXTRAPOLATION = 1.5
+
+SAMPLES_SEL = (
+    "SELECT extra_data FROM perf_profile_entry "
+    "WHERE name = %s AND start > %s "
+    "AND extra_data->>'cost_factors' IS NOT NULL AND extra_data->>'error' IS NULL "
+    "ORDER BY id DESC LIMIT %s"
+)
+
+
+def perf_entries_to_samples(extra_datas: Sequence[Dict]) -> pd.DataFrame:
+    """Converts the `extra_data` of `Executor.map` perf_profile_entry rows into a DataFrame with
+    one row per invocation, with a column for each cost factor, `memory_mb` and `time_s`"""
+    dfs = []
+    for extra_data in extra_datas:
+        cost_factors = extra_data.get('cost_factors') or {}
+        mem_usages = extra_data.get('mem_usages') or []
+        exec_times = extra_data.get('exec_times') or []
+        n_items = len(next(iter(cost_factors.values()), []))
+        if n_items == 0 or len(mem_usages) != n_items or len(exec_times) != n_items:
+            continue
+        df = pd.DataFrame(cost_factors)
+        # ru_maxrss is in KB
+        df['memory_mb'] = np.array(mem_usages, dtype=float) / 1024
+        df['time_s'] = np.array(exec_times, dtype=float)
+        dfs.append(df)
+    if not dfs:
+        return pd.DataFrame(columns=['memory_mb', 'time_s'])
+    samples_df = pd.concat(dfs, ignore_index=True)
+    return samples_df[(samples_df.memory_mb > 0) & (samples_df.time_s >= 0)]
+
+
+class CostModel:
+    """
+    Linear models predicting the peak memory usage and execution time of one invocation
+    of a function from its cost factors, fitted with least squares to previous invocations.
+
+    Memory predictions are upper bounds: the largest underestimate seen in the training data is
+    added to each prediction, and the result is scaled by `MEMORY_SAFETY_FACTOR`.
+    """
+
+    def __init__(
+        self,
+        factor_names: List[str],
+        memory_coefs: np.ndarray,
+        memory_margin: float,
+        time_coefs: np.ndarray,
+        max_factors: np.ndarray,
+    ):
+        self.factor_names = factor_names
+        self.memory_coefs = memory_coefs
+        self.memory_margin = memory_margin
+        self.time_coefs = time_coefs
+        self.max_factors = max_factors
+
+    @staticmethod
+    def _design_matrix(factors: np.ndarray) -> np.ndarray:
+        return np.hstack([np.ones((len(factors), 1)), factors])
+
+    @classmethod
+    def fit(cls, samples_df: pd.DataFrame, factor_names: List[str]) -> Optional[CostModel]:
+        """Returns None if there aren't enough samples that have all of `factor_names`"""
+        if any(name not in samples_df.columns for name in factor_names):
+            return None
+        samples_df = samples_df.dropna(subset=factor_names)
+        if len(samples_df) < max(MIN_SAMPLES, 2 * (len(factor_names) + 1)):
+            return None
+
+        factors = samples_df[factor_names].values.astype(float)
+        x = cls._design_matrix(factors)
+        memory_coefs = np.linalg.lstsq(x, samples_df.memory_mb.values, rcond=None)[0]
+        time_coefs = np.linalg.lstsq(x, samples_df.time_s.values, rcond=None)[0]
+        memory_margin = max(np.max(samples_df.memory_mb.values - x @ memory_coefs), 0)
+        return cls(factor_names, memory_coefs, memory_margin, time_coefs, factors.max(axis=0))
+
+    def can_predict(self, cost_factors: pd.DataFrame) -> bool:
+        """False if the model would have to extrapolate too far beyond the training data"""
+        factors = cost_factors[self.factor_names].values.astype(float)
+        return bool((factors <= np.maximum(self.max_factors, 1) * MAX_EXTRAPOLATION).all())
+
+    def predict(self, cost_factors: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the predicted upper bound of memory usage (MB) and the predicted execution
+        time (seconds) of each row of `cost_factors`"""
+        x = self._design_matrix(cost_factors[self.factor_names].values.astype(float))
+        memory = (x @ self.memory_coefs + self.memory_margin) * MEMORY_SAFETY_FACTOR
+        times = np.maximum(x @ self.time_coefs, 0)
+        return memory, times
+
+
+class CostModelPlanner:
+    """
+    Chooses `runtime_memory` for each invocation of `Executor.map` based on `CostModel`s fitted
+    to the perf_profile entries of previous runs of the same function. Models are fitted on
+    first use and cached for the lifetime of the planner.
+
+    Args:
+        db: sm.engine.db.DB instance
+        max_age: Only use perf entries more recent than this
+        max_entries: Max number of perf entries (each covering a whole `map` call) to load per
+            function
+    """
+
+    def __init__(self, db, max_age=timedelta(days=30), max_entries=200):
+        self._db = db
+        self._max_age = max_age
+        self._max_entries = max_entries
+        self._models: Dict[Tuple[str, Tuple[str, ...]], Optional[CostModel]] = {}
+        # The planner is shared by concurrent pipeline stages, but DB instances can't be used
+        # from multiple threads at once
+        self._lock = threading.Lock()
+
+    def load_samples(self, func_name: str) -> pd.DataFrame:
+        rows = self._db.select(
+            SAMPLES_SEL, (func_name, datetime.now() - self._max_age, self._max_entries)
+        )
+        return perf_entries_to_samples([extra_data for (extra_data,) in rows])
+
+    def get_model(self, func_name: str, factor_names: List[str]) -> Optional[CostModel]:
+        key = (func_name, tuple(factor_names))
+        with self._lock:
+            if key not in self._models:
+                try:
+                    self._models[key] = CostModel.fit(self.load_samples(func_name), factor_names)
+                except Exception:
+                    logger.warning(f'Failed to fit cost model for {func_name}', exc_info=True)
+                    self._models[key] = None
+            return self._models[key]
+
+    def plan(
+        self, func_name: str, cost_factors: pd.DataFrame
+    ) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Returns the runtime memory (MB, rounded up to a power of 2) and predicted execution
+        time of each invocation, or None if there's no trustworthy model for the function"""
+        model = self.get_model(func_name, list(cost_factors.columns))
+        if model is None or not model.can_predict(cost_factors):
+            return None
+        memory, times = model.predict(cost_factors)
+        memory = np.maximum(memory, MIN_RUNTIME_MEMORY)
+        runtime_memory = (2 ** np.ceil(np.log2(memory))).astype(int)
+        return runtime_memory, times
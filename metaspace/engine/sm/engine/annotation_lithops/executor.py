@@ -3,11 +3,15 @@ from __future__ import annotations
 import inspect
 import logging
 import resource
+import time
 import traceback
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import ExitStack
+from contextvars import copy_context
 from datetime import datetime
 from itertools import chain
-from threading import Thread, current_thread
+from threading import Lock, Thread, current_thread
 from typing import List, Callable, TypeVar, Iterable, Sequence, Dict, Optional
 
 import lithops
@@ -15,7 +19,17 @@ import numpy as np
 import pandas as pd
 from lithops.future import ResponseFuture
 from lithops.storage import Storage
+from lithops.wait import ALWAYS
 
+try:
+    # Lithops 2.x only. Its `FunctionExecutor.wait` stops the invoker when it returns, which
+    # discards invocations that are still queued, and each call starts a timeout-checker thread
+    # that outlives it, so it can't be used to repeatedly poll running tasks.
+    from lithops.wait.wait_storage import _wait_storage
+except ImportError:
+    _wait_storage = None
+
+from sm.engine.annotation_lithops.cost_model import CostModel, CostModelPlanner
 from sm.engine.utils.perf_profile import SubtaskProfiler, Profiler, NullProfiler
 
 logger = logging.getLogger('engine.lithops-wrapper')
@@ -30,12 +44,44 @@ MEM_LIMITS = {
     'ibm_cf': 4096,
     'ibm_vpc': 128 * 2 ** 30,
 }
+#: Running tasks are re-launched if they take longer than this multiple of the median duration of
+#: completed tasks, and longer than STRAGGLER_MIN_TIME seconds.
+#: Both can be overridden in the `speculation` section of the Lithops config.
+STRAGGLER_MULTIPLE = 3
+STRAGGLER_MIN_TIME = 60
+#: Fraction of tasks that must be complete before the median duration is considered reliable
+STRAGGLER_MIN_COMPLETED = 0.5
+SPECULATION_POLL_INTERVAL = 1
+#: Lithops 2.x polling limits, matching those of its `wait_storage`
+POLL_RETURN_EARLY_N = 32
+POLL_MAX_DIRECT_QUERY_N = 64
 
 
 class LithopsStalledException(Exception):
     pass
 
 
+#: Exceptions that are likely to be fixed by retrying with more memory
+RETRYABLE_EXCEPTIONS = (MemoryError, TimeoutError)
+
+
+def _poll_futures(executor, futures: List[ResponseFuture], running_futures: set):
+    """Updates the states of `futures` without waiting for them to finish.
+    `running_futures` must be kept between calls for the same futures."""
+    if _wait_storage is not None:
+        _wait_storage(
+            futures,
+            running_futures,
+            executor.internal_storage,
+            False,  # download_results
+            False,  # throw_except
+            POLL_RETURN_EARLY_N,
+            POLL_MAX_DIRECT_QUERY_N,
+        )
+    else:
+        executor.wait(futures, throw_except=False, return_when=ALWAYS)
+
+
 def _build_wrapper_func(func: Callable[..., TRet]) -> Callable[..., TRet]:
     def wrapper_func(*args, **kwargs):
         def finalize_perf():
@@ -87,7 +133,7 @@ def _save_subtask_perf(
     if futures:
         exec_times = [f.stats.get('worker_func_exec_time', -1) for f in futures]
     else:
-        exec_times = [-1]
+        exec_times = [-1] * len(subtask_perfs)
     inner_times = subtask_data.pop('inner time', [-1])
     mem_befores = subtask_data.pop('mem before', [-1])
     mem_afters = subtask_data.pop('mem after', [-1])
@@ -127,21 +173,32 @@ class Executor:
 
     Current features:
       * Switch to the Standalone executor if >4GB of memory is required
-      * Retry with 2x more memory if an execution fails due to an OOM
+      * Retry items that failed due to an OOM or timeout with 2x more memory. Results of the items
+        that succeeded are kept, so they aren't re-run
+      * Speculatively re-launch straggling tasks that run much longer than the median task.
+        Whichever copy of the task finishes first is used.
       * Collect & record per-invocation performance statistics & custom data
         * A named kwarg `perf` of type `SubtaskPerf` will be injected if in the parameter list,
           allowing a function to supply more granular timing data and add custom data.
         * Memory & time usage is recorded for each invocation.
-        * A `cost_factors` DataFrame may be supplied - currently just saved to DB, but planned
-          to be used as a data source for predicting memory & time usage automatically based on
-          previous executions.
+        * A `cost_factors` DataFrame may be supplied. It is saved to DB, and if a `planner` is
+          supplied it's used to predict the memory & time usage of each job based on previous
+          executions of the same function. Jobs are then grouped by their predicted memory
+          requirements, and each group is run with its own `runtime_memory` on the executor that
+          supports it, instead of using the caller-supplied `runtime_memory` for all jobs.
           This DF should have one row per job (in the same order), and each column should be a float
           that represents some factor that could contribute to memory/time usage.
       * Utility functions e.g. `map_unpack` and `map_concat` for applying common transformations
         to the result data.
     """
 
-    def __init__(self, lithops_config: Dict, perf: Profiler = None, debug_run_locally=False):
+    def __init__(
+        self,
+        lithops_config: Dict,
+        perf: Profiler = None,
+        debug_run_locally=False,
+        planner: CostModelPlanner = None,
+    ):
         self.debug_run_locally = debug_run_locally
         self.is_hybrid = False
         if debug_run_locally:
@@ -169,7 +226,14 @@ class Executor:
         self.storage = Storage(lithops_config)
         self._include_modules = lithops_config['lithops'].get('include_modules', [])
         self._execution_timeout = lithops_config['lithops'].get('execution_timeout', 3600) + 60
+        speculation_config = lithops_config.get('speculation', {})
+        self._straggler_multiple = speculation_config.get('straggler_multiple', STRAGGLER_MULTIPLE)
+        self._straggler_min_time = speculation_config.get('min_time', STRAGGLER_MIN_TIME)
         self._perf = perf or NullProfiler()
+        self._planner = planner
+        # Lithops executors can't safely start jobs from multiple threads at once, e.g. when
+        # independent pipeline stages run concurrently
+        self._invoke_lock = Lock()
 
     def map(
         self,
@@ -180,12 +244,26 @@ class Executor:
         runtime_memory: int = None,
         include_modules=None,
         debug_run_locally=False,
+        use_planner=True,
         **lithops_kwargs,
     ) -> List[TRet]:
+        # pylint: disable=too-many-locals,too-many-branches
         if len(func_args) == 0:
             return []
         if cost_factors is not None:
             assert len(cost_factors) == len(func_args)
+            if self._planner is not None and use_planner:
+                plan = self._planner.plan(func.__name__, cost_factors)
+                if plan is not None:
+                    return self._map_planned(
+                        func,
+                        func_args,
+                        cost_factors,
+                        *plan,
+                        include_modules=include_modules,
+                        debug_run_locally=debug_run_locally,
+                        **lithops_kwargs,
+                    )
         if runtime_memory is None:
             runtime_memory = 512
         # Make sure runtime_memory is a power of 2 to avoid making too many runtime variants
@@ -197,41 +275,59 @@ class Executor:
         wrapper_func = _build_wrapper_func(func)
         func_name = func.__name__
         attempt = 1
+        # (result, subtask_perf) of each item, filled in as items succeed
+        return_vals: List = [None] * len(func_args)
+        pending_idxs = list(range(len(func_args)))
 
         while True:
             start_time = datetime.now()
+            attempt_args = [func_args[idx] for idx in pending_idxs]
+            attempt_cost_factors = None
+            if cost_factors is not None:
+                attempt_cost_factors = cost_factors.iloc[pending_idxs].reset_index(drop=True)
 
             logger.info(
-                f'executor.map({func_name}, {len(func_args)} items, {runtime_memory}MB, '
+                f'executor.map({func_name}, {len(attempt_args)} items, {runtime_memory}MB, '
                 f'attempt {attempt})'
             )
-            futures, return_vals, exc = self._dispatch_map(
-                wrapper_func, func_args, runtime_memory, debug_run_locally, lithops_kwargs
+            futures, attempt_return_vals, exc = self._dispatch_map(
+                wrapper_func, attempt_args, runtime_memory, debug_run_locally, lithops_kwargs
             )
+            succeeded = [
+                i
+                for i, return_val in enumerate(attempt_return_vals or [])
+                if return_val is not None
+            ]
+            for i in succeeded:
+                return_vals[pending_idxs[i]] = attempt_return_vals[i]
+
+            if succeeded and self._perf:
+                _save_subtask_perf(
+                    self._perf,
+                    func_name=func_name,
+                    # pylint: disable=unsubscriptable-object # (because futures is Optional)
+                    futures=[futures[i] for i in succeeded] if futures else None,
+                    subtask_perfs=[attempt_return_vals[i][1] for i in succeeded],
+                    cost_factors=(
+                        attempt_cost_factors.iloc[succeeded].reset_index(drop=True)
+                        if attempt_cost_factors is not None
+                        else None
+                    ),
+                    attempt=attempt,
+                    runtime_memory=runtime_memory,
+                    start_time=start_time,
+                )
 
             if exc is None:
-                if self._perf:
-                    _save_subtask_perf(
-                        self._perf,
-                        func_name=func_name,
-                        futures=futures,
-                        subtask_perfs=[subtask_perf for result, subtask_perf in return_vals],
-                        cost_factors=cost_factors,
-                        attempt=attempt,
-                        runtime_memory=runtime_memory,
-                        start_time=start_time,
-                    )
-
                 logger.info(
-                    f'executor.map({func_name}, {len(func_args)} items, {runtime_memory}MB, '
+                    f'executor.map({func_name}, {len(attempt_args)} items, {runtime_memory}MB, '
                     f'attempt {attempt}) - {(datetime.now() - start_time).total_seconds():.3f}s'
                 )
 
                 return [result for result, subtask_perf in return_vals]
 
-            failed_idxs = [i for i, f in enumerate(futures or []) if f.error]
-            # pylint: disable=unsubscriptable-object # (because futures is Optional)
-            failed_activation_ids = [futures[i].activation_id for i in failed_idxs]
+            failed_idxs = [pending_idxs[i] for i, f in enumerate(futures or []) if f.error]
+            failed_activation_ids = [f.activation_id for f in futures or [] if f.error]
 
             self._perf.record_entry(
                 func_name,
@@ -243,14 +339,16 @@ class Executor:
                 failed_activation_ids=failed_activation_ids,
             )
 
-            if isinstance(exc, (MemoryError, TimeoutError)) and runtime_memory <= 4096:
+            if isinstance(exc, RETRYABLE_EXCEPTIONS) and runtime_memory <= 4096:
                 old_memory = runtime_memory
                 runtime_memory *= 2
                 attempt += 1
+                pending_idxs = [idx for idx, val in enumerate(return_vals) if val is None]
 
                 logger.warning(
-                    f'{func_name} raised {type(exc)} with {old_memory}MB, retrying with '
-                    f'{runtime_memory}MB. Failed activation(s): {failed_activation_ids}'
+                    f'{func_name} raised {type(exc)} with {old_memory}MB, retrying '
+                    f'{len(pending_idxs)} of {len(func_args)} items with {runtime_memory}MB. '
+                    f'Failed activation(s): {failed_activation_ids}'
                 )
             elif isinstance(exc, LithopsStalledException):
                 logger.critical(
@@ -278,7 +376,10 @@ class Executor:
                 func_kwargs = {}
                 if 'storage' in inspect.signature(wrapper_func).parameters:
                     func_kwargs['storage'] = self.storage
-                return_vals = [wrapper_func(*funcargs, **func_kwargs) for funcargs in func_args]
+                # Items after a failed item are left as None so that they're retried with it
+                return_vals = [None] * len(func_args)
+                for i, funcargs in enumerate(func_args):
+                    return_vals[i] = wrapper_func(*funcargs, **func_kwargs)
             except Exception as exc:
                 exception = exc
         else:
@@ -298,10 +399,35 @@ class Executor:
                             from sm.engine.utils.db_mutex import DBMutex
 
                             stack.enter_context(DBMutex().lock('vm', self._execution_timeout))
-                        futures = executor.map(
-                            wrapper_func, func_args, runtime_memory=runtime_memory, **lithops_kwargs
-                        )
-                        return_vals = executor.get_result(futures)
+                            # Set number of parallel workers based on memory requirements. This is
+                            # done inside the mutex as other threads may share the executor.
+                            # Lithops>=2.2.17 can configure this via
+                            # `.map(worker_processes=workers)`
+                            executor.config['lithops']['workers'] = min(
+                                20, MEM_LIMITS.get(executor_type) // runtime_memory
+                            )
+                        with self._invoke_lock:
+                            futures = list(
+                                executor.map(
+                                    wrapper_func,
+                                    func_args,
+                                    runtime_memory=runtime_memory,
+                                    **lithops_kwargs,
+                                )
+                            )
+                        try:
+                            return_vals = self._get_results_speculatively(
+                                executor,
+                                futures,
+                                wrapper_func,
+                                func_args,
+                                runtime_memory,
+                                lithops_kwargs,
+                            )
+                        except RETRYABLE_EXCEPTIONS:
+                            # Keep the successful results so that only failed items are retried
+                            return_vals = self._get_successful_results(executor, futures)
+                            raise
                         if is_standalone:
                             # Dismantle & wait for it to stop while the mutex is still active
                             # to avoid a race condition, as there's still some instability if a
@@ -310,7 +436,7 @@ class Executor:
                 except Exception as exc:
                     exception = exc
 
-            executor = self._select_executor(runtime_memory)
+            executor_type, executor = self._select_executor(runtime_memory)
             thread = Thread(target=run, name=f'{current_thread().name}-ex', daemon=True)
             thread.start()
             thread.join(self._execution_timeout)
@@ -319,6 +445,153 @@ class Executor:
 
         return futures, return_vals, exception
 
+    @staticmethod
+    def _get_successful_results(executor, futures):
+        """Waits for all `futures` to finish, then returns their results, with None in place of
+        the results of failed futures"""
+        executor.wait(futures, throw_except=False)
+        return_vals = []
+        for future in futures:
+            try:
+                return_vals.append(future.result(internal_storage=executor.internal_storage))
+            except Exception:
+                return_vals.append(None)
+        return return_vals
+
+    def _get_results_speculatively(
+        self, executor, futures, wrapper_func, func_args, runtime_memory, lithops_kwargs
+    ):
+        """Waits for the results of `futures`, re-launching straggling tasks in separate
+        invocations. The first copy of each task to succeed is used, and replaces the original
+        future in `futures` in-place so that its stats are recorded. Errors are only raised once
+        all copies of a task have failed."""
+        if not self._straggler_multiple or len(futures) < 2:
+            # Stragglers can only be detected by comparing against other tasks
+            return executor.get_result(futures)
+
+        copies = [[future] for future in futures]
+        run_starts: Dict[int, float] = {}
+        durations: List[float] = []
+        pending = set(range(len(futures)))
+        running_futures: set = set()
+        while pending:
+            _poll_futures(executor, [f for i in pending for f in copies[i]], running_futures)
+            now = time.time()
+            for i in sorted(pending):
+                for future in copies[i]:
+                    if not future.invoked:
+                        run_starts.setdefault(id(future), now)
+                finished = [f for f in copies[i] if (f.ready or f.done) and not f.error]
+                if finished:
+                    futures[i] = finished[0]
+                    durations.append(
+                        finished[0].stats.get('worker_exec_time', now - run_starts[id(finished[0])])
+                    )
+                    pending.discard(i)
+                elif all(f.error for f in copies[i]):
+                    futures[i] = copies[i][-1]
+                    # Raises the task's exception
+                    executor.get_result([futures[i]])
+
+            if pending and len(durations) >= len(futures) * STRAGGLER_MIN_COMPLETED:
+                threshold = max(
+                    np.median(durations) * self._straggler_multiple, self._straggler_min_time
+                )
+                stragglers = [
+                    i
+                    for i in sorted(pending)
+                    if len(copies[i]) == 1
+                    and copies[i][0].running
+                    and now - run_starts[id(copies[i][0])] > threshold
+                ]
+                if stragglers:
+                    logger.warning(
+                        f'{wrapper_func.__name__}: re-launching {len(stragglers)} straggling '
+                        f'task(s) that ran longer than {threshold:.0f}s: {stragglers}, '
+                        f'activation ID(s): {[copies[i][0].activation_id for i in stragglers]}'
+                    )
+                    with self._invoke_lock:
+                        speculative_futures = executor.map(
+                            wrapper_func,
+                            [func_args[i] for i in stragglers],
+                            runtime_memory=runtime_memory,
+                            **lithops_kwargs,
+                        )
+                    for i, future in zip(stragglers, speculative_futures):
+                        copies[i].append(future)
+
+            if pending:
+                time.sleep(SPECULATION_POLL_INTERVAL)
+
+        if any(len(fs) > 1 for fs in copies):
+            # `get_result` cleans up each job, which can block until the losing copies finish.
+            # Their temporary data is left for `Executor.clean` instead.
+            return [future.result(internal_storage=executor.internal_storage) for future in futures]
+        return executor.get_result(futures)
+
+    def _map_planned(
+        self,
+        func: Callable[..., TRet],
+        func_args: Sequence,
+        cost_factors: pd.DataFrame,
+        task_memory: np.ndarray,
+        task_times: np.ndarray,
+        **kwargs,
+    ) -> List[TRet]:
+        """Runs each group of jobs with the same planned memory as a separate `map`.
+        Groups that need different executors run concurrently. Groups for the same executor run
+        one after another, longest predicted time first, so that they don't compete for workers."""
+        tier_idxs = defaultdict(list)
+        for idx, memory in enumerate(task_memory.tolist()):
+            tier_idxs[memory].append(idx)
+        tiers = sorted(tier_idxs.items(), key=lambda tier: -task_times[tier[1]].max())
+        logger.info(
+            f'Planned {func.__name__}: '
+            + ', '.join(f'{len(idxs)} items with {memory}MB' for memory, idxs in tiers)
+            + f', predicted max time {task_times.max():.0f}s'
+        )
+
+        executor_tiers = defaultdict(list)
+        for memory, idxs in tiers:
+            executor_tiers[self._executor_type(memory, kwargs['debug_run_locally'])].append(
+                (memory, idxs)
+            )
+
+        results: List = [None] * len(func_args)
+
+        def run_executor_tiers(tiers):
+            for memory, idxs in tiers:
+                tier_results = self.map(
+                    func,
+                    [func_args[idx] for idx in idxs],
+                    cost_factors=cost_factors.iloc[idxs].reset_index(drop=True),
+                    runtime_memory=memory,
+                    use_planner=False,
+                    **kwargs,
+                )
+                for idx, result in zip(idxs, tier_results):
+                    results[idx] = result
+
+        with ThreadPoolExecutor(len(executor_tiers)) as pool:
+            # Copy context so that logs are still captured by `capture_logs`
+            tier_futures = [
+                pool.submit(copy_context().run, run_executor_tiers, tiers)
+                for tiers in executor_tiers.values()
+            ]
+            # Raise any exceptions
+            for future in tier_futures:
+                future.result()
+
+        return results
+
+    def _executor_type(self, runtime_memory, debug_run_locally=False):
+        if self.debug_run_locally or debug_run_locally:
+            return None
+        for executor_type in self.executors:
+            if runtime_memory <= MEM_LIMITS.get(executor_type, runtime_memory):
+                return executor_type
+        return None
+
     def _select_executor(self, runtime_memory):
         valid_executors = [
             (executor_type, executor)
@@ -328,15 +601,14 @@ class Executor:
         assert valid_executors, f'Could not find an executor supporting {runtime_memory}MB'
         executor_type, executor = valid_executors[0]
         logger.debug(f'Selected executor {executor_type}')
-
-        if executor.config['lithops']['mode'] == 'standalone':
-            # Set number of parallel workers based on memory requirements
-            # Lithops>=2.2.17 can configure this via `.map(worker_processes=workers)`
-            executor.config['lithops']['workers'] = min(
-                20, MEM_LIMITS.get(executor_type) // runtime_memory
-            )
-
-        return executor
+        return executor_type, executor
+
+    def get_cost_model(self, func_name: str, factor_names: List[str]) -> Optional[CostModel]:
+        """Returns the model fitted to previous runs of `func_name` with the given cost factors,
+        if a planner was supplied and has enough data"""
+        if self._planner is None:
+            return None
+        return self._planner.get_model(func_name, factor_names)
 
     def map_unpack(self, func, args: Sequence, *, runtime_memory=None, **kwargs):
         results = self.map(func, args, runtime_memory=runtime_memory, **kwargs)
@@ -1,15 +1,22 @@
 from __future__ import annotations
 
+import json
 import logging
+import mmap
+import os
 import pickle
 from concurrent.futures import Future, ThreadPoolExecutor
-from typing import TypeVar, Generic, List, Iterable, overload, Any, Tuple, Union
+from typing import TypeVar, Generic, List, Iterable, overload, Any, Tuple, Union, Optional, Sequence
 
 import numpy as np
+import pandas as pd
 import pyarrow as pa
+from lithops.constants import LITHOPS_TEMP_DIR
 from lithops.storage import Storage
 from lithops.storage.utils import CloudObject
 
+from sm.engine.annotation.image_slab import ImageSlab
+
 logger = logging.getLogger('annotation-pipeline')
 TItem = TypeVar('TItem')
 TArg = TypeVar('TArg')
@@ -28,33 +35,674 @@ class CObj(Generic[TItem], CloudObject):
         CloudObject.__init__(self, backend, bucket, key)
 
 
-def serialize_to_file(obj, path):
+# Typed cloud object format: an 8-byte header of COBJ_MAGIC followed by a 1-byte tag for
+# the type of the payload. DataFrames and numeric numpy arrays are stored as Arrow IPC streams,
+# which can be read without copying (e.g. directly from a memory-mapped file) unless they were
+# compressed. Everything else is explicitly pickled. Data without the header was saved with
+# the legacy `pa.serialize`/pickle format and is still readable.
+COBJ_MAGIC = b'SMCOBJ1'
+COBJ_HEADER_LEN = len(COBJ_MAGIC) + 1
+COBJ_DATAFRAME = b'D'
+COBJ_NDARRAY = b'N'
+COBJ_PICKLE = b'P'
+COBJ_COMPRESSIONS = (None, 'lz4', 'zstd')
+# Pickles made with protocol 2+ always start with the PROTO opcode
+PICKLE_PROTO_OPCODE = pickle.PROTO[0]
+
+
+def _is_arrow_compatible_values(values) -> bool:
+    dtype = values.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        return _is_arrow_compatible_values(dtype.categories)
+    if dtype.kind == 'O':
+        return pd.api.types.infer_dtype(values, skipna=True) in ('string', 'empty')
+    return dtype.kind in 'biufMm'
+
+
+def _is_arrow_compatible_df(df: pd.DataFrame) -> bool:
+    """Checks that a DataFrame will be unchanged by a round trip through Arrow. Arrow would e.g.
+    convert non-string column names to strings and lists in object columns to numpy arrays."""
+    index_levels = [df.index.get_level_values(i) for i in range(df.index.nlevels)]
+    return (
+        df.columns.is_unique
+        and all(isinstance(col, str) for col in df.columns)
+        and all(name is None or isinstance(name, str) for name in df.index.names)
+        and all(_is_arrow_compatible_values(df[col]) for col in df.columns)
+        and (
+            isinstance(df.index, pd.RangeIndex)
+            or all(_is_arrow_compatible_values(level) for level in index_levels)
+        )
+    )
+
+
+def _serialize_arrow(kind: bytes, table: pa.Table, compression: Optional[str]) -> bytes:
+    options = pa.ipc.IpcWriteOptions(compression=compression)
+
+    def write(sink):
+        sink.write(COBJ_MAGIC + kind)
+        with pa.ipc.new_stream(sink, table.schema, options=options) as writer:
+            writer.write_table(table)
+
+    if compression is not None:
+        sink = pa.BufferOutputStream()
+        write(sink)
+        return sink.getvalue().to_pybytes()
+
+    # Uncompressed output is cheap to measure in advance. Writing into a pre-allocated buffer is
+    # several times faster than letting BufferOutputStream repeatedly grow its buffer.
+    mock_sink = pa.MockOutputStream()
+    write(mock_sink)
+    buf = pa.allocate_buffer(mock_sink.size())
+    write(pa.FixedSizeBufferWriter(buf))
+    return buf.to_pybytes()
+
+
+def _ndarray_to_table(arr: np.ndarray) -> pa.Table:
+    arr = np.require(arr, arr.dtype.newbyteorder('='), 'C')
+    metadata = {'shape': json.dumps(arr.shape)}
+    return pa.table({'values': arr.reshape(-1)}).replace_schema_metadata(metadata)
+
+
+def _table_to_ndarray(table: pa.Table) -> np.ndarray:
+    shape = json.loads(table.schema.metadata[b'shape'])
+    values = table.column('values')
+    if values.num_chunks == 1:
+        arr = values.chunk(0).to_numpy(zero_copy_only=False)
+    else:
+        arr = values.to_numpy()
+    return arr.reshape(shape)
+
+
+def serialize(obj, compression: Optional[str] = None) -> bytes:
+    """Serializes an object in the typed cloud object format.
+
+    Args:
+        obj: Any picklable object. DataFrames and numeric numpy arrays are stored in the more
+            efficient Arrow IPC format if they can be round-tripped through Arrow unchanged.
+        compression: 'lz4' or 'zstd' to compress Arrow payloads. Compressed payloads can't be
+            deserialized without copying, so this is only worthwhile for objects that are
+            transferred over a slow network.
+    """
+    assert compression in COBJ_COMPRESSIONS, f'Unsupported compression: {compression}'
+    try:
+        # Exact type checks, as subclasses wouldn't be restored as their own type
+        # pylint: disable=unidiomatic-typecheck
+        if type(obj) is pd.DataFrame and _is_arrow_compatible_df(obj):
+            table = pa.Table.from_pandas(obj, preserve_index=None)
+            return _serialize_arrow(COBJ_DATAFRAME, table, compression)
+        if type(obj) is np.ndarray and obj.dtype.kind in 'biuf':
+            return _serialize_arrow(COBJ_NDARRAY, _ndarray_to_table(obj), compression)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        logger.debug(f'Falling back to pickle for unsupported {type(obj).__name__}', exc_info=True)
+
+    return COBJ_MAGIC + COBJ_PICKLE + pickle.dumps(obj, protocol=5)
+
+
+def _deserialize_legacy(data):
+    if len(data) > 0 and data[0] == PICKLE_PROTO_OPCODE:
+        return pickle.loads(data)
+    try:
+        return pa.deserialize(data)
+    except pa.lib.ArrowInvalid:
+        return pickle.loads(data)
+
+
+def deserialize(data):
+    """Deserializes an object saved by `serialize`, or in the legacy format.
+    `data` can be any bytes-like object. DataFrames and numpy arrays from uncompressed Arrow
+    payloads are backed by `data` without copying, and are therefore read-only."""
+    if bytes(data[: len(COBJ_MAGIC)]) != COBJ_MAGIC:
+        return _deserialize_legacy(data)
+
+    kind = bytes(data[len(COBJ_MAGIC) : COBJ_HEADER_LEN])
+    if kind == COBJ_PICKLE:
+        return pickle.loads(memoryview(data)[COBJ_HEADER_LEN:])
+
+    table = pa.ipc.open_stream(pa.py_buffer(data).slice(COBJ_HEADER_LEN)).read_all()
+    if kind == COBJ_DATAFRAME:
+        return table.to_pandas(split_blocks=True)
+    if kind == COBJ_NDARRAY:
+        return _table_to_ndarray(table)
+    raise ValueError(f'Unknown cloud object type: {kind!r}')
+
+
+def serialize_to_file(obj, path, compression: Optional[str] = None):
     with open(path, 'wb') as file:
-        file.write(pa.serialize(obj).to_buffer())
+        file.write(serialize(obj, compression))
 
 
 def deserialize_from_file(path):
+    """Deserializes an object from a memory map of the file at `path`. Arrow payloads stay backed
+    by the memory map, so the file must not be modified in-place while they're still in use."""
     with open(path, 'rb') as file:
-        data = pa.deserialize(file.read())
+        if os.fstat(file.fileno()).st_size == 0:
+            return deserialize(b'')
+        # The memory map isn't explicitly closed, as that would fail while any objects are still
+        # backed by it. It's closed when it's garbage collected.
+        return deserialize(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+# Columnar dataset segment format: a fixed-size header, a sparse m/z index with the m/z of every
+# DS_SEGM_INDEX_STEP-th row, then the raw mz, int and sp_i columns. Sections are aligned to
+# DS_SEGM_ALIGN bytes so that they can be used in-place, e.g. from a memory map, and the rows of
+# any m/z range can be located with a small ranged read of the index.
+DS_SEGM_MAGIC = b'SMDSSEG1'
+DS_SEGM_ALIGN = 64
+DS_SEGM_INDEX_STEP = 1024
+DS_SEGM_HEADER = np.dtype(
+    [
+        ('magic', 'S8'),
+        ('n_rows', '<u8'),
+        ('first_row', '<u8'),
+        ('mz_dtype', 'S8'),
+        ('index_step', '<u8'),
+        ('index_offset', '<u8'),
+        ('mz_offset', '<u8'),
+        ('int_offset', '<u8'),
+        ('sp_i_offset', '<u8'),
+        ('size', '<u8'),
+    ]
+)
+DS_SEGM_INT_DTYPE = np.dtype('<f4')
+DS_SEGM_SP_I_DTYPE = np.dtype('<u4')
+
+
+def _align(offset):
+    return -(-offset // DS_SEGM_ALIGN) * DS_SEGM_ALIGN
+
+
+def serialize_ds_segm(mzs: np.ndarray, ints: np.ndarray, sp_inds: np.ndarray, first_row=0):
+    """Serializes a dataset segment in the columnar format. `mzs` must be sorted."""
+    mz_dtype = np.dtype(mzs.dtype).newbyteorder('<')
+    index = mzs[::DS_SEGM_INDEX_STEP]
+    index_offset = _align(DS_SEGM_HEADER.itemsize)
+    mz_offset = _align(index_offset + len(index) * mz_dtype.itemsize)
+    int_offset = _align(mz_offset + len(mzs) * mz_dtype.itemsize)
+    sp_i_offset = _align(int_offset + len(ints) * DS_SEGM_INT_DTYPE.itemsize)
+    size = sp_i_offset + len(sp_inds) * DS_SEGM_SP_I_DTYPE.itemsize
+
+    data = bytearray(size)
+    header = np.frombuffer(data, DS_SEGM_HEADER, 1)
+    header[0] = (
+        DS_SEGM_MAGIC,
+        len(mzs),
+        first_row,
+        mz_dtype.str.encode(),
+        DS_SEGM_INDEX_STEP,
+        index_offset,
+        mz_offset,
+        int_offset,
+        sp_i_offset,
+        size,
+    )
+    np.frombuffer(data, mz_dtype, len(index), index_offset)[:] = index
+    np.frombuffer(data, mz_dtype, len(mzs), mz_offset)[:] = mzs
+    np.frombuffer(data, DS_SEGM_INT_DTYPE, len(ints), int_offset)[:] = ints
+    np.frombuffer(data, DS_SEGM_SP_I_DTYPE, len(sp_inds), sp_i_offset)[:] = sp_inds
     return data
 
 
-def serialize(obj):
-    try:
-        return pa.serialize(obj).to_buffer().to_pybytes()
-    except pa.lib.SerializationCallbackError:
-        return pickle.dumps(obj)
+def _parse_ds_segm_header(data) -> Optional[np.void]:
+    if len(data) < DS_SEGM_HEADER.itemsize or bytes(data[: len(DS_SEGM_MAGIC)]) != DS_SEGM_MAGIC:
+        return None
+    return np.frombuffer(data, DS_SEGM_HEADER, 1)[0]
+
+
+def _ds_segm_index_len(header: np.void) -> int:
+    return -(-int(header['n_rows']) // int(header['index_step']))
+
+
+def deserialize_ds_segm(data) -> pd.DataFrame:
+    """Deserializes a dataset segment saved either in the columnar format or as a DataFrame.
+    Columnar segments aren't copied, e.g. `deserialize_ds_segm(mmap.mmap(...))`
+    returns a DataFrame backed by the memory-mapped file."""
+    header = _parse_ds_segm_header(data)
+    if header is None:
+        return deserialize(data)
+
+    n_rows, first_row = int(header['n_rows']), int(header['first_row'])
+    mz_dtype = np.dtype(header['mz_dtype'].decode())
+    return pd.DataFrame(
+        {
+            'mz': np.frombuffer(data, mz_dtype, n_rows, int(header['mz_offset'])),
+            'int': np.frombuffer(data, DS_SEGM_INT_DTYPE, n_rows, int(header['int_offset'])),
+            'sp_i': np.frombuffer(data, DS_SEGM_SP_I_DTYPE, n_rows, int(header['sp_i_offset'])),
+        },
+        index=pd.RangeIndex(first_row, first_row + n_rows),
+        copy=False,
+    )
+
+
+def save_ds_segm(
+    storage: Storage, mzs: np.ndarray, ints: np.ndarray, sp_inds: np.ndarray, first_row=0
+) -> CObj[pd.DataFrame]:
+    data = serialize_ds_segm(mzs, ints, sp_inds, first_row)
+    # Some storage backends only accept bytes
+    return storage.put_cloudobject(bytes(data))
+
+
+def load_ds_segm(storage: Storage, cobj: CloudObject) -> pd.DataFrame:
+    """Loads a dataset segment saved with either `save_ds_segm` or `save_cobj`"""
+    return deserialize_ds_segm(storage.get_cloudobject(cobj))
+
+
+def load_ds_segm_index(storage: Storage, cobj: CloudObject) -> Optional[Tuple[np.void, np.ndarray]]:
+    """Reads only the header and sparse m/z index of a columnar dataset segment.
+    Returns None for segments in other formats."""
+    [header_data] = get_ranges_from_cobject(storage, cobj, [(0, DS_SEGM_HEADER.itemsize)])
+    header = _parse_ds_segm_header(header_data)
+    if header is None:
+        return None
+    index_start = int(header['index_offset'])
+    index_dtype = np.dtype(header['mz_dtype'].decode())
+    index_end = index_start + _ds_segm_index_len(header) * index_dtype.itemsize
+    if index_end == index_start:
+        return header, np.zeros(0, dtype=index_dtype)
+    [index_data] = get_ranges_from_cobject(storage, cobj, [(index_start, index_end)])
+    return header, np.frombuffer(index_data, index_dtype)
+
+
+def ds_segm_rows_in_mz_range(header: np.void, index: np.ndarray, mz_lo, mz_hi) -> Tuple[int, int]:
+    """Uses a segment's sparse m/z index to find a range of rows that includes all rows with
+    `mz_lo <= mz <= mz_hi`. The range can include up to `index_step` extra rows at each end."""
+    index_step, n_rows = int(header['index_step']), int(header['n_rows'])
+    row_lo = max(int(np.searchsorted(index, mz_lo, 'left')) - 1, 0) * index_step
+    row_hi = min(int(np.searchsorted(index, mz_hi, 'right')) * index_step, n_rows)
+    return row_lo, max(row_lo, row_hi)
+
+
+def _read_into(stream, buffer: memoryview) -> int:
+    """Fills `buffer` from a file-like `stream`, without intermediate copies if possible.
+    Returns the number of bytes read, which is less than `len(buffer)` only if the stream ended."""
+    pos = 0
+    readinto = getattr(stream, 'readinto', None)
+    while pos < len(buffer):
+        if readinto is not None:
+            n_read = readinto(buffer[pos:])
+        else:
+            chunk = stream.read(min(len(buffer) - pos, 8 * 2 ** 20))
+            n_read = len(chunk)
+            buffer[pos : pos + n_read] = chunk
+        if not n_read:
+            break
+        pos += n_read
+    return pos
+
+
+def _read_exactly_into(stream, buffer: memoryview):
+    n_read = _read_into(stream, buffer)
+    if n_read < len(buffer):
+        raise EOFError(f'Expected {len(buffer) - n_read} more bytes')
+
+
+def load_ds_segms(
+    storage: Storage,
+    cobjs: List[CloudObject],
+    segm_lens: List[int],
+    mz_dtype,
+    mz_range: Optional[Tuple[float, float]] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Loads consecutive dataset segments into one pre-allocated array per column, returned as
+    (mzs, ints, sp_inds). Columnar segments are streamed directly into the arrays, segments in
+    other formats are deserialized one at a time.
+
+    If `mz_range` is specified, only rows with `mz_range[0] <= mz <= mz_range[1]` are returned.
+    As the segments are sorted by m/z, only the first and last segments can contain rows outside
+    of this range. For these segments, the sparse m/z index is used to download only
+    the needed rows."""
+    row_ranges = [(0, int(segm_len)) for segm_len in segm_lens]
+    headers: List[Optional[np.void]] = [None] * len(cobjs)
+    if mz_range is not None and len(cobjs) > 0:
+        for segm_i in sorted({0, len(cobjs) - 1}):
+            header_index = load_ds_segm_index(storage, cobjs[segm_i])
+            if header_index is not None:
+                headers[segm_i] = header_index[0]
+                row_ranges[segm_i] = ds_segm_rows_in_mz_range(*header_index, *mz_range)
+
+    bounds = np.cumsum([0] + [row_hi - row_lo for row_lo, row_hi in row_ranges])
+    mzs = np.empty(bounds[-1], dtype=mz_dtype)
+    ints = np.empty(bounds[-1], dtype=DS_SEGM_INT_DTYPE)
+    sp_inds = np.empty(bounds[-1], dtype=DS_SEGM_SP_I_DTYPE)
+
+    def load_segm(args):
+        cobj, segm_len, header, (row_lo, row_hi), start, end = args
+        if row_hi - row_lo < segm_len:
+            load_segm_rows(cobj, header, row_lo, row_hi, start, end)
+            return
+
+        stream = storage.get_object(cobj.bucket, cobj.key, stream=True)
+        header_data = bytearray(DS_SEGM_HEADER.itemsize)
+        n_read = _read_into(stream, memoryview(header_data))
+        header = _parse_ds_segm_header(header_data)
+        if header is None:
+            segm_df = deserialize(bytes(header_data[:n_read]) + stream.read())
+            assert len(segm_df) == end - start, 'unexpected ds_segm length'
+            mzs[start:end] = segm_df.mz.values
+            ints[start:end] = segm_df.int.values
+            sp_inds[start:end] = segm_df.sp_i.values
+            return
+
+        assert header['n_rows'] == end - start, 'unexpected ds_segm length'
+        assert np.dtype(header['mz_dtype'].decode()) == mzs.dtype, 'unexpected ds_segm mz dtype'
+        pos = DS_SEGM_HEADER.itemsize
+        for offset, arr in [
+            (header['mz_offset'], mzs),
+            (header['int_offset'], ints),
+            (header['sp_i_offset'], sp_inds),
+        ]:
+            # Skip the index and alignment padding
+            _read_exactly_into(stream, memoryview(bytearray(int(offset) - pos)))
+            _read_exactly_into(stream, memoryview(arr[start:end]).cast('B'))
+            pos = int(offset) + (end - start) * arr.itemsize
+
+    def load_segm_rows(cobj, header, row_lo, row_hi, start, end):
+        if row_lo == row_hi:
+            return
+        assert np.dtype(header['mz_dtype'].decode()) == mzs.dtype, 'unexpected ds_segm mz dtype'
+        columns = [
+            (int(header['mz_offset']), mzs),
+            (int(header['int_offset']), ints),
+            (int(header['sp_i_offset']), sp_inds),
+        ]
+        ranges = [
+            (offset + row_lo * arr.itemsize, offset + row_hi * arr.itemsize)
+            for offset, arr in columns
+        ]
+        for (_, arr), data in zip(columns, get_ranges_from_cobject(storage, cobj, ranges)):
+            arr[start:end] = np.frombuffer(data, arr.dtype)
+
+    with ThreadPoolExecutor(4) as pool:
+        list(
+            pool.map(load_segm, zip(cobjs, segm_lens, headers, row_ranges, bounds[:-1], bounds[1:]))
+        )
+
+    if mz_range is not None:
+        # Drop the extra rows included due to the granularity of the index
+        start = np.searchsorted(mzs, mz_range[0], 'left')
+        end = np.searchsorted(mzs, mz_range[1], 'right')
+        mzs, ints, sp_inds = mzs[start:end], ints[start:end], sp_inds[start:end]
+
+    return mzs, ints, sp_inds
+
+
+# Image slab chunk format: a fixed-size header and a directory with the formula indexes,
+# theoretical peak intensities and image offsets of the ImageSlab, followed by compressed blocks of
+# the images of consecutive formulas. The blocks are listed in the directory, so that the images
+# of a few formulas can be loaded with ranged reads of only the directory and their blocks.
+# In each block, the pixel indexes of each image are sorted and delta-encoded, and the bytes of
+# the intensities are shuffled so that the similar high-order bytes of floats are adjacent.
+IMAGE_SLAB_MAGIC = b'SMIMGSL1'
+IMAGE_SLAB_BLOCK_SIZE = 64 * 1024
+IMAGE_SLAB_CODEC = 'zstd'
+IMAGE_SLAB_HEADER = np.dtype(
+    [
+        ('magic', 'S8'),
+        ('n_formulas', '<u8'),
+        ('n_peaks', '<u8'),
+        ('nrows', '<u8'),
+        ('ncols', '<u8'),
+        ('ints_dtype', 'S8'),
+        ('codec', 'S8'),
+        ('n_blocks', '<u8'),
+        ('formula_is_offset', '<u8'),
+        ('centr_ints_offset', '<u8'),
+        ('offsets_offset', '<u8'),
+        ('blocks_offset', '<u8'),
+        ('data_offset', '<u8'),
+        ('size', '<u8'),
+    ]
+)
+IMAGE_SLAB_PIXEL_DTYPE = np.dtype('<u4')
+
+
+def _sort_image_pixels(image_slab: ImageSlab) -> Tuple[np.ndarray, np.ndarray]:
+    image_ids = np.repeat(np.arange(len(image_slab.offsets) - 1), np.diff(image_slab.offsets))
+    order = np.lexsort((image_slab.pixel_inds, image_ids))
+    return image_slab.pixel_inds[order].astype(IMAGE_SLAB_PIXEL_DTYPE), image_slab.ints[order]
+
+
+def _delta_encode(pixel_inds: np.ndarray, image_starts: np.ndarray) -> np.ndarray:
+    """Replaces each pixel index with its difference from the previous pixel index in the same
+    image. The first pixel index of each image is kept as-is."""
+    deltas = pixel_inds.copy()
+    deltas[1:] -= pixel_inds[:-1]
+    image_starts = image_starts[image_starts < len(pixel_inds)]
+    deltas[image_starts] = pixel_inds[image_starts]
+    return deltas
+
+
+def _delta_decode(deltas: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    sums = np.cumsum(deltas, dtype=np.int64)
+    sizes = np.diff(offsets)
+    starts = offsets[:-1][sizes > 0]
+    sums_before_image = sums[starts] - deltas[starts]
+    return (sums - np.repeat(sums_before_image, sizes[sizes > 0])).astype(IMAGE_SLAB_PIXEL_DTYPE)
+
+
+def _split_image_slab_blocks(image_slab: ImageSlab, value_size: int) -> np.ndarray:
+    """Returns the formula positions where blocks start, plus the end position"""
+    formula_ends = image_slab.offsets[:: image_slab.n_peaks][1:] * value_size
+    bounds = [0]
+    while bounds[-1] < image_slab.n_formulas:
+        start_size = image_slab.offsets[bounds[-1] * image_slab.n_peaks] * value_size
+        end = np.searchsorted(formula_ends, start_size + IMAGE_SLAB_BLOCK_SIZE, 'left') + 1
+        bounds.append(min(max(end, bounds[-1] + 1), image_slab.n_formulas))
+    return np.array(bounds, dtype=np.int64)
+
+
+def serialize_image_slab(image_slab: ImageSlab) -> bytes:
+    """Serializes an ImageSlab in the compressed image slab chunk format"""
+    # pylint: disable=too-many-locals
+    ints_dtype = np.dtype(image_slab.ints.dtype).newbyteorder('<')
+    value_size = IMAGE_SLAB_PIXEL_DTYPE.itemsize + ints_dtype.itemsize
+    offsets = image_slab.offsets.astype(np.int64)
+    pixel_inds, ints = _sort_image_pixels(image_slab)
+    deltas = _delta_encode(pixel_inds, offsets[:-1])
+    ints = ints.astype(ints_dtype)
+
+    formula_bounds = _split_image_slab_blocks(image_slab, value_size)
+    blocks = []
+    for start, end in zip(formula_bounds[:-1], formula_bounds[1:]):
+        val_lo, val_hi = offsets[start * image_slab.n_peaks], offsets[end * image_slab.n_peaks]
+        # Shuffle the bytes of the intensities by transposing them
+        int_bytes = ints[val_lo:val_hi].view(np.uint8)
+        int_bytes = int_bytes.reshape(val_hi - val_lo, ints_dtype.itemsize).T
+        raw = deltas[val_lo:val_hi].tobytes() + np.ascontiguousarray(int_bytes).tobytes()
+        blocks.append(pa.compress(raw, codec=IMAGE_SLAB_CODEC, asbytes=True))
+    block_offsets = np.append(0, np.cumsum([len(block) for block in blocks], dtype=np.int64))
+
+    formula_is_offset = _align(IMAGE_SLAB_HEADER.itemsize)
+    centr_ints_offset = _align(formula_is_offset + image_slab.n_formulas * 8)
+    offsets_offset = _align(centr_ints_offset + image_slab.centr_ints.size * 8)
+    blocks_offset = _align(offsets_offset + len(offsets) * 8)
+    data_offset = _align(blocks_offset + 2 * len(block_offsets) * 8)
+    size = data_offset + int(block_offsets[-1])
+
+    data = bytearray(size)
+    header = np.frombuffer(data, IMAGE_SLAB_HEADER, 1)
+    header[0] = (
+        IMAGE_SLAB_MAGIC,
+        image_slab.n_formulas,
+        image_slab.n_peaks,
+        image_slab.nrows,
+        image_slab.ncols,
+        ints_dtype.str.encode(),
+        IMAGE_SLAB_CODEC.encode(),
+        len(blocks),
+        formula_is_offset,
+        centr_ints_offset,
+        offsets_offset,
+        blocks_offset,
+        data_offset,
+        size,
+    )
+    for offset, arr in [
+        (formula_is_offset, image_slab.formula_is.astype('<i8')),
+        (centr_ints_offset, image_slab.centr_ints.astype('<f8').ravel()),
+        (offsets_offset, offsets.astype('<i8')),
+        (blocks_offset, np.stack([formula_bounds, block_offsets]).astype('<i8').ravel()),
+    ]:
+        data[offset : offset + arr.nbytes] = arr.tobytes()
+    for block, block_offset in zip(blocks, block_offsets):
+        data[data_offset + block_offset : data_offset + block_offset + len(block)] = block
+    return bytes(data)
+
+
+def _parse_image_slab_header(data) -> Optional[np.void]:
+    if (
+        len(data) < IMAGE_SLAB_HEADER.itemsize
+        or bytes(data[: len(IMAGE_SLAB_MAGIC)]) != IMAGE_SLAB_MAGIC
+    ):
+        return None
+    return np.frombuffer(data, IMAGE_SLAB_HEADER, 1)[0]
+
+
+def _image_slab_directory_range(header: np.void) -> Tuple[int, int]:
+    return int(header['formula_is_offset']), int(header['data_offset'])
+
+
+def _parse_image_slab_directory(header: np.void, data, start=0):
+    """Returns (formula_is, centr_ints, offsets, formula_bounds, block_offsets) from `data`,
+    which contains the serialized image slab from byte `start` onwards"""
+    n_formulas, n_peaks = int(header['n_formulas']), int(header['n_peaks'])
+    n_blocks = int(header['n_blocks'])
+
+    def read(offset, dtype, count):
+        return np.frombuffer(data, dtype, count, int(offset) - start)
+
+    formula_is = read(header['formula_is_offset'], '<i8', n_formulas)
+    centr_ints = read(header['centr_ints_offset'], '<f8', n_formulas * n_peaks)
+    offsets = read(header['offsets_offset'], '<i8', n_formulas * n_peaks + 1)
+    blocks = read(header['blocks_offset'], '<i8', 2 * (n_blocks + 1)).reshape(2, -1)
+    return formula_is, centr_ints.reshape(n_formulas, n_peaks), offsets, blocks[0], blocks[1]
+
+
+def _decode_image_slab_blocks(header, directory, block_datas, block_idxs) -> ImageSlab:
+    # pylint: disable=too-many-locals
+    formula_is, centr_ints, offsets, formula_bounds, _ = directory
+    n_peaks = int(header['n_peaks'])
+    ints_dtype = np.dtype(header['ints_dtype'].decode())
+    codec = header['codec'].decode()
+
+    slabs = []
+    for block_i, block_data in zip(block_idxs, block_datas):
+        start, end = formula_bounds[block_i], formula_bounds[block_i + 1]
+        block_offsets = offsets[start * n_peaks : end * n_peaks + 1] - offsets[start * n_peaks]
+        n_values = int(block_offsets[-1])
+        raw = pa.decompress(
+            block_data,
+            decompressed_size=n_values * (IMAGE_SLAB_PIXEL_DTYPE.itemsize + ints_dtype.itemsize),
+            codec=codec,
+        )
+        deltas = np.frombuffer(raw, IMAGE_SLAB_PIXEL_DTYPE, n_values)
+        int_bytes = np.frombuffer(
+            raw, np.uint8, n_values * ints_dtype.itemsize, n_values * deltas.itemsize
+        )
+        ints = int_bytes.reshape(ints_dtype.itemsize, n_values).T.copy().view(ints_dtype).ravel()
+        slabs.append(
+            ImageSlab(
+                formula_is=formula_is[start:end],
+                centr_ints=centr_ints[start:end],
+                offsets=block_offsets,
+                pixel_inds=_delta_decode(deltas, block_offsets),
+                ints=ints.astype(ints_dtype.newbyteorder('=')),
+                nrows=int(header['nrows']),
+                ncols=int(header['ncols']),
+            )
+        )
+
+    if not slabs:
+        return ImageSlab(
+            formula_is=formula_is[:0],
+            centr_ints=centr_ints[:0],
+            offsets=np.zeros(1, dtype=np.int64),
+            pixel_inds=np.zeros(0, dtype=IMAGE_SLAB_PIXEL_DTYPE),
+            ints=np.zeros(0, dtype=ints_dtype.newbyteorder('=')),
+            nrows=int(header['nrows']),
+            ncols=int(header['ncols']),
+        )
+    return ImageSlab.concat(slabs)
+
+
+def deserialize_image_slab(data) -> ImageSlab:
+    """Deserializes an ImageSlab saved either in the image slab chunk format or with `serialize`.
+    The pixels of each image are sorted by pixel index."""
+    header = _parse_image_slab_header(data)
+    if header is None:
+        return deserialize(data)
+
+    directory = _parse_image_slab_directory(header, data)
+    data_offset = int(header['data_offset'])
+    block_offsets = directory[4]
+    block_datas = [
+        memoryview(data)[data_offset + lo : data_offset + hi]
+        for lo, hi in zip(block_offsets[:-1], block_offsets[1:])
+    ]
+    return _decode_image_slab_blocks(header, directory, block_datas, range(len(block_datas)))
+
+
+def save_image_slab(storage: Storage, image_slab: ImageSlab) -> CObj[ImageSlab]:
+    return storage.put_cloudobject(serialize_image_slab(image_slab))
+
+
+def load_image_slab(
+    storage: Storage, cobj: CObj[ImageSlab], formula_is: Optional[Sequence[int]] = None
+) -> ImageSlab:
+    """Loads an ImageSlab saved with either `save_image_slab` or `save_cobj`.
+
+    If `formula_is` is specified, only the images of these formulas are returned, in the same
+    order. For slabs in the chunk format, only the header, the directory and the blocks containing
+    these formulas are downloaded and decompressed."""
+    if formula_is is None:
+        return deserialize_image_slab(storage.get_cloudobject(cobj))
+
+    [header_data] = get_ranges_from_cobject(storage, cobj, [(0, IMAGE_SLAB_HEADER.itemsize)])
+    header = _parse_image_slab_header(header_data)
+    if header is None:
+        image_slab = load_cobj(storage, cobj)
+        return image_slab.take(image_slab.positions(formula_is))
+
+    dir_start, dir_end = _image_slab_directory_range(header)
+    [dir_data] = get_ranges_from_cobject(storage, cobj, [(dir_start, dir_end)])
+    directory = _parse_image_slab_directory(header, dir_data, dir_start)
+    slab_formula_is, _, _, formula_bounds, block_offsets = directory
+
+    order = np.argsort(slab_formula_is, kind='stable')
+    positions = order[np.searchsorted(slab_formula_is, formula_is, sorter=order)]
+    block_idxs = np.unique(np.searchsorted(formula_bounds, positions, 'right') - 1)
+    data_offset = int(header['data_offset'])
+    block_ranges = [
+        (data_offset + int(block_offsets[i]), data_offset + int(block_offsets[i + 1]))
+        for i in block_idxs
+    ]
+    block_datas = get_ranges_from_cobject(storage, cobj, block_ranges) if block_ranges else []
 
+    image_slab = _decode_image_slab_blocks(header, directory, block_datas, block_idxs)
+    return image_slab.take(image_slab.positions(formula_is))
 
-def deserialize(data):
-    try:
-        return pa.deserialize(data)
-    except pa.lib.ArrowInvalid:
-        return pickle.loads(data)
+
+def _get_local_path(storage: Storage, bucket: str, key: str) -> Optional[str]:
+    """Returns the path of an object if it's in localhost storage"""
+    if storage.backend != 'localhost':
+        return None
+    return os.path.join(LITHOPS_TEMP_DIR, bucket, key)
 
 
-def save_cobj(storage: Storage, obj: TItem, bucket: str = None, key: str = None) -> CObj[TItem]:
-    return storage.put_cloudobject(serialize(obj), bucket, key)
+def save_cobj(
+    storage: Storage,
+    obj: TItem,
+    bucket: str = None,
+    key: str = None,
+    compression: Optional[str] = None,
+) -> CObj[TItem]:
+    data = serialize(obj, compression)
+    if key is not None:
+        # localhost storage overwrites files in-place. Remove the old file first, so that
+        # any objects memory-mapped from it by `load_cobj` aren't modified
+        path = _get_local_path(storage, bucket or storage.bucket, key)
+        if path is not None and os.path.isfile(path):
+            os.unlink(path)
+    return storage.put_cloudobject(data, bucket, key)
 
 
 @overload
@@ -68,16 +716,23 @@ def load_cobj(storage: Storage, cobj: CloudObject):
 
 
 def load_cobj(storage: Storage, cobj):
+    """Loads an object saved by `save_cobj`. Objects in localhost storage are memory-mapped,
+    so that Arrow payloads don't need to be copied into memory."""
     try:
+        path = _get_local_path(storage, cobj.bucket, cobj.key)
+        if path is not None and os.path.isfile(path):
+            return deserialize_from_file(path)
         return deserialize(storage.get_cloudobject(cobj))
     except Exception:
         logger.error(f'Failed to deserialize {cobj}')
         raise
 
 
-def save_cobjs(storage: Storage, objs: Iterable[TItem]) -> List[CObj[TItem]]:
+def save_cobjs(
+    storage: Storage, objs: Iterable[TItem], compression: Optional[str] = None
+) -> List[CObj[TItem]]:
     with ThreadPoolExecutor() as pool:
-        return list(pool.map(lambda obj: save_cobj(storage, obj), objs))
+        return list(pool.map(lambda obj: save_cobj(storage, obj, compression=compression), objs))
 
 
 @overload
@@ -135,6 +790,19 @@ def iter_cobjs_with_prefetch(
     return _iter_with_prefetch(lambda cobj: load_cobj(storage, cobj), cobjs, prefetch)
 
 
+def iter_image_slabs_with_prefetch(
+    storage: Storage,
+    cobjs: List[CObj[ImageSlab]],
+    formula_is_lists: List[Sequence[int]],
+    prefetch=1,
+) -> Iterable[ImageSlab]:
+    """Lazily loads the images of the formulas in `formula_is_lists[i]` from `cobjs[i]`,
+    prefetching up to `prefetch` items ahead."""
+    return _iter_with_prefetch(
+        lambda args: load_image_slab(storage, *args), list(zip(cobjs, formula_is_lists)), prefetch
+    )
+
+
 def get_ranges_from_cobject(
     storage: Storage, cobj: CloudObject, ranges: Union[List[Tuple[int, int]], np.ndarray]
 ) -> List[bytes]:
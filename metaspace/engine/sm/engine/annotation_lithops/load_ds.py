@@ -15,12 +15,19 @@ from sm.engine.annotation_lithops.io import (
     save_cobj,
     CObj,
     get_ranges_from_cobject,
+    save_ds_segm,
+    load_ds_segm,
+    load_ds_segms,
     load_cobj,
+    DS_SEGM_INDEX_STEP,
 )
 from sm.engine.annotation_lithops.utils import get_pixel_indices
 from sm.engine.utils.perf_profile import SubtaskProfiler
 
 logger = logging.getLogger('annotation-pipeline')
+# Approximate size of the chunks that spectra are sorted in when the dataset is too large to sort
+# all at once. See `_load_ds_sorted_runs`
+SORT_RUN_SIZE_MB = 512
 
 
 def load_portable_spectrum_reader(storage: Storage, imzml_cobject: CloudObject):
@@ -69,9 +76,11 @@ def get_spectra(
         yield sp_idx, mzs.copy(), ints.copy()
 
 
-def _load_spectra(storage, imzml_reader, ibd_cobject):
+def _load_spectra(storage, imzml_reader, ibd_cobject, sp_range=None):
+    """Reads the spectra with indexes in `range(*sp_range)`, or all spectra if `sp_range` is None"""
+    first_sp, end_sp = sp_range or (0, len(imzml_reader.coordinates))
     # Pre-allocate lists of mz & int arrays
-    n_spectra = len(imzml_reader.coordinates)
+    n_spectra = end_sp - first_sp
     mz_arrays = [np.array([], dtype=imzml_reader.mzPrecision)] * n_spectra
     int_arrays = [np.array([], dtype=np.float32)] * n_spectra
     sp_lens = np.empty(n_spectra, np.int64)
@@ -79,14 +88,14 @@ def _load_spectra(storage, imzml_reader, ibd_cobject):
     def read_spectrum_chunk(start_end):
         spectra = get_spectra(storage, imzml_reader, ibd_cobject, list(range(*start_end)))
         for sp_i, mzs, ints in spectra:
-            mz_arrays[sp_i] = mzs
-            int_arrays[sp_i] = ints.astype(np.float32)
-            sp_lens[sp_i] = len(ints)
+            mz_arrays[sp_i - first_sp] = mzs
+            int_arrays[sp_i - first_sp] = ints.astype(np.float32)
+            sp_lens[sp_i - first_sp] = len(ints)
 
     # Break into approx. 100MB chunks to read in parallel
-    n_peaks = np.sum(imzml_reader.mzLengths)
-    n_chunks = min(int(np.ceil(n_peaks / (10 * 2 ** 20))), n_spectra)
-    chunk_bounds = np.linspace(0, n_spectra, n_chunks + 1, dtype=np.int64)
+    n_peaks = np.sum(imzml_reader.mzLengths[first_sp:end_sp])
+    n_chunks = max(min(int(np.ceil(n_peaks / (10 * 2 ** 20))), n_spectra), 1)
+    chunk_bounds = np.linspace(first_sp, end_sp, n_chunks + 1, dtype=np.int64)
     spectrum_chunks = zip(chunk_bounds, chunk_bounds[1:])
 
     with ThreadPoolExecutor(4) as executor:
@@ -96,7 +105,7 @@ def _load_spectra(storage, imzml_reader, ibd_cobject):
     return np.concatenate(mz_arrays), np.concatenate(int_arrays), sp_lens
 
 
-def _sort_spectra(imzml_reader, mzs, ints, sp_lens):
+def _sort_spectra(imzml_reader, mzs, ints, sp_lens, first_sp=0):
     # Specify mergesort explicitly because numpy often chooses heapsort which is super slow
     by_mz = np.argsort(mzs, kind='mergesort')
 
@@ -107,7 +116,7 @@ def _sort_spectra(imzml_reader, mzs, ints, sp_lens):
     ints[:] = ints[by_mz]
     # Build sp_idxs after sorting mzs. Sorting mzs uses the most memory, so it's best to keep
     # sp_idxs in a compacted form with sp_lens until the last minute.
-    sp_id_to_idx = get_pixel_indices(imzml_reader.coordinates)
+    sp_id_to_idx = get_pixel_indices(imzml_reader.coordinates)[first_sp : first_sp + len(sp_lens)]
     sp_idxs = np.empty(len(ints), np.uint32)
     sp_lens = np.insert(np.cumsum(sp_lens), 0, 0)
     for sp_idx, start, end in zip(sp_id_to_idx, sp_lens[:-1], sp_lens[1:]):
@@ -116,10 +125,24 @@ def _sort_spectra(imzml_reader, mzs, ints, sp_lens):
     return mzs, ints, sp_idxs
 
 
-def _upload_segments(storage, ds_segm_size_mb, imzml_reader, mzs, ints, sp_idxs):
+def _get_row_size(imzml_reader):
+    return (4 if imzml_reader.mzPrecision == 'f' else 8) + 4 + 4
+
+
+def _save_segment(storage, mzs, ints, sp_idxs, first_row, columnar):
+    if columnar:
+        return save_ds_segm(storage, mzs, ints, sp_idxs, first_row)
+    df = pd.DataFrame(
+        {'mz': mzs, 'int': ints, 'sp_i': sp_idxs},
+        index=pd.RangeIndex(first_row, first_row + len(mzs)),
+    )
+    return save_cobj(storage, df)
+
+
+def _upload_segments(storage, ds_segm_size_mb, imzml_reader, mzs, ints, sp_idxs, columnar=False):
     # Split into segments no larger than ds_segm_size_mb
     total_n_mz = len(sp_idxs)
-    row_size = (4 if imzml_reader.mzPrecision == 'f' else 8) + 4 + 4
+    row_size = _get_row_size(imzml_reader)
     segm_n = int(np.ceil(total_n_mz * row_size / (ds_segm_size_mb * 2 ** 20)))
     segm_bounds = np.linspace(0, total_n_mz, segm_n + 1, dtype=np.int64)
     segm_ranges = list(zip(segm_bounds[:-1], segm_bounds[1:]))
@@ -128,11 +151,9 @@ def _upload_segments(storage, ds_segm_size_mb, imzml_reader, mzs, ints, sp_idxs)
 
     def upload_segm(start_end):
         start, end = start_end
-        df = pd.DataFrame(
-            {'mz': mzs[start:end], 'int': ints[start:end], 'sp_i': sp_idxs[start:end]},
-            index=pd.RangeIndex(start, end),
+        return _save_segment(
+            storage, mzs[start:end], ints[start:end], sp_idxs[start:end], start, columnar
         )
-        return save_cobj(storage, df)
 
     with ThreadPoolExecutor(2) as executor:
         ds_segms_cobjs = list(executor.map(upload_segm, segm_ranges))
@@ -143,6 +164,7 @@ def _load_ds(
     imzml_cobject: CloudObject,
     ibd_cobject: CloudObject,
     ds_segm_size_mb: int,
+    ds_segm_columnar: bool,
     *,
     storage: Storage,
     perf: SubtaskProfiler,
@@ -166,15 +188,148 @@ def _load_ds(
 
     logger.info('Uploading segments')
     ds_segms_cobjs, ds_segments_bounds, ds_segm_lens = _upload_segments(
-        storage, ds_segm_size_mb, imzml_reader, mzs, ints, sp_idxs
+        storage, ds_segm_size_mb, imzml_reader, mzs, ints, sp_idxs, ds_segm_columnar
     )
     perf.record_entry('uploaded segments', n_segms=len(ds_segms_cobjs))
 
     return imzml_reader, ds_segments_bounds, ds_segms_cobjs, ds_segm_lens
 
 
+def _load_imzml_reader(imzml_cobject: CloudObject, *, storage: Storage, perf: SubtaskProfiler):
+    imzml_reader = load_portable_spectrum_reader(storage, imzml_cobject)
+    perf.record_entry('loaded imzml', n_peaks=np.sum(imzml_reader.intensityLengths))
+    return imzml_reader, save_cobj(storage, imzml_reader)
+
+
+def _sort_spectra_chunk(
+    imzml_reader_cobj: CObj[PortableSpectrumReader],
+    ibd_cobject: CloudObject,
+    first_sp: int,
+    end_sp: int,
+    *,
+    storage: Storage,
+    perf: SubtaskProfiler,
+):
+    """Sorts the peaks of a range of spectra by m/z and saves them as one columnar segment.
+    Returns the segment's length and a sample of every DS_SEGM_INDEX_STEP-th m/z."""
+    imzml_reader = load_cobj(storage, imzml_reader_cobj)
+    mzs, ints, sp_lens = _load_spectra(storage, imzml_reader, ibd_cobject, (first_sp, end_sp))
+    perf.record_entry('read spectra', n_peaks=len(mzs))
+
+    mzs, ints, sp_idxs = _sort_spectra(imzml_reader, mzs, ints, sp_lens, first_sp)
+    perf.record_entry('sorted spectra')
+
+    run_cobj = save_ds_segm(storage, mzs, ints, sp_idxs)
+    perf.record_entry('uploaded run')
+
+    return run_cobj, len(mzs), mzs[::DS_SEGM_INDEX_STEP].copy()
+
+
+def _merge_sorted_runs(
+    run_cobjs: List[CloudObject],
+    run_lens: List[int],
+    mz_lo: float,
+    mz_hi: float,
+    mz_dtype: str,
+    columnar: bool,
+    *,
+    storage: Storage,
+    perf: SubtaskProfiler,
+):
+    """Merges the peaks with `mz_lo <= mz < mz_hi` from all sorted runs into one dataset segment.
+    The segment's row index starts at 0, as the lengths of the preceding segments aren't known."""
+
+    def load_run(cobj_len):
+        cobj, run_len = cobj_len
+        mzs, ints, sp_idxs = load_ds_segms(storage, [cobj], [run_len], mz_dtype, (mz_lo, mz_hi))
+        end = np.searchsorted(mzs, mz_hi, 'left')
+        return mzs[:end], ints[:end], sp_idxs[:end]
+
+    with ThreadPoolExecutor(8) as pool:
+        pieces = list(pool.map(load_run, zip(run_cobjs, run_lens)))
+    mzs, ints, sp_idxs = [np.concatenate(col) for col in zip(*pieces)]
+    del pieces
+    perf.record_entry('loaded runs', n_peaks=len(mzs))
+
+    # The pieces are already sorted, so a stable sort just merges them. It also keeps peaks with
+    # equal m/zs in the same order as sorting all spectra at once would.
+    by_mz = np.argsort(mzs, kind='mergesort')
+    mzs, ints, sp_idxs = mzs[by_mz], ints[by_mz], sp_idxs[by_mz]
+    del by_mz
+    perf.record_entry('merged runs')
+
+    if len(mzs) == 0:
+        return None, 0, None
+    segm_cobj = _save_segment(storage, mzs, ints, sp_idxs, 0, columnar)
+    perf.record_entry('uploaded segment')
+    return segm_cobj, len(mzs), (mzs[0], mzs[-1])
+
+
+def _load_ds_sorted_runs(  # pylint: disable=too-many-locals
+    executor: Executor,
+    imzml_cobject: CloudObject,
+    ibd_cobject: CloudObject,
+    ds_segm_size_mb: int,
+    ds_segm_columnar: bool,
+):
+    """Out-of-core alternative to `_load_ds` for datasets that are too large to sort in memory.
+    Each spectrum chunk is sorted separately into a "run", then the runs are partitioned by m/z
+    and each partition is merged into one dataset segment. The partition boundaries are chosen
+    from the runs' sparse m/z indexes so that segments are approximately `ds_segm_size_mb`."""
+    imzml_reader, imzml_reader_cobj = executor.call(
+        _load_imzml_reader, (imzml_cobject,), runtime_memory=4096
+    )
+    row_size = _get_row_size(imzml_reader)
+
+    # Split spectra into chunks of approximately SORT_RUN_SIZE_MB peaks
+    n_spectra = len(imzml_reader.coordinates)
+    sp_lens_cumsum = np.cumsum(imzml_reader.mzLengths)
+    n_runs = max(int(np.ceil(sp_lens_cumsum[-1] * row_size / (SORT_RUN_SIZE_MB * 2 ** 20))), 1)
+    run_peak_bounds = np.linspace(0, sp_lens_cumsum[-1], n_runs + 1)[1:-1]
+    run_sp_bounds = np.unique(
+        np.concatenate(
+            [[0], np.searchsorted(sp_lens_cumsum, run_peak_bounds, 'left') + 1, [n_spectra]]
+        ).clip(0, n_spectra)
+    )
+    run_cobjs, run_lens, run_samples = executor.map_unpack(
+        _sort_spectra_chunk,
+        [
+            (imzml_reader_cobj, ibd_cobject, int(first_sp), int(end_sp))
+            for first_sp, end_sp in zip(run_sp_bounds[:-1], run_sp_bounds[1:])
+        ],
+        runtime_memory=4096,
+    )
+
+    # Each sample represents DS_SEGM_INDEX_STEP peaks. Pick every n-th sample as a boundary
+    samples = np.sort(np.concatenate(run_samples))
+    samples_per_segm = max(int(ds_segm_size_mb * 2 ** 20 / row_size / DS_SEGM_INDEX_STEP), 1)
+    mz_bounds = np.unique(samples[samples_per_segm::samples_per_segm])
+    mz_bounds = np.concatenate([[-np.inf], mz_bounds, [np.inf]])
+
+    segm_cobjs, segm_lens, segm_mz_ranges = executor.map_unpack(
+        _merge_sorted_runs,
+        [
+            (run_cobjs, run_lens, mz_lo, mz_hi, imzml_reader.mzPrecision, ds_segm_columnar)
+            for mz_lo, mz_hi in zip(mz_bounds[:-1], mz_bounds[1:])
+        ],
+        runtime_memory=2048,
+    )
+    executor.storage.delete_cloudobjects([imzml_reader_cobj, *run_cobjs])
+
+    non_empty = [i for i, segm_len in enumerate(segm_lens) if segm_len > 0]
+    ds_segms_cobjs = [segm_cobjs[i] for i in non_empty]
+    ds_segments_bounds = np.array([segm_mz_ranges[i] for i in non_empty]).reshape(-1, 2)
+    ds_segm_lens = np.array([segm_lens[i] for i in non_empty], dtype=np.int64)
+
+    return imzml_reader, ds_segments_bounds, ds_segms_cobjs, ds_segm_lens
+
+
 def load_ds(
-    executor: Executor, imzml_cobject: CloudObject, ibd_cobject: CloudObject, ds_segm_size_mb: int
+    executor: Executor,
+    imzml_cobject: CloudObject,
+    ibd_cobject: CloudObject,
+    ds_segm_size_mb: int,
+    ds_segm_columnar: bool = False,
 ):
     try:
         ibd_head = executor.storage.head_object(ibd_cobject.bucket, ibd_cobject.key)
@@ -188,16 +343,16 @@ def load_ds(
     # most memory-intense part (sorting the m/z array).
     if ibd_size_mb * 3 + 512 < 4096:
         logger.debug(f'Found {ibd_size_mb}MB .ibd file. Trying serverless load_ds')
-        runtime_memory = 4096
+        imzml_reader, ds_segments_bounds, ds_segms_cobjs, ds_segm_lens = executor.call(
+            _load_ds,
+            (imzml_cobject, ibd_cobject, ds_segm_size_mb, ds_segm_columnar),
+            runtime_memory=4096,
+        )
     else:
-        logger.debug(f'Found {ibd_size_mb}MB .ibd file. Using VM-based load_ds')
-        runtime_memory = 32768
-
-    imzml_reader, ds_segments_bounds, ds_segms_cobjs, ds_segm_lens = executor.call(
-        _load_ds,
-        (imzml_cobject, ibd_cobject, ds_segm_size_mb),
-        runtime_memory=runtime_memory,
-    )
+        logger.debug(f'Found {ibd_size_mb}MB .ibd file. Using sorted runs load_ds')
+        imzml_reader, ds_segments_bounds, ds_segms_cobjs, ds_segm_lens = _load_ds_sorted_runs(
+            executor, imzml_cobject, ibd_cobject, ds_segm_size_mb, ds_segm_columnar
+        )
 
     logger.info(f'Segmented dataset chunks into {len(ds_segms_cobjs)} segments')
 
@@ -206,7 +361,7 @@ def load_ds(
 
 def validate_ds_segments(fexec, imzml_reader, ds_segments_bounds, ds_segms_cobjs, ds_segm_lens):
     def get_segm_stats(cobj, storage):
-        segm = load_cobj(storage, cobj)
+        segm = load_ds_segm(storage, cobj)
         assert (
             segm.columns == ['mz', 'int', 'sp_i']
         ).all(), f'Wrong ds_segm columns: {segm.columns}'
@@ -18,6 +18,7 @@ from sm.engine.annotation_lithops.calculate_centroids import (
     calculate_centroids,
     validate_centroids,
 )
+from sm.engine.annotation_lithops.centroids_store import CentroidsStore
 from sm.engine.annotation_lithops.executor import Executor
 from sm.engine.annotation_lithops.io import (
     CObj,
@@ -131,7 +132,10 @@ def get_moldb_centroids(
         else:
             formula_cobjs, db_data_cobjs = build_moldb(executor, ds_config, moldbs)
             isocalc_wrapper = IsocalcWrapper(ds_config)
-            peaks_cobjs = calculate_centroids(executor, formula_cobjs, isocalc_wrapper)
+            centroids_store = CentroidsStore(sm_storage, isocalc_wrapper) if use_cache else None
+            peaks_cobjs = calculate_centroids(
+                executor, formula_cobjs, isocalc_wrapper, centroids_store
+            )
             if debug_validate:
                 validate_centroids(executor, peaks_cobjs)
 
@@ -1,7 +1,10 @@
 from __future__ import annotations
 
 import logging
-from typing import List, Tuple, Optional, Dict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextvars import copy_context
+from datetime import datetime
+from typing import List, Tuple, Optional, Dict, Callable, Sequence
 
 import numpy as np
 import pandas as pd
@@ -10,13 +13,20 @@ from pyimzml.ImzMLParser import PortableSpectrumReader
 
 from sm.engine.annotation_lithops.annotate import process_centr_segments
 from sm.engine.annotation_lithops.build_moldb import InputMolDb, DbFDRData
-from sm.engine.annotation_lithops.cache import PipelineCacher, use_pipeline_cache
+from sm.engine.annotation_lithops.cache import (
+    PipelineCacher,
+    TracksStageUpdates,
+    use_pipeline_cache,
+)
 from sm.engine.annotation_lithops.calculate_centroids import calculate_centroids, validate_centroids
 from sm.engine.annotation_lithops.executor import Executor
 from sm.engine.annotation_lithops.io import CObj, iter_cobjs_with_prefetch
 from sm.engine.annotation_lithops.load_ds import load_ds, validate_ds_segments
 from sm.engine.annotation_lithops.moldb_pipeline import get_moldb_centroids
-from sm.engine.annotation_lithops.prepare_results import filter_results_and_make_pngs
+from sm.engine.annotation_lithops.prepare_results import (
+    filter_results_and_make_pngs,
+    run_fdr_and_make_pngs,
+)
 from sm.engine.annotation_lithops.run_fdr import run_fdr
 from sm.engine.annotation_lithops.segment_centroids import (
     segment_centroids,
@@ -26,11 +36,12 @@ from sm.engine.db import DB
 from sm.engine.ds_config import DSConfig
 from sm.engine.annotation.isocalc_wrapper import IsocalcWrapper
 from sm.engine.config import SMConfig
+from sm.engine.utils.perf_profile import Profiler, NullProfiler
 
 logger = logging.getLogger('annotation-pipeline')
 
 
-class Pipeline:  # pylint: disable=too-many-instance-attributes
+class Pipeline(TracksStageUpdates):  # pylint: disable=too-many-instance-attributes
     formula_cobjs: List[CObj[pd.DataFrame]]
     db_data_cobjs: List[CObj[DbFDRData]]
     peaks_cobjs: List[CObj[pd.DataFrame]]
@@ -40,11 +51,13 @@ class Pipeline:  # pylint: disable=too-many-instance-attributes
     ds_segm_lens: np.ndarray
     is_intensive_dataset: bool
     db_segms_cobjs: List[CObj[pd.DataFrame]]
+    db_segms_df: pd.DataFrame
     formula_metrics_df: pd.DataFrame
     images_df: pd.DataFrame
     fdrs: Dict[int, pd.DataFrame]
     results_dfs: Dict[int, pd.DataFrame]
     png_cobjs: List[CObj[List[Tuple[int, bytes]]]]
+    cube_cobjs: List[CloudObject]
 
     def __init__(
         self,
@@ -56,7 +69,11 @@ class Pipeline:  # pylint: disable=too-many-instance-attributes
         lithops_config=None,
         cache_key=None,
         use_db_cache=True,
+        perf: Profiler = None,
+        stream_results=True,
+        png_options=None,
     ):
+        # pylint: disable=too-many-arguments
         lithops_config = lithops_config or SMConfig.get_conf()['lithops']
         self.lithops_config = lithops_config
         self._db = DB()
@@ -77,28 +94,83 @@ class Pipeline:  # pylint: disable=too-many-instance-attributes
             self.cacher = None
 
         self.use_db_cache = use_db_cache
+        self.perf = perf or NullProfiler()
+        # Start generating each database's PNGs as soon as its FDR is known, instead of running
+        # `run_fdr` and `prepare_results` as separate stages
+        self.stream_results = stream_results
+        # PngGenerator arguments, see sm.engine.annotation.png_generator.get_png_options
+        self.png_options = png_options
         self.ds_segm_size_mb = 128
+        self.ds_segm_columnar = True
 
     def __call__(
         self, debug_validate=False, use_cache=True
     ) -> Tuple[Dict[int, pd.DataFrame], List[CObj[List[Tuple[int, bytes]]]]]:
         # pylint: disable=unexpected-keyword-arg
-        self.prepare_moldb(debug_validate=debug_validate)
-
-        self.load_ds(use_cache=use_cache)
-        if debug_validate:
-            self.validate_load_ds()
-
-        self.segment_centroids(use_cache=use_cache)
-        if debug_validate:
-            self.validate_segment_centroids()
-
-        self.annotate(use_cache=use_cache)
-        self.run_fdr(use_cache=use_cache)
-        self.prepare_results(use_cache=use_cache)
+        def load_ds():
+            self.load_ds(use_cache=use_cache)
+            if debug_validate:
+                self.validate_load_ds()
+
+        def segment_centroids():
+            self.segment_centroids(use_cache=use_cache)
+            if debug_validate:
+                self.validate_segment_centroids()
+
+        stages = {
+            'prepare_moldb': ([], lambda: self.prepare_moldb(debug_validate=debug_validate)),
+            'load_ds': ([], load_ds),
+            'segment_centroids': (['prepare_moldb', 'load_ds'], segment_centroids),
+            'annotate': (['segment_centroids'], lambda: self.annotate(use_cache=use_cache)),
+        }
+        if self.stream_results:
+            stages['run_fdr_and_prepare_results'] = (
+                ['annotate'],
+                lambda: self.run_fdr_and_prepare_results(use_cache=use_cache),
+            )
+        else:
+            stages['run_fdr'] = (['annotate'], lambda: self.run_fdr(use_cache=use_cache))
+            stages['prepare_results'] = (
+                ['run_fdr'],
+                lambda: self.prepare_results(use_cache=use_cache),
+            )
+        self.run_stages(stages)
 
         return self.results_dfs, self.png_cobjs
 
+    def run_stages(self, stages: Dict[str, Tuple[Sequence[str], Callable[[], None]]]):
+        """Runs each stage as soon as all the stages it depends on have finished, so that
+        independent stages run concurrently. A perf entry is recorded for each stage.
+
+        Args:
+            stages: stage name -> (names of stages it depends on, function that runs the stage)
+        """
+
+        def run_stage(name, func):
+            start = datetime.now()
+            func()
+            self.perf.record_entry(f'{name} stage finished', start, datetime.now(), stage=name)
+
+        remaining = dict(stages)
+        finished: set = set()
+        running = {}
+        with ThreadPoolExecutor(len(stages), thread_name_prefix='pipeline') as pool:
+            while remaining or running:
+                for name, (deps, func) in list(remaining.items()):
+                    if finished.issuperset(deps):
+                        logger.debug(f'Starting stage {name}')
+                        # Copy context so that logs are still captured by `capture_logs`
+                        future = pool.submit(copy_context().run, run_stage, name, func)
+                        running[future] = name
+                        del remaining[name]
+                assert running, f'Unsatisfiable stage dependencies: {list(remaining)}'
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finished.add(running.pop(future))
+                    # Raise any exceptions. Already-running stages are allowed to finish first
+                    future.result()
+
     def prepare_moldb(self, debug_validate=False):
         self.db_data_cobjs, self.peaks_cobjs = get_moldb_centroids(
             executor=self.executor,
@@ -125,7 +197,13 @@ class Pipeline:  # pylint: disable=too-many-instance-attributes
             self.ds_segments_bounds,
             self.ds_segms_cobjs,
             self.ds_segm_lens,
-        ) = load_ds(self.executor, self.imzml_cobject, self.ibd_cobject, self.ds_segm_size_mb)
+        ) = load_ds(
+            self.executor,
+            self.imzml_cobject,
+            self.ibd_cobject,
+            self.ds_segm_size_mb,
+            self.ds_segm_columnar,
+        )
 
         self.is_intensive_dataset = len(self.ds_segms_cobjs) * self.ds_segm_size_mb > 5000
 
@@ -138,9 +216,10 @@ class Pipeline:  # pylint: disable=too-many-instance-attributes
             self.ds_segm_lens,
         )
 
-    @use_pipeline_cache
+    # Version 2 also sets db_segms_df
+    @use_pipeline_cache(version=2)
     def segment_centroids(self):
-        self.db_segms_cobjs = segment_centroids(
+        self.db_segms_cobjs, self.db_segms_df = segment_centroids(
             self.executor,
             self.peaks_cobjs,
             self.ds_segms_cobjs,
@@ -167,9 +246,9 @@ class Pipeline:  # pylint: disable=too-many-instance-attributes
             self.ds_segments_bounds,
             self.ds_segm_lens,
             self.db_segms_cobjs,
+            self.db_segms_df,
             self.imzml_reader,
             self.ds_config,
-            self.ds_segm_size_mb,
             self.is_intensive_dataset,
         )
         logger.info(f'Metrics calculated: {self.formula_metrics_df.shape[0]}')
@@ -180,13 +259,26 @@ class Pipeline:  # pylint: disable=too-many-instance-attributes
 
     @use_pipeline_cache
     def prepare_results(self):
-        self.results_dfs, self.png_cobjs = filter_results_and_make_pngs(
+        self.results_dfs, self.png_cobjs, self.cube_cobjs = filter_results_and_make_pngs(
             self.executor,
             self.formula_metrics_df,
             self.moldbs,
             self.fdrs,
             self.images_df,
             self.imzml_reader,
+            self.png_options,
+        )
+
+    @use_pipeline_cache
+    def run_fdr_and_prepare_results(self):
+        (self.fdrs, self.results_dfs, self.png_cobjs, self.cube_cobjs,) = run_fdr_and_make_pngs(
+            self.executor,
+            self.formula_metrics_df,
+            self.db_data_cobjs,
+            self.moldbs,
+            self.images_df,
+            self.imzml_reader,
+            self.png_options,
         )
 
     def clean(self, all_caches=False):
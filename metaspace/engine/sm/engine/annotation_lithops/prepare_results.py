@@ -1,53 +1,194 @@
 import logging
 from collections import defaultdict
-from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from io import BytesIO
+from threading import Lock
+from typing import BinaryIO, Dict, List, Optional, Set, Tuple
 
 import numpy as np
 import pandas as pd
 from lithops.storage import Storage
+from lithops.storage.utils import CloudObject
 from pyimzml.ImzMLParser import PortableSpectrumReader
 
 from sm.engine.annotation_lithops.annotate import make_sample_area_mask
-from sm.engine.annotation_lithops.build_moldb import InputMolDb
+from sm.engine.annotation_lithops.build_moldb import InputMolDb, DbFDRData
+from sm.engine.annotation_lithops.cost_model import CostModel
 from sm.engine.annotation_lithops.executor import Executor
-from sm.engine.annotation_lithops.io import save_cobj, iter_cobjs_with_prefetch
+from sm.engine.annotation_lithops.io import save_cobj, iter_image_slabs_with_prefetch, CObj
+from sm.engine.annotation_lithops.run_fdr import save_msms, run_fdr_for_dbs
 from sm.engine.annotation_lithops.utils import ds_dims
+from sm.engine.annotation.analysis_cube import AnalysisCubeReader, AnalysisCubeWriter
 from sm.engine.annotation.png_generator import PngGenerator
+from sm.engine.utils.perf_profile import SubtaskProfiler
 
 logger = logging.getLogger('annotation-pipeline')
 
 
-def _split_png_jobs(image_tasks_df, w, h):
-    # Guess the cost per imageset, and split into relatively even chunks.
-    # This is a quick attempt and needs review
-    # This assumes they're already sorted by cobj, and factors in:
-    # * Number of populated pixels (because very sparse images should be much faster to encode)
-    # * Total image size (because even empty pixels have some cost)
-    # * Cost of loading a new cobj
-    # * Constant overhead per image
-    cobj_keys = [cobj.key for cobj in image_tasks_df.cobj]
-    cobj_changed = np.array(
-        [(i == 0 or key == cobj_keys[i - 1]) for i, key in enumerate(cobj_keys)]
+#: Cost factors of each PNG job, from which its execution time is predicted
+PNG_COST_FACTORS = ['n_cobjs', 'n_images', 'n_pixels', 'n_image_pixels']
+#: Target execution time of each PNG job in seconds
+PNG_JOB_TIME = 60
+#: Estimated seconds per unit of each of PNG_COST_FACTORS, used until enough jobs have been
+#: recorded to fit a model. These match the original hand-tuned costs, for which jobs were sized
+#: to have 1e8 cost units each.
+DEFAULT_PNG_FACTOR_TIMES = np.array([100000, 1000, 1, 0.2]) * PNG_JOB_TIME / 1e8
+
+
+def _get_png_job_times(cost_model: Optional[CostModel]) -> Tuple[float, np.ndarray]:
+    """Returns the predicted fixed time per job and the time per unit of each of PNG_COST_FACTORS"""
+    if cost_model is not None:
+        # Negative coefficients are possible in least-squares fits, but aren't useful for splitting
+        time_coefs = np.maximum(cost_model.time_coefs, 0)
+        if time_coefs[1:].any():
+            return time_coefs[0], time_coefs[1:]
+    return 0.0, DEFAULT_PNG_FACTOR_TIMES
+
+
+def _get_png_job_bounds(
+    image_times: np.ndarray,
+    cobj_bounds: np.ndarray,
+    cobj_time: float,
+    total_time: float,
+    job_time: float,
+) -> np.ndarray:
+    """Returns the bounds of the jobs in the images, which are sorted by cobj"""
+    n_jobs = int(np.ceil(total_time / max(PNG_JOB_TIME - job_time, PNG_JOB_TIME / 2))) or 1
+    target_time = total_time / n_jobs
+
+    # Split the images into pieces that are either whole cobjs, or even parts of cobjs that are
+    # too big for a single job
+    piece_bounds = [cobj_bounds]
+    for start, end in zip(cobj_bounds[:-1], cobj_bounds[1:]):
+        cum_times = np.cumsum(image_times[start:end])
+        n_pieces = max(int(round((cum_times[-1] + cobj_time) / target_time)), 1)
+        split_times = cum_times[-1] * np.arange(1, n_pieces) / n_pieces
+        piece_bounds.append(start + np.searchsorted(cum_times, split_times))
+    piece_bounds = np.unique(np.concatenate(piece_bounds))
+    piece_times = np.add.reduceat(image_times, piece_bounds[:-1]) + cobj_time
+
+    # Group consecutive pieces into jobs based on the time at the middle of each piece
+    job_idxs = np.minimum((np.cumsum(piece_times) - piece_times / 2) // target_time, n_jobs - 1)
+    return piece_bounds[np.flatnonzero(np.diff(job_idxs, prepend=-1, append=-1))]
+
+
+def _split_png_jobs(
+    image_tasks_df: pd.DataFrame, w: int, h: int, cost_model: CostModel = None
+) -> Tuple[List[List[pd.DataFrame]], pd.DataFrame]:
+    """Splits the images into jobs that are each predicted to take about PNG_JOB_TIME seconds.
+    The number of jobs scales with the predicted total time.
+    The images of each image cobj are kept in the same job, so that no cobj is loaded by multiple
+    jobs, unless a single cobj is predicted to take much longer than PNG_JOB_TIME.
+
+    Returns the jobs and a DataFrame with the PNG_COST_FACTORS of each job."""
+    if len(image_tasks_df) == 0:
+        logger.debug('No PNG jobs generated - probably no annotations')
+        return [], pd.DataFrame(columns=PNG_COST_FACTORS)
+
+    job_time, factor_times = _get_png_job_times(cost_model)
+    cobj_time = factor_times[0]
+    cobj_idxs, _ = pd.factorize(np.array([cobj.key for cobj in image_tasks_df.cobj]))
+    order = np.argsort(cobj_idxs, kind='stable')
+    image_tasks_df, cobj_idxs = image_tasks_df.iloc[order], cobj_idxs[order]
+    n_pixels = image_tasks_df.n_pixels.values.astype(float)
+    image_times = factor_times[1] + factor_times[2] * n_pixels + factor_times[3] * w * h
+    cobj_bounds = np.flatnonzero(np.diff(cobj_idxs, prepend=-1, append=-1))
+
+    total_time = image_times.sum() + cobj_time * (len(cobj_bounds) - 1)
+    if np.isfinite(total_time) and total_time > 0:
+        job_bounds = _get_png_job_bounds(image_times, cobj_bounds, cobj_time, total_time, job_time)
+    else:
+        # The cost model can't predict anything, e.g. it was fitted to jobs that all took 0s
+        logger.warning(f'Predicted PNG time is {total_time}, making a PNG job per image cobj')
+        job_bounds = cobj_bounds
+    job_ranges = list(zip(job_bounds[:-1], job_bounds[1:]))
+    jobs = [[image_tasks_df.iloc[start:end]] for start, end in job_ranges]
+    cost_factors = pd.DataFrame(
+        {
+            'n_cobjs': [len(np.unique(cobj_idxs[start:end])) for start, end in job_ranges],
+            'n_images': np.diff(job_bounds),
+            'n_pixels': [n_pixels[start:end].sum() for start, end in job_ranges],
+            'n_image_pixels': np.diff(job_bounds) * w * h,
+        },
+        columns=PNG_COST_FACTORS,
+    )
+
+    job_times = job_time + cost_factors.values @ factor_times
+    logger.debug(
+        f'Generated {len(jobs)} PNG jobs, predicted min time: {np.min(job_times):.1f}s, '
+        f'max time: {np.max(job_times):.1f}s, total time: {np.sum(job_times):.1f}s'
     )
-    image_tasks_df['cost'] = image_tasks_df.n_pixels + (w * h) / 5 + cobj_changed * 100000 + 1000
-    total_cost = image_tasks_df.cost.sum()
-    n_jobs = int(np.ceil(np.clip(total_cost / 1e8, 1, 100)))
-    job_bound_vals = np.linspace(0, total_cost + 1, n_jobs + 1)
-    job_bound_idxs = np.searchsorted(np.cumsum(image_tasks_df.cost), job_bound_vals)
-    jobs = [
-        [image_tasks_df.iloc[start:end]]
-        for start, end in zip(job_bound_idxs[:-1], job_bound_idxs[1:])
-        if start != end
-    ]
-    if jobs:
-        job_costs = [df.cost.sum() for df, in jobs]
-        logger.debug(
-            f'Generated {len(jobs)} PNG jobs, min cost: {np.min(job_costs)}, '
-            f'max cost: {np.max(job_costs)}, total cost: {total_cost}'
+    return jobs, cost_factors
+
+
+def _filter_results(
+    formula_metrics_df: pd.DataFrame, moldbs: List[InputMolDb], moldb_id: int, fdr: pd.DataFrame
+) -> pd.DataFrame:
+    result_df = formula_metrics_df.join(fdr, how='inner').sort_values('fdr')
+    # Filter out zero-MSM annotations again to ensure that untargeted databases don't get
+    # zero-MSM annotations, even if they have some overlap with targeted databases.
+    is_targeted = any(db['targeted'] for db in moldbs if db['id'] == moldb_id)
+    if not is_targeted:
+        result_df = result_df[(result_df.msm > 0) & (result_df.fdr < 1)]
+    return result_df
+
+
+def make_pngs(
+    fexec: Executor,
+    image_tasks_df: pd.DataFrame,
+    imzml_reader: PortableSpectrumReader,
+    png_options: Optional[Dict] = None,
+) -> Tuple[List[CObj[List[Tuple[int, List[Optional[bytes]]]]]], List[CloudObject]]:
+    """Generates the PNGs of each image. Each job also writes the first-isotope images of its
+    formulas to a partial analysis cube keyed by formula_i, so that `save_analysis_cubes` only
+    needs to merge the partial cubes instead of loading the images again.
+
+    Returns the cobjs of the PNGs and of the partial analysis cubes"""
+    w, h = ds_dims(imzml_reader.coordinates)
+    mask = make_sample_area_mask(imzml_reader.coordinates)
+    pixel_inds = np.flatnonzero(mask)
+    png_generator = PngGenerator(mask, **(png_options or {}))
+
+    def save_png_chunk(df: pd.DataFrame, *, storage: Storage, perf: SubtaskProfiler):
+        pngs = []
+        groups = defaultdict(lambda: [])
+        for formula_i, cobj in df.cobj.items():
+            groups[cobj].append(formula_i)
+        cube_data = BytesIO()
+        cube_writer = AnalysisCubeWriter(cube_data, pixel_inds, *mask.shape)
+        img = np.zeros(mask.size, dtype=np.float32)
+
+        image_slab_iter = iter_image_slabs_with_prefetch(
+            storage, list(groups.keys()), list(groups.values())
         )
-    else:
-        logger.debug('No PNG jobs generated - probably no annotations')
-    return jobs
+        for image_slab in image_slab_iter:
+            for pos, formula_i in enumerate(image_slab.formula_is.tolist()):
+                formula_pngs = []
+                for peak_i in range(image_slab.n_peaks):
+                    sparse_image = image_slab.sparse_image(pos, peak_i)
+                    formula_pngs.append(
+                        png_generator.generate_sparse_png(*sparse_image)
+                        if sparse_image is not None
+                        else None
+                    )
+                    if peak_i == 0:
+                        img[:] = 0
+                        if sparse_image is not None:
+                            np.add.at(img, *sparse_image)
+                        cube_writer.append(str(formula_i), img[pixel_inds])
+                pngs.append((formula_i, formula_pngs))
+        cube_writer.finish()
+        perf.record_entry('generated pngs', n_cobjs=len(groups), n_images=len(pngs))
+        cobj = save_cobj(storage, pngs)
+        cube_cobj = storage.put_cloudobject(cube_data.getvalue())
+        perf.record_entry('saved pngs')
+        return cobj, cube_cobj
+
+    cost_model = fexec.get_cost_model(save_png_chunk.__name__, PNG_COST_FACTORS)
+    jobs, cost_factors = _split_png_jobs(image_tasks_df, w, h, cost_model)
+    results = fexec.map(save_png_chunk, jobs, cost_factors=cost_factors, include_modules=['png'])
+    return [cobj for cobj, _ in results], [cube_cobj for _, cube_cobj in results]
 
 
 def filter_results_and_make_pngs(
@@ -57,40 +198,114 @@ def filter_results_and_make_pngs(
     fdrs: Dict[int, pd.DataFrame],
     images_df: pd.DataFrame,
     imzml_reader: PortableSpectrumReader,
+    png_options: Optional[Dict] = None,
 ):
     results_dfs = {}
     all_formula_is = set()
     for moldb_id, fdr in fdrs.items():
-        result_df = formula_metrics_df.join(fdr, how='inner').sort_values('fdr')
-        # Filter out zero-MSM annotations again to ensure that untargeted databases don't get
-        # zero-MSM annotations, even if they have some overlap with targeted databases.
-        is_targeted = any(db['targeted'] for db in moldbs if db['id'] == moldb_id)
-        if not is_targeted:
-            result_df = result_df[(result_df.msm > 0) & (result_df.fdr < 1)]
-        results_dfs[moldb_id] = result_df
+        results_dfs[moldb_id] = _filter_results(formula_metrics_df, moldbs, moldb_id, fdr)
         all_formula_is.update(results_dfs[moldb_id].index)
 
     image_tasks_df = images_df[images_df.index.isin(all_formula_is)].copy()
-    w, h = ds_dims(imzml_reader.coordinates)
-    jobs = _split_png_jobs(image_tasks_df, w, h)
-    png_generator = PngGenerator(make_sample_area_mask(imzml_reader.coordinates))
+    png_cobjs, cube_cobjs = make_pngs(fexec, image_tasks_df, imzml_reader, png_options)
 
-    def save_png_chunk(df: pd.DataFrame, *, storage: Storage):
-        pngs = []
-        groups = defaultdict(lambda: [])
-        for formula_i, cobj in df.cobj.items():
-            groups[cobj].append(formula_i)
+    return results_dfs, png_cobjs, cube_cobjs
 
-        image_dict_iter = iter_cobjs_with_prefetch(storage, list(groups.keys()))
-        for image_dict, formula_is in zip(image_dict_iter, groups.values()):
-            for formula_i in formula_is:
-                formula_pngs = [
-                    png_generator.generate_png(img.toarray()) if img is not None else None
-                    for img in image_dict[formula_i]
-                ]
-                pngs.append((formula_i, formula_pngs))
-        return save_cobj(storage, pngs)
 
-    png_cobjs = fexec.map(save_png_chunk, jobs, include_modules=['png'])
+def run_fdr_and_make_pngs(
+    fexec: Executor,
+    formula_metrics_df: pd.DataFrame,
+    db_data_cobjs: List[CObj[DbFDRData]],
+    moldbs: List[InputMolDb],
+    images_df: pd.DataFrame,
+    imzml_reader: PortableSpectrumReader,
+    png_options: Optional[Dict] = None,
+):
+    """Equivalent to `run_fdr` followed by `filter_results_and_make_pngs`, but each database's
+    FDR is estimated in a separate invocation, and PNG generation for its annotations starts as
+    soon as its FDR is known, instead of waiting for the slowest database.
+    Images are only generated once, even if they're annotated in multiple databases."""
+    msms_cobj = save_msms(fexec, formula_metrics_df)
+    lock = Lock()
+    scheduled_formula_is: Set[int] = set()
+
+    def process_db(db_data_cobj):
+        [(moldb_id, fdr)] = run_fdr_for_dbs(fexec, msms_cobj, [db_data_cobj])
+        result_df = _filter_results(formula_metrics_df, moldbs, moldb_id, fdr)
+        with lock:
+            new_formula_is = set(result_df.index).difference(scheduled_formula_is)
+            scheduled_formula_is.update(new_formula_is)
+
+        image_tasks_df = images_df[images_df.index.isin(new_formula_is)].copy()
+        png_cobjs, cube_cobjs = (
+            make_pngs(fexec, image_tasks_df, imzml_reader, png_options)
+            if new_formula_is
+            else ([], [])
+        )
+        return moldb_id, fdr, result_df, png_cobjs, cube_cobjs
+
+    logger.info('Estimating FDRs and generating PNGs...')
+    with ThreadPoolExecutor(max(len(db_data_cobjs), 1)) as pool:
+        # Copy context so that logs are still captured by `capture_logs`
+        futures = [
+            pool.submit(copy_context().run, process_db, db_data_cobj)
+            for db_data_cobj in db_data_cobjs
+        ]
+        db_results = [future.result() for future in futures]
+    fexec.storage.delete_cloudobjects([msms_cobj])
+
+    fdrs = {moldb_id: fdr for moldb_id, fdr, *_ in db_results}
+    results_dfs = {moldb_id: result_df for moldb_id, _, result_df, *_ in db_results}
+    png_cobjs = [cobj for _, _, _, db_png_cobjs, _ in db_results for cobj in db_png_cobjs]
+    cube_cobjs = [cobj for *_, db_cube_cobjs in db_results for cobj in db_cube_cobjs]
+    return fdrs, results_dfs, png_cobjs, cube_cobjs
+
+
+def _cobj_range_reader(storage: Storage, cobj: CloudObject):
+    """Returns a `ReadRange` function of an analysis cube in a CloudObject"""
+    size = int(storage.head_object(cobj.bucket, cobj.key)['content-length'])
+
+    def read_range(start, end):
+        start, end = (size + start, size) if start < 0 else (start, end)
+        args = {'Range': f'bytes={start}-{end - 1}'}
+        return storage.get_object(cobj.bucket, cobj.key, extra_get_args=args)
+
+    return read_range
+
+
+def save_analysis_cubes(
+    storage: Storage,
+    cube_cobjs: List[CloudObject],
+    imzml_reader: PortableSpectrumReader,
+    cube_row_keys: Dict[int, Dict[int, str]],
+    cube_fps: Dict[int, BinaryIO],
+):
+    """Writes the first-isotope images of formulas to analysis cubes, so that post-processing can
+    use them without decoding PNGs. For each `cube_id`, every formula in `cube_row_keys[cube_id]`
+    gets a row in the cube written to `cube_fps[cube_id]`, keyed by its value in
+    `cube_row_keys[cube_id]`. The compressed chunks of the partial cubes written by `make_pngs`
+    that contain any of these formulas are copied as they are, and only the directory is
+    rewritten, with null keys for the other formulas in these chunks. Only the needed chunks are
+    downloaded, with ranged reads."""
+    mask = make_sample_area_mask(imzml_reader.coordinates)
+    nrows, ncols = mask.shape
+    pixel_inds = np.flatnonzero(mask)
+    writers = {
+        cube_id: AnalysisCubeWriter(fp, pixel_inds, nrows, ncols)
+        for cube_id, fp in cube_fps.items()
+    }
+
+    for cube_cobj in cube_cobjs:
+        reader = AnalysisCubeReader(_cobj_range_reader(storage, cube_cobj))
+        for chunk_i in range(reader.n_chunks):
+            formula_is = [int(key) for key in reader.chunk_keys(chunk_i)]
+            chunk_data = None
+            for cube_id, row_keys in cube_row_keys.items():
+                keys = [row_keys.get(formula_i) for formula_i in formula_is]
+                if any(key is not None for key in keys):
+                    if chunk_data is None:
+                        chunk_data = reader.read_chunk(chunk_i)
+                    writers[cube_id].append_chunk(chunk_data, keys)
 
-    return results_dfs, png_cobjs
+    for writer in writers.values():
+        writer.finish()
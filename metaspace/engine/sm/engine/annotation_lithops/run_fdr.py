@@ -1,53 +1,72 @@
 from __future__ import annotations
 
 import logging
-from typing import List, Dict
+from typing import List, Dict, Tuple
 
 import pandas as pd
 from lithops.storage import Storage
 
 from sm.engine.annotation_lithops.build_moldb import DbFDRData
 from sm.engine.annotation_lithops.executor import Executor
-from sm.engine.annotation_lithops.io import load_cobj, CObj
+from sm.engine.annotation_lithops.io import load_cobj, save_cobj, CObj
 
 logger = logging.getLogger('annotation-pipeline')
 
 
-def run_fdr(
-    executor: Executor, formula_scores_df: pd.DataFrame, db_data_cobjs: List[CObj[DbFDRData]]
-) -> Dict[int, pd.DataFrame]:
-    msms_df = formula_scores_df[['msm']]
-
-    def _run_fdr_for_db(db_data_cobject: CObj[DbFDRData], *, storage: Storage):
-        print(f'Loading FDR data from {db_data_cobject}')
-        db_data = load_cobj(storage, db_data_cobject)
-        moldb_id = db_data['id']
-        fdr = db_data['fdr']
-        formula_map_df = db_data['formula_map_df']
-
-        formula_msm = formula_map_df.merge(
-            msms_df, how='inner', left_on='formula_i', right_index=True
-        )
-        modifiers = fdr.target_modifiers_df[['chem_mod', 'neutral_loss', 'adduct']]
-        results_df = (
-            fdr.estimate_fdr(formula_msm)
-            .assign(moldb_id=moldb_id)
-            .set_index('formula_i')
-            .merge(modifiers, left_on='modifier', right_index=True)
-            .drop(columns=['modifier'])
-        )
-
-        if not db_data['targeted']:
-            results_df = results_df[results_df.fdr <= 1]
-
-        return db_data['id'], results_df
+def _run_fdr_for_db(
+    db_data_cobject: CObj[DbFDRData], msms_cobject: CObj[pd.DataFrame], *, storage: Storage
+) -> Tuple[int, pd.DataFrame]:
+    print(f'Loading FDR data from {db_data_cobject}')
+    db_data = load_cobj(storage, db_data_cobject)
+    msms_df = load_cobj(storage, msms_cobject)
+    moldb_id = db_data['id']
+    fdr = db_data['fdr']
+    formula_map_df = db_data['formula_map_df']
+
+    formula_msm = formula_map_df.merge(msms_df, how='inner', left_on='formula_i', right_index=True)
+    modifiers = fdr.target_modifiers_df[['chem_mod', 'neutral_loss', 'adduct']]
+    results_df = (
+        fdr.estimate_fdr(formula_msm)
+        .assign(moldb_id=moldb_id)
+        .set_index('formula_i')
+        .merge(modifiers, left_on='modifier', right_index=True)
+        .drop(columns=['modifier'])
+    )
+
+    if not db_data['targeted']:
+        results_df = results_df[results_df.fdr <= 1]
+
+    return db_data['id'], results_df
+
+
+def save_msms(executor: Executor, formula_scores_df: pd.DataFrame) -> CObj[pd.DataFrame]:
+    """Saves the MSM of each formula so that FDR actions don't need the whole metrics DataFrame
+    to be serialized with the function"""
+    return save_cobj(executor.storage, formula_scores_df[['msm']])
 
-    logger.info('Estimating FDRs...')
-    results = executor.map(_run_fdr_for_db, db_data_cobjs, runtime_memory=1024)
+
+def run_fdr_for_dbs(
+    executor: Executor, msms_cobj: CObj[pd.DataFrame], db_data_cobjs: List[CObj[DbFDRData]]
+) -> List[Tuple[int, pd.DataFrame]]:
+    results = executor.map(
+        _run_fdr_for_db, [(co, msms_cobj) for co in db_data_cobjs], runtime_memory=1024
+    )
 
     for moldb_id, moldb_fdrs in results:
         logger.info(f'DB {moldb_id} number of annotations with FDR less than:')
         for fdr_step in [0.05, 0.1, 0.2, 0.5]:
             logger.info(f'{fdr_step * 100:2.0f}%: {(moldb_fdrs.fdr <= fdr_step).sum()}')
 
+    return results
+
+
+def run_fdr(
+    executor: Executor, formula_scores_df: pd.DataFrame, db_data_cobjs: List[CObj[DbFDRData]]
+) -> Dict[int, pd.DataFrame]:
+    msms_cobj = save_msms(executor, formula_scores_df)
+
+    logger.info('Estimating FDRs...')
+    results = run_fdr_for_dbs(executor, msms_cobj, db_data_cobjs)
+    executor.storage.delete_cloudobjects([msms_cobj])
+
     return dict(results)
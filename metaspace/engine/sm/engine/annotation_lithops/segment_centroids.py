@@ -10,7 +10,7 @@ import numpy as np
 import pandas as pd
 from lithops.storage.utils import CloudObject
 
-from sm.engine.annotation_lithops.annotate import choose_ds_segments
+from sm.engine.annotation_lithops.annotate import choose_ds_segments, get_centr_segm_mz_range
 from sm.engine.annotation_lithops.calculate_centroids import validate_formulas_not_in_multiple_segms
 from sm.engine.annotation_lithops.executor import Executor
 from sm.engine.annotation_lithops.io import (
@@ -98,7 +98,13 @@ def segment_centroids(
     ds_segm_size_mb: int,
     is_intensive_dataset: bool,
     isocalc_wrapper: IsocalcWrapper,
-) -> List[CObj[pd.DataFrame]]:
+) -> Tuple[List[CObj[pd.DataFrame]], pd.DataFrame]:
+    """Splits the centroids into segments that can each be annotated by a single invocation.
+
+    Returns:
+        the segments, and a DataFrame with the number of centroids (`n_centroids`) and the range
+        of spectrum m/zs that can match them (`mz_min`, `mz_max`) for each segment
+    """
     # pylint: disable=too-many-locals,too-many-statements
     max_ds_segms_size_per_db_segm_mb = 2560 if is_intensive_dataset else 1536
     mz_min, mz_max = ds_segms_bounds[0, 0], ds_segms_bounds[-1, 1]
@@ -198,7 +204,8 @@ def segment_centroids(
             max_ds_segms_to_download_n, max_segm = segms[0]
 
         def _second_level_upload(df):
-            return save_cobj(storage, df)
+            mz_min, mz_max = get_centr_segm_mz_range(df, isocalc_wrapper)
+            return save_cobj(storage, df), (len(df), mz_min, mz_max)
 
         print(f'Storing {len(segms)} centroids segments')
         with ThreadPoolExecutor(max_workers=128) as pool:
@@ -215,13 +222,17 @@ def segment_centroids(
 
     first_level_cobjs = [co for cos in first_level_segms_cobjs for co in cos.values()]
 
-    db_segms_cobjs = fexec.map_concat(
+    db_segms = fexec.map_concat(
         merge_centr_df_segments, second_level_segms_cobjs, runtime_memory=512
     )
+    db_segms_cobjs = [cobj for cobj, _ in db_segms]
+    db_segms_df = pd.DataFrame(
+        [stats for _, stats in db_segms], columns=['n_centroids', 'mz_min', 'mz_max']
+    )
 
     fexec.storage.delete_cloudobjects(first_level_cobjs)
 
-    return db_segms_cobjs
+    return db_segms_cobjs, db_segms_df
 
 
 def validate_centroid_segments(fexec, db_segms_cobjs, ds_segms_bounds, isocalc_wrapper):
@@ -25,7 +25,7 @@ from sm.engine.annotation_spark.segmenter import (
 )
 from sm.engine.ds_config import DSConfig
 from sm.engine.annotation.fdr import FDR
-from sm.engine.formula_parser import safe_generate_ion_formula
+from sm.engine.formula_parser import safe_generate_ion_formulas
 from sm.engine.annotation.isocalc_wrapper import IsocalcWrapper
 from sm.engine.molecular_db import MolecularDB
 from sm.engine.config import SMConfig
@@ -53,27 +53,16 @@ def init_fdr(ds_config: DSConfig, moldbs: List[MolecularDB]) -> List[Tuple[Molec
     return moldb_fdr_list
 
 
-def collect_ion_formulas(
-    spark_context: pyspark.SparkContext, moldb_fdr_list: List[Tuple[MolecularDB, FDR]]
-) -> pd.DataFrame:
+def collect_ion_formulas(moldb_fdr_list: List[Tuple[MolecularDB, FDR]]) -> pd.DataFrame:
     """Collect all ion formulas that need to be searched for."""
 
     logger.info('Collecting ion formulas')
 
-    def gen_ion_formulas(args):
-        formula, modifier = args
-        ion_formula = safe_generate_ion_formula(formula, modifier)
-        return ion_formula, formula, modifier
-
     ion_formula_map_dfs = []
     for moldb, fdr in moldb_fdr_list:
-        ion_formulas = (
-            spark_context.parallelize(fdr.ion_tuples())
-            .map(gen_ion_formulas)
-            .filter(lambda t: t[0])
-            .collect()
-        )
-        df = pd.DataFrame(ion_formulas, columns=['ion_formula', 'formula', 'modifier'])
+        df = pd.DataFrame(fdr.ion_tuples(), columns=['formula', 'modifier'])
+        df.insert(0, 'ion_formula', safe_generate_ion_formulas(df.formula, df.modifier))
+        df = df[~df.ion_formula.isna()].reset_index(drop=True)
         df.insert(0, 'moldb_id', moldb.id)
         ion_formula_map_dfs.append(df)
 
@@ -272,7 +261,7 @@ class MSMSearch:
         self._perf.record_entry('segmented ds')
 
         moldb_fdr_list = init_fdr(self._ds_config, self._moldbs)
-        ion_formula_map_df = collect_ion_formulas(self._spark_context, moldb_fdr_list)
+        ion_formula_map_df = collect_ion_formulas(moldb_fdr_list)
         self._perf.record_entry('collected ion formulas')
 
         formula_centroids = self._fetch_formula_centroids(ion_formula_map_df)
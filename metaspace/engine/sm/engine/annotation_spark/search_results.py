@@ -11,15 +11,22 @@ from sm.engine.config import SMConfig
 from sm.engine.image_storage import ImageStorage
 from sm.engine.db import DB
 from sm.engine.ion_mapping import get_ion_id_mapping
-from sm.engine.annotation.png_generator import PngGenerator
+from sm.engine.annotation.png_generator import PngGenerator, get_png_options
 
 logger = logging.getLogger('engine')
-METRICS_INS = (
-    'INSERT INTO annotation ('
-    '   job_id, formula, chem_mod, neutral_loss, adduct, msm, fdr, stats, iso_image_ids, ion_id'
-    ') '
-    'VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)'
-)
+METRICS_TABLE = 'annotation'
+METRICS_COLUMNS = [
+    'job_id',
+    'formula',
+    'chem_mod',
+    'neutral_loss',
+    'adduct',
+    'msm',
+    'fdr',
+    'stats',
+    'iso_image_ids',
+    'ion_id',
+]
 
 
 class SearchResults:
@@ -40,25 +47,31 @@ class SearchResults:
         self.n_peaks = n_peaks
         self.charge = charge
 
-    def _metrics_table_row_gen(self, job_id, metr_df, ion_image_ids, ion_mapping):
-        for _, row in metr_df.iterrows():
-            m = OrderedDict((name, row[name]) for name in self.metric_names)
-            metr_json = json.dumps(m)
-            if row.formula_i not in ion_image_ids:
-                logger.debug(f'Missing "formula_i": {row}, {ion_image_ids}')
-            image_ids = ion_image_ids[row.formula_i]['iso_image_ids']
-            yield (
-                job_id,
-                row.formula,
-                row.chem_mod,
-                row.neutral_loss,
-                row.adduct,
-                float(row.msm),
-                float(row.fdr),
-                metr_json,
-                image_ids,
-                ion_mapping[row.formula, row.chem_mod, row.neutral_loss, row.adduct],
-            )
+    def _metrics_table_df(self, job_id, metr_df, ion_image_ids, ion_tuples, ion_mapping):
+        missing_formula_is = metr_df.formula_i[~metr_df.formula_i.isin(ion_image_ids.keys())]
+        if not missing_formula_is.empty:
+            logger.debug(f'Missing "formula_i": {missing_formula_is.tolist()}, {ion_image_ids}')
+        metric_rows = zip(*(metr_df[name].tolist() for name in self.metric_names))
+        return pd.DataFrame(
+            {
+                'job_id': job_id,
+                'formula': metr_df.formula.values,
+                'chem_mod': metr_df.chem_mod.values,
+                'neutral_loss': metr_df.neutral_loss.values,
+                'adduct': metr_df.adduct.values,
+                'msm': metr_df.msm.values.astype(float),
+                'fdr': metr_df.fdr.values.astype(float),
+                'stats': [
+                    json.dumps(OrderedDict(zip(self.metric_names, metrics)))
+                    for metrics in metric_rows
+                ],
+                'iso_image_ids': [
+                    ion_image_ids[formula_i]['iso_image_ids'] for formula_i in metr_df.formula_i
+                ],
+                'ion_id': [ion_mapping[ion] for ion in ion_tuples],
+            },
+            columns=METRICS_COLUMNS,
+        )
 
     def store_ion_metrics(self, ion_metrics_df, ion_image_ids, db):
         """Store ion metrics and iso image ids in the database."""
@@ -69,16 +82,16 @@ class SearchResults:
         ion_tuples = list(ions.itertuples(False, None))
         ion_mapping = get_ion_id_mapping(db, ion_tuples, self.charge)
 
-        rows = self._metrics_table_row_gen(
-            self.job_id, ion_metrics_df.reset_index(), ion_image_ids, ion_mapping
+        metrics_table_df = self._metrics_table_df(
+            self.job_id, ion_metrics_df.reset_index(), ion_image_ids, ion_tuples, ion_mapping
         )
-        db.insert(METRICS_INS, list(rows))
+        db.copy_df(METRICS_TABLE, metrics_table_df)
 
     def _post_images_to_image_store(self, ion_images_rdd, alpha_channel, n_peaks):
         logger.info('Posting iso images to image store')
-        png_generator = PngGenerator(alpha_channel, greyscale=True)
-        ds_id = self.ds_id
         sm_config = SMConfig.get_conf()
+        png_generator = PngGenerator(alpha_channel, greyscale=True, **get_png_options(sm_config))
+        ds_id = self.ds_id
 
         def generate_png_and_post(partition):
             image_storage = ImageStorage(sm_config)
@@ -87,7 +100,9 @@ class SearchResults:
                 iso_image_ids = [None] * n_peaks
                 for k, img in enumerate(imgs):
                     if img is not None:
-                        img_bytes = png_generator.generate_png(img.toarray())
+                        img_bytes = png_generator.generate_sparse_png(
+                            img.row.astype(np.int64) * img.shape[1] + img.col, img.data
+                        )
                         iso_image_ids[k] = image_storage.post_image(
                             image_storage.ISO, ds_id, img_bytes
                         )
@@ -9,6 +9,7 @@ from requests.api import post
 from sm.engine import molecular_db
 from sm.engine.annotation.job import del_jobs
 from sm.engine.annotation_lithops.annotation_job import ServerAnnotationJob
+from sm.engine.annotation_lithops.cost_model import CostModelPlanner
 from sm.engine.annotation_lithops.executor import Executor
 from sm.engine.annotation_spark.annotation_job import AnnotationJob
 from sm.engine.postprocessing.colocalization import Colocalization
@@ -108,7 +109,9 @@ class DatasetManager:
             del_jobs(ds)
         ds.save(self._db, self._es)
         with perf_profile(self._db, 'annotate_lithops', ds.id) as perf:
-            executor = Executor(self._sm_config['lithops'], perf=perf)
+            executor = Executor(
+                self._sm_config['lithops'], perf=perf, planner=CostModelPlanner(self._db)
+            )
 
             ServerAnnotationJob(executor, ds, perf).run()
 
@@ -153,6 +156,11 @@ class DatasetManager:
 
         self.logger.info(f'Deleting dataset: {ds.id}')
         del_jobs(ds)
+        try:
+            Colocalization(self._db).delete_cache(ds)
+        except Exception:
+            # The cache is only an optimization, so failing to delete it shouldn't stop the rest
+            self.logger.warning(f'Failed to delete colocalization cache: {ds.id}', exc_info=True)
         del_optical_image(self._db, ds.id)
         delete_ion_thumbnail(self._db, ds)
         self._es.delete_ds(ds.id)
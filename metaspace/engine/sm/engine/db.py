@@ -1,9 +1,12 @@
 import functools
+import io
 import logging
 import threading
 from contextlib import contextmanager
-from typing import Optional
+from typing import Iterable, Iterator, Optional
 
+import numpy as np
+import pandas as pd
 from psycopg2.extras import execute_values
 import psycopg2.extensions
 from psycopg2.pool import ThreadedConnectionPool
@@ -13,6 +16,11 @@ psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY)
 
 logger = logging.getLogger('engine.db')
 
+#: Number of rows that `DB.copy_df` converts to CSV at once
+COPY_CHUNK_ROWS = 10000
+#: NULL marker used by `DB.copy_df`, so that empty strings and NULLs can be told apart
+COPY_NULL = '\\N'
+
 
 class ConnectionPool:
     pool: Optional[ThreadedConnectionPool] = None
@@ -92,6 +100,77 @@ def db_call(func):
     return wrapper
 
 
+def to_pg_array(values) -> Optional[str]:
+    """Formats a list as a Postgres array literal, e.g. for COPY"""
+    if values is None:
+        return None
+    items = (
+        'NULL'
+        if value is None
+        else '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+        for value in values
+    )
+    return '{' + ','.join(items) + '}'
+
+
+def _df_to_csv_chunks(df: pd.DataFrame) -> Iterator[str]:
+    for start in range(0, len(df), COPY_CHUNK_ROWS):
+        chunk = df.iloc[start : start + COPY_CHUNK_ROWS].copy()
+        for col in chunk.columns:
+            if chunk[col].dtype == object and chunk[col].map(_is_list).any():
+                chunk[col] = chunk[col].map(to_pg_array)
+        yield chunk.to_csv(header=False, index=False, na_rep=COPY_NULL)
+
+
+def _is_list(value):
+    return isinstance(value, (list, tuple, np.ndarray))
+
+
+class _IterReader(io.TextIOBase):
+    """Read-only file-like object that lazily concatenates the strings of an iterator"""
+
+    def __init__(self, chunks: Iterable[str]):
+        super().__init__()
+        self._chunks = iter(chunks)
+        self._buffer = ''
+        # Position of the unread part of the buffer. The read part is only dropped when the next
+        # chunk is appended, so that each read doesn't copy the rest of the buffer
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def _append_next_chunk(self) -> bool:
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            return False
+        self._buffer = self._buffer[self._pos :] + chunk
+        self._pos = 0
+        return True
+
+    def _take(self, end):
+        result = self._buffer[self._pos : end]
+        self._pos += len(result)
+        return result
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            result = ''.join([self._buffer[self._pos :], *self._chunks])
+            self._buffer, self._pos = '', 0
+            return result
+        while len(self._buffer) - self._pos < size and self._append_next_chunk():
+            pass
+        return self._take(self._pos + size)
+
+    def readline(self, size=-1):
+        while self._buffer.find('\n', self._pos) < 0 and self._append_next_chunk():
+            pass
+        end = self._buffer.find('\n', self._pos) + 1 or len(self._buffer)
+        if size is not None and size >= 0:
+            end = min(end, self._pos + size)
+        return self._take(end)
+
+
 class DB:
     """Postgres database access provider."""
 
@@ -196,6 +275,34 @@ class DB:
             ids.append(self._curs.fetchone()[0])
         return ids
 
+    @db_call
+    def insert_values(self, sql, rows, template=None, fetch=False, page_size=1000):
+        """Execute insert query for many rows in a few round trips with `execute_values`
+
+        Args
+        ------------
+        sql : string
+            sql insert query in INSERT INTO TABLE (...) VALUES %s format,
+            optionally with a RETURNING clause
+        rows : list
+            list of tuples as table rows
+        template : string
+            snippet to merge each row into, e.g. '(%s, %s::json)'
+        fetch : bool
+            whether to return the rows returned by the RETURNING clause
+        page_size : int
+            maximum number of rows per statement
+        Returns
+        ------------
+        : list
+            if fetch is True, the returned rows, in the same order as `rows`
+        """
+        if not rows:
+            return [] if fetch else None
+        return execute_values(
+            self._curs, sql, rows, template=template, page_size=page_size, fetch=fetch
+        )
+
     @db_call
     def alter(self, sql, params=None):
         """Execute alter query
@@ -241,3 +348,23 @@ class DB:
             f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT CSV, DELIMITER '{sep}')",
             inp_file,
         )
+
+    @db_call
+    def copy_df(self, table, df: pd.DataFrame):
+        """Insert the rows of a DataFrame into a table with a single streamed COPY
+
+        Args
+        ------------
+        table : string
+            table to insert new rows into
+        df : pandas.DataFrame
+            rows to insert, with one column per table column. List values are inserted as
+            arrays, and None and NaN values as NULLs
+        """
+        if df.empty:
+            return
+        self._curs.copy_expert(
+            f"COPY {table} ({', '.join(df.columns)}) FROM STDIN "
+            f"WITH (FORMAT CSV, NULL '{COPY_NULL}')",
+            _IterReader(_df_to_csv_chunks(df)),
+        )
@@ -1,6 +1,9 @@
 import re
 from collections import Counter
 
+import numpy as np
+import pandas as pd
+
 from sm.engine.errors import SMError
 
 CLEAN_REGEXP = re.compile(r'[.=]')
@@ -125,3 +128,120 @@ def safe_generate_ion_formula(*parts):
         return generate_ion_formula(*(part for part in parts if part))
     except ParseFormulaError:
         return None
+
+
+def _parse_modifier(modifier):
+    """Parses a modifier the same way `generate_ion_formula` applies adducts.
+
+    Returns the total change in count of each element and the lowest running change of each
+    element, which is needed to detect intermediate negative counts, or None if the modifier
+    is invalid.
+    """
+    deltas = Counter()
+    min_deltas = Counter()
+    if modifier and modifier not in ('[M]+', '[M]-'):
+        if not ADDUCT_VALIDATE_REGEXP.match(modifier):
+            return None
+        for operation, adduct_part in ADDUCT_REGEXP.findall(modifier):
+            for elem, n in parse_formula(adduct_part):
+                if operation == '+':
+                    deltas[elem] += n
+                else:
+                    deltas[elem] -= n
+                    min_deltas[elem] = min(min_deltas[elem], deltas[elem])
+    return deltas, min_deltas
+
+
+def _chnops_order(elements):
+    """The elements present in `elements`, in the order used by `_format_formula`"""
+    return [elem for elem in _chnops_sort(dict.fromkeys(elements)) if elem in elements]
+
+
+def _format_formulas(counts, elements, count_parts):
+    """Vectorized `_format_formula` for a matrix of element counts with one row per element.
+    `elements` must already be in CHNOPS order. `count_parts` caches the formatted parts of
+    each element, indexed by count."""
+    ion_formulas = np.full(counts.shape[1], '', dtype='O')
+    for elem, elem_counts in zip(elements, counts):
+        col_idxs = np.flatnonzero(elem_counts)
+        if len(col_idxs):
+            if elem not in count_parts:
+                count_parts[elem] = np.array(
+                    ['', elem, *(f'{elem}{n}' for n in range(2, 1024))], dtype='O'
+                )
+            parts_table = count_parts[elem]
+            nonzero_counts = elem_counts[col_idxs]
+            parts = parts_table[np.minimum(nonzero_counts, len(parts_table) - 1)]
+            is_large = nonzero_counts >= len(parts_table)
+            if is_large.any():
+                parts[is_large] = [f'{elem}{n}' for n in nonzero_counts[is_large]]
+            ion_formulas[col_idxs] += parts
+    return ion_formulas
+
+
+def safe_generate_ion_formulas(formulas, modifiers, block_size=2 ** 16):
+    # pylint: disable=too-many-locals
+    """Vectorized equivalent of `safe_generate_ion_formula(formula, modifier)` for many
+    (formula, modifier) pairs.
+
+    Each unique formula and modifier is only parsed once into element counts. Pairs are then
+    processed in groups with the same modifier, so that ion formulas can be calculated by adding
+    the modifier's element counts to a matrix of the formulas' element counts.
+
+    Args:
+        formulas: sequence of formulas
+        modifiers: sequence of modifiers, the same length as `formulas`
+        block_size: max number of pairs to process at once, limiting the size of the matrices
+
+    Returns:
+        np.ndarray: object array of ion formulas, with None for invalid ions
+    """
+    formulas = np.asarray(formulas, dtype='O')
+    modifiers = np.asarray(modifiers, dtype='O')
+    formula_codes, unique_formulas = pd.factorize(formulas)
+    modifier_codes, unique_modifiers = pd.factorize(modifiers)
+
+    formula_elems = [dict(parse_formula(CLEAN_REGEXP.sub('', f))) for f in unique_formulas]
+    formula_elem_set = {elem for elems in formula_elems for elem in elems}
+    formula_elem_order = _chnops_order(formula_elem_set)
+    # Element counts with one row per element and one column per unique formula
+    formula_counts = np.zeros((len(formula_elem_order), len(unique_formulas)), dtype=np.int64)
+    for row_i, elem in enumerate(formula_elem_order):
+        formula_counts[row_i] = [elems.get(elem, 0) for elems in formula_elems]
+
+    ion_formulas = np.full(len(formulas), None, dtype='O')
+    count_parts = {}
+    modifier_order = np.argsort(modifier_codes, kind='stable')
+    modifier_bounds = np.searchsorted(
+        modifier_codes[modifier_order], np.arange(len(unique_modifiers) + 1)
+    )
+    for modifier_i, modifier in enumerate(unique_modifiers):
+        parsed_modifier = _parse_modifier(modifier)
+        if parsed_modifier is None:
+            continue
+        deltas, min_deltas = parsed_modifier
+        elem_set = formula_elem_set.union(deltas)
+        elem_order = _chnops_order(elem_set)
+        formula_rows = [elem_order.index(elem) for elem in formula_elem_order]
+        delta_rows = [elem_order.index(elem) for elem in deltas]
+        delta_counts = np.array(list(deltas.values()), dtype=np.int64)[:, None]
+        min_delta_rows = [elem_order.index(elem) for elem in min_deltas]
+        min_delta_counts = np.array(list(min_deltas.values()), dtype=np.int64)[:, None]
+
+        group_idxs = modifier_order[modifier_bounds[modifier_i] : modifier_bounds[modifier_i + 1]]
+        for start in range(0, len(group_idxs), block_size):
+            idxs = group_idxs[start : start + block_size]
+            counts = np.zeros((len(elem_order), len(idxs)), dtype=np.int64)
+            counts[formula_rows] = formula_counts[:, formula_codes[idxs]]
+            # Counts must not become negative at any step of applying the modifier
+            valid = (counts[min_delta_rows] + min_delta_counts >= 0).all(axis=0)
+            counts[delta_rows] += delta_counts
+            valid &= (counts > 0).any(axis=0)
+            ion_formulas[idxs[valid]] = _format_formulas(counts[:, valid], elem_order, count_parts)
+
+    # safe_generate_ion_formula drops empty parts, so an empty formula makes the modifier be
+    # parsed as the formula. This is rare enough to not be worth vectorizing.
+    for idx in np.flatnonzero(~unique_formulas.astype(bool)[formula_codes]):
+        ion_formulas[idx] = safe_generate_ion_formula(formulas[idx], modifiers[idx])
+
+    return ion_formulas
@@ -2,15 +2,18 @@ import io
 import json
 import logging
 import uuid
+from collections import defaultdict
 from concurrent.futures.thread import ThreadPoolExecutor
 from enum import Enum
-from typing import List, Tuple, Callable, Dict
+from typing import List, Tuple, Callable, Dict, BinaryIO, Optional
 
 import numpy as np
 from botocore.exceptions import ClientError
 from scipy.ndimage import zoom
+from scipy.sparse import csr_matrix, vstack
 import PIL.Image
 
+from sm.engine.annotation.analysis_cube import AnalysisCubeReader
 from sm.engine.config import SMConfig
 from sm.engine.storage import get_s3_resource, create_bucket, get_s3_client
 from sm.engine.utils.retry_on_exception import retry_on_exception
@@ -75,13 +78,46 @@ class ImageStorage:
         key = self._make_key(image_type, ds_id, image_id)
         return f'{endpoint}/{self.bucket.name}/{key}'
 
-    def get_ion_images_for_analysis(
+    @staticmethod
+    def _make_analysis_cube_key(ds_id, job_id):
+        return f'analysis/{ds_id}/{job_id}'
+
+    def post_analysis_cube(self, ds_id: str, job_id: int, fp: BinaryIO):
+        """Uploads an analysis cube (see `sm.engine.annotation.analysis_cube`) of a job's
+        annotations, replacing any previous cube of the job"""
+        self.bucket.Object(self._make_analysis_cube_key(ds_id, job_id)).upload_fileobj(fp)
+
+    def get_analysis_cube(self, ds_id: str, job_id: int) -> Optional[AnalysisCubeReader]:
+        """Returns a reader for the analysis cube of a job, or None if the job doesn't have one"""
+        obj = self.bucket.Object(self._make_analysis_cube_key(ds_id, job_id))
+
+        def read_range(start, end):
+            byte_range = f'bytes={start}' if start < 0 else f'bytes={start}-{end - 1}'
+            return obj.get(Range=byte_range)['Body'].read()
+
+        try:
+            return AnalysisCubeReader(read_range)
+        except ClientError as error:
+            if error.response['Error']['Code'] == 'NoSuchKey':
+                return None
+            raise
+        except ValueError:
+            # E.g. a cube in an older format. The images are then loaded from the PNGs instead
+            logger.warning(f'Unreadable analysis cube for job {job_id}', exc_info=True)
+            return None
+
+    def delete_analysis_cube(self, ds_id: str, job_id: int):
+        self.bucket.Object(self._make_analysis_cube_key(ds_id, job_id)).delete()
+
+    def get_ion_images_for_analysis(  # pylint: disable=too-many-locals,too-many-statements
         self,
         ds_id: str,
         image_ids: List[str],
         hotspot_percentile: int = 99,
         max_size: Tuple[int, int] = None,
         max_mem_mb: int = 2048,
+        job_ids: List[int] = None,
+        sparse: bool = False,
     ):
         """Retrieves ion images, does hot-spot removal and resizing,
         and returns them as numpy array.
@@ -94,13 +130,19 @@ class ImageStorage:
                 If images are greater than this size, they will be downsampled to fit in this size
             max_mem_mb (Union[None, float]):
                 If the output numpy array would require more than this amount of memory,
-                images will be downsampled to fit
+                images will be downsampled to fit. Ignored if `sparse` is True
+            job_ids (Union[None, list[int]]):
+                The job that produced each image. If specified, images are read from the jobs'
+                analysis cubes where possible, instead of downloading and decoding their PNGs
+            sparse:
+                If True, the images are returned as a sparse matrix, so that they can be kept at
+                full resolution
 
         Returns:
             tuple[np.ndarray, np.ndarray, tuple[int, int]]
                 (value, mask, (h, w))
-                value - A float32 numpy array with shape (len(img_ids), h * w)
-                    where each row is one image
+                value - A float32 numpy array (or scipy.sparse.csr_matrix if `sparse` is True)
+                    with shape (len(img_ids), h * w) where each row is one image
                 mask - A float32 numpy array with shape (h, w) containing the ion image mask.
                     May contain values that are between 0 and 1 if downsampling
                     caused both filled and empty pixels to be merged
@@ -108,23 +150,22 @@ class ImageStorage:
                     reconstructs the image
         """
         assert all(image_ids)
+        assert job_ids is None or len(job_ids) == len(image_ids)
 
         zoom_factor = 1
         h, w = None, None
         value, mask = None, None
 
-        def setup_shared_vals(img):
+        def setup_shared_vals(img_h, img_w, raw_mask):
             nonlocal zoom_factor, h, w, value, mask
 
-            img_h, img_w = img.height, img.width
             if max_size:
                 size_zoom = min(max_size[0] / img_h, max_size[1] / img_w)
                 zoom_factor = min(zoom_factor, size_zoom)
-            if max_mem_mb:
+            if max_mem_mb and not sparse:
                 expected_mem = img_h * img_w * len(image_ids) * 4 / 1024 / 1024
                 zoom_factor = min(zoom_factor, max_mem_mb / expected_mem)
 
-            raw_mask = np.float32(np.array(img)[:, :, 3] != 0)
             if abs(zoom_factor - 1) < 0.001:
                 zoom_factor = 1
                 mask = raw_mask
@@ -132,16 +173,12 @@ class ImageStorage:
                 mask = zoom(raw_mask, zoom_factor, prefilter=False)
 
             h, w = mask.shape
-            value = np.empty((len(image_ids), h * w), dtype=np.float32)
-
-        def process_img(img_id: str, idx, do_setup=False):
-            img_bytes = self.get_image(self.ISO, ds_id, img_id)
-            img = PIL.Image.open(io.BytesIO(img_bytes))
-            if do_setup:
-                setup_shared_vals(img)
-
-            img_arr = np.asarray(img, dtype=np.float32)[:, :, 0]
+            if sparse:
+                value = [None] * len(image_ids)
+            else:
+                value = np.empty((len(image_ids), h * w), dtype=np.float32)
 
+        def process_arr(img_arr, idx):
             # Try to use the hotspot percentile,
             # but fall back to the image's maximum or 1.0 if needed
             # to ensure that there are no divide-by-zero issues
@@ -158,13 +195,52 @@ class ImageStorage:
             np.clip(zoomed_img, 0, None, out=zoomed_img)
             zoomed_img /= np.max(zoomed_img) or 1
 
-            value[idx, :] = zoomed_img.ravel()  # pylint: disable=unsupported-assignment-operation
+            if sparse:
+                value[idx] = csr_matrix(zoomed_img.reshape(1, -1))
+            else:
+                value[
+                    idx, :
+                ] = zoomed_img.ravel()  # pylint: disable=unsupported-assignment-operation
 
-        process_img(image_ids[0], 0, do_setup=True)
-        with ThreadPoolExecutor() as executor:
-            for _ in executor.map(process_img, image_ids[1:], range(1, len(image_ids))):
-                pass
+        def process_img(img_id: str, idx, do_setup=False):
+            img_bytes = self.get_image(self.ISO, ds_id, img_id)
+            img = PIL.Image.open(io.BytesIO(img_bytes))
+            if do_setup:
+                raw_mask = np.float32(np.array(img)[:, :, 3] != 0)
+                setup_shared_vals(img.height, img.width, raw_mask)
+
+            process_arr(np.asarray(img, dtype=np.float32)[:, :, 0], idx)
 
+        job_image_idxs: Dict[int, Dict[str, int]] = defaultdict(dict)
+        for idx, (img_id, job_id) in enumerate(zip(image_ids, job_ids or [])):
+            job_image_idxs[job_id][img_id] = idx
+
+        png_idxs = set(range(len(image_ids)))
+        with ThreadPoolExecutor() as executor:
+            for job_id, image_idxs in job_image_idxs.items():
+                cube = self.get_analysis_cube(ds_id, job_id)
+                if cube is None:
+                    continue
+                if value is None:
+                    setup_shared_vals(cube.nrows, cube.ncols, np.float32(cube.mask()))
+                for chunk_img_ids, chunk_values in cube.iter_chunks(list(image_idxs)):
+                    chunk_idxs = [image_idxs[img_id] for img_id in chunk_img_ids]
+                    chunk_imgs = map(cube.to_image, chunk_values)
+                    for _ in executor.map(process_arr, chunk_imgs, chunk_idxs):
+                        pass
+                    png_idxs.difference_update(chunk_idxs)
+
+            if png_idxs:
+                png_idxs = sorted(png_idxs)
+                if value is None:
+                    process_img(image_ids[png_idxs[0]], png_idxs[0], do_setup=True)
+                    png_idxs = png_idxs[1:]
+                png_img_ids = [image_ids[idx] for idx in png_idxs]
+                for _ in executor.map(process_img, png_img_ids, png_idxs):
+                    pass
+
+        if sparse and value is not None:
+            value = vstack(value, format='csr')
         return value, mask, (h, w)
 
 
@@ -180,6 +256,8 @@ post_image: Callable[[ImageType, str, bytes], str]
 delete_image: Callable[[ImageType, str, str], None]
 get_image_url: Callable[[ImageType, str, str], str]
 get_ion_images_for_analysis = None
+post_analysis_cube: Callable[[str, int, BinaryIO], None]
+delete_analysis_cube: Callable[[str, int], None]
 
 
 @retry_on_exception(ClientError)
@@ -223,10 +301,12 @@ def init(sm_config: Dict):
 
     # pylint: disable=global-statement
     global _instance, get_image, post_image, delete_image, get_image_url
-    global get_ion_images_for_analysis
+    global get_ion_images_for_analysis, post_analysis_cube, delete_analysis_cube
     _instance = ImageStorage(sm_config)
     get_image = _instance.get_image
     post_image = _instance.post_image
     delete_image = _instance.delete_image
     get_image_url = _instance.get_image_url
     get_ion_images_for_analysis = _instance.get_ion_images_for_analysis
+    post_analysis_cube = _instance.post_analysis_cube
+    delete_analysis_cube = _instance.delete_analysis_cube
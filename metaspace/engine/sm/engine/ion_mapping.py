@@ -2,7 +2,7 @@ from sm.engine.formula_parser import format_ion_formula, safe_generate_ion_formu
 
 ION_INS = (
     'INSERT INTO graphql.ion (ion, formula, chem_mod, neutral_loss, adduct, charge, ion_formula) '
-    'VALUES (%s, %s, %s, %s, %s, %s, %s) '
+    'VALUES %s '
     'RETURNING id'
 )
 ION_SEL = (
@@ -43,7 +43,7 @@ def get_ion_id_mapping(db, ion_tuples, charge):
             (format_ion_formula(*ion, charge=charge), *ion, charge, safe_generate_ion_formula(*ion))
             for ion in missing_ions
         ]
-        ids = db.insert_return(ION_INS, rows)
+        ids = [row[0] for row in db.insert_values(ION_INS, rows, fetch=True)]
         ion_to_id.update((row[1:5], id) for id, row in zip(ids, rows))
 
     return ion_to_id
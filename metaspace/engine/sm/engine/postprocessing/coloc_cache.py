@@ -0,0 +1,512 @@
+from __future__ import annotations
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from time import time_ns
+from typing import Dict, Iterator, List, Optional, Tuple
+from uuid import uuid4
+
+import numpy as np
+import pandas as pd
+from lithops.storage import Storage
+from lithops.storage.utils import StorageNoSuchKeyError
+from scipy.sparse import issparse, csr_matrix, vstack
+
+from sm.engine.annotation_lithops.io import save_cobj, deserialize
+from sm.engine.annotation_lithops.utils import jsonhash
+
+logger = logging.getLogger('engine')
+
+#: Maximum number of clustering results kept in the cache
+MAX_CACHED_SAMPLES = 100
+#: Number of segments (or objects with clustering results) above which they're all rewritten
+#: as a single one
+MAX_CACHED_SEGMENTS = 8
+
+
+def _concat_rows(mats):
+    if any(issparse(mat) for mat in mats):
+        return vstack([csr_matrix(mat) for mat in mats], format='csr')
+    return np.concatenate(mats)
+
+
+def _isin(values, ion_ids: Optional[np.ndarray]) -> np.ndarray:
+    if ion_ids is None:
+        return np.ones(len(values), dtype=bool)
+    return np.isin(values, ion_ids)
+
+
+class ColocCacheData:
+    """
+    The cached colocalization entries of a set of ions, plus the entries that were calculated
+    since they were loaded.
+
+    Attributes:
+        h, w: shape of the images that the cached vectors were made from
+        ion_ids: ids of the cached ions
+        images: for each algorithm, the L2-normalized image vector of each cached ion
+        pairs: for each algorithm, a DataFrame with the ion_id_a, ion_id_b and score of each pair
+            of cached ions that has a score of at least the minimum score and was among the top
+            pairs of either ion when it was calculated. Each pair is only included once.
+        pruned_scores: for each algorithm, a DataFrame with the segment_idx, ion_id, level and
+            score of the highest score of the pairs of each ion that were discarded, for each
+            FDR level (by index) that the other ions of the pairs were annotated at
+        samples: sample_ion_ids of previous clusterings, keyed by the hash of the clustered ion ids
+    """
+
+    def __init__(
+        self,
+        h: Optional[int] = None,
+        w: Optional[int] = None,
+        ion_ids: Optional[np.ndarray] = None,
+        images: Optional[Dict] = None,
+        pairs: Optional[Dict[str, pd.DataFrame]] = None,
+        samples: Optional[Dict[str, List[int]]] = None,
+        segment_idxs: Optional[np.ndarray] = None,
+        contexts: Optional[List[np.ndarray]] = None,
+        context_levels: Optional[List[np.ndarray]] = None,
+        pruned_scores: Optional[Dict[str, pd.DataFrame]] = None,
+    ):
+        # pylint: disable=too-many-arguments
+        self.h = h
+        self.w = w
+        self.ion_ids = np.zeros(0, dtype=np.int64) if ion_ids is None else ion_ids
+        self.images = images or {}
+        self.pairs = pairs or {}
+        self.pruned_scores = pruned_scores or {}
+        self.samples = samples or {}
+        # The segment that each cached ion was added in, the ions that each segment's scores
+        # were calculated against, and the FDR levels that those ions were annotated at
+        self._segment_idxs = np.zeros(0, dtype=np.int64) if segment_idxs is None else segment_idxs
+        self._contexts = contexts or []
+        self._context_levels = context_levels or []
+        self._ion_idxs = pd.Index(self.ion_ids)
+        self.is_cleared = False
+        self.new_segment: Optional[Dict] = None
+        self.new_samples: Dict[str, List[int]] = {}
+
+    def clear(self):
+        """Discards the cached entries, e.g. because the images have changed size"""
+        self.__init__()
+        self.is_cleared = True
+
+    def is_cached(self, ion_ids: np.ndarray) -> np.ndarray:
+        return np.isin(ion_ids, self.ion_ids)
+
+    def get_images(self, algorithm: str, ion_ids: np.ndarray):
+        """Returns the cached image vectors of `ion_ids`, which must all be cached"""
+        idxs = self._ion_idxs.get_indexer(ion_ids)
+        assert (idxs >= 0).all(), 'Some ions are not cached'
+        return self.images[algorithm][idxs]
+
+    def get_pairs(self, algorithm: str, ion_ids: np.ndarray) -> Tuple[np.ndarray, ...]:
+        """Returns the cached pairs as (idxs_a, idxs_b, scores), with indexes into `ion_ids`"""
+        pairs_df = self.pairs.get(algorithm)
+        if pairs_df is None or pairs_df.empty:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+        ion_idxs = pd.Index(ion_ids)
+        idxs_a = ion_idxs.get_indexer(pairs_df.ion_id_a)
+        idxs_b = ion_idxs.get_indexer(pairs_df.ion_id_b)
+        valid = (idxs_a >= 0) & (idxs_b >= 0)
+        return idxs_a[valid], idxs_b[valid], pairs_df.score.values[valid]
+
+    def get_pruned_scores(
+        self, algorithm: str, ion_ids: np.ndarray, levels: np.ndarray
+    ) -> np.ndarray:
+        """Returns the highest score of the discarded cached pairs of each of `ion_ids` with ions
+        at each FDR level, as a (len(ion_ids), n_levels) array.
+
+        Args:
+            levels: (len(ion_ids), n_levels) boolean mask of the FDR levels of `ion_ids`
+
+        If some ions of a segment are now annotated at a level that they weren't annotated at
+        when the segment was saved, the pairs that the segment discarded may be with ions at
+        any level, so the segment's highest discarded score of each ion is used for all levels.
+        """
+        result = np.zeros(levels.shape, dtype=np.float32)
+        pruned_df = self.pruned_scores.get(algorithm)
+        if pruned_df is None or pruned_df.empty:
+            return result
+
+        ion_idxs = pd.Index(ion_ids)
+        idxs = ion_idxs.get_indexer(pruned_df.ion_id)
+        valid = idxs >= 0
+        idxs = idxs[valid]
+        seg_idxs = pruned_df.segment_idx.values[valid]
+        pruned_levels = pruned_df.level.values[valid]
+        scores = pruned_df.score.values[valid]
+
+        levels_unchanged = np.ones(len(self._contexts), dtype=bool)
+        for seg_i, (context, context_levels) in enumerate(
+            zip(self._contexts, self._context_levels)
+        ):
+            context_idxs = ion_idxs.get_indexer(context)
+            in_job = context_idxs >= 0
+            levels_unchanged[seg_i] = not (
+                levels[context_idxs[in_job]] & ~context_levels[in_job]
+            ).any()
+
+        unchanged = levels_unchanged[seg_idxs]
+        np.maximum.at(result, (idxs[unchanged], pruned_levels[unchanged]), scores[unchanged])
+        np.maximum.at(result, idxs[~unchanged], scores[~unchanged, None])
+        return result
+
+    def iter_missing_pair_blocks(self, ion_ids: np.ndarray) -> Iterator[Tuple[np.ndarray, ...]]:
+        """Finds pairs of cached ions that have never been scored, because they weren't
+        annotated together, e.g. when they were only annotated with different databases.
+
+        A segment's scores cover all pairs of its ions with the ions of its context, which
+        includes every ion that was cached at that time. A pair of ions from segments i < j is
+        therefore scored if both ions are in the context of segment j or any later segment.
+
+        Yields (row_idxs, col_idxs, is_missing) blocks, with indexes into `ion_ids` and a
+        (len(row_idxs), len(col_idxs)) boolean mask of the missing pairs.
+        """
+        seg_idxs = np.full(len(ion_ids), -1)
+        is_cached = self.is_cached(ion_ids)
+        seg_idxs[is_cached] = self._segment_idxs[self._ion_idxs.get_indexer(ion_ids[is_cached])]
+        in_context = np.array(
+            [np.isin(ion_ids, context) for context in self._contexts], dtype=np.float32
+        ).reshape(len(self._contexts), len(ion_ids))
+
+        for seg_j in range(len(self._contexts)):
+            col_idxs = np.flatnonzero(seg_idxs == seg_j)
+            for seg_i in range(seg_j):
+                row_idxs = np.flatnonzero(seg_idxs == seg_i)
+                if len(row_idxs) and len(col_idxs):
+                    later_contexts = in_context[seg_j:]
+                    is_scored = (later_contexts[:, row_idxs].T @ later_contexts[:, col_idxs]) > 0
+                    if not is_scored.all():
+                        yield row_idxs, col_idxs, ~is_scored
+
+    def add_entries(
+        self, h, w, ion_ids, images, pairs, pruned_scores, context_ion_ids, context_levels
+    ):
+        """Records newly calculated entries, so that they're saved by `ColocCache.save`
+
+        Args:
+            h, w: shape of the images
+            ion_ids: ids of the ions that weren't cached
+            images: for each algorithm, the image vectors of `ion_ids`
+            pairs: for each algorithm, a DataFrame of newly scored pairs, in the same format
+                as `ColocCacheData.pairs`
+            pruned_scores: for each algorithm, a DataFrame with the ion_id, level and score of
+                the highest discarded score of the newly scored pairs
+            context_ion_ids: ids of all ions that the new scores were calculated against
+            context_levels: (len(context_ion_ids), n_levels) boolean mask of their FDR levels
+        """
+        self.h, self.w = h, w
+        self.new_segment = {
+            'ion_ids': np.asarray(ion_ids, dtype=np.int64),
+            'segment_idxs': np.zeros(len(ion_ids), dtype=np.int64),
+            'contexts': [np.asarray(context_ion_ids, dtype=np.int64)],
+            'context_levels': [np.asarray(context_levels, dtype=bool)],
+            'images': images,
+            'pairs': pairs,
+            'pruned_scores': {alg: df.assign(segment_idx=0) for alg, df in pruned_scores.items()},
+        }
+
+    def add_samples(self, key: str, sample_ion_ids: List[int]):
+        self.samples[key] = sample_ion_ids
+        self.new_samples[key] = sample_ion_ids
+
+
+class ColocCache:
+    """
+    Persistent store of the normalized image vectors and pair scores calculated by a dataset's
+    colocalization jobs, so that when the dataset gains a molecular database or some annotations
+    change, only the scores of the new ions need to be calculated. Results of clustering are also
+    stored, so that clustering only needs to be re-run for FDR levels whose annotations changed.
+
+    The entries only depend on the ion images, so a separate cache is kept for each combination
+    of dataset and the parameters that can affect its images or scores (its config other than
+    `database_ids`, and the colocalization parameters). Entries are saved in segments, one for
+    each job that calculated new scores, and clustering results are saved in separate objects.
+    When there are more than `MAX_CACHED_SEGMENTS` of either, they're rewritten as one.
+
+    Nothing is ever updated in place, so that jobs can save to the same cache concurrently:
+    segments and clustering results are written under new keys and found by listing the cache.
+    A segment's objects are listed by a `meta` object, which is written last and deleted first,
+    so that unfinished segments aren't loaded.
+    """
+
+    def __init__(self, storage: Storage, sm_storage: Dict, ds_id: str, params: Dict):
+        self.storage = storage
+        self.bucket, raw_prefix = sm_storage['pipeline_cache']
+        self.ds_prefix = f'{raw_prefix}/coloc/{ds_id}'
+        self.prefix = f'{self.ds_prefix}/{jsonhash(params)}'
+
+    @staticmethod
+    def _new_id():
+        # Ordered by creation time, so that the latest segments and samples can be found
+        return f'{time_ns():020d}-{uuid4().hex}'
+
+    def _segment_key(self, segment_id: str, name: str):
+        return f'{self.prefix}/{segment_id}/{name}'
+
+    def _samples_key(self, samples_id: str):
+        return f'{self.prefix}/samples/{samples_id}'
+
+    def _get_object(self, key: str):
+        return deserialize(self.storage.get_object(self.bucket, key))
+
+    def _try_get_object(self, key: str):
+        try:
+            return self._get_object(key)
+        except StorageNoSuchKeyError:
+            # Deleted by another job since it was listed
+            return None
+
+    def _load_manifest(self) -> Optional[Dict]:
+        """Lists the saved segments and clustering results. Those that were saved for images of
+        a different size than the latest ones are returned separately as stale.
+        Returns None if nothing is cached."""
+        keys = self.storage.list_keys(self.bucket, f'{self.prefix}/')
+        samples_prefix = self._samples_key('')
+        meta_keys = sorted(
+            key for key in keys if key.endswith('/meta') and not key.startswith(samples_prefix)
+        )
+        samples_keys = sorted(key for key in keys if key.startswith(samples_prefix))
+        with ThreadPoolExecutor(4) as executor:
+            segments = [
+                seg for seg in executor.map(self._try_get_object, meta_keys) if seg is not None
+            ]
+            samples_objs = [
+                obj for obj in executor.map(self._try_get_object, samples_keys) if obj is not None
+            ]
+        if not segments and not samples_objs:
+            return None
+
+        latest = max(segments + samples_objs, key=lambda obj: obj['id'])
+        h, w = latest['h'], latest['w']
+
+        def is_current(obj):
+            return (obj['h'], obj['w']) == (h, w)
+
+        current_segments = sorted(filter(is_current, segments), key=lambda seg: seg['id'])
+        samples = {}
+        for obj in sorted(filter(is_current, samples_objs), key=lambda obj: obj['id']):
+            samples.update(obj['samples'])
+        return {
+            'h': h,
+            'w': w,
+            'algorithms': current_segments[-1]['algorithms'] if current_segments else [],
+            'segments': current_segments,
+            'samples': dict(list(samples.items())[-MAX_CACHED_SAMPLES:]),
+            'samples_ids': [obj['id'] for obj in samples_objs if is_current(obj)],
+            'stale_segments': [seg for seg in segments if not is_current(seg)],
+            'stale_samples_ids': [obj['id'] for obj in samples_objs if not is_current(obj)],
+        }
+
+    def _load_segment(self, segment: Dict, ion_ids: Optional[np.ndarray]) -> Dict:
+        """Loads the entries of a segment that involve only `ion_ids`, or all entries if it's
+        None. A segment that was made by rewriting several segments contains all of their
+        contexts, and the index of the context that each ion was added with."""
+
+        def get(name):
+            return self._get_object(self._segment_key(segment['id'], name))
+
+        seg_ion_ids = get('ion_ids')
+        keep = _isin(seg_ion_ids, ion_ids)
+        images = {
+            algorithm: get(f'images_{algorithm}')[keep] for algorithm in segment['algorithms']
+        }
+        pairs, pruned_scores = {}, {}
+        for algorithm in segment['algorithms']:
+            pairs_df = get(f'pairs_{algorithm}')
+            pairs[algorithm] = pairs_df[
+                _isin(pairs_df.ion_id_a, ion_ids) & _isin(pairs_df.ion_id_b, ion_ids)
+            ]
+            pruned_df = get(f'pruned_scores_{algorithm}')
+            pruned_scores[algorithm] = pruned_df[_isin(pruned_df.ion_id, ion_ids)]
+        contexts, context_levels = [], []
+        for context, levels in zip(get('contexts'), get('context_levels')):
+            in_context = _isin(context, ion_ids)
+            contexts.append(context[in_context])
+            context_levels.append(levels[in_context])
+        return {
+            'ion_ids': seg_ion_ids[keep],
+            'segment_idxs': get('segment_idxs')[keep],
+            'contexts': contexts,
+            'context_levels': context_levels,
+            'images': images,
+            'pairs': pairs,
+            'pruned_scores': pruned_scores,
+        }
+
+    def _load_segments(self, manifest: Dict, ion_ids: Optional[np.ndarray]) -> ColocCacheData:
+        try:
+            with ThreadPoolExecutor(4) as executor:
+                segments = list(
+                    executor.map(
+                        lambda segment: self._load_segment(segment, ion_ids), manifest['segments']
+                    )
+                )
+        except StorageNoSuchKeyError:
+            logger.warning(f'Colocalization cache {self.prefix} is incomplete, ignoring it')
+            return ColocCacheData()
+
+        algorithms = manifest['algorithms']
+        samples = manifest['samples']
+        if not segments:
+            return ColocCacheData(manifest['h'], manifest['w'], samples=samples)
+
+        # Make the segment indexes of each segment's ions and discarded scores point into
+        # the combined list of contexts
+        offsets = np.cumsum([0] + [len(segment['contexts']) for segment in segments])
+        # An ion can be in several segments if two jobs added it at the same time
+        all_ion_ids = np.concatenate([segment['ion_ids'] for segment in segments])
+        cached_ion_ids, first_idxs = np.unique(all_ion_ids, return_index=True)
+        segment_idxs = np.concatenate(
+            [segment['segment_idxs'] + offset for segment, offset in zip(segments, offsets)]
+        )
+        images = {
+            algorithm: _concat_rows([segment['images'][algorithm] for segment in segments])[
+                first_idxs
+            ]
+            for algorithm in algorithms
+        }
+        pairs = {
+            algorithm: pd.concat(
+                [segment['pairs'][algorithm] for segment in segments], ignore_index=True
+            ).drop_duplicates(['ion_id_a', 'ion_id_b'])
+            for algorithm in algorithms
+        }
+        pruned_scores = {
+            algorithm: pd.concat(
+                [
+                    segment['pruned_scores'][algorithm].assign(
+                        segment_idx=lambda df, offset=offset: df.segment_idx + offset
+                    )
+                    for segment, offset in zip(segments, offsets)
+                ],
+                ignore_index=True,
+            )
+            for algorithm in algorithms
+        }
+        return ColocCacheData(
+            manifest['h'],
+            manifest['w'],
+            cached_ion_ids,
+            images,
+            pairs,
+            samples,
+            segment_idxs[first_idxs],
+            [context for segment in segments for context in segment['contexts']],
+            [levels for segment in segments for levels in segment['context_levels']],
+            pruned_scores,
+        )
+
+    def load(self, ion_ids: np.ndarray) -> ColocCacheData:
+        """Loads the cached entries of `ion_ids`. Returns empty data if nothing is cached."""
+        manifest = self._load_manifest()
+        if manifest is None:
+            return ColocCacheData()
+        return self._load_segments(manifest, ion_ids)
+
+    def _save_segment(self, segment: Dict, h: int, w: int) -> Dict:
+        segment_id = self._new_id()
+        algorithms = list(segment['images'])
+        objs = {
+            'ion_ids': segment['ion_ids'],
+            'segment_idxs': segment['segment_idxs'],
+            'contexts': segment['contexts'],
+            'context_levels': segment['context_levels'],
+            **{f'images_{alg}': imgs for alg, imgs in segment['images'].items()},
+            **{f'pairs_{alg}': df for alg, df in segment['pairs'].items()},
+            **{f'pruned_scores_{alg}': df for alg, df in segment['pruned_scores'].items()},
+        }
+        for name, obj in objs.items():
+            save_cobj(
+                self.storage,
+                obj,
+                self.bucket,
+                self._segment_key(segment_id, name),
+                compression='zstd',
+            )
+        meta = {'id': segment_id, 'h': h, 'w': w, 'algorithms': algorithms}
+        save_cobj(self.storage, meta, self.bucket, self._segment_key(segment_id, 'meta'))
+        return meta
+
+    def _compact(self, manifest: Dict) -> List[Dict]:
+        """Rewrites all segments of the manifest as a single segment, so that loading doesn't
+        need to read every segment that was ever saved. Returns the replaced segments."""
+        data = self._load_segments(manifest, None)
+        if data.h is None:
+            # Another job deleted some of the segments while compacting them at the same time
+            return []
+        self._save_segment(
+            {
+                'ion_ids': data.ion_ids,
+                'segment_idxs': data._segment_idxs,  # pylint: disable=protected-access
+                'contexts': data._contexts,  # pylint: disable=protected-access
+                'context_levels': data._context_levels,  # pylint: disable=protected-access
+                'images': data.images,
+                'pairs': data.pairs,
+                'pruned_scores': data.pruned_scores,
+            },
+            manifest['h'],
+            manifest['w'],
+        )
+        return manifest['segments']
+
+    def _save_samples(self, samples: Dict, h: int, w: int) -> str:
+        samples_id = self._new_id()
+        obj = {'id': samples_id, 'h': h, 'w': w, 'samples': samples}
+        save_cobj(self.storage, obj, self.bucket, self._samples_key(samples_id))
+        return samples_id
+
+    def save(self, data: ColocCacheData):
+        """Saves the entries that were added to `data` since it was loaded"""
+        if data.new_segment is None and not data.new_samples:
+            return
+
+        manifest = self._load_manifest()
+        stale_segments, stale_samples_ids = [], []
+        if manifest is None:
+            # Caches for other parameters are left over from before the dataset was reprocessed
+            keys = self.storage.list_keys(self.bucket, f'{self.ds_prefix}/')
+            stale_keys = [key for key in keys if not key.startswith(f'{self.prefix}/')]
+            if stale_keys:
+                self.storage.delete_objects(self.bucket, stale_keys)
+        else:
+            stale_segments = manifest['stale_segments']
+            stale_samples_ids = manifest['stale_samples_ids']
+            if data.is_cleared or (manifest['h'], manifest['w']) != (data.h, data.w):
+                stale_segments = stale_segments + manifest['segments']
+                stale_samples_ids = stale_samples_ids + manifest['samples_ids']
+                manifest = None
+
+        if data.new_segment is not None:
+            segment = self._save_segment(data.new_segment, data.h, data.w)
+            if manifest is not None and len(manifest['segments']) >= MAX_CACHED_SEGMENTS:
+                manifest['segments'].append(segment)
+                stale_segments.extend(self._compact(manifest))
+
+        if data.new_samples:
+            samples = data.new_samples
+            if manifest is not None and len(manifest['samples_ids']) >= MAX_CACHED_SEGMENTS:
+                samples = {**manifest['samples'], **samples}
+                samples = dict(list(samples.items())[-MAX_CACHED_SAMPLES:])
+                stale_samples_ids.extend(manifest['samples_ids'])
+            self._save_samples(samples, data.h, data.w)
+
+        for segment in stale_segments:
+            self._delete_segment(segment['id'])
+        for samples_id in stale_samples_ids:
+            self._delete_keys(self._samples_key(samples_id))
+
+    def _delete_segment(self, segment_id: str):
+        # Delete the segment's meta object first, so that the segment isn't loaded partially
+        self._delete_keys(self._segment_key(segment_id, 'meta'))
+        self._delete_keys(f'{self.prefix}/{segment_id}/')
+
+    def _delete_keys(self, prefix):
+        keys = self.storage.list_keys(self.bucket, prefix)
+        if keys:
+            self.storage.delete_objects(self.bucket, keys)
+
+    def clear(self):
+        """Deletes all cached entries of the dataset, including those for other parameters"""
+        logger.info(f'Clearing colocalization cache {self.ds_prefix}')
+        self._delete_keys(f'{self.ds_prefix}/')
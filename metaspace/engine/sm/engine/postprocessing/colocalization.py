@@ -1,21 +1,29 @@
 import logging
+import os
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from traceback import format_exc
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 import numpy as np
 import pandas as pd
-from sklearn.metrics.pairwise import pairwise_kernels
-from sklearn.cluster import spectral_clustering
-from scipy.ndimage import zoom, median_filter
+from sklearn.cluster import k_means
+from sklearn.manifold import spectral_embedding
+from sklearn.preprocessing import normalize
+from threadpoolctl import threadpool_limits
+from scipy.ndimage import median_filter
+from scipy.sparse import issparse, coo_matrix, csr_matrix, vstack
+from lithops.storage import Storage
 
 from sm.engine.annotation_lithops.executor import Executor
 from sm.engine.annotation_lithops.io import save_cobj, iter_cobjs_with_prefetch
+from sm.engine.annotation_lithops.utils import jsonhash
 from sm.engine.dataset import Dataset
 from sm.engine.ion_mapping import get_ion_id_mapping
 from sm.engine.config import SMConfig
 from sm.engine.image_storage import ImageStorage
+from sm.engine.postprocessing.coloc_cache import ColocCache, ColocCacheData
 
 COLOC_JOB_DEL = 'DELETE FROM graphql.coloc_job WHERE ds_id = %s AND moldb_id = %s'
 
@@ -27,10 +35,8 @@ COLOC_JOB_INS = (
     'RETURNING id'
 )
 
-COLOC_ANN_INS = (
-    'INSERT INTO graphql.coloc_annotation(coloc_job_id, ion_id, coloc_ion_ids, coloc_coeffs) '
-    'VALUES (%s, %s, %s, %s)'
-)
+COLOC_ANN_TABLE = 'graphql.coloc_annotation'
+COLOC_ANN_COLUMNS = ['coloc_job_id', 'ion_id', 'coloc_ion_ids', 'coloc_coeffs']
 
 SUCCESSFUL_COLOC_JOB_SEL = (
     'SELECT moldb_id FROM graphql.coloc_job '
@@ -40,7 +46,7 @@ SUCCESSFUL_COLOC_JOB_SEL = (
 )
 
 ANNOTATIONS_SEL = (
-    'SELECT iso_image_ids[1], formula, chem_mod, neutral_loss, adduct, fdr '
+    'SELECT iso_image_ids[1], formula, chem_mod, neutral_loss, adduct, fdr, job_id '
     'FROM annotation m '
     'WHERE m.job_id = ('
     '    SELECT id FROM job j '
@@ -56,6 +62,21 @@ DATASET_CONFIG_SEL = (
     "WHERE id = %s"
 )
 
+#: FDR levels that colocalization jobs are run at
+FDR_LEVELS = [0.05, 0.1, 0.2, 0.5]
+#: Algorithms that colocalization jobs are run with
+COLOC_ALGORITHMS = ['median_thresholded_cosine', 'cosine']
+#: Approximate memory limit for the part of the similarity matrix that is computed at once
+COLOC_BLOCK_MEM_MB = 256
+#: Scores below this are discarded
+COLOC_MIN_SCORE = 0.3
+#: Maximum number of colocalized annotations stored per annotation
+COLOC_MAX_SAMPLES = 100
+#: Number of k-means restarts when clustering annotations into each number of clusters
+COLOC_KMEANS_N_INIT = 100
+#: Number of parallel tasks that the k-means restarts of each number of clusters are split into
+COLOC_KMEANS_N_TASKS = 10
+
 logger = logging.getLogger('engine')
 
 
@@ -141,28 +162,58 @@ def _labels_to_clusters(labels, scores):
     return [sorted(cluster, key=lambda i: -typicalness[i]) for cluster in clusters]
 
 
-def _label_clusters(scores):
+def _run_kmeans(embedding, n_clusters, seed, n_init):
+    _, labels, inertia = k_means(
+        embedding[:, :n_clusters], n_clusters, random_state=seed, n_init=n_init
+    )
+    return inertia, labels
+
+
+def _label_clusters(scores, random_state=1):
+    # pylint: disable=too-many-locals
     n_samples = scores.shape[0]
     min_clusters = min(int(np.round(np.sqrt(n_samples))), 20)
     max_clusters = min(n_samples, 20)
 
-    results = []
-    last_error = None
-
+    # Similar to running `spectral_clustering` for each number of clusters, except that the
+    # eigendecomposition is only done once. Each number of clusters uses the leading eigenvectors
+    # of the embedding.
+    random_state = np.random.RandomState(random_state)
     with warnings.catch_warnings():
         warnings.filterwarnings(
             'ignore',
             '.*Graph is not fully connected, spectral embedding may not work as expected.*',
         )
-        for n_clusters in range(min_clusters, max_clusters + 1):
-            try:
-                labels = spectral_clustering(
-                    affinity=scores, n_clusters=n_clusters, random_state=1, n_init=100
-                )
-                cluster_score = np.mean([scores[a, b] for a, b in enumerate(labels)])
-                results.append((n_clusters, cluster_score, labels))
-            except Exception as e:
-                last_error = e
+        embedding = spectral_embedding(
+            scores, n_components=max_clusters, random_state=random_state, drop_first=False
+        )
+
+    # The k-means restarts are split into a fixed number of tasks with their own seeds, so that
+    # they can run in parallel and the labels don't depend on the number of threads.
+    # Each task is limited to one OpenMP/BLAS thread so that the pool doesn't oversubscribe the CPU
+    seeds = random_state.randint(np.iinfo(np.int32).max, size=COLOC_KMEANS_N_TASKS).tolist()
+    n_init = -(-COLOC_KMEANS_N_INIT // COLOC_KMEANS_N_TASKS)
+    n_threads = min(COLOC_KMEANS_N_TASKS, os.cpu_count() or 1)
+    with threadpool_limits(limits=1), ThreadPoolExecutor(n_threads) as executor:
+        futures = {
+            n_clusters: [
+                executor.submit(_run_kmeans, embedding, n_clusters, seed, n_init) for seed in seeds
+            ]
+            for n_clusters in range(min_clusters, max_clusters + 1)
+        }
+
+    results = []
+    last_error = None
+    for n_clusters, n_clusters_futures in futures.items():
+        try:
+            # Keep the restart with the lowest inertia, preferring earlier tasks on ties
+            _, labels = min(
+                (future.result() for future in n_clusters_futures), key=lambda result: result[0]
+            )
+            cluster_score = np.mean([scores[a, b] for a, b in enumerate(labels)])
+            results.append((n_clusters, cluster_score, labels))
+        except Exception as e:
+            last_error = e
 
     if not results:
         raise last_error
@@ -177,57 +228,278 @@ def _label_clusters(scores):
     return best_labels
 
 
-def _get_best_colocs(scores, max_samples, min_score):
-    coloc_idxs = []
-    for i in range(scores.shape[0]):
-        pairing_scores = scores[i, :].copy()
-        pairing_scores[pairing_scores < min_score] = 0  # Discard scores below threshold
-        pairing_scores[i] = 0  # Ignore self-correlation
+def _normalize_rows(images):
+    """L2-normalizes each row of a dense or sparse matrix, in place if possible.
+    Rows that are all zeros are left as zeros, so that their similarity to everything is 0."""
+    if images.shape[0] == 0:
+        return images
+    return normalize(images, copy=False)
+
+
+def _get_block_rows(n_images, block_mem_mb):
+    """Number of rows of the n_images x n_images similarity matrix to compute at once.
+    Each block is copied once while it's filtered."""
+    return max(int(block_mem_mb * 1024 * 1024 / (n_images * 4 * 2)), 1)
+
+
+def _median_threshold_images(images, h, w, block_rows):
+    """Returns a copy of the images where the pixels of each image that are below its median are
+    zeroed and a 3x3 median filter is applied. Images are processed `block_rows` at a time."""
+    is_sparse = issparse(images)
+    result = [] if is_sparse else np.empty_like(images)
+    for start in range(0, images.shape[0], block_rows):
+        block = images[start : start + block_rows]
+        block = block.toarray() if is_sparse else block.copy()
+        cnt = block.shape[0]
+        block[block < np.quantile(block, 0.5, axis=1, keepdims=True)] = 0
+        block = median_filter(block.reshape((cnt, h, w)), (1, 3, 3)).reshape((cnt, h * w))
+        if is_sparse:
+            result.append(csr_matrix(block))
+        else:
+            result[start : start + block_rows] = block
 
-        num_above_min_score = np.count_nonzero(pairing_scores)
-        num_to_keep = np.minimum(num_above_min_score, max_samples)
+    if is_sparse:
+        return vstack(result, format='csr') if result else images.copy()
+    return result
 
-        coloc_idxs.append(list(np.argsort(pairing_scores)[::-1][:num_to_keep]))
 
-    return coloc_idxs
+def _empty_pairs():
+    return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
 
 
-def _format_coloc_annotations(ion_ids, scores, colocs):
-    for i, js in enumerate(colocs):  # pylint: disable=invalid-name
-        sorted_js = sorted(js, key=lambda j: -scores[i, j])  # pylint: disable=cell-var-from-loop
-        base_ion_id = ion_ids.item(i)
-        other_ion_ids = [ion_ids.item(j) for j in sorted_js]
-        other_ion_scores = [scores.item((i, j)) for j in sorted_js]
+def _concat_pairs(pair_sets):
+    return tuple(np.concatenate(arrs) for arrs in zip(*pair_sets))
 
-        yield base_ion_id, other_ion_ids, other_ion_scores
 
+def _get_top_pairs(idxs_a, idxs_b, scores, fdr_masks, max_samples):
+    """Returns a mask of the pairs that are among the top `max_samples` pairs of either of their
+    images at any FDR level, ranked in the same order as `_get_best_colocs`. Each pair must only
+    be included once."""
+    n_pairs = len(scores)
+    keep = np.zeros(n_pairs, dtype=bool)
+    srcs, dsts = np.concatenate([idxs_a, idxs_b]), np.concatenate([idxs_b, idxs_a])
+    src_scores = np.concatenate([scores, scores])
+    pair_idxs = np.tile(np.arange(n_pairs), 2)
+    for fdr_mask in fdr_masks.values():
+        in_level = np.flatnonzero(fdr_mask[srcs] & fdr_mask[dsts])
+        order = in_level[np.lexsort((dsts[in_level], -src_scores[in_level], srcs[in_level]))]
+        sorted_srcs = srcs[order]
+        ranks = np.arange(len(order)) - np.searchsorted(sorted_srcs, sorted_srcs)
+        keep[pair_idxs[order[ranks < max_samples]]] = True
+    return keep
 
-def _downscale_image_if_required(img, num_annotations):
-    # Aim for a maximum of 0.5 gigapixel (=2GB) total across the whole dataset,
-    # as multiple copies are created during processing
-    max_pixels = int(512 * 1024 * 1024 / num_annotations)
 
-    zoom_factor = (max_pixels / (img.shape[0] * img.shape[1])) ** 0.5
-    if zoom_factor > 1:
-        return img
-    with warnings.catch_warnings():
-        # ignore "UserWarning: From scipy 0.13.0, the output shape of zoom() is calculated
-        # with round() instead of int()
-        # - for these inputs the size of the returned array has changed."
-        warnings.filterwarnings('ignore', '.*the output shape of zoom.*')
-        return zoom(img, zoom_factor)
+def _record_pruned_scores(pruned_scores, idxs_a, idxs_b, scores, fdr_masks):
+    """Raises `pruned_scores`, a (n_images, n_levels) array, to the highest score of each image's
+    discarded pairs with images at each FDR level"""
+    for level_i, fdr_mask in enumerate(fdr_masks.values()):
+        b_in_level, a_in_level = fdr_mask[idxs_b], fdr_mask[idxs_a]
+        np.maximum.at(pruned_scores[:, level_i], idxs_a[b_in_level], scores[b_in_level])
+        np.maximum.at(pruned_scores[:, level_i], idxs_b[a_in_level], scores[a_in_level])
+
+
+def _prune_pairs(pairs, fdr_masks, max_samples, pruned_scores):
+    """Keeps only the pairs that are among the top pairs of either of their images at any FDR
+    level. Scores of discarded pairs are recorded in `pruned_scores`."""
+    idxs_a, idxs_b, scores = pairs
+    keep = _get_top_pairs(idxs_a, idxs_b, scores, fdr_masks, max_samples)
+    _record_pruned_scores(pruned_scores, idxs_a[~keep], idxs_b[~keep], scores[~keep], fdr_masks)
+    return idxs_a[keep], idxs_b[keep], scores[keep]
+
+
+def _collect_top_pairs(pair_blocks, n_images, fdr_masks, max_samples):
+    """Combines blocks of (idxs_a, idxs_b, scores) pairs, in which each pair is only included
+    once, keeping only the top pairs. Blocks are pruned once enough pairs are pending, so that
+    the cost of pruning is spread over many blocks.
+
+    Returns
+    ----------
+    tuple[tuple[np.ndarray, np.ndarray, np.ndarray], np.ndarray]
+        (image_idxs_a, image_idxs_b, scores) of the kept pairs, and a (n_images, n_levels) array
+        of the highest score of each image's discarded pairs with images at each FDR level
+    """
+    pruned_scores = np.zeros((n_images, len(fdr_masks)), dtype=np.float32)
+    pair_sets, n_pending = [_empty_pairs()], 0
+    for block_pairs in pair_blocks:
+        pair_sets.append(block_pairs)
+        n_pending += len(block_pairs[2])
+        if n_pending > n_images * max_samples:
+            pair_sets = [
+                _prune_pairs(_concat_pairs(pair_sets), fdr_masks, max_samples, pruned_scores)
+            ]
+            n_pending = 0
+    pairs = _prune_pairs(_concat_pairs(pair_sets), fdr_masks, max_samples, pruned_scores)
+    return pairs, pruned_scores
+
+
+def _get_thresholded_scores(
+    normed_images,
+    row_idxs,
+    block_rows,
+    fdr_masks,
+    max_samples=COLOC_MAX_SAMPLES,
+    min_score=COLOC_MIN_SCORE,
+):
+    """Calculates the cosine similarities of the images at `row_idxs` with all images.
+
+    The similarity matrix is computed `block_rows` rows at a time from L2-normalized images, and
+    only the pairs with a score of at least `min_score` that are among the top `max_samples`
+    pairs of either image at any FDR level are kept, instead of the whole matrix.
+
+    Returns
+    ----------
+    tuple[tuple[np.ndarray, np.ndarray, np.ndarray], np.ndarray]
+        (image_idxs_a, image_idxs_b, scores) of each kept pair, excluding self-similarity and
+        only including each pair once, and the discarded scores as in `_collect_top_pairs`
+    """
+    is_row = np.zeros(normed_images.shape[0], dtype=bool)
+    is_row[row_idxs] = True
+
+    def iter_blocks():
+        for start in range(0, len(row_idxs), block_rows):
+            block_idxs = row_idxs[start : start + block_rows]
+            block = normed_images[block_idxs] @ normed_images.T
+            block = block.toarray() if issparse(block) else np.asarray(block)
+            block_rows_i, block_cols = np.nonzero(block >= min_score)
+            # Ignore self-correlation, and only keep one direction of pairs of two rows
+            keep = ~is_row[block_cols] | (block_idxs[block_rows_i] < block_cols)
+            block_rows_i, block_cols = block_rows_i[keep], block_cols[keep]
+            yield block_idxs[block_rows_i], block_cols, block[block_rows_i, block_cols]
+
+    return _collect_top_pairs(iter_blocks(), normed_images.shape[0], fdr_masks, max_samples)
+
+
+def _get_block_scores(
+    normed_images,
+    row_idxs,
+    col_idxs,
+    is_missing,
+    block_rows,
+    fdr_masks,
+    max_samples=COLOC_MAX_SAMPLES,
+    min_score=COLOC_MIN_SCORE,
+):
+    """Calculates the cosine similarities of the pairs of images in `is_missing`, a boolean mask
+    of shape (len(row_idxs), len(col_idxs)), in the same format as `_get_thresholded_scores`"""
+    col_images = normed_images[col_idxs]
+
+    def iter_blocks():
+        for start in range(0, len(row_idxs), block_rows):
+            block = normed_images[row_idxs[start : start + block_rows]] @ col_images.T
+            block = block.toarray() if issparse(block) else np.asarray(block)
+            block_rows_i, block_cols = np.nonzero(
+                (block >= min_score) & is_missing[start : start + block_rows]
+            )
+            yield (
+                row_idxs[start + block_rows_i],
+                col_idxs[block_cols],
+                block[block_rows_i, block_cols],
+            )
+
+    return _collect_top_pairs(iter_blocks(), normed_images.shape[0], fdr_masks, max_samples)
+
+
+def _merge_pairs(pair_sets, n_images, fdr_masks, max_samples, pruned_scores):
+    """Combines sets of (idxs_a, idxs_b, scores, is_calculated) pairs that may overlap, keeping
+    the first copy of each pair and only the top pairs. Only discarded pairs that were calculated
+    by this job are recorded in `pruned_scores`, as the cached ones stay cached."""
+    idxs_a, idxs_b, scores, is_calculated = _concat_pairs(pair_sets)
+    pair_keys = np.minimum(idxs_a, idxs_b) * n_images + np.maximum(idxs_a, idxs_b)
+    _, first_idxs = np.unique(pair_keys, return_index=True)
+    idxs_a, idxs_b = idxs_a[first_idxs], idxs_b[first_idxs]
+    scores, is_calculated = scores[first_idxs], is_calculated[first_idxs]
+
+    keep = _get_top_pairs(idxs_a, idxs_b, scores, fdr_masks, max_samples)
+    discard = ~keep & is_calculated
+    _record_pruned_scores(
+        pruned_scores, idxs_a[discard], idxs_b[discard], scores[discard], fdr_masks
+    )
+    return idxs_a[keep], idxs_b[keep], scores[keep], is_calculated[keep]
+
+
+def _with_is_calculated(pairs, is_calculated):
+    return (*pairs, np.full(len(pairs[2]), is_calculated))
+
+
+def _get_uncertain_idxs(colocs, cached_pruned_scores, max_samples):
+    """Finds the images that a previous job may have discarded cached pairs of that would be
+    among their top pairs now, i.e. those whose lowest top score at an FDR level (or 0 if they
+    have fewer than `max_samples` partners) isn't higher than their highest discarded score"""
+    is_uncertain = np.zeros(len(cached_pruned_scores), dtype=bool)
+    for level_i, fdr_colocs in enumerate(colocs.values()):
+        for i, _, scores in fdr_colocs:
+            pruned_score = cached_pruned_scores[i, level_i]
+            min_top_score = scores[-1] if len(scores) >= max_samples else 0
+            if pruned_score > 0 and pruned_score >= min_top_score:
+                is_uncertain[i] = True
+    return np.flatnonzero(is_uncertain)
+
+
+def _get_best_colocs(pair_scores, fdr_masks, max_samples=COLOC_MAX_SAMPLES):
+    """Finds the most colocalized images of each image among the images in each FDR mask.
+
+    Args
+    ----------
+    pair_scores: scipy.sparse.csr_matrix
+        Symmetric matrix of the scores of all pairs of images that are high enough to be kept
+    fdr_masks: dict[float, np.ndarray]
+        For each FDR level, a boolean mask of the images that are annotated at that level
+    max_samples: int
+
+    Returns
+    ----------
+    dict[float, list[tuple[int, np.ndarray, np.ndarray]]]
+        For each FDR level, (image_idx, partner_image_idxs, partner_scores) for each image in its
+        mask, with the top `max_samples` partners sorted by descending score.
+    """
+    colocs = {}
+    for fdr, fdr_mask in fdr_masks.items():
+        fdr_idxs = np.flatnonzero(fdr_mask)
+        masked_scores = pair_scores[fdr_idxs][:, fdr_idxs].tocsr()
+        colocs[fdr] = []
+        for i, start, end in zip(
+            fdr_idxs.tolist(), masked_scores.indptr[:-1], masked_scores.indptr[1:]
+        ):
+            col_idxs, row_scores = masked_scores.indices[start:end], masked_scores.data[start:end]
+            if len(col_idxs) > max_samples:
+                top = np.argpartition(-row_scores, max_samples - 1)[:max_samples]
+                col_idxs, row_scores = col_idxs[top], row_scores[top]
+            order = np.lexsort((col_idxs, -row_scores))
+            colocs[fdr].append((i, fdr_idxs[col_idxs[order]], row_scores[order]))
+
+    return colocs
+
+
+def _merge_rows(new_rows, cached_rows, is_new):
+    """Combines the rows of new and cached images into one matrix in the order given by `is_new`"""
+    if cached_rows is None or cached_rows.shape[0] == 0:
+        return new_rows
+    if issparse(new_rows) or issparse(cached_rows):
+        rows = vstack([csr_matrix(new_rows), csr_matrix(cached_rows)], format='csr')
+    else:
+        rows = np.concatenate([new_rows, cached_rows])
+    order = np.argsort(np.concatenate([np.flatnonzero(is_new), np.flatnonzero(~is_new)]))
+    return rows[order]
 
 
-def _median_thresholded_cosine(images, h, w):
-    cnt = images.shape[0]
-    images[images < np.quantile(images, 0.5, axis=1, keepdims=True)] = 0
-    images = median_filter(images.reshape((cnt, h, w)), (1, 3, 3)).reshape((cnt, h * w))
-    return pairwise_kernels(images, metric='cosine')
+def _pairs_to_matrix(n_images, idxs_a, idxs_b, scores):
+    """Makes a symmetric sparse matrix from pairs that are each only included once"""
+    return coo_matrix(
+        (
+            np.concatenate([scores, scores]),
+            (np.concatenate([idxs_a, idxs_b]), np.concatenate([idxs_b, idxs_a])),
+        ),
+        shape=(n_images, n_images),
+    ).tocsr()
 
 
-def _get_sample_ion_ids(scores, cluster_max_images, trunc_fdr_mask, trunc_masked_ion_ids):
+def _format_coloc_annotations(ion_ids, colocs):
+    for i, js, scores in colocs:  # pylint: disable=invalid-name
+        yield ion_ids.item(i), ion_ids[js].tolist(), scores.tolist()
+
+
+def _get_sample_ion_ids(trunc_scores, trunc_fdr_mask, trunc_masked_ion_ids):
     try:
-        trunc_scores = scores[:cluster_max_images, :cluster_max_images]
         trunc_masked_scores = trunc_scores[trunc_fdr_mask, :][:, trunc_fdr_mask]
         logger.debug(f'Clustering with ' f'{trunc_masked_scores.shape[0]} annotations')
         labels = _label_clusters(trunc_masked_scores)
@@ -239,16 +511,115 @@ def _get_sample_ion_ids(scores, cluster_max_images, trunc_fdr_mask, trunc_masked
         return []
 
 
+def _get_new_pairs_df(ion_ids, idxs_a, idxs_b, scores):
+    ion_ids_a, ion_ids_b = ion_ids[idxs_a], ion_ids[idxs_b]
+    return pd.DataFrame(
+        {
+            'ion_id_a': np.minimum(ion_ids_a, ion_ids_b),
+            'ion_id_b': np.maximum(ion_ids_a, ion_ids_b),
+            'score': scores.astype(np.float32),
+        }
+    )
+
+
+def _get_pruned_scores_df(ion_ids, pruned_scores):
+    idxs, levels = np.nonzero(pruned_scores)
+    return pd.DataFrame(
+        {'ion_id': ion_ids[idxs], 'level': levels, 'score': pruned_scores[idxs, levels]}
+    )
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+def _get_colocs(
+    algorithm,
+    normed_images,
+    ion_ids,
+    new_idxs,
+    missing_pair_blocks,
+    fdr_masks,
+    block_rows,
+    max_samples,
+    cache_data,
+):
+    """Finds the top colocalized images of each image using the newly calculated and the cached
+    pairs of images.
+
+    Returns
+    ----------
+    tuple[dict, pd.DataFrame, pd.DataFrame]
+        the colocs as in `_get_best_colocs`, and the newly calculated pairs and discarded scores
+        to cache, which are empty if nothing was calculated
+    """
+    n_images = len(ion_ids)
+    pruned_scores = np.zeros((n_images, len(fdr_masks)), dtype=np.float32)
+    pair_sets = [_with_is_calculated(cache_data.get_pairs(algorithm, ion_ids), False)]
+    calculated = [
+        _get_thresholded_scores(normed_images, new_idxs, block_rows, fdr_masks, max_samples)
+    ]
+    for row_idxs, col_idxs, is_missing in missing_pair_blocks:
+        calculated.append(
+            _get_block_scores(
+                normed_images, row_idxs, col_idxs, is_missing, block_rows, fdr_masks, max_samples
+            )
+        )
+    for pairs, block_pruned_scores in calculated:
+        pair_sets.append(_with_is_calculated(pairs, True))
+        np.maximum(pruned_scores, block_pruned_scores, out=pruned_scores)
+    pairs = _merge_pairs(pair_sets, n_images, fdr_masks, max_samples, pruned_scores)
+    colocs = _get_best_colocs(_pairs_to_matrix(n_images, *pairs[:3]), fdr_masks, max_samples)
+
+    # Cached pairs were only kept if they were among the top pairs in the jobs that calculated
+    # them. If a discarded pair could be among the top pairs now, e.g. because some annotations
+    # were removed, the scores of its images are calculated again
+    levels = np.stack(list(fdr_masks.values()), axis=1)
+    uncertain_idxs = _get_uncertain_idxs(
+        colocs, cache_data.get_pruned_scores(algorithm, ion_ids, levels), max_samples
+    )
+    if len(uncertain_idxs):
+        logger.debug(f'Recalculating {algorithm} scores of {len(uncertain_idxs)} cached images')
+        row_pairs, row_pruned_scores = _get_thresholded_scores(
+            normed_images, uncertain_idxs, block_rows, fdr_masks, max_samples
+        )
+        np.maximum(pruned_scores, row_pruned_scores, out=pruned_scores)
+        pairs = _merge_pairs(
+            [pairs, _with_is_calculated(row_pairs, True)],
+            n_images,
+            fdr_masks,
+            max_samples,
+            pruned_scores,
+        )
+        colocs = _get_best_colocs(_pairs_to_matrix(n_images, *pairs[:3]), fdr_masks, max_samples)
+
+    idxs_a, idxs_b, scores, is_calculated = pairs
+    new_pairs_df = _get_new_pairs_df(
+        ion_ids, idxs_a[is_calculated], idxs_b[is_calculated], scores[is_calculated]
+    )
+    return colocs, new_pairs_df, _get_pruned_scores_df(ion_ids, pruned_scores)
+
+
 # pylint: disable=cell-var-from-loop
-def analyze_colocalization(ds_id, moldb_id, images, ion_ids, fdrs, h, w, cluster_max_images=5000):
+def analyze_colocalization(  # pylint: disable=too-many-statements
+    ds_id,
+    moldb_id,
+    images,
+    ion_ids,
+    fdrs,
+    h,
+    w,
+    cluster_max_images=5000,
+    block_mem_mb=COLOC_BLOCK_MEM_MB,
+    cache_data=None,
+    max_samples=COLOC_MAX_SAMPLES,
+):
     """Calculate co-localization of ion images for all algorithms and yield results
 
     Args
     ----------
     ds_id: str
     moldb_id: int
-    images: FreeableRef[np.ndarray]
-        2D array where each row contains the pixels from one image
+    images: FreeableRef[np.ndarray | scipy.sparse.spmatrix]
+        2D array or sparse matrix where each row contains the pixels from one image.
+        If `cache_data` is specified, only the images of the ions that aren't cached
         WARNING: This FreeableRef is released during use to save memory
     ion_ids: np.ndarray
         1D array where each item is the ion_id for the corresponding row in images
@@ -256,9 +627,20 @@ def analyze_colocalization(ds_id, moldb_id, images, ion_ids, fdrs, h, w, cluster
         1D array where each item is the fdr for the corresponding row in images
     cluster_max_images: int
         maximum number of images used for clustering
+    block_mem_mb: int
+        approximate memory limit for the blocks of the similarity matrix that are
+        computed at once
+    cache_data: ColocCacheData
+        Previously calculated image vectors, scores and clusterings to reuse. Entries that are
+        calculated are added to it, so that they can be saved after all jobs have been consumed.
+    max_samples: int
+        maximum number of colocalized annotations per annotation. Only the scores of pairs that
+        are among the top `max_samples` of either annotation at any FDR level are kept
     """
+    cache_data = cache_data if cache_data is not None else ColocCacheData()
+    is_new = ~cache_data.is_cached(ion_ids)
     assert images.ref.shape[1] >= 3
-    assert images.ref.shape[0] == ion_ids.shape[0] == fdrs.shape[0], (
+    assert images.ref.shape[0] == is_new.sum() and ion_ids.shape[0] == fdrs.shape[0], (
         images.ref.shape,
         ion_ids.shape,
         fdrs.shape,
@@ -269,36 +651,89 @@ def analyze_colocalization(ds_id, moldb_id, images, ion_ids, fdrs, h, w, cluster
         logger.info('Not enough annotations to perform colocalization')
         return
 
-    logger.debug('Calculating colocalization metrics')
-    cos_scores = pairwise_kernels(images.ref, metric='cosine')
-    med_cos_scores = _median_thresholded_cosine(images.ref, h, w)
+    logger.debug(
+        f'Calculating colocalization metrics ({is_new.sum()} of {len(ion_ids)} images not cached)'
+    )
+    fdr_masks = {fdr: fdrs <= fdr + 0.001 for fdr in FDR_LEVELS}
+    n_trunc = min(len(ion_ids), cluster_max_images)
+    new_idxs = np.flatnonzero(is_new)
+    block_rows = _get_block_rows(len(ion_ids), block_mem_mb)
+    # Sparse images are made dense a block at a time, so the block's pixels are limited as well
+    med_block_rows = min(block_rows, _get_block_rows(h * w, block_mem_mb))
+    med_images = _median_threshold_images(images.ref, h, w, med_block_rows)
+    new_images = {'cosine': _normalize_rows(images.ref)}
     images.free()
+    new_images['median_thresholded_cosine'] = _normalize_rows(med_images)
+    del med_images
+
+    missing_pair_blocks = list(cache_data.iter_missing_pair_blocks(ion_ids))
+    colocs, new_pairs, new_pruned_scores = {}, {}, {}
+    for algorithm in COLOC_ALGORITHMS:
+        cached_images = (
+            cache_data.get_images(algorithm, ion_ids[~is_new]) if not is_new.all() else None
+        )
+        normed_images = _merge_rows(new_images[algorithm], cached_images, is_new)
+        colocs[algorithm], new_pairs[algorithm], new_pruned_scores[algorithm] = _get_colocs(
+            algorithm,
+            normed_images,
+            ion_ids,
+            new_idxs,
+            missing_pair_blocks,
+            fdr_masks,
+            block_rows,
+            max_samples,
+            cache_data,
+        )
+        if algorithm == 'median_thresholded_cosine':
+            trunc_images = normed_images[:n_trunc]
+        del normed_images
+
+    has_new_scores = any(not df.empty for df in [*new_pairs.values(), *new_pruned_scores.values()])
+    if len(new_idxs) or missing_pair_blocks or has_new_scores:
+        cache_data.add_entries(
+            h,
+            w,
+            ion_ids[new_idxs],
+            new_images,
+            new_pairs,
+            new_pruned_scores,
+            context_ion_ids=ion_ids,
+            context_levels=np.stack(list(fdr_masks.values()), axis=1),
+        )
+    del new_images
 
-    trunc_ion_ids = ion_ids[:cluster_max_images]
-    trunc_fdrs = fdrs[:cluster_max_images]
+    trunc_ion_ids = ion_ids[:n_trunc]
+    trunc_scores = None
 
-    for fdr in [0.05, 0.1, 0.2, 0.5]:
-        fdr_mask = fdrs <= fdr + 0.001
+    for fdr in FDR_LEVELS:
+        fdr_mask = fdr_masks[fdr]
         masked_ion_ids = ion_ids[fdr_mask]
 
-        trunc_fdr_mask = trunc_fdrs <= fdr + 0.001
+        trunc_fdr_mask = fdr_mask[:n_trunc]
         trunc_masked_ion_ids = trunc_ion_ids[trunc_fdr_mask]
 
         if len(masked_ion_ids) > 1:
-            sample_ion_ids = _get_sample_ion_ids(
-                med_cos_scores, cluster_max_images, trunc_fdr_mask, trunc_masked_ion_ids
-            )
+            # Clustering only depends on the clustered images, so it's only re-run if they changed
+            samples_key = jsonhash(trunc_masked_ion_ids.tolist())
+            sample_ion_ids = cache_data.samples.get(samples_key)
+            if sample_ion_ids is None:
+                if trunc_scores is None:
+                    trunc_scores = trunc_images @ trunc_images.T
+                    trunc_scores = (
+                        trunc_scores.toarray() if issparse(trunc_scores) else trunc_scores
+                    )
+                sample_ion_ids = _get_sample_ion_ids(
+                    trunc_scores, trunc_fdr_mask, trunc_masked_ion_ids
+                )
+                if sample_ion_ids:
+                    cache_data.add_samples(samples_key, sample_ion_ids)
 
-            def run_alg(algorithm, scores):
+            def make_job(algorithm):
                 logger.debug(
                     f'Finding best colocalizations with {algorithm} at FDR {fdr} '
                     f'({len(masked_ion_ids)} annotations)'
                 )
-                masked_scores = scores if fdr_mask.all() else scores[fdr_mask, :][:, fdr_mask]
-                colocs = _get_best_colocs(masked_scores, max_samples=100, min_score=0.3)
-                coloc_annotations = list(
-                    _format_coloc_annotations(masked_ion_ids, masked_scores, colocs)
-                )
+                coloc_annotations = list(_format_coloc_annotations(ion_ids, colocs[algorithm][fdr]))
                 return ColocalizationJob(
                     ds_id,
                     moldb_id,
@@ -311,21 +746,53 @@ def analyze_colocalization(ds_id, moldb_id, images, ion_ids, fdrs, h, w, cluster
                     coloc_annotations=coloc_annotations,
                 )
 
-            yield run_alg('median_thresholded_cosine', med_cos_scores)
-            yield run_alg('cosine', cos_scores)
+            yield make_job('median_thresholded_cosine')
+            yield make_job('cosine')
         else:
             logger.debug(
                 f'Skipping FDR {fdr} as there are only {len(masked_ion_ids)} annotation(s)'
             )
 
 
+def _load_images(image_storage, ds_id, image_ids, job_ids):
+    logger.debug(f'Getting {len(image_ids)} images')
+    # Ion images are mostly empty, so they're kept sparse at full resolution instead of being
+    # downsampled to fit a dense array in memory
+    images, _, (h, w) = image_storage.get_ion_images_for_analysis(
+        ds_id, image_ids, job_ids=job_ids, sparse=True
+    )
+    logger.debug(f'Finished getting images. Image size: {h}x{w}')
+    return images, h, w
+
+
 def _get_images(
-    image_storage: ImageStorage, ds_id: str, image_ids: List[str]
+    image_storage: ImageStorage,
+    ds_id: str,
+    image_ids: List[str],
+    job_ids: List[int],
+    ion_ids: np.ndarray = None,
+    cache_data: ColocCacheData = None,
 ) -> Tuple[FreeableRef, int, int]:
+    """Gets the images for analysis. If `cache_data` is specified, only the images of the ions
+    that aren't cached are loaded. If they don't have the same shape as the cached images,
+    the cache entries are discarded and all images are loaded."""
+    if cache_data is not None and len(cache_data.ion_ids):
+        new_idxs = np.flatnonzero(~cache_data.is_cached(ion_ids))
+        if len(new_idxs) == 0:
+            images = np.zeros((0, cache_data.h * cache_data.w), dtype=np.float32)
+            return FreeableRef(images), cache_data.h, cache_data.w
+
+        images, h, w = _load_images(
+            image_storage, ds_id, [image_ids[i] for i in new_idxs], [job_ids[i] for i in new_idxs]
+        )
+        if (h, w) == (cache_data.h, cache_data.w):
+            return FreeableRef(images), h, w
+
+        logger.info('Image size differs from cached images. Discarding colocalization cache')
+        cache_data.clear()
+
     if image_ids:
-        logger.debug(f'Getting {len(image_ids)} images')
-        images, _, (h, w) = image_storage.get_ion_images_for_analysis(ds_id, image_ids)
-        logger.debug(f'Finished getting images. Image size: {h}x{w}')
+        images, h, w = _load_images(image_storage, ds_id, image_ids, job_ids)
     else:
         images = np.zeros((0, 0), dtype=np.float32)
         h, w = 1, 1
@@ -333,10 +800,72 @@ def _get_images(
     return FreeableRef(images), h, w
 
 
+def _get_cache_params(ds_config):
+    """Parameters that affect the cached colocalization entries of a dataset"""
+    return {
+        'ds_config': {k: v for k, v in ds_config.items() if k != 'database_ids'},
+        'min_score': COLOC_MIN_SCORE,
+        'max_samples': COLOC_MAX_SAMPLES,
+        'fdr_levels': FDR_LEVELS,
+    }
+
+
+def _run_coloc_task(
+    image_storage: ImageStorage,
+    cache: Optional[ColocCache],
+    ds_id,
+    moldb_id,
+    image_ids,
+    ion_ids,
+    fdrs,
+    job_ids,
+):
+    """Yields the colocalization jobs of one molecular database, reusing and updating `cache`
+    if it's specified. Failing to use the cache doesn't fail the jobs."""
+    cache_data = None
+    if cache is not None:
+        try:
+            cache_data = cache.load(ion_ids)
+        except Exception:
+            logger.warning('Failed to load colocalization cache', exc_info=True)
+            cache_data = ColocCacheData()
+
+    images, h, w = _get_images(image_storage, ds_id, image_ids, job_ids, ion_ids, cache_data)
+    yield from analyze_colocalization(
+        ds_id, moldb_id, images, ion_ids, fdrs, h, w, cache_data=cache_data
+    )
+
+    if cache is not None:
+        try:
+            cache.save(cache_data)
+        except Exception:
+            logger.warning('Failed to save colocalization cache', exc_info=True)
+
+
 class Colocalization:
-    def __init__(self, db):
+    def __init__(self, db, use_cache=True):
+        """
+        Args:
+            db: DB instance
+            use_cache: Whether to reuse the image vectors, scores and clusterings of previous
+                colocalization jobs of the dataset. Requires the `pipeline_cache` Lithops storage.
+        """
         self._db = db
         self._sm_config = SMConfig.get_conf()
+        self._cache_sm_storage = None
+        sm_storage = self._sm_config.get('lithops', {}).get('sm_storage', {})
+        if use_cache and 'pipeline_cache' in sm_storage:
+            self._cache_sm_storage = sm_storage
+
+    def _get_cache(self, storage: Storage, ds: Dataset) -> Optional[ColocCache]:
+        if self._cache_sm_storage is None:
+            return None
+        return ColocCache(storage, self._cache_sm_storage, ds.id, _get_cache_params(ds.config))
+
+    def delete_cache(self, ds: Dataset):
+        """Deletes the cached colocalization entries of the dataset"""
+        if self._cache_sm_storage is not None:
+            self._get_cache(Storage(self._sm_config['lithops']), ds).clear()
 
     def _save_job_to_db(self, job):
         (job_id,) = self._db.insert_return(
@@ -356,7 +885,7 @@ class Colocalization:
         )
 
         annotations = [(job_id, *ann) for ann in job.coloc_annotations]
-        self._db.insert(COLOC_ANN_INS, annotations)
+        self._db.copy_df(COLOC_ANN_TABLE, pd.DataFrame(annotations, columns=COLOC_ANN_COLUMNS))
 
     def _get_ion_annotations(self, ds_id, moldb_id, charge):
         annotation_rows = self._db.select(ANNOTATIONS_SEL, [ds_id, moldb_id])
@@ -364,20 +893,22 @@ class Colocalization:
         if num_annotations != 0:
             ion_tuples = [
                 (formula, chem_mod, neutral_loss, adduct)
-                for image, formula, chem_mod, neutral_loss, adduct, fdr in annotation_rows
+                for image, formula, chem_mod, neutral_loss, adduct, fdr, job_id in annotation_rows
             ]
             ion_id_mapping = get_ion_id_mapping(self._db, ion_tuples, charge)
             ion_ids = np.array([ion_id_mapping[ion_tuple] for ion_tuple in ion_tuples])
             fdrs = np.array([row[5] for row in annotation_rows])
 
             image_ids = [row[0] for row in annotation_rows]
+            job_ids = [row[6] for row in annotation_rows]
 
         else:
             image_ids = []
             ion_ids = np.zeros((0,), dtype=np.int64)
             fdrs = np.zeros((0,), dtype=np.float32)
+            job_ids = []
 
-        return image_ids, ion_ids, fdrs
+        return image_ids, ion_ids, fdrs, job_ids
 
     def _iter_pending_coloc_tasks(self, ds_id: str, reprocess: bool = False):
         moldb_ids, charge = self._db.select_one(DATASET_CONFIG_SEL, [ds_id])
@@ -388,12 +919,14 @@ class Colocalization:
                 # Clear old jobs from DB
                 self._db.alter(COLOC_JOB_DEL, [ds_id, moldb_id])
 
-                image_ids, ion_ids, fdrs = self._get_ion_annotations(ds_id, moldb_id, charge)
+                image_ids, ion_ids, fdrs, job_ids = self._get_ion_annotations(
+                    ds_id, moldb_id, charge
+                )
                 if len(ion_ids) > 2:
                     # Technically `len(ion_ids) == 2` is enough,
                     # but spearmanr returns a scalar instead of a matrix
                     # when there are only 2 items, and it's not worth handling this edge case
-                    yield moldb_id, image_ids, ion_ids, fdrs
+                    yield moldb_id, image_ids, ion_ids, fdrs, job_ids
                 else:
                     logger.debug(f'Not enough annotations in {ds_id} on {moldb_id}')
             else:
@@ -409,11 +942,18 @@ class Colocalization:
             reprocess: Whether to re-run colocalization jobs against databases
                 that have already successfully run
         """
-        for moldb_id, image_ids, ion_ids, fdrs in self._iter_pending_coloc_tasks(ds.id, reprocess):
+        cache = None
+        if self._cache_sm_storage is not None:
+            cache = self._get_cache(Storage(self._sm_config['lithops']), ds)
+
+        for moldb_id, image_ids, ion_ids, fdrs, job_ids in self._iter_pending_coloc_tasks(
+            ds.id, reprocess
+        ):
             logger.info(f'Running colocalization job for {ds.id} on {moldb_id}')
-            images, h, w = _get_images(ImageStorage(), ds.id, image_ids)
             try:
-                for job in analyze_colocalization(ds.id, moldb_id, images, ion_ids, fdrs, h, w):
+                for job in _run_coloc_task(
+                    ImageStorage(), cache, ds.id, moldb_id, image_ids, ion_ids, fdrs, job_ids
+                ):
                     self._save_job_to_db(job)
             except Exception:
                 logger.warning('Colocalization job failed', exc_info=True)
@@ -425,13 +965,19 @@ class Colocalization:
         # import psycopg2 and fails inside Functions
         ds_id = ds.id
         sm_config = self._sm_config
+        cache_sm_storage = self._cache_sm_storage
+        cache_params = _get_cache_params(ds.config)
 
-        def run_coloc_job(moldb_id, image_ids, ion_ids, fdrs, *, storage):
+        def run_coloc_job(moldb_id, image_ids, ion_ids, fdrs, job_ids, *, storage):
+            cache = None
+            if cache_sm_storage is not None:
+                cache = ColocCache(storage, cache_sm_storage, ds_id, cache_params)
             # Use web_app_url to get the publicly-exposed storage server address, because
             # Functions can't use the private address
-            images, h, w = _get_images(ImageStorage(sm_config), ds_id, image_ids)
             cobjs = []
-            for job in analyze_colocalization(ds_id, moldb_id, images, ion_ids, fdrs, h, w):
+            for job in _run_coloc_task(
+                ImageStorage(sm_config), cache, ds_id, moldb_id, image_ids, ion_ids, fdrs, job_ids
+            ):
                 cobjs.append(save_cobj(storage, job))
             return cobjs
 
@@ -13,7 +13,7 @@ from sm.engine.dataset import Dataset
 from sm.engine import image_storage
 
 ISO_IMAGE_SEL = (
-    "SELECT iso_image_ids[1] "
+    "SELECT iso_image_ids[1], job_id "
     "FROM annotation m "
     "JOIN job j on j.id = m.job_id "
     "WHERE ds_id = %s AND iso_image_ids[1] IS NOT NULL "
@@ -173,11 +173,12 @@ def _thumb_from_pixel_clusters(images, mask, h, w, use_distance_from_centroid=Fa
 
 # pylint: disable=too-many-function-args
 def _generate_ion_thumbnail_image(image_storage, ds_id, annotation_rows, algorithm):
-    image_ids = [image_id for image_id, in annotation_rows]
+    image_ids = [image_id for image_id, job_id in annotation_rows]
+    job_ids = [job_id for image_id, job_id in annotation_rows]
 
     # Hotspot percentile is lowered as a lazy way to brighten images
     images, mask, (h, w) = image_storage.get_ion_images_for_analysis(
-        ds_id, image_ids, max_size=(200, 200), hotspot_percentile=90
+        ds_id, image_ids, max_size=(200, 200), hotspot_percentile=90, job_ids=job_ids
     )
 
     logger.debug(f'Generating ion thumbnail: {algorithm}({len(images)} x {h} x {w}) ')
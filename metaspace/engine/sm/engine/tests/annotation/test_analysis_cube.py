@@ -0,0 +1,115 @@
+from io import BytesIO
+
+import numpy as np
+import pytest
+
+from sm.engine.annotation.analysis_cube import AnalysisCubeWriter, AnalysisCubeReader
+
+
+def make_cube(n_rows, chunk_size):
+    rng = np.random.default_rng(42)
+    nrows, ncols = 4, 5
+    pixel_inds = np.array([1, 2, 3, 6, 7, 8, 11, 12, 13, 17])
+    rows = rng.uniform(0, 100, (n_rows, len(pixel_inds))).astype(np.float32)
+    rows[rows < 50] = 0
+
+    fp = BytesIO()
+    writer = AnalysisCubeWriter(fp, pixel_inds, nrows, ncols, chunk_size=chunk_size)
+    for i, row in enumerate(rows):
+        writer.append(f'img{i}', row)
+    writer.finish()
+    return fp.getvalue(), pixel_inds, rows
+
+
+def make_reader(data):
+    reads = []
+
+    def read_range(start, end):
+        reads.append((start, end))
+        return data[start:end]
+
+    return AnalysisCubeReader(read_range), reads
+
+
+def test_analysis_cube_roundtrip():
+    # 3 rows per chunk
+    data, pixel_inds, rows = make_cube(10, chunk_size=120)
+
+    reader, _ = make_reader(data)
+
+    assert (reader.n_rows, reader.n_pixels, reader.n_chunks) == (10, 10, 4)
+    assert (reader.nrows, reader.ncols) == (4, 5)
+    assert reader.pixel_inds.tolist() == pixel_inds.tolist()
+    assert reader.keys == [f'img{i}' for i in range(10)]
+    assert np.flatnonzero(reader.mask()).tolist() == pixel_inds.tolist()
+    chunks = list(reader.iter_chunks(reader.keys))
+    assert [keys for keys, _ in chunks] == [
+        ['img0', 'img1', 'img2'],
+        ['img3', 'img4', 'img5'],
+        ['img6', 'img7', 'img8'],
+        ['img9'],
+    ]
+    values = np.concatenate([values for _, values in chunks])
+    assert values.dtype == np.float32
+    assert np.array_equal(values, rows)
+    img = reader.to_image(rows[4])
+    assert img.shape == (4, 5)
+    assert np.array_equal(img.ravel()[pixel_inds], rows[4])
+    assert not img.ravel()[np.setdiff1d(np.arange(20), pixel_inds)].any()
+
+
+def test_analysis_cube_reads_only_needed_chunks():
+    data, _, rows = make_cube(10, chunk_size=120)
+    reader, reads = make_reader(data)
+    # Footer and directory
+    assert len(reads) == 2
+
+    # Keys are returned in cube order, and missing keys are skipped
+    chunks = list(reader.iter_chunks(['img7', 'missing', 'img1', 'img6']))
+
+    assert [keys for keys, _ in chunks] == [['img1'], ['img6', 'img7']]
+    assert np.array_equal(chunks[0][1], rows[[1]])
+    assert np.array_equal(chunks[1][1], rows[[6, 7]])
+    assert len(reads) == 4
+    assert list(reader.iter_chunks(['missing'])) == []
+
+
+def test_analysis_cube_append_chunk_copies_compressed_chunks():
+    # 3 rows per chunk
+    data, pixel_inds, rows = make_cube(10, chunk_size=120)
+    src_reader, _ = make_reader(data)
+
+    fp = BytesIO()
+    writer = AnalysisCubeWriter(fp, pixel_inds, 4, 5, chunk_size=120)
+    writer.append('new0', rows[9])
+    writer.append_chunk(src_reader.read_chunk(1), ['img3', None, 'img5'])
+    writer.append_chunk(src_reader.read_chunk(3), ['img9'])
+    writer.append('new1', rows[0])
+    writer.finish()
+    reader, _ = make_reader(fp.getvalue())
+
+    assert reader.n_chunks == 4
+    assert reader.keys == ['new0', 'img3', None, 'img5', 'img9', 'new1']
+    assert [reader.chunk_keys(i) for i in range(4)] == [
+        ['new0'],
+        ['img3', None, 'img5'],
+        ['img9'],
+        ['new1'],
+    ]
+    chunks = list(reader.iter_chunks(['new1', 'img5', 'img4', 'img9', 'img3']))
+    assert [keys for keys, _ in chunks] == [['img3', 'img5'], ['img9'], ['new1']]
+    assert np.array_equal(np.concatenate([values for _, values in chunks]), rows[[3, 5, 9, 0]])
+
+
+def test_analysis_cube_empty():
+    data, _, _ = make_cube(0, chunk_size=120)
+
+    reader, _ = make_reader(data)
+
+    assert reader.n_rows == 0
+    assert list(reader.iter_chunks(['img0'])) == []
+
+
+def test_analysis_cube_rejects_other_data():
+    with pytest.raises(ValueError):
+        make_reader(b'\x00' * 100)
@@ -3,13 +3,21 @@ from unittest.mock import patch
 import numpy as np
 import pandas as pd
 import pytest
+from cpyImagingMSpec import measure_of_chaos
 from pandas.util.testing import assert_frame_equal
+from scipy.ndimage import gaussian_filter
 from scipy.sparse import coo_matrix
 
+from sm.engine.annotation.image_slab import ImageSlab
 from sm.engine.annotation.formula_validator import (
     formula_image_metrics,
     make_compute_image_metrics,
     replace_nan,
+    make_compute_image_metrics_batch,
+    _dense_sums,
+    compute_and_filter_metrics_batch,
+    measure_of_chaos_sparse,
+    nullify_images_with_too_few_pixels,
 )
 
 
@@ -111,6 +119,214 @@ def test_targeted_database_metrics():
     assert_frame_equal(metrics_df, exp_metrics_df)
 
 
+def make_random_formula_image_sets(n_formulas, nrows, ncols):
+    rs = np.random.RandomState(42)
+
+    def random_image(density):
+        n = int(nrows * ncols * density)
+        row_inds, col_inds = np.divmod(rs.randint(0, nrows * ncols, n), ncols)
+        data = (rs.random_sample(n) * 100).astype(np.float32)
+        return coo_matrix((data, (row_inds, col_inds)), shape=(nrows, ncols))
+
+    formula_image_sets = []
+    for _ in range(n_formulas):
+        first_img = random_image(rs.random_sample() * 0.5)
+        f_images = [first_img]
+        for _ in range(3):
+            choice = rs.random_sample()
+            if choice < 0.2:
+                f_images.append(None)
+            elif choice < 0.6:
+                # Correlated with the first image
+                data = first_img.data * rs.random_sample(first_img.nnz).astype(np.float32)
+                f_images.append(
+                    coo_matrix((data, (first_img.row, first_img.col)), shape=first_img.shape)
+                )
+            else:
+                f_images.append(random_image(rs.random_sample() * 0.3))
+        f_ints = [100.0, *sorted(rs.random_sample(3) * 50, reverse=True)]
+        formula_image_sets.append((f_images, f_ints))
+    return formula_image_sets
+
+
+def make_image_slab(formula_image_sets, nrows, ncols):
+    return ImageSlab.from_images(
+        formula_is=range(len(formula_image_sets)),
+        centr_ints=[f_ints for _, f_ints in formula_image_sets],
+        images=[f_images for f_images, _ in formula_image_sets],
+        nrows=nrows,
+        ncols=ncols,
+    )
+
+
+@pytest.mark.parametrize('full_sample_area', [True, False])
+# The larger frame is summed by numpy in more than one chunk
+@pytest.mark.parametrize('nrows, ncols', [(20, 30), (90, 101)])
+def test_compute_img_metrics_batch_is_identical_to_compute_img_metrics(
+    nrows, ncols, full_sample_area
+):
+    img_gen_config = {'n_levels': 30}
+    sample_area_mask = np.ones((nrows, ncols), dtype=bool)
+    if not full_sample_area:
+        sample_area_mask[:, :3] = False
+    compute_metrics = make_compute_image_metrics(sample_area_mask, nrows, ncols, img_gen_config)
+    compute_metrics_batch = make_compute_image_metrics_batch(
+        sample_area_mask, nrows, ncols, img_gen_config
+    )
+    # Empty images are always nullified before computing metrics, as slabs can't represent them
+    formula_image_sets = [
+        (nullify_images_with_too_few_pixels(f_images, 1), f_ints)
+        for f_images, f_ints in make_random_formula_image_sets(200, nrows, ncols)
+    ]
+
+    exp_metrics = [compute_metrics(*formula_image_set) for formula_image_set in formula_image_sets]
+    metrics = compute_metrics_batch(make_image_slab(formula_image_sets, nrows, ncols))
+
+    assert sum(m['msm'] > 0 for m in exp_metrics) > 50, 'test data should have some annotations'
+    assert metrics == exp_metrics
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_dense_sums_match_numpy_sum(dtype):
+    rs = np.random.RandomState(42)
+    lengths = np.concatenate([rs.randint(1, 300, 50), rs.randint(300, 30000, 50)])
+    vectors = [
+        (rs.random_sample(n) < rs.random_sample()) * rs.random_sample(n) * 10 ** rs.randint(-3, 6)
+        for n in lengths
+    ]
+    vectors = [v.astype(dtype) for v in vectors]
+    positions = [rs.permutation(np.flatnonzero(v)) for v in vectors]
+
+    sums = _dense_sums(
+        np.repeat(np.arange(len(vectors)), [len(pos) for pos in positions]),
+        np.concatenate(positions),
+        np.concatenate([v[pos] for v, pos in zip(vectors, positions)]),
+        lengths,
+    )
+
+    assert sums.dtype == dtype
+    assert sums.tolist() == [v.sum() for v in vectors]
+
+
+def make_random_chaos_images(nrows, ncols, seed):
+    rs = np.random.RandomState(seed)
+    mask = rs.random_sample((nrows, ncols)) < rs.random_sample()
+    yield rs.random_sample((nrows, ncols)) * mask * 1000
+    # Values lying exactly on the level thresholds
+    yield rs.randint(0, 31, (nrows, ncols)) * mask
+    # Smooth blobs, the kind of images that get low chaos values
+    yield gaussian_filter(rs.random_sample((nrows, ncols)), 2) * (mask | (rs.random_sample() < 0.5))
+
+
+@pytest.mark.parametrize('n_levels', [1, 7, 30, 32])
+@pytest.mark.parametrize('nrows, ncols', [(1, 1), (1, 17), (13, 1), (20, 30), (47, 39)])
+def test_measure_of_chaos_sparse_matches_cpyimagingmspec(n_levels, nrows, ncols):
+    for seed in range(10):
+        for img in make_random_chaos_images(nrows, ncols, seed):
+            img = img.astype(np.float32)
+
+            exp_moc = measure_of_chaos(img, n_levels)
+            moc = measure_of_chaos_sparse(coo_matrix(img), n_levels)
+
+            np.testing.assert_equal(moc, exp_moc)
+
+
+def test_measure_of_chaos_sparse_duplicate_pixels():
+    rs = np.random.RandomState(42)
+    nrows, ncols, n = 10, 12, 300
+    row_inds, col_inds = np.divmod(rs.randint(0, nrows * ncols, n), ncols)
+    data = (rs.random_sample(n) * 100).astype(np.float32)
+    img = coo_matrix((data, (row_inds, col_inds)), shape=(nrows, ncols))
+
+    assert measure_of_chaos_sparse(img, 30) == measure_of_chaos(img.toarray(), 30)
+
+
+def test_measure_of_chaos_sparse_empty_image():
+    assert np.isnan(measure_of_chaos_sparse(coo_matrix((5, 5), dtype=np.float32), 30))
+
+
+@pytest.mark.parametrize('sparse_chaos', [True, False])
+def test_compute_img_metrics_chaos_matches_cpyimagingmspec(sparse_chaos):
+    nrows, ncols = 20, 30
+    img_gen_config = {'ppm': 3, 'n_levels': 30, 'min_px': 1}
+    sample_area_mask = np.ones((nrows, ncols), dtype=bool)
+    compute_metrics = make_compute_image_metrics(sample_area_mask, nrows, ncols, img_gen_config)
+    compute_metrics_batch = make_compute_image_metrics_batch(
+        sample_area_mask, nrows, ncols, img_gen_config
+    )
+    formula_image_sets = make_random_formula_image_sets(100, nrows, ncols)
+
+    # Make either the sparse or the dense implementation always cheaper
+    sparse_cost = 0 if sparse_chaos else nrows * ncols
+    with patch('sm.engine.annotation.formula_validator.CHAOS_SPARSE_PIXEL_COST', 0), patch(
+        'sm.engine.annotation.formula_validator.CHAOS_SPARSE_OVERHEAD', sparse_cost
+    ):
+        metrics = [compute_metrics(*formula_image_set) for formula_image_set in formula_image_sets]
+        batch_metrics = compute_metrics_batch(make_image_slab(formula_image_sets, nrows, ncols))
+
+    assert sum(m['chaos'] > 0 for m in metrics) > 20, 'test data should have some annotations'
+    for m, batch_m, (f_images, _) in zip(metrics, batch_metrics, formula_image_sets):
+        if m['spatial'] > 0:
+            exp_moc = measure_of_chaos(f_images[0].toarray(), img_gen_config['n_levels'])
+            exp_chaos = 0 if np.isclose(exp_moc, 1.0) else replace_nan(exp_moc)
+            assert m['chaos'] == exp_chaos
+            assert batch_m['chaos'] == exp_chaos
+
+
+def test_compute_and_filter_metrics_batch():
+    exp_metrics = OrderedDict(
+        [
+            ('chaos', 0.9),
+            ('spatial', 0.9),
+            ('spectral', 0.9),
+            ('msm', 0.9 ** 3),
+            ('total_iso_ints', [213.0, 120.0]),
+            ('min_iso_ints', [0, 0]),
+            ('max_iso_ints', [100.0, 50.0]),
+        ]
+    )
+    zero_metrics = OrderedDict(exp_metrics, msm=0)
+
+    img_0 = coo_matrix([[0, 100, 100], [10, 0, 3]])
+    img_1 = coo_matrix([[0, 50, 50], [0, 20, 0]])
+    image_slab = ImageSlab.from_images(
+        formula_is=[0, 1, 2, 3, 4],
+        centr_ints=[[100, 10]] * 5,
+        images=[
+            [img_0, img_1],
+            [img_0, img_1],
+            [img_0, None],
+            [None, img_1],  # missing first peak
+            [coo_matrix([[0, 0, 1], [0, 0, 0]]), img_1],  # first peak has too few pixels
+        ],
+        nrows=2,
+        ncols=3,
+    )
+    batches = []
+
+    def compute_metrics_batch(image_slab):
+        batches.append(image_slab)
+        return [exp_metrics, exp_metrics, zero_metrics][: image_slab.n_formulas]
+
+    results = list(
+        compute_and_filter_metrics_batch(
+            [image_slab],
+            compute_metrics_batch,
+            target_formula_inds={0},
+            targeted_database_formula_inds=set(),
+            min_px=2,
+        )
+    )
+
+    assert [batch.formula_is.tolist() for batch in batches] == [[0, 1, 2]]
+    assert len(results) == 1
+    formula_metrics, result_slab = results[0]
+    assert formula_metrics == [(0, exp_metrics), (1, exp_metrics)]
+    assert result_slab.formula_is.tolist() == [0]
+    assert np.array_equal(result_slab.dense_image(0, 0), img_0.toarray())
+    assert np.array_equal(result_slab.dense_image(0, 1), img_1.toarray())
+
+
 @pytest.mark.parametrize('nan_value', [None, np.NaN, np.NAN, np.inf])
 def test_replace_nan(nan_value):
     default_v = 1
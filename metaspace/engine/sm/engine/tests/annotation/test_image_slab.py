@@ -0,0 +1,54 @@
+import numpy as np
+from scipy.sparse import coo_matrix
+
+from sm.engine.annotation.image_slab import ImageSlab, gather_ranges
+
+
+def make_image_slab():
+    return ImageSlab.from_images(
+        formula_is=[7, 3, 5],
+        centr_ints=[[100, 10], [100, 20], [100, 30]],
+        images=[
+            [coo_matrix([[0, 1, 2], [3, 0, 0]]), None],
+            [None, coo_matrix(([4, 5], ([1, 1], [2, 2])), shape=(2, 3))],  # repeated pixel
+            [coo_matrix([[6, 0, 0], [0, 0, 7]]), coo_matrix([[0, 0, 0], [8, 0, 0]])],
+        ],
+        nrows=2,
+        ncols=3,
+    )
+
+
+def test_gather_ranges():
+    assert gather_ranges(np.array([5, 0, 2]), np.array([2, 0, 3])).tolist() == [5, 6, 2, 3, 4]
+    assert gather_ranges(np.array([], dtype=int), np.array([], dtype=int)).tolist() == []
+
+
+def test_image_slab_images():
+    image_slab = make_image_slab()
+
+    assert image_slab.n_formulas == 3
+    assert image_slab.n_peaks == 2
+    assert image_slab.image_sizes().tolist() == [[3, 0], [0, 2], [2, 1]]
+    assert image_slab.positions([5, 7]).tolist() == [2, 0]
+    assert image_slab.image(0, 1) is None
+    assert image_slab.dense_image(1, 0) is None
+    assert image_slab.sparse_image(1, 0) is None
+    pixel_inds, ints = image_slab.sparse_image(1, 1)
+    assert pixel_inds.tolist() == [5, 5] and ints.tolist() == [4, 5]
+    assert np.array_equal(image_slab.image(1, 1).toarray(), [[0, 0, 0], [0, 0, 9]])
+    assert np.array_equal(image_slab.dense_image(1, 1), [[0, 0, 0], [0, 0, 9]])
+    assert np.array_equal(image_slab.dense_image(2, 0), [[6, 0, 0], [0, 0, 7]])
+
+
+def test_image_slab_take_and_concat():
+    image_slab = make_image_slab()
+
+    taken = image_slab.take(np.array([2, 0]), image_mask=np.array([[False, True], [True, True]]))
+    concatenated = ImageSlab.concat([taken, image_slab.take(np.array([1]))])
+
+    assert concatenated.formula_is.tolist() == [5, 7, 3]
+    assert concatenated.centr_ints.tolist() == [[100, 30], [100, 10], [100, 20]]
+    assert concatenated.image_sizes().tolist() == [[0, 1], [3, 0], [0, 2]]
+    assert np.array_equal(concatenated.dense_image(0, 1), [[0, 0, 0], [8, 0, 0]])
+    assert np.array_equal(concatenated.dense_image(1, 0), [[0, 1, 2], [3, 0, 0]])
+    assert np.array_equal(concatenated.dense_image(2, 1), [[0, 0, 0], [0, 0, 9]])
@@ -0,0 +1,57 @@
+from unittest.mock import MagicMock
+
+import numpy as np
+import pandas as pd
+
+from sm.engine.annotation_lithops.annotate import (
+    estimate_ds_rows_in_mz_ranges,
+    gen_iso_image_slabs,
+)
+
+
+def test_gen_iso_image_slabs():
+    nrows, ncols = 2, 3
+    sp_mzs = np.array([100.0, 100.0, 100.01, 200.0, 200.01, 300.0, 400.0])
+    sp_inds = np.array([0, 1, 1, 5, 2, 3, 4], dtype=np.uint32)
+    sp_ints = np.array([1, 2, 3, 4, 5, 6, 7], dtype=np.float32)
+    centr_df = pd.DataFrame(
+        [
+            (1, 1, 200.0, 50.0),
+            (1, 0, 100.0, 100.0),
+            (0, 0, 300.0, 100.0),
+            (0, 1, 350.0, 10.0),  # no peaks in the dataset
+            (2, 0, 400.0, 100.0),
+        ],
+        columns=['formula_i', 'peak_i', 'mz', 'int'],
+    )
+    isocalc_wrapper = MagicMock()
+    isocalc_wrapper.mass_accuracy_bounds = lambda mzs: (mzs - 0.05, mzs + 0.05)
+
+    image_slabs = list(
+        gen_iso_image_slabs(
+            sp_inds, sp_mzs, sp_ints, centr_df, nrows, ncols, isocalc_wrapper, max_values=4
+        )
+    )
+
+    # Formula 1 has more than max_values values, but slabs can't be empty
+    assert [slab.formula_is.tolist() for slab in image_slabs] == [[0], [1], [2]]
+    assert all(slab.n_peaks == 4 for slab in image_slabs)
+    assert image_slabs[0].centr_ints.tolist() == [[100, 10, 0, 0]]
+    assert image_slabs[1].centr_ints.tolist() == [[100, 50, 0, 0]]
+    assert image_slabs[0].image_sizes().tolist() == [[1, 0, 0, 0]]
+    assert image_slabs[1].image_sizes().tolist() == [[3, 2, 0, 0]]
+    assert np.array_equal(image_slabs[0].dense_image(0, 0), [[0, 0, 0], [6, 0, 0]])
+    assert np.array_equal(image_slabs[1].dense_image(0, 0), [[1, 5, 0], [0, 0, 0]])
+    assert np.array_equal(image_slabs[1].dense_image(0, 1), [[0, 0, 5], [0, 0, 4]])
+    assert np.array_equal(image_slabs[2].dense_image(0, 0), [[0, 0, 0], [0, 7, 0]])
+
+
+def test_estimate_ds_rows_in_mz_ranges():
+    ds_segments_bounds = np.array([[100.0, 200.0], [200.0, 400.0], [500.0, 500.0]])
+    ds_segm_lens = np.array([10, 40, 5])
+
+    ds_rows = estimate_ds_rows_in_mz_ranges(
+        ds_segments_bounds, ds_segm_lens, [150.0, 0.0, 450.0, 490.0], [300.0, 1000.0, 460.0, 510.0]
+    )
+
+    assert ds_rows.tolist() == [25.0, 55.0, 0.0, 5.0]
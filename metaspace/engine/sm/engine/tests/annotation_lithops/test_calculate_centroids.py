@@ -0,0 +1,65 @@
+from unittest.mock import patch
+
+import pandas as pd
+
+from sm.engine.annotation.isocalc_wrapper import IsocalcWrapper
+from sm.engine.annotation_lithops.calculate_centroids import calculate_centroids
+from sm.engine.annotation_lithops.centroids_store import CentroidsStore
+from sm.engine.annotation_lithops.executor import Executor
+from sm.engine.annotation_lithops.io import save_cobjs, load_cobjs
+from tests.conftest import executor, sm_config, ds_config
+
+
+def make_formula_cobjs(storage, ion_formulas, chunk_size=3):
+    formulas_df = pd.DataFrame(
+        {
+            'ion_formula': ion_formulas,
+            'target': [i % 2 == 0 for i in range(len(ion_formulas))],
+            'targeted': [i % 3 == 0 for i in range(len(ion_formulas))],
+        }
+    ).rename_axis(index='formula_i')
+    chunks = [
+        formulas_df.iloc[start : start + chunk_size]
+        for start in range(0, len(formulas_df), chunk_size)
+    ]
+    return save_cobjs(storage, chunks)
+
+
+def load_peaks_df(storage, peaks_cobjs):
+    return pd.concat(load_cobjs(storage, peaks_cobjs)).sort_values(['formula_i', 'peak_i'])
+
+
+def test_calculate_centroids_with_store(executor: Executor, sm_config, ds_config):
+    storage = executor.storage
+    isocalc_wrapper = IsocalcWrapper(ds_config)
+    centroids_store = CentroidsStore(sm_config['lithops']['sm_storage'], isocalc_wrapper)
+    centroids_store.clear(storage)
+    ion_formulas = ['H2O', 'CO2', 'C6H12O6', 'NH4', 'H2SO4', 'Invalid', 'C5H5N5O', 'C2H6O']
+    formula_cobjs = make_formula_cobjs(storage, ion_formulas)
+
+    exp_peaks_df = load_peaks_df(
+        storage, calculate_centroids(executor, formula_cobjs, isocalc_wrapper)
+    )
+    peaks_df = load_peaks_df(
+        storage, calculate_centroids(executor, formula_cobjs, isocalc_wrapper, centroids_store)
+    )
+
+    pd.testing.assert_frame_equal(peaks_df, exp_peaks_df)
+
+    # Only the new ion formula should be calculated when the store is reused
+    formula_cobjs = make_formula_cobjs(storage, ['C3H7NO2', *ion_formulas])
+    calculated_formulas = []
+
+    def calculate_centroids_spy(self, ion_formulas):
+        calculated_formulas.extend(ion_formulas)
+        return orig_calculate_centroids(self, ion_formulas)
+
+    orig_calculate_centroids = CentroidsStore.calculate_centroids
+    with patch.object(CentroidsStore, 'calculate_centroids', calculate_centroids_spy):
+        peaks_df = load_peaks_df(
+            storage, calculate_centroids(executor, formula_cobjs, isocalc_wrapper, centroids_store)
+        )
+
+    assert calculated_formulas == ['C3H7NO2']
+    assert peaks_df.loc[1:].mz.tolist() == exp_peaks_df.mz.tolist()
+    centroids_store.clear(storage)
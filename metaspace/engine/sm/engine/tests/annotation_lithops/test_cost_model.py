@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+
+from sm.engine.annotation_lithops.cost_model import (
+    CostModel,
+    CostModelPlanner,
+    perf_entries_to_samples,
+)
+from sm.engine.annotation_lithops.executor import Executor
+from sm.engine.utils.perf_profile import Profiler
+from tests.conftest import sm_config
+
+
+class MockDB:
+    def __init__(self, extra_datas):
+        self.extra_datas = extra_datas
+        self.queries = []
+
+    def select(self, sql, params=None):
+        self.queries.append(params)
+        return [(extra_data,) for extra_data in self.extra_datas]
+
+
+class RecordingProfiler(Profiler):
+    def __init__(self):
+        self.entries = []
+
+    def record_entry(self, name, start=None, finish=None, **extra_data):
+        self.entries.append((name, extra_data))
+
+    def add_extra_data(self, **extra_data):
+        pass
+
+
+def make_perf_entries(n_entries=5, n_items=10):
+    """Entries as recorded by Executor.map for a function using ~(100 + n_images * 10) MB"""
+    rng = np.random.default_rng(42)
+    entries = []
+    for _ in range(n_entries):
+        n_images = rng.integers(1, 200, n_items)
+        mem_usages_mb = 100 + n_images * 10 + rng.uniform(0, 20, n_items)
+        entries.append(
+            {
+                'cost_factors': {'n_images': n_images.tolist()},
+                'mem_usages': (mem_usages_mb * 1024).tolist(),
+                'exec_times': (n_images * 0.5).tolist(),
+            }
+        )
+    return entries
+
+
+def test_perf_entries_to_samples():
+    entries = make_perf_entries(n_entries=2, n_items=3)
+    # Invalid entries should be skipped
+    entries.append({'cost_factors': None, 'mem_usages': [1024], 'exec_times': [1]})
+    entries.append({'cost_factors': {'n_images': [1, 2]}, 'mem_usages': [-1], 'exec_times': [1]})
+
+    samples_df = perf_entries_to_samples(entries)
+
+    assert samples_df.columns.tolist() == ['n_images', 'memory_mb', 'time_s']
+    assert len(samples_df) == 6
+    assert samples_df.memory_mb.tolist()[0] == entries[0]['mem_usages'][0] / 1024
+
+
+def test_cost_model_predicts_upper_bound():
+    samples_df = perf_entries_to_samples(make_perf_entries())
+
+    model = CostModel.fit(samples_df, ['n_images'])
+    memory, times = model.predict(samples_df[['n_images']])
+
+    assert (memory >= samples_df.memory_mb.values).all()
+    assert (memory <= samples_df.memory_mb.values * 1.5).all()
+    np.testing.assert_allclose(times, samples_df.time_s.values, rtol=1e-6)
+    assert model.can_predict(pd.DataFrame({'n_images': [250]}))
+    assert not model.can_predict(pd.DataFrame({'n_images': [1000]}))
+    assert CostModel.fit(samples_df.iloc[:5], ['n_images']) is None
+    assert CostModel.fit(samples_df, ['n_images', 'unknown']) is None
+
+
+def test_planner_plans_memory_tiers():
+    db = MockDB(make_perf_entries())
+    planner = CostModelPlanner(db)
+
+    runtime_memory, _ = planner.plan('func', pd.DataFrame({'n_images': [1, 50, 190]}))
+
+    assert runtime_memory.tolist() == [256, 1024, 4096]
+    assert planner.plan('func', pd.DataFrame({'n_images': [10000]})) is None
+    assert planner.plan('func', pd.DataFrame({'other_factor': [1]})) is None
+    # Models are cached per function and set of cost factors
+    assert planner.plan('func', pd.DataFrame({'n_images': [5]})) is not None
+    assert len(db.queries) == 2
+
+
+def test_executor_map_runs_planned_memory_tiers(sm_config):
+    perf = RecordingProfiler()
+    planner = CostModelPlanner(MockDB(make_perf_entries()))
+    executor = Executor(sm_config['lithops'], perf=perf, debug_run_locally=True, planner=planner)
+    n_images = [190, 1, 50, 2, 180]
+
+    def func(i, n):
+        return i * 2
+
+    results = executor.map(
+        func,
+        [(i, n) for i, n in enumerate(n_images)],
+        cost_factors=pd.DataFrame({'n_images': n_images}),
+        runtime_memory=512,
+    )
+
+    assert results == [0, 2, 4, 6, 8]
+    tiers = {
+        entry['runtime_memory']: entry['cost_factors']['n_images'] for name, entry in perf.entries
+    }
+    assert tiers == {4096: [190, 180], 256: [1, 2], 1024: [50]}
+
+    # Without a usable model, the supplied runtime_memory should be used
+    perf.entries.clear()
+    executor.map(func, [(0, 0)], cost_factors=pd.DataFrame({'other': [1]}), runtime_memory=512)
+    assert [entry['runtime_memory'] for name, entry in perf.entries] == [512]
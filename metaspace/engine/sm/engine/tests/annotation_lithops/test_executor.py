@@ -0,0 +1,223 @@
+from copy import deepcopy
+
+import pandas as pd
+import pytest
+
+from sm.engine.annotation_lithops import executor as executor_module
+from sm.engine.annotation_lithops.executor import Executor
+from sm.engine.utils.perf_profile import Profiler
+from tests.conftest import sm_config
+
+
+class RecordingProfiler(Profiler):
+    def __init__(self):
+        self.entries = []
+
+    def record_entry(self, name, start=None, finish=None, **extra_data):
+        self.entries.append((name, extra_data))
+
+    def add_extra_data(self, **extra_data):
+        pass
+
+
+@pytest.fixture()
+def localhost_executor(sm_config):
+    lithops_config = deepcopy(sm_config['lithops'])
+    lithops_config['localhost'] = {'worker_processes': 4}
+    lithops_config['lithops']['include_modules'] = ['sm']
+    lithops_config['speculation'] = {'straggler_multiple': 2, 'min_time': 1}
+    perf = RecordingProfiler()
+    executor = Executor(lithops_config, perf=perf)
+    executor.perf = perf
+
+    yield executor
+
+    executor.clean()
+
+
+def test_map_relaunches_stragglers(localhost_executor: Executor, tmp_path):
+    def sleep_on_first_attempt(i, delay, marker_dir):
+        # pylint: disable=import-outside-toplevel,reimported
+        import time
+        from pathlib import Path
+
+        marker = Path(marker_dir) / str(i)
+        if not marker.exists():
+            marker.touch()
+            time.sleep(delay)
+        return i
+
+    # Item 1 is injected with a long delay on its first attempt, so the second attempt should win
+    delays = [0.1, 20, 0.1, 0.1, 0.1]
+
+    results = localhost_executor.map(
+        sleep_on_first_attempt, [(i, delay, str(tmp_path)) for i, delay in enumerate(delays)]
+    )
+
+    assert results == [0, 1, 2, 3, 4]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['0', '1', '2', '3', '4']
+    [(_, perf_data)] = localhost_executor.perf.entries
+    assert perf_data['attempts'] == 1
+    assert max(perf_data['exec_times']) < 10
+
+
+def test_map_raises_once_all_copies_fail(localhost_executor: Executor):
+    def fail_on_item_2(i):
+        if i == 2:
+            raise ValueError('Injected failure')
+        return i
+
+    with pytest.raises(ValueError, match='Injected failure'):
+        localhost_executor.map(fail_on_item_2, [(i,) for i in range(4)])
+
+
+def test_map_retries_only_failed_items(sm_config):
+    perf = RecordingProfiler()
+    executor = Executor(sm_config['lithops'], perf=perf, debug_run_locally=True)
+    calls = []
+
+    def fail_first_call(i):
+        calls.append(i)
+        if i in (1, 3) and calls.count(i) == 1:
+            raise MemoryError()
+        return i * 2
+
+    results = executor.map(
+        fail_first_call,
+        [(i,) for i in range(5)],
+        cost_factors=pd.DataFrame({'i': range(5)}),
+        runtime_memory=512,
+    )
+
+    assert results == [0, 2, 4, 6, 8]
+    # Items are run in order and the debug executor stops at the first failure,
+    # so later items are only run in the retry
+    assert calls == [0, 1, 1, 2, 3, 3, 4]
+    attempts = [
+        (
+            entry['attempts'] if 'error' not in entry else entry['attempt'],
+            entry['runtime_memory'],
+            'error' in entry,
+            entry.get('cost_factors'),
+        )
+        for name, entry in perf.entries
+    ]
+    assert attempts == [
+        (1, 512, False, {'i': [0]}),
+        (1, 512, True, None),
+        (2, 1024, False, {'i': [1, 2]}),
+        (2, 1024, True, None),
+        (3, 2048, False, {'i': [3, 4]}),
+    ]
+
+
+def test_map_retries_only_failed_items_on_lithops(localhost_executor: Executor, tmp_path):
+    def fail_on_first_attempt(i, marker_dir):
+        # pylint: disable=import-outside-toplevel
+        import uuid
+        from pathlib import Path
+
+        first_attempt = not any(Path(marker_dir).glob(f'{i}-*'))
+        (Path(marker_dir) / f'{i}-{uuid.uuid4()}').touch()
+        if i in (1, 3) and first_attempt:
+            raise MemoryError()
+        return i
+
+    results = localhost_executor.map(
+        fail_on_first_attempt, [(i, str(tmp_path)) for i in range(5)], runtime_memory=512
+    )
+
+    assert results == [0, 1, 2, 3, 4]
+    runs = sorted(p.name.split('-')[0] for p in tmp_path.iterdir())
+    assert runs == ['0', '1', '1', '2', '3', '3', '4']
+    assert [
+        (entry['runtime_memory'], 'error' in entry, entry.get('num_actions'))
+        for name, entry in localhost_executor.perf.entries
+    ] == [(512, False, 3), (512, True, None), (1024, False, 2)]
+
+
+class PinnedApiFuture:
+    """Stands in for a Lithops 2.2.14 `ResponseFuture`"""
+
+    def __init__(self, value, error=False):
+        self.value = value
+        self.invoked = True
+        self.running = False
+        self.ready = False
+        self.done = False
+        self.error = False
+        self.stats = {'worker_exec_time': 0.1}
+        self.activation_id = None
+        self._fails = error
+
+    def finish(self):
+        self.invoked = False
+        self.ready = not self._fails
+        self.done = self.error = self._fails
+
+    def result(self, throw_except=True, internal_storage=None):
+        if self._fails:
+            raise MemoryError()
+        return self.value
+
+
+class PinnedApiFunctionExecutor:
+    """Has the signatures of the Lithops 2.2.14 `FunctionExecutor` methods that `Executor` uses
+    to wait for results, so that unsupported arguments raise a TypeError"""
+
+    internal_storage = None
+
+    def __init__(self):
+        self.wait_calls = []
+
+    def wait(
+        self,
+        fs=None,
+        throw_except=True,
+        return_when=1,
+        download_results=False,
+        timeout=None,
+        THREADPOOL_SIZE=128,
+        WAIT_DUR_SEC=1,
+    ):
+        self.wait_calls.append(return_when)
+        for future in fs:
+            future.finish()
+        return fs, []
+
+    def get_result(
+        self, fs=None, throw_except=True, timeout=None, THREADPOOL_SIZE=128, WAIT_DUR_SEC=1
+    ):
+        return [future.result() for future in fs]
+
+
+def pinned_api_wait_storage(
+    fs,
+    running_futures,
+    internal_storage,
+    download_results,
+    throw_except,
+    return_early_n,
+    max_direct_query_n,
+    pbar=None,
+    random_query=False,
+    THREADPOOL_SIZE=128,
+):
+    for future in fs:
+        future.finish()
+    return fs, []
+
+
+def test_wait_for_results_with_pinned_lithops_api(sm_config, monkeypatch):
+    monkeypatch.setattr(executor_module, '_wait_storage', pinned_api_wait_storage)
+    executor = Executor(sm_config['lithops'], debug_run_locally=True)
+    fexec = PinnedApiFunctionExecutor()
+
+    futures = [PinnedApiFuture(i) for i in range(3)]
+    results = executor._get_results_speculatively(fexec, futures, None, [], 1024, {})
+    assert results == [0, 1, 2]
+    # Polling with `FunctionExecutor.wait` would stop the invoker, discarding queued invocations
+    assert fexec.wait_calls == []
+
+    futures = [PinnedApiFuture(0), PinnedApiFuture(1, error=True), PinnedApiFuture(2)]
+    assert executor._get_successful_results(fexec, futures) == [0, None, 2]
@@ -0,0 +1,288 @@
+import mmap
+import pickle
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from sm.engine.annotation.image_slab import ImageSlab
+from sm.engine.annotation_lithops.executor import Executor
+from sm.engine.annotation_lithops.io import (
+    DS_SEGM_ALIGN,
+    DS_SEGM_INDEX_STEP,
+    serialize_ds_segm,
+    deserialize_ds_segm,
+    save_ds_segm,
+    load_ds_segm,
+    load_ds_segms,
+    load_ds_segm_index,
+    ds_segm_rows_in_mz_range,
+    save_cobj,
+    load_cobj,
+    serialize,
+    deserialize,
+    COBJ_MAGIC,
+    COBJ_DATAFRAME,
+    COBJ_NDARRAY,
+    COBJ_PICKLE,
+    IMAGE_SLAB_HEADER,
+    serialize_image_slab,
+    deserialize_image_slab,
+    save_image_slab,
+    load_image_slab,
+)
+from tests.conftest import executor, sm_config
+
+
+def make_ds_segm(n_rows, mz_dtype, start=0):
+    rng = np.random.default_rng(n_rows)
+    return pd.DataFrame(
+        {
+            'mz': np.sort(rng.uniform(100, 1000, n_rows)).astype(mz_dtype),
+            'int': rng.uniform(0, 1000, n_rows).astype(np.float32),
+            'sp_i': rng.integers(0, 10000, n_rows).astype(np.uint32),
+        },
+        index=pd.RangeIndex(start, start + n_rows),
+    )
+
+
+@pytest.mark.parametrize('mz_dtype', ['f', 'd'])
+@pytest.mark.parametrize('n_rows', [0, 1, 13, 1000])
+def test_serialize_ds_segm_roundtrip(mz_dtype, n_rows):
+    segm_df = make_ds_segm(n_rows, mz_dtype, start=42)
+
+    data = serialize_ds_segm(segm_df.mz.values, segm_df.int.values, segm_df.sp_i.values, 42)
+    result_df = deserialize_ds_segm(data)
+
+    pd.testing.assert_frame_equal(result_df, segm_df)
+    buf_address = np.frombuffer(data, np.uint8).ctypes.data
+    for col in ['mz', 'int', 'sp_i']:
+        assert (result_df[col].values.ctypes.data - buf_address) % DS_SEGM_ALIGN == 0
+
+
+def test_deserialize_ds_segm_from_mmap(tmp_path):
+    segm_df = make_ds_segm(100, 'd')
+    path = tmp_path / 'segm'
+    path.write_bytes(serialize_ds_segm(segm_df.mz.values, segm_df.int.values, segm_df.sp_i.values))
+
+    with path.open('rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        result_df = deserialize_ds_segm(mm)
+        pd.testing.assert_frame_equal(result_df, segm_df)
+        del result_df
+
+
+def test_load_ds_segms(executor: Executor):
+    storage = executor.storage
+    segm_dfs = [make_ds_segm(10, 'd'), make_ds_segm(0, 'd', 10), make_ds_segm(1000, 'd', 10)]
+    cobjs = [
+        save_ds_segm(
+            storage, segm_dfs[0].mz.values, segm_dfs[0].int.values, segm_dfs[0].sp_i.values
+        ),
+        # Segments saved in the previous DataFrame format should still be readable
+        save_cobj(storage, segm_dfs[1]),
+        save_ds_segm(
+            storage, segm_dfs[2].mz.values, segm_dfs[2].int.values, segm_dfs[2].sp_i.values, 10
+        ),
+    ]
+
+    mzs, ints, sp_inds = load_ds_segms(storage, cobjs, [len(df) for df in segm_dfs], 'd')
+
+    expected_df = pd.concat(segm_dfs)
+    np.testing.assert_array_equal(mzs, expected_df.mz.values)
+    np.testing.assert_array_equal(ints, expected_df.int.values)
+    np.testing.assert_array_equal(sp_inds, expected_df.sp_i.values)
+    pd.testing.assert_frame_equal(load_ds_segm(storage, cobjs[1]), segm_dfs[1])
+    pd.testing.assert_frame_equal(load_ds_segm(storage, cobjs[2]), segm_dfs[2])
+
+
+def test_ds_segm_rows_in_mz_range(executor: Executor):
+    segm_df = make_ds_segm(DS_SEGM_INDEX_STEP * 5 + 3, 'd')
+    cobj = save_ds_segm(
+        executor.storage, segm_df.mz.values, segm_df.int.values, segm_df.sp_i.values
+    )
+    header, index = load_ds_segm_index(executor.storage, cobj)
+    mzs = segm_df.mz.values
+
+    for mz_lo, mz_hi in [(0, 2000), (300, 301), (mzs[2000], mzs[4000]), (2000, 3000), (0, 1)]:
+        row_lo, row_hi = ds_segm_rows_in_mz_range(header, index, mz_lo, mz_hi)
+
+        in_range = (mzs >= mz_lo) & (mzs <= mz_hi)
+        assert not in_range[:row_lo].any() and not in_range[row_hi:].any()
+        assert row_hi - row_lo <= in_range.sum() + 2 * DS_SEGM_INDEX_STEP
+
+
+@pytest.mark.parametrize('mz_range_i', [0, 1, 2, 3])
+def test_load_ds_segms_mz_range(executor: Executor, mz_range_i):
+    storage = executor.storage
+    ds_df = make_ds_segm(DS_SEGM_INDEX_STEP * 9, 'f')
+    segm_bounds = [0, 3000, 3000, 7000, DS_SEGM_INDEX_STEP * 9]
+    segm_dfs = [ds_df.iloc[lo:hi] for lo, hi in zip(segm_bounds[:-1], segm_bounds[1:])]
+    cobjs = [
+        save_ds_segm(storage, df.mz.values, df.int.values, df.sp_i.values, df.index.start)
+        for df in segm_dfs
+    ]
+    mzs = ds_df.mz.values
+    mz_range = [(0, 2000), (mzs[100], mzs[8000]), (mzs[5000], mzs[5001]), (50, 60)][mz_range_i]
+
+    result = load_ds_segms(storage, cobjs, [len(df) for df in segm_dfs], 'f', mz_range)
+
+    expected_df = ds_df[(ds_df.mz >= mz_range[0]) & (ds_df.mz <= mz_range[1])]
+    np.testing.assert_array_equal(result[0], expected_df.mz.values)
+    np.testing.assert_array_equal(result[1], expected_df.int.values)
+    np.testing.assert_array_equal(result[2], expected_df.sp_i.values)
+
+
+def make_centroids_df():
+    return pd.DataFrame(
+        {
+            'formula_i': np.repeat(np.arange(5, dtype=np.uint32), 4),
+            'peak_i': np.tile(np.arange(4, dtype=np.uint8), 5),
+            'mz': np.linspace(100, 200, 20),
+            'int': np.linspace(0, 100, 20, dtype=np.float32),
+            'ignore': False,
+        }
+    ).set_index('formula_i')
+
+
+@pytest.mark.parametrize('compression', [None, 'lz4', 'zstd'])
+@pytest.mark.parametrize(
+    'obj',
+    [
+        make_ds_segm(1000, 'f', start=10),
+        make_centroids_df(),
+        pd.DataFrame({'formula': ['H2O', None], 'target': [True, False], 'c': ['a', 'b']}).astype(
+            {'c': 'category'}
+        ),
+        pd.DataFrame(columns=['formula_i', 'mz']),
+    ],
+)
+def test_serialize_dataframe(obj, compression):
+    data = serialize(obj, compression)
+
+    assert data[: len(COBJ_MAGIC) + 1] == COBJ_MAGIC + COBJ_DATAFRAME
+    pd.testing.assert_frame_equal(deserialize(data), obj)
+
+
+@pytest.mark.parametrize(
+    'obj',
+    [
+        np.arange(12, dtype=np.uint32).reshape(3, 4),
+        np.array(1.5),
+        np.zeros((0, 2), 'f'),
+        np.eye(3).T,
+    ],
+)
+def test_serialize_ndarray(obj):
+    data = serialize(obj, 'lz4')
+
+    assert data[: len(COBJ_MAGIC) + 1] == COBJ_MAGIC + COBJ_NDARRAY
+    result = deserialize(data)
+    assert result.dtype == obj.dtype and result.shape == obj.shape
+    np.testing.assert_array_equal(result, obj)
+
+
+@pytest.mark.parametrize(
+    'obj',
+    [
+        {'id': 1, 'formula_map_df': make_centroids_df()},
+        ['H2O', 'CO2'],
+        # DataFrames and arrays that Arrow can't round-trip unchanged
+        pd.DataFrame({0: [1, 2]}),
+        pd.DataFrame({'a': [[1], [2, 3]]}),
+        np.array(['H2O']),
+    ],
+)
+def test_serialize_pickles_other_objects(obj):
+    data = serialize(obj)
+
+    assert data[: len(COBJ_MAGIC) + 1] == COBJ_MAGIC + COBJ_PICKLE
+    result = deserialize(data)
+    if isinstance(obj, dict):
+        pd.testing.assert_frame_equal(result.pop('formula_map_df'), obj['formula_map_df'])
+        assert result == {'id': 1}
+    elif isinstance(obj, pd.DataFrame):
+        pd.testing.assert_frame_equal(result, obj)
+    elif isinstance(obj, np.ndarray):
+        np.testing.assert_array_equal(result, obj)
+    else:
+        assert result == obj
+
+
+def test_deserialize_legacy_format():
+    segm_df = make_ds_segm(100, 'd')
+
+    pd.testing.assert_frame_equal(deserialize(pa.serialize(segm_df).to_buffer()), segm_df)
+    assert deserialize(pickle.dumps({'id': 1})) == {'id': 1}
+
+
+def test_load_cobj_from_local_storage(executor: Executor):
+    storage = executor.storage
+    segm_df = make_ds_segm(100, 'd')
+    cobj = save_cobj(storage, segm_df, key='test_load_cobj')
+
+    result_df = load_cobj(storage, cobj)
+    # Overwriting the object shouldn't affect the memory-mapped copy that's still in use
+    save_cobj(storage, make_ds_segm(10, 'f'), key='test_load_cobj')
+
+    pd.testing.assert_frame_equal(result_df, segm_df)
+    assert len(load_cobj(storage, cobj)) == 10
+    storage.delete_cloudobjects([cobj])
+
+
+def make_image_slab(n_formulas, n_peaks=4, nrows=50, ncols=60):
+    rng = np.random.default_rng(n_formulas)
+    sizes = rng.integers(0, 300, n_formulas * n_peaks)
+    sizes[::7] = 0  # Missing images
+    return ImageSlab(
+        formula_is=rng.permutation(n_formulas * 2)[:n_formulas],
+        centr_ints=rng.uniform(0, 100, (n_formulas, n_peaks)),
+        offsets=np.append(0, np.cumsum(sizes)),
+        # Pixels can be repeated and aren't necessarily in order
+        pixel_inds=rng.integers(0, nrows * ncols, sizes.sum()).astype(np.uint32),
+        ints=rng.uniform(0, 1000, sizes.sum()).astype(np.float32),
+        nrows=nrows,
+        ncols=ncols,
+    )
+
+
+def assert_image_slabs_equal(result: ImageSlab, expected: ImageSlab):
+    np.testing.assert_array_equal(result.formula_is, expected.formula_is)
+    np.testing.assert_array_equal(result.centr_ints, expected.centr_ints)
+    np.testing.assert_array_equal(result.offsets, expected.offsets)
+    assert result.ints.dtype == expected.ints.dtype
+    for pos in range(expected.n_formulas):
+        for peak_i in range(expected.n_peaks):
+            if expected.offsets[pos * expected.n_peaks + peak_i + 1] > 0:
+                np.testing.assert_array_equal(
+                    result.dense_image(pos, peak_i), expected.dense_image(pos, peak_i)
+                )
+
+
+@pytest.mark.parametrize('n_formulas', [0, 1, 500])
+def test_serialize_image_slab_roundtrip(n_formulas):
+    image_slab = make_image_slab(n_formulas)
+
+    data = serialize_image_slab(image_slab)
+
+    assert_image_slabs_equal(deserialize_image_slab(data), image_slab)
+    if n_formulas == 500:
+        assert np.frombuffer(data, IMAGE_SLAB_HEADER, 1)[0]['n_blocks'] > 1
+        # Random intensities are incompressible, so most of the savings here are in pixel indexes
+        assert len(data) < len(serialize(image_slab)) * 0.7
+
+
+def test_load_image_slab_formulas(executor: Executor):
+    storage = executor.storage
+    image_slab = make_image_slab(500)
+    # Slabs saved in the previous format should still be readable
+    cobjs = [save_image_slab(storage, image_slab), save_cobj(storage, image_slab)]
+    formula_is = image_slab.formula_is[[400, 3, 250]]
+
+    for cobj in cobjs:
+        result = load_image_slab(storage, cobj, formula_is)
+
+        assert_image_slabs_equal(result, image_slab.take([400, 3, 250]))
+        assert load_image_slab(storage, cobj, []).n_formulas == 0
+        assert_image_slabs_equal(load_image_slab(storage, cobj), image_slab)
+    storage.delete_cloudobjects(cobjs)
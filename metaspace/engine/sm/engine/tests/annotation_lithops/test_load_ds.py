@@ -0,0 +1,54 @@
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+from pyimzml.ImzMLWriter import ImzMLWriter
+
+from sm.engine.annotation_lithops import load_ds as load_ds_module
+from sm.engine.annotation_lithops.executor import Executor
+from sm.engine.annotation_lithops.io import load_ds_segm
+from sm.engine.annotation_lithops.load_ds import _load_ds, _load_ds_sorted_runs
+from tests.conftest import executor, sm_config
+
+
+def make_imzml(path, nrows=10, ncols=12, mz_dtype=np.float64):
+    rng = np.random.default_rng(42)
+    with ImzMLWriter(str(path / 'ds.imzML'), mz_dtype=mz_dtype, mode='processed') as writer:
+        for y in range(nrows):
+            for x in range(ncols):
+                n_peaks = rng.integers(0, 300)
+                # Round m/zs so that there are some equal m/zs in different spectra
+                mzs = np.sort(np.round(rng.uniform(100, 1000, n_peaks), 1))
+                ints = rng.uniform(0, 100, n_peaks).astype(np.float32)
+                ints[rng.uniform(size=n_peaks) < 0.1] = 0
+                writer.addSpectrum(mzs, ints, (x + 1, y + 1))
+    return path / 'ds.imzML', path / 'ds.ibd'
+
+
+@pytest.mark.parametrize('ds_segm_columnar', [False, True])
+def test_load_ds_sorted_runs_matches_load_ds(executor: Executor, tmp_path, ds_segm_columnar):
+    storage = executor.storage
+    imzml_path, ibd_path = make_imzml(tmp_path)
+    imzml_cobject = storage.put_cloudobject(imzml_path.read_bytes())
+    ibd_cobject = storage.put_cloudobject(ibd_path.read_bytes())
+    # Use tiny runs & segments to test splitting & merging
+    ds_segm_size_mb = 0.05
+
+    _, exp_bounds, exp_cobjs, exp_lens = executor.call(
+        _load_ds, (imzml_cobject, ibd_cobject, ds_segm_size_mb, True)
+    )
+    with patch.object(load_ds_module, 'SORT_RUN_SIZE_MB', 0.1):
+        _, bounds, cobjs, lens = _load_ds_sorted_runs(
+            executor, imzml_cobject, ibd_cobject, ds_segm_size_mb, ds_segm_columnar
+        )
+
+    assert len(cobjs) > 2
+    assert len(cobjs) == len(lens) == len(bounds)
+    exp_df = np.concatenate([load_ds_segm(storage, cobj).values for cobj in exp_cobjs])
+    segm_dfs = [load_ds_segm(storage, cobj) for cobj in cobjs]
+    np.testing.assert_array_equal(np.concatenate([df.values for df in segm_dfs]), exp_df)
+    np.testing.assert_array_equal(lens, [len(df) for df in segm_dfs])
+    np.testing.assert_array_equal(bounds, [(df.mz.min(), df.mz.max()) for df in segm_dfs])
+    assert (bounds[1:, 0] > bounds[:-1, 1]).all()
+    assert sum(lens) == sum(exp_lens)
+    assert exp_bounds[0, 0] == bounds[0, 0] and exp_bounds[-1, 1] == bounds[-1, 1]
@@ -0,0 +1,163 @@
+from datetime import datetime
+from threading import Barrier, Lock
+from time import sleep
+
+import pytest
+
+from sm.engine.annotation_lithops.cache import use_pipeline_cache
+from sm.engine.annotation_lithops.executor import Executor
+from sm.engine.annotation_lithops.pipeline import Pipeline
+from sm.engine.utils.perf_profile import DBProfiler, Profiler
+from tests.conftest import executor, sm_config, ds_config
+
+
+class RecordingProfiler(Profiler):
+    def __init__(self):
+        self.entries = []
+
+    def record_entry(self, name, start=None, finish=None, **extra_data):
+        self.entries.append((extra_data['stage'], start, finish))
+
+    def add_extra_data(self, **extra_data):
+        pass
+
+
+class ConcurrentStagesPipeline(Pipeline):
+    """Stages `a` and `b` can only finish if they run concurrently"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.barrier = Barrier(2, timeout=10)
+
+    @use_pipeline_cache
+    def stage_a(self):
+        self.barrier.wait()
+        self.a = 'a'
+
+    @use_pipeline_cache
+    def stage_b(self):
+        self.barrier.wait()
+        self.b = 'b'
+
+    @use_pipeline_cache
+    def stage_c(self):
+        self.c = self.a + self.b
+
+
+def make_pipeline(executor: Executor, ds_config, **kwargs):
+    return ConcurrentStagesPipeline(
+        None, None, [], ds_config, executor=executor, perf=RecordingProfiler(), **kwargs
+    )
+
+
+def run_stages(pipe, use_cache=True):
+    pipe.run_stages(
+        {
+            'c': (['a', 'b'], lambda: pipe.stage_c(use_cache=use_cache)),
+            'a': ([], lambda: pipe.stage_a(use_cache=use_cache)),
+            'b': ([], lambda: pipe.stage_b(use_cache=use_cache)),
+        }
+    )
+
+
+def test_run_stages_overlaps_independent_stages(executor: Executor, ds_config):
+    pipe = make_pipeline(executor, ds_config)
+
+    run_stages(pipe)
+
+    assert pipe.c == 'ab'
+    stage_times = {stage: (start, finish) for stage, start, finish in pipe.perf.entries}
+    assert list(stage_times) in (['a', 'b', 'c'], ['b', 'a', 'c'])
+    assert stage_times['a'][0] < stage_times['b'][1] and stage_times['b'][0] < stage_times['a'][1]
+    assert stage_times['c'][0] >= max(stage_times['a'][1], stage_times['b'][1])
+
+
+def test_run_stages_raises_stage_errors(executor: Executor, ds_config):
+    pipe = make_pipeline(executor, ds_config)
+
+    def fail():
+        raise ValueError('Stage failed')
+
+    with pytest.raises(ValueError, match='Stage failed'):
+        pipe.run_stages({'a': ([], fail), 'b': (['a'], pipe.stage_c)})
+    with pytest.raises(AssertionError, match='Unsatisfiable'):
+        pipe.run_stages({'a': (['b'], pipe.stage_c), 'b': (['a'], pipe.stage_c)})
+
+
+def test_concurrent_stages_are_cached_separately(executor: Executor, ds_config):
+    pipe = make_pipeline(executor, ds_config, cache_key='test_concurrent_stages')
+    pipe.clean()
+    try:
+        run_stages(pipe, use_cache=False)
+
+        assert pipe.cacher.load('stage_a') == ({'a': 'a'}, None)
+        assert pipe.cacher.load('stage_b') == ({'b': 'b'}, None)
+        assert pipe.cacher.load('stage_c') == ({'c': 'ab'}, None)
+
+        # Stages loaded from the cache don't wait on the barrier
+        cached_pipe = make_pipeline(executor, ds_config, cache_key='test_concurrent_stages')
+        cached_pipe.barrier = None
+        run_stages(cached_pipe)
+        assert (cached_pipe.a, cached_pipe.b, cached_pipe.c) == ('a', 'b', 'ab')
+    finally:
+        pipe.clean()
+
+
+class VersionedStagePipeline(Pipeline):
+    @use_pipeline_cache
+    def stage_v1(self):
+        self.a = 'a'
+
+    @use_pipeline_cache(version=2)
+    def stage_v2(self):
+        self.a = 'a'
+        self.b = 'b'
+
+
+def test_cached_stage_versions(executor: Executor, ds_config):
+    pipe = VersionedStagePipeline(
+        None, None, [], ds_config, executor=executor, cache_key='test_cached_stage_versions'
+    )
+    pipe.clean()
+    try:
+        # An entry cached by version 1 of the stage
+        pipe.cacher.save(({'a': 'old'}, None), 'stage_v2')
+        pipe.stage_v1()
+        pipe.stage_v2()
+
+        assert pipe.cacher.load('stage_v1') == ({'a': 'a'}, None)
+        assert pipe.cacher.load('stage_v2.v2') == ({'a': 'a', 'b': 'b'}, None)
+        assert (pipe.a, pipe.b) == ('a', 'b')
+    finally:
+        pipe.clean()
+
+
+class ThreadCheckingDB:
+    """Fails if it's used from multiple threads at once, like a DB instance sharing a cursor"""
+
+    def __init__(self):
+        self.rows = []
+        self._lock = Lock()
+
+    def insert(self, sql, rows):
+        assert self._lock.acquire(blocking=False), 'DB used concurrently'
+        try:
+            sleep(0.01)
+            self.rows.extend(rows)
+        finally:
+            self._lock.release()
+
+
+def test_run_stages_records_entries_from_parallel_stages(executor: Executor, ds_config):
+    db = ThreadCheckingDB()
+    pipe = make_pipeline(executor, ds_config)
+    pipe.perf = DBProfiler(db, 1, datetime.now())
+    n_stages = 8
+    barrier = Barrier(n_stages, timeout=10)
+
+    pipe.run_stages({f'stage{i}': ([], barrier.wait) for i in range(n_stages)})
+
+    assert sorted(seq for _, seq, *_ in db.rows) == list(range(n_stages))
+    assert sorted(name for _, _, name, *_ in db.rows) == sorted(
+        f'stage{i} stage finished' for i in range(n_stages)
+    )
@@ -0,0 +1,190 @@
+from io import BytesIO
+from typing import List
+from unittest.mock import MagicMock
+
+import numpy as np
+import pandas as pd
+import pytest
+from lithops.storage.utils import CloudObject
+
+from sm.engine.annotation_lithops.annotate import ImagesManager, gen_iso_image_slabs
+from sm.engine.annotation_lithops.build_moldb import InputMolDb, get_formulas_df
+from sm.engine.annotation_lithops.executor import Executor
+from sm.engine.annotation.analysis_cube import AnalysisCubeReader
+from sm.engine.annotation_lithops.io import save_cobj, load_cobjs, load_image_slab
+from sm.engine.annotation_lithops.cost_model import CostModel
+from sm.engine.annotation_lithops.prepare_results import (
+    filter_results_and_make_pngs,
+    make_pngs,
+    run_fdr_and_make_pngs,
+    save_analysis_cubes,
+    _split_png_jobs,
+    PNG_COST_FACTORS,
+    PNG_JOB_TIME,
+)
+from sm.engine.annotation_lithops.run_fdr import run_fdr
+from tests.conftest import executor, sm_config, ds_config
+
+
+def make_annotation_data(executor: Executor, ds_config):
+    storage = executor.storage
+    moldbs: List[InputMolDb] = [
+        {'id': 0, 'targeted': False, 'cobj': save_cobj(storage, ['H2O', 'CO2', 'C6H12O6'])},
+        {'id': 1, 'targeted': True, 'cobj': save_cobj(storage, ['CO2', 'H2SO4'])},
+        {'id': 2, 'targeted': True, 'cobj': save_cobj(storage, ['H2SO4', 'NH4', 'C5H5N5O'])},
+    ]
+    db_data_cobjs, formulas_df = get_formulas_df(storage, ds_config, moldbs)
+
+    # Give every ion an image with one peak in a pixel, and a random MSM
+    rng = np.random.default_rng(42)
+    nrows, ncols = 3, 4
+    formula_is = formulas_df.index.values
+    centr_df = pd.DataFrame(
+        {'formula_i': formula_is, 'peak_i': 0, 'mz': 100.0 + formula_is, 'int': 100.0}
+    )
+    sp_mzs = centr_df.mz.values
+    sp_inds = (formula_is % (nrows * ncols)).astype(np.uint32)
+    sp_ints = rng.uniform(1, 100, len(formula_is)).astype(np.float32)
+    isocalc_wrapper = MagicMock()
+    isocalc_wrapper.mass_accuracy_bounds = lambda mzs: (mzs - 0.05, mzs + 0.05)
+    images_manager = ImagesManager(storage)
+    for image_slab in gen_iso_image_slabs(
+        sp_inds, sp_mzs, sp_ints, centr_df, nrows, ncols, isocalc_wrapper, max_formulas=5
+    ):
+        images_manager.append([], image_slab)
+    _, images_df = images_manager.finish()
+
+    formula_metrics_df = pd.DataFrame(
+        {'msm': rng.choice([0, 0.5, 0.9, 1], len(formula_is)), 'spatial': 1.0},
+        index=pd.Index(formula_is, name='formula_i'),
+    )
+    imzml_reader = MagicMock()
+    imzml_reader.coordinates = [(x + 1, y + 1, 1) for y in range(nrows) for x in range(ncols)]
+
+    return db_data_cobjs, formula_metrics_df, moldbs, images_df, imzml_reader
+
+
+def load_pngs(executor: Executor, png_cobjs):
+    return sorted(
+        (formula_i, pngs)
+        for chunk in load_cobjs(executor.storage, png_cobjs)
+        for formula_i, pngs in chunk
+    )
+
+
+def test_run_fdr_and_make_pngs_matches_separate_stages(executor: Executor, ds_config):
+    db_data_cobjs, formula_metrics_df, moldbs, images_df, imzml_reader = make_annotation_data(
+        executor, ds_config
+    )
+
+    exp_fdrs = run_fdr(executor, formula_metrics_df, db_data_cobjs)
+    exp_results_dfs, exp_png_cobjs, exp_cube_cobjs = filter_results_and_make_pngs(
+        executor, formula_metrics_df, moldbs, exp_fdrs, images_df, imzml_reader
+    )
+    fdrs, results_dfs, png_cobjs, cube_cobjs = run_fdr_and_make_pngs(
+        executor, formula_metrics_df, db_data_cobjs, moldbs, images_df, imzml_reader
+    )
+
+    assert list(fdrs) == list(exp_fdrs) == [0, 1, 2]
+    for moldb_id, exp_fdr in exp_fdrs.items():
+        pd.testing.assert_frame_equal(fdrs[moldb_id], exp_fdr)
+        pd.testing.assert_frame_equal(results_dfs[moldb_id], exp_results_dfs[moldb_id])
+    pngs = load_pngs(executor, png_cobjs)
+    assert len(pngs) > 0
+    assert pngs == load_pngs(executor, exp_png_cobjs)
+    # Formulas that are annotated in several databases should only have their PNGs made once
+    assert len({formula_i for formula_i, _ in pngs}) == len(pngs)
+    assert len(cube_cobjs) == len(png_cobjs)
+    assert len(exp_cube_cobjs) == len(exp_png_cobjs)
+
+
+def test_save_analysis_cubes(executor: Executor, ds_config):
+    _, _, _, images_df, imzml_reader = make_annotation_data(executor, ds_config)
+    formula_is = images_df.index.values
+    cube_row_keys = {
+        10: {formula_i: f'img{formula_i}' for formula_i in formula_is[:3]},
+        11: {formula_i: f'img{formula_i}' for formula_i in formula_is[1:]},
+    }
+    cube_fps = {10: BytesIO(), 11: BytesIO()}
+
+    _, cube_cobjs = make_pngs(executor, images_df, imzml_reader)
+    save_analysis_cubes(executor.storage, cube_cobjs, imzml_reader, cube_row_keys, cube_fps)
+
+    for cube_id, row_keys in cube_row_keys.items():
+        data = cube_fps[cube_id].getvalue()
+        reader = AnalysisCubeReader(lambda start, end: data[start:end])
+        assert sorted(key for key in reader.keys if key is not None) == sorted(row_keys.values())
+        assert (reader.nrows, reader.ncols) == (3, 4)
+        assert reader.mask().all()
+        for keys, values in reader.iter_chunks(reader.keys):
+            for key, row in zip(keys, values):
+                formula_i = int(key[3:])
+                image_slab = load_image_slab(
+                    executor.storage, images_df.cobj[formula_i], [formula_i]
+                )
+                assert np.array_equal(reader.to_image(row), image_slab.dense_image(0, 0))
+
+
+def make_image_tasks_df(cobj_sizes, n_pixels=100):
+    cobjs = [CloudObject('localhost', 'bucket', f'images{i}') for i in range(len(cobj_sizes))]
+    return pd.DataFrame(
+        {
+            'n_pixels': n_pixels,
+            'cobj': [cobj for cobj, size in zip(cobjs, cobj_sizes) for _ in range(size)],
+        },
+        index=pd.Index(np.arange(sum(cobj_sizes)), name='formula_i'),
+    )
+
+
+def make_cost_model(cobj_time=0, image_time=0, pixel_time=0):
+    """A model of PNG jobs that take exactly the given times for each factor"""
+    time_coefs = np.array([0, cobj_time, image_time, pixel_time, 0])
+    return CostModel(PNG_COST_FACTORS, np.zeros(5), 0, time_coefs, np.ones(4))
+
+
+def test_split_png_jobs_aligns_jobs_to_cobjs():
+    # Each cobj takes 1/4 of a job, except the 3rd, which takes 10 jobs
+    cobj_sizes = [25, 25, 1000, 25, 25, 25, 25]
+    image_tasks_df = make_image_tasks_df(cobj_sizes)
+    cost_model = make_cost_model(image_time=PNG_JOB_TIME / 100)
+
+    jobs, cost_factors = _split_png_jobs(image_tasks_df, 10, 10, cost_model)
+
+    job_keys = [[cobj.key for cobj in df.cobj.unique()] for df, in jobs]
+    assert job_keys[0] == ['images0', 'images1']
+    assert job_keys[1:11] == [['images2']] * 10
+    assert job_keys[11:] == [['images3', 'images4', 'images5', 'images6']]
+    assert cost_factors.n_cobjs.tolist() == [len(keys) for keys in job_keys]
+    assert cost_factors.n_images.tolist() == [len(df) for df, in jobs]
+    assert cost_factors.n_pixels.tolist() == [df.n_pixels.sum() for df, in jobs]
+    pd.testing.assert_frame_equal(pd.concat([df for df, in jobs]), image_tasks_df)
+
+
+def test_split_png_jobs_scales_with_cost():
+    image_tasks_df = make_image_tasks_df([100] * 10)
+
+    # Without a model, the default costs should be used
+    jobs, _ = _split_png_jobs(image_tasks_df, 10, 10)
+    assert len(jobs) == 1
+    # There's no upper limit on the number of jobs. Each image takes 1/5 of a job here
+    jobs, _ = _split_png_jobs(
+        image_tasks_df, 10, 10, make_cost_model(pixel_time=PNG_JOB_TIME / 500)
+    )
+    assert len(jobs) == 200
+    jobs, _ = _split_png_jobs(image_tasks_df, 10, 10, make_cost_model(cobj_time=PNG_JOB_TIME))
+    assert len(jobs) == 10
+    jobs, cost_factors = _split_png_jobs(image_tasks_df.iloc[:0], 10, 10)
+    assert jobs == [] and cost_factors.empty
+
+
+@pytest.mark.parametrize(
+    'cost_model', [make_cost_model(pixel_time=1), make_cost_model(image_time=np.nan)]
+)
+def test_split_png_jobs_without_predicted_costs_makes_a_job_per_cobj(cost_model):
+    # The images have no pixels, so the model predicts that everything takes 0s, or NaN
+    image_tasks_df = make_image_tasks_df([3, 1, 2], n_pixels=0)
+
+    jobs, cost_factors = _split_png_jobs(image_tasks_df, 10, 10, cost_model)
+
+    assert [len(df) for df, in jobs] == [3, 1, 2]
+    assert cost_factors.n_cobjs.tolist() == [1, 1, 1]
@@ -3,7 +3,6 @@ from unittest.mock import patch
 from sm.engine.ds_config import DSConfigIsotopeGeneration
 from sm.engine.molecular_db import MolecularDB
 from sm.engine.annotation_spark.msm_basic_search import init_fdr, collect_ion_formulas
-from tests.conftest import spark_context
 
 BASIC_ISOTOPE_GENERATION_CONFIG: DSConfigIsotopeGeneration = {
     "instrument": "Orbitrap",
@@ -41,7 +40,7 @@ class TestMsmBasicSearch:
         _, fdr = moldb_fdr_list[0]
         assert not fdr.td_df.empty
 
-    def test_collect_ion_formulas(self, fetch_formulas_mock, spark_context):
+    def test_collect_ion_formulas(self, fetch_formulas_mock):
         ds_config = {
             'analysis_version': 1,
             'fdr': {'decoy_sample_size': 20},
@@ -49,12 +48,12 @@ class TestMsmBasicSearch:
         }
         moldb_fdr_list = init_fdr(ds_config, [MolecularDB(0, 'test_db', 'version')])
 
-        df = collect_ion_formulas(spark_context, moldb_fdr_list)
+        df = collect_ion_formulas(moldb_fdr_list)
 
         assert df.columns.tolist() == ['moldb_id', 'ion_formula', 'formula', 'modifier']
         assert df.shape == (42, 4)
 
-    def test_decoy_sample_size_30(self, fetch_formulas_mock, spark_context):
+    def test_decoy_sample_size_30(self, fetch_formulas_mock):
         ds_config = {
             'analysis_version': 1,
             'fdr': {'decoy_sample_size': 30},
@@ -62,12 +61,12 @@ class TestMsmBasicSearch:
         }
         moldb_fdr_list = init_fdr(ds_config, [MolecularDB(0, 'test_db', 'version')])
 
-        df = collect_ion_formulas(spark_context, moldb_fdr_list)
+        df = collect_ion_formulas(moldb_fdr_list)
 
         assert df.columns.tolist() == ['moldb_id', 'ion_formula', 'formula', 'modifier']
         assert df.shape == (62, 4)
 
-    def test_neutral_losses_and_chem_mods(self, fetch_formulas_mock, spark_context):
+    def test_neutral_losses_and_chem_mods(self, fetch_formulas_mock):
         ds_config = {
             'analysis_version': 1,
             'fdr': {'decoy_sample_size': 1},
@@ -75,7 +74,7 @@ class TestMsmBasicSearch:
         }
         moldb_fdr_list = init_fdr(ds_config, [MolecularDB(0, 'test_db', 'version')])
 
-        df = collect_ion_formulas(spark_context, moldb_fdr_list)
+        df = collect_ion_formulas(moldb_fdr_list)
 
         assert df.columns.tolist() == ['moldb_id', 'ion_formula', 'formula', 'modifier']
         # 2 formulas * (4 target adducts + (4 target adducts * 1 decoy adducts per target adduct)
@@ -1,7 +1,9 @@
 from itertools import product
 from unittest.mock import patch
 
+import numpy as np
 import pandas as pd
+import pytest
 from pandas.util.testing import assert_frame_equal
 
 from sm.engine.annotation.fdr import FDR
@@ -35,11 +37,37 @@ def test_fdr_decoy_adduct_selection_saves_corr():
     fdr.decoy_adducts_selection(target_formulas=['H2O'])
 
     assert_frame_equal(
-        fdr.td_df.sort_values(by=['formula', 'tm', 'dm']).reset_index(drop=True),
+        fdr.td_df.astype(object).sort_values(by=['formula', 'tm', 'dm']).reset_index(drop=True),
         exp_target_decoy_df.sort_values(by=['formula', 'tm', 'dm']).reset_index(drop=True),
     )
 
 
+def test_fdr_decoy_adduct_selection_is_reproducible():
+    def select_decoys():
+        fdr = FDR(
+            fdr_config={'decoy_sample_size': 20},
+            chem_mods=['-H+C'],
+            neutral_losses=['-H2O'],
+            target_adducts=['+H', '+Na', '+K'],
+            analysis_version=1,
+        )
+        fdr.decoy_adducts_selection(target_formulas=[f'C{i}H{i * 2}O' for i in range(1, 100)])
+        return fdr
+
+    fdr = select_decoys()
+    td_df = fdr.td_df
+
+    assert_frame_equal(td_df, select_decoys().td_df)
+    assert len(td_df) == 99 * len(fdr.target_modifiers_df) * 20
+    for (formula, tm), group_df in td_df.astype(object).groupby(['formula', 'tm']):
+        dm_prefix = fdr.target_modifiers_df.decoy_modifier_prefix[tm]
+        assert group_df.dm.nunique() == 20
+        assert all(dm.startswith(dm_prefix) for dm in group_df.dm)
+        assert not set(group_df.dm.str[len(dm_prefix) :]) & {'+H', '+Na', '+K'}
+    # Each decoy sample should contain a spread of decoy adducts
+    assert td_df.dm[::20].nunique() > 20
+
+
 def test_estimate_fdr_returns_correct_df():
     fdr = FDR(
         fdr_config=FDR_CONFIG,
@@ -165,3 +193,67 @@ def test_chem_mods_and_neutral_losses():
     assert min_count < len(ions) <= max_count
     target_ions = list(product(formulas, target_modifiers))
     assert set(target_ions).issubset(set(map(tuple, ions)))
+
+
+def estimate_fdr_reference(fdr, formula_msm):
+    """The original implementation of FDR.estimate_fdr, which merges tables for each decoy sample"""
+
+    def msm_fdr_map(target_msm, decoy_msm):
+        target_msm_hits = pd.Series(target_msm.msm.value_counts(), name='target')
+        decoy_msm_hits = pd.Series(decoy_msm.msm.value_counts(), name='decoy')
+        msm_df = (
+            pd.concat([target_msm_hits, decoy_msm_hits], axis=1)
+            .fillna(0)
+            .sort_index(ascending=False)
+        )
+        msm_df['target_cum'] = msm_df.target.cumsum()
+        msm_df['decoy_cum'] = msm_df.decoy.cumsum()
+        msm_df['fdr'] = msm_df.decoy_cum / msm_df.target_cum
+        return msm_df.fdr
+
+    td_df = fdr.td_df.set_index('tm')
+    target_fdr_df_list = []
+    for tm in fdr.target_modifiers_df.index.drop_duplicates():
+        target_msm = formula_msm[formula_msm.modifier == tm]
+        full_decoy_df = td_df.loc[tm, ['formula', 'dm']]
+        msm_fdr_list = []
+        for i in range(fdr.decoy_sample_size):
+            decoy_subset_df = full_decoy_df[i :: fdr.decoy_sample_size]
+            decoy_msm = pd.merge(
+                formula_msm,
+                decoy_subset_df,
+                left_on=['formula', 'modifier'],
+                right_on=['formula', 'dm'],
+            )
+            msm_fdr_list.append(msm_fdr_map(target_msm, decoy_msm))
+        msm_fdr_avg = pd.Series(pd.concat(msm_fdr_list, axis=1).median(axis=1), name='fdr')
+        target_fdr = fdr._digitize_fdr(target_msm.join(msm_fdr_avg, on='msm'))
+        target_fdr_df_list.append(target_fdr.drop('msm', axis=1))
+    return pd.concat(target_fdr_df_list, axis=0)
+
+
+@pytest.mark.parametrize('analysis_version', [1, 2])
+@pytest.mark.parametrize('decoy_sample_size', [1, 5, 20])
+def test_estimate_fdr_matches_reference(analysis_version, decoy_sample_size):
+    fdr = FDR(
+        fdr_config={'decoy_sample_size': decoy_sample_size},
+        chem_mods=['-H+C'],
+        neutral_losses=['-H2O'],
+        target_adducts=['+H', '+Na', '+K'],
+        analysis_version=analysis_version,
+    )
+    formulas = [f'C{i}H{i * 2}O' for i in range(1, 100)]
+    fdr.decoy_adducts_selection(target_formulas=formulas)
+    rng = np.random.default_rng(42)
+    formula_msm = pd.DataFrame(fdr.ion_tuples(), columns=['formula', 'modifier'])
+    # Include ties, zero MSMs and ions that weren't annotated
+    formula_msm['msm'] = rng.choice(np.linspace(0, 1, 50), len(formula_msm)) ** 2
+    formula_msm = formula_msm.sample(frac=0.8, random_state=42)
+    formula_msm['formula_i'] = np.arange(len(formula_msm))
+
+    result = fdr.estimate_fdr(formula_msm)
+
+    assert_frame_equal(result, estimate_fdr_reference(fdr, formula_msm))
+    np.testing.assert_array_equal(
+        fdr._median_fdrs(formula_msm, block_size=7), fdr._median_fdrs(formula_msm)
+    )
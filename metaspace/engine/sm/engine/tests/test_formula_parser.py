@@ -5,6 +5,7 @@ from pyMSpec.pyisocalc import pyisocalc
 from sm.engine.formula_parser import (
     generate_ion_formula,
     safe_generate_ion_formula,
+    safe_generate_ion_formulas,
     ParseFormulaError,
     format_ion_formula,
 )
@@ -67,3 +68,18 @@ def test_format_ion_formula():
     assert format_ion_formula('M', '-H2O', '[M]-', charge=-1) == 'M-H2O-'
     assert format_ion_formula('M', charge=-10) == 'M-10'
     assert format_ion_formula('M', charge=10) == 'M+10'
+
+
+def test_safe_generate_ion_formulas_matches_safe_generate_ion_formula():
+    formulas = ['C2H6O', 'C40H78NO8P', 'CH3CH3', 'C0H2', 'C.H2=O', 'NaCl', 'Xy', 'C2000H', '']
+    modifiers = [
+        *['', '+H', '-H2O+H', '-H+C-H2O+Na', '[M]+', '[M]-', '+Xe', '+C2000', 'invalid'],
+        # Invalid because of negative counts, including intermediate ones
+        *['-Cl', '-H10+H10', '+H-H2', '+Na-Na', '-C+C', '-H6+H6', '-C2+C'],
+    ]
+    # Both functions fail if the formula and modifier are both empty
+    pairs = [(f, m) for f, m in product(formulas, modifiers) if f or m]
+
+    ion_formulas = safe_generate_ion_formulas(*zip(*pairs), block_size=5)
+
+    assert ion_formulas.tolist() == [safe_generate_ion_formula(f, m) for f, m in pairs]
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+from png import Reader
+
+from sm.engine.annotation.png_encoder import encode_png, FILTER_ADAPTIVE
+
+
+def read_png(png_bytes):
+    width, height, rows, info = Reader(bytes=png_bytes).asDirect()
+    return np.array([list(row) for row in rows]).reshape(height, width, info['planes']), info
+
+
+@pytest.mark.parametrize('filter_type', [0, 1, 2, 3, 4, FILTER_ADAPTIVE])
+@pytest.mark.parametrize(
+    'shape, bitdepth', [((1, 1), 8), ((5, 7, 2), 16), ((13, 3, 3), 8), ((8, 9, 4), 16)]
+)
+def test_encode_png_roundtrip(shape, bitdepth, filter_type):
+    rng = np.random.default_rng(42)
+    pixels = rng.integers(0, 2 ** bitdepth, shape)
+    # Include flat regions, which are compressed differently by each filter
+    pixels[: shape[0] // 2] = 0
+
+    png_bytes = encode_png(pixels, bitdepth, compression_level=9, filter_type=filter_type)
+
+    result, info = read_png(png_bytes)
+    np.testing.assert_array_equal(result, pixels.reshape(result.shape))
+    assert info['bitdepth'] == bitdepth
+    assert info['greyscale'] == (len(shape) == 2 or shape[2] <= 2)
+    assert info['alpha'] == (len(shape) == 3 and shape[2] in (2, 4))
+
+
+def test_encode_png_invalid_filter():
+    with pytest.raises(ValueError):
+        encode_png(np.zeros((2, 2), dtype=np.uint8), filter_type=5)
@@ -1,8 +1,11 @@
+from io import BytesIO
+
 import numpy as np
+import pytest
 from numpy.testing import assert_almost_equal, assert_equal
-from png import Reader
+from png import Reader, Writer
 
-from sm.engine.annotation.png_generator import PngGenerator
+from sm.engine.annotation.png_generator import PngGenerator, get_png_options
 
 
 def test_png_gen_greyscale_works():
@@ -22,3 +25,75 @@ def test_png_gen_greyscale_works():
     assert_almost_equal(
         np.array(list(pixels)).reshape(grey_shape)[:, :, 0], norm_img_data, decimal=4
     )
+
+
+@pytest.mark.parametrize('filter_type', [0, 'adaptive'])
+def test_png_gen_matches_pypng(filter_type):
+    rng = np.random.default_rng(42)
+    alpha_ch = (rng.uniform(size=(20, 30)) < 0.9).astype(float)
+    img_data = np.where(rng.uniform(size=(20, 30)) < 0.3, rng.exponential(size=(20, 30)), 0)
+    gen = PngGenerator(alpha_ch, greyscale=True, filter_type=filter_type)
+
+    img = gen._to_image(img_data)
+    fp = BytesIO()
+    Writer(width=30, height=20, alpha=True, greyscale=True, bitdepth=16).write(
+        fp, img.reshape(20, 30 * 2).tolist()
+    )
+
+    _, _, exp_pixels, _ = Reader(bytes=fp.getvalue()).asDirect()
+    _, _, pixels, _ = Reader(bytes=gen.generate_png(img_data)).asDirect()
+    assert_equal(np.array(list(pixels)), np.array(list(exp_pixels)))
+
+
+def test_png_gen_sparse_matches_dense():
+    rng = np.random.default_rng(42)
+    alpha_ch = (rng.uniform(size=(10, 12)) < 0.9).astype(float)
+    gen = PngGenerator(alpha_ch, greyscale=True)
+    all_pixels = np.arange(120)
+    images = [
+        (rng.choice(120, 10, replace=False), rng.exponential(size=10)),
+        # Repeated, unsorted pixels
+        (rng.integers(0, 120, 30), rng.exponential(size=30)),
+        # Negative values make empty pixels non-zero, and the buffer has to be fully reset
+        (rng.choice(120, 10, replace=False), rng.normal(size=10)),
+        (all_pixels, rng.exponential(size=120)),
+        (np.array([5]), np.array([3.0])),
+        (rng.choice(120, 50, replace=False), rng.exponential(size=50)),
+    ]
+
+    for pixel_inds, values in images:
+        for dtype in [np.float32, np.float64]:
+            dense = np.zeros(120, dtype=dtype)
+            np.add.at(dense, pixel_inds, values.astype(dtype))
+
+            exp_png = gen.generate_png(dense.reshape(10, 12))
+            sparse_png = gen.generate_sparse_png(pixel_inds, values.astype(dtype))
+
+            _, _, exp_pixels, _ = Reader(bytes=exp_png).asDirect()
+            _, _, pixels, _ = Reader(bytes=sparse_png).asDirect()
+            assert_equal(np.array(list(pixels)), np.array(list(exp_pixels)))
+
+
+def test_png_gen_options_from_config():
+    rng = np.random.default_rng(42)
+    alpha_ch = np.ones((50, 60))
+    img_data = np.where(rng.uniform(size=(50, 60)) < 0.3, rng.exponential(size=(50, 60)), 0)
+    fast_options = get_png_options(
+        {'image_storage': {'png_compression_level': 1, 'png_filter': 'adaptive'}}
+    )
+    gen = PngGenerator(alpha_ch, greyscale=True, **get_png_options({}))
+    fast_gen = PngGenerator(alpha_ch, greyscale=True, **fast_options)
+
+    # By default, files are compressed like pypng's to avoid increasing storage size
+    img = gen._to_image(img_data)
+    fp = BytesIO()
+    Writer(width=60, height=50, alpha=True, greyscale=True, bitdepth=16).write(
+        fp, img.reshape(50, 60 * 2).tolist()
+    )
+    png_bytes = gen.generate_png(img_data)
+    assert len(png_bytes) == len(fp.getvalue())
+
+    assert fast_options == {'compression_level': 1, 'filter_type': 'adaptive'}
+    _, _, exp_pixels, _ = Reader(bytes=png_bytes).asDirect()
+    _, _, pixels, _ = Reader(bytes=fast_gen.generate_png(img_data)).asDirect()
+    assert_equal(np.array(list(pixels)), np.array(list(exp_pixels)))
@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import json
 import logging
+import threading
 from collections import defaultdict
 from contextlib import contextmanager, ExitStack
 from datetime import datetime, timedelta
@@ -33,6 +34,9 @@ class DBProfiler(Profiler):
         self._profile_id = profile_id
         self._next_seq = 0
         self._last_record_time = start_time
+        # Entries can be recorded from concurrent pipeline stages. DB instances can't be used
+        # from multiple threads at once, and sequence numbers must be unique
+        self._lock = threading.Lock()
 
     def record_entry(
         self,
@@ -52,27 +56,30 @@ class DBProfiler(Profiler):
             finish: Defaults to now
             extra_data: Must be JSON-serializable
         """
-        now = datetime.now()
-        start = start or self._last_record_time
-        finish = finish or now
-        self._db.insert(
-            "INSERT INTO perf_profile_entry (profile_id, sequence, name, start, finish, extra_data)"
-            " VALUES (%s, %s, %s, %s, %s, %s)",
-            [(self._profile_id, self._next_seq, name, start, finish, json.dumps(extra_data))],
-        )
-        self._last_record_time = now
-        self._next_seq += 1
+        with self._lock:
+            now = datetime.now()
+            start = start or self._last_record_time
+            finish = finish or now
+            self._db.insert(
+                "INSERT INTO perf_profile_entry "
+                "(profile_id, sequence, name, start, finish, extra_data) "
+                "VALUES (%s, %s, %s, %s, %s, %s)",
+                [(self._profile_id, self._next_seq, name, start, finish, json.dumps(extra_data))],
+            )
+            self._last_record_time = now
+            self._next_seq += 1
 
     def add_extra_data(self, **extra_data):
         """Adds custom data to the top-level perf_profile"""
-        (old_extra_data,) = self._db.select_one(
-            'SELECT extra_data FROM perf_profile WHERE id = %s', (self._profile_id,)
-        )
-        extra_data_json = json.dumps({**(old_extra_data or {}), **extra_data})
-        self._db.alter(
-            'UPDATE perf_profile SET extra_data = %s WHERE id = %s',
-            (extra_data_json, self._profile_id),
-        )
+        with self._lock:
+            (old_extra_data,) = self._db.select_one(
+                'SELECT extra_data FROM perf_profile WHERE id = %s', (self._profile_id,)
+            )
+            extra_data_json = json.dumps({**(old_extra_data or {}), **extra_data})
+            self._db.alter(
+                'UPDATE perf_profile SET extra_data = %s WHERE id = %s',
+                (extra_data_json, self._profile_id),
+            )
 
 
 class NullProfiler(Profiler):
@@ -2,11 +2,19 @@ from unittest.mock import MagicMock, patch
 
 import numpy as np
 import pandas as pd
+from scipy.sparse import csr_matrix
 
+from sm.engine.postprocessing.coloc_cache import ColocCache, ColocCacheData
 from sm.engine.postprocessing.colocalization import (
     analyze_colocalization,
     Colocalization,
     FreeableRef,
+    _get_best_colocs,
+    _get_images,
+    _label_clusters,
+    _get_thresholded_scores,
+    _normalize_rows,
+    _pairs_to_matrix,
 )
 from sm.engine.db import DB
 from .utils import create_test_molecular_db, create_test_ds
@@ -29,6 +37,248 @@ def test_valid_colocalization_jobs_generated():
     )  # First annotation was colocalized with at least one other
 
 
+def make_coloc_images(n_images=60, h=5, w=10):
+    rng = np.random.default_rng(42)
+    patterns = rng.uniform(0, 1, (4, h * w)) * (rng.uniform(0, 1, (4, h * w)) > 0.5)
+    images = patterns[np.arange(n_images) % 4] * rng.uniform(0.5, 2, (n_images, 1))
+    images += rng.uniform(0, 0.5, (n_images, h * w)) * (rng.uniform(0, 1, (n_images, h * w)) > 0.8)
+    ion_ids = np.arange(n_images) * 4
+    fdrs = np.array([[0.05, 0.1, 0.2, 0.5][i % 4] for i in range(n_images)])
+    return images.astype(np.float32), ion_ids, fdrs
+
+
+def test_get_best_colocs_matches_full_score_matrix():
+    images, _, fdrs = make_coloc_images()
+    normed_images = _normalize_rows(images.copy())
+    exp_scores = normed_images @ normed_images.T
+    fdr_masks = {0.1: fdrs <= 0.1, 0.5: fdrs <= 0.5}
+
+    (idxs_a, idxs_b, scores), pruned_scores = _get_thresholded_scores(
+        normed_images, np.arange(len(images)), 7, fdr_masks, max_samples=3, min_score=0.5
+    )
+    pair_scores = _pairs_to_matrix(len(images), idxs_a, idxs_b, scores)
+    colocs = _get_best_colocs(pair_scores, fdr_masks, max_samples=3)
+
+    # Only the top pairs of each image at each FDR level should be kept
+    assert len(scores) <= len(images) * 3 * len(fdr_masks)
+    assert pruned_scores.shape == (len(images), len(fdr_masks)) and pruned_scores.max() >= 0.5
+
+    for fdr, fdr_mask in fdr_masks.items():
+        assert [i for i, _, _ in colocs[fdr]] == np.flatnonzero(fdr_mask).tolist()
+        for i, js, scores in colocs[fdr]:
+            row_scores = np.where(fdr_mask, exp_scores[i], 0)
+            row_scores[i] = 0
+            exp_js = np.argsort(-row_scores, kind='stable')[:3]
+            exp_js = exp_js[row_scores[exp_js] >= 0.5]
+            assert js.tolist() == exp_js.tolist()
+            assert np.allclose(scores, row_scores[exp_js])
+
+
+def test_label_clusters_is_deterministic():
+    # Images made from 4 patterns. Clusters shouldn't contain images of several patterns
+    images, _, _ = make_coloc_images(n_images=32)
+    images = _normalize_rows(images)
+    scores = images @ images.T
+    patterns = np.arange(32) % 4
+
+    labels = _label_clusters(scores)
+
+    assert np.array_equal(labels, _label_clusters(scores))
+    for label in np.unique(labels):
+        assert len(np.unique(patterns[labels == label])) == 1
+
+
+def assert_coloc_jobs_match(jobs, exp_jobs):
+    assert [(job.fdr, job.algorithm_name, job.ion_ids) for job in jobs] == [
+        (job.fdr, job.algorithm_name, job.ion_ids) for job in exp_jobs
+    ]
+    for job, exp_job in zip(jobs, exp_jobs):
+        assert len(job.coloc_annotations) == len(exp_job.coloc_annotations)
+        for (ion_id, other_ion_ids, scores), (exp_ion_id, exp_other_ion_ids, exp_scores) in zip(
+            job.coloc_annotations, exp_job.coloc_annotations
+        ):
+            # Scores can differ by rounding errors, which may reorder near-equal scores
+            assert ion_id == exp_ion_id
+            assert set(other_ion_ids) == set(exp_other_ion_ids)
+            assert np.allclose(sorted(scores), sorted(exp_scores), atol=1e-6)
+
+
+def test_colocalization_results_dont_depend_on_block_size():
+    images, ion_ids, fdrs = make_coloc_images()
+
+    def run(images, block_mem_mb):
+        return list(
+            analyze_colocalization(
+                'ds_id',
+                'HMDB_v4',
+                FreeableRef(images),
+                ion_ids,
+                fdrs,
+                5,
+                10,
+                block_mem_mb=block_mem_mb,
+            )
+        )
+
+    jobs = run(images.copy(), 256)
+    assert len(jobs) == 8
+    # 21 rows per block
+    assert_coloc_jobs_match(run(images.copy(), 0.01), jobs)
+    assert_coloc_jobs_match(run(csr_matrix(images), 0.01), jobs)
+
+
+def run_cached_colocalization(cache, images, ion_ids, fdrs, **kwargs):
+    cache_data = cache.load(ion_ids)
+    is_new = ~cache_data.is_cached(ion_ids)
+    jobs = list(
+        analyze_colocalization(
+            'ds_id',
+            'HMDB_v4',
+            FreeableRef(images[is_new]),
+            ion_ids,
+            fdrs,
+            5,
+            10,
+            cache_data=cache_data,
+            **kwargs,
+        )
+    )
+    cache.save(cache_data)
+    return jobs, cache_data
+
+
+def test_cached_colocalization_matches_uncached(executor, sm_config):
+    images, ion_ids, fdrs = make_coloc_images()
+    cache = ColocCache(executor.storage, sm_config['lithops']['sm_storage'], 'ds_id', {})
+
+    def run(idxs):
+        return run_cached_colocalization(cache, images[idxs], ion_ids[idxs], fdrs[idxs])
+
+    def run_uncached(idxs):
+        return list(
+            analyze_colocalization(
+                'ds_id', 'HMDB_v4', FreeableRef(images[idxs]), ion_ids[idxs], fdrs[idxs], 5, 10
+            )
+        )
+
+    # Two databases with overlapping annotations
+    for idxs, new_idxs in [
+        (np.arange(0, 40), np.arange(0, 40)),
+        (np.arange(20, 60), np.arange(40, 60)),
+    ]:
+        jobs, cache_data = run(idxs)
+        assert_coloc_jobs_match(jobs, run_uncached(idxs))
+        assert cache_data.new_segment['ion_ids'].tolist() == ion_ids[new_idxs].tolist()
+
+    # Pairs of ions that were only annotated in different databases should be filled in
+    idxs = np.arange(60)
+    jobs, cache_data = run(idxs)
+    exp_jobs = run_uncached(idxs)
+    assert_coloc_jobs_match(jobs, exp_jobs)
+    assert [job.sample_ion_ids for job in jobs] == [job.sample_ion_ids for job in exp_jobs]
+    assert len(cache_data.new_segment['ion_ids']) == 0
+    assert len(cache_data.new_segment['pairs']['cosine']) > 0
+
+    # Nothing should be recalculated
+    jobs, cache_data = run(idxs)
+    assert_coloc_jobs_match(jobs, exp_jobs)
+    assert cache_data.new_segment is None
+    assert not cache_data.new_samples
+
+    # Clustering should only be re-run for FDR levels whose annotations changed
+    changed_fdrs = fdrs.copy()
+    changed_fdrs[0] = 0.5
+    jobs, cache_data = run_cached_colocalization(cache, images, ion_ids, changed_fdrs)
+    assert cache_data.new_segment is None
+    assert len(cache_data.new_samples) == 3
+
+
+def test_cached_colocalization_with_discarded_pairs_matches_uncached(executor, sm_config):
+    images, ion_ids, fdrs = make_coloc_images()
+    cache = ColocCache(executor.storage, sm_config['lithops']['sm_storage'], 'ds_id', {'k': 3})
+    changed_fdrs = np.where(np.arange(len(fdrs)) % 3 == 0, 0.05, fdrs)
+
+    # Overlapping databases, annotations whose FDRs changed and annotations that were removed
+    for idxs, run_fdrs in [
+        (np.arange(0, 40), fdrs),
+        (np.arange(20, 60), fdrs),
+        (np.arange(0, 60), changed_fdrs),
+        (np.arange(10, 50), fdrs),
+        (np.arange(0, 60), fdrs),
+    ]:
+        with patch('sm.engine.postprocessing.coloc_cache.MAX_CACHED_SEGMENTS', 2):
+            jobs, cache_data = run_cached_colocalization(
+                cache, images[idxs], ion_ids[idxs], run_fdrs[idxs], max_samples=3
+            )
+        exp_jobs = analyze_colocalization(
+            'ds_id',
+            'HMDB_v4',
+            FreeableRef(images[idxs]),
+            ion_ids[idxs],
+            run_fdrs[idxs],
+            5,
+            10,
+            max_samples=3,
+        )
+        assert_coloc_jobs_match(jobs, list(exp_jobs))
+        if cache_data.new_segment is not None:
+            for pairs_df in cache_data.new_segment['pairs'].values():
+                assert len(pairs_df) <= len(idxs) * 3 * 4
+
+    # Segments should have been rewritten as one segment when there were too many
+    assert len(cache._load_manifest()['segments']) <= 2  # pylint: disable=protected-access
+
+
+def test_concurrently_saved_cache_entries_are_kept(executor, sm_config):
+    images, ion_ids, fdrs = make_coloc_images()
+    cache = ColocCache(executor.storage, sm_config['lithops']['sm_storage'], 'ds_id', {})
+    run_cached_colocalization(cache, images[:20], ion_ids[:20], fdrs[:20])
+
+    # Both jobs load the cache before either of them saves its entries
+    pending = []
+    with patch.object(cache, 'save', pending.append):
+        for idxs in [np.arange(0, 40), np.arange(20, 60)]:
+            run_cached_colocalization(cache, images[idxs], ion_ids[idxs], fdrs[idxs])
+    for cache_data in pending:
+        cache.save(cache_data)
+
+    loaded_data = cache.load(ion_ids)
+    assert loaded_data.is_cached(ion_ids).all()
+    for cache_data in pending:
+        assert cache_data.new_samples.items() <= loaded_data.samples.items()
+
+
+def test_get_images_only_loads_uncached_images():
+    ion_ids = np.array([1, 2, 3, 4])
+    image_ids = ['img1', 'img2', 'img3', 'img4']
+    cache_data = ColocCacheData(
+        5, 5, np.array([2, 4]), {'cosine': np.zeros((2, 25), dtype=np.float32)}
+    )
+    image_storage = MagicMock()
+    image_storage.get_ion_images_for_analysis.return_value = (
+        np.ones((2, 25), dtype=np.float32),
+        None,
+        (5, 5),
+    )
+
+    images, h, w = _get_images(image_storage, 'ds_id', image_ids, [1] * 4, ion_ids, cache_data)
+
+    assert images.ref.shape == (2, 25) and (h, w) == (5, 5)
+    assert image_storage.get_ion_images_for_analysis.call_args[0][1] == ['img1', 'img3']
+    assert image_storage.get_ion_images_for_analysis.call_args[1]['sparse']
+
+    # If the images have changed size, the cache should be discarded
+    image_storage.get_ion_images_for_analysis.side_effect = [
+        (np.ones((2, 16), dtype=np.float32), None, (4, 4)),
+        (np.ones((4, 16), dtype=np.float32), None, (4, 4)),
+    ]
+
+    images, h, w = _get_images(image_storage, 'ds_id', image_ids, [1] * 4, ion_ids, cache_data)
+
+    assert images.ref.shape == (4, 16) and (h, w) == (4, 4)
+    assert cache_data.is_cleared and len(cache_data.ion_ids) == 0
+
+
 def mock_get_ion_images_for_analysis(ds_id, img_ids, **kwargs):
     images = (
         np.array(
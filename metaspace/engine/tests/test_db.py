@@ -1,4 +1,6 @@
-from sm.engine.db import ConnectionPool, DB, transaction_context
+import pandas as pd
+
+from sm.engine.db import ConnectionPool, DB, transaction_context, COPY_CHUNK_ROWS, _IterReader
 
 TABLE_CREATE = 'CREATE TABLE job (id SERIAL NOT NULL, moldb_id integer, ds_id text)'
 JOB_INS = 'INSERT INTO job (moldb_id, ds_id) VALUES (%s, %s) RETURNING id'
@@ -44,3 +46,65 @@ def test_insert_nested_transaction_rollback(sm_config, empty_test_db):
         db2 = DB()
         row = db2.select_one(JOB_SEL, (job_id,))
         assert row == []
+
+
+def test_insert_values_returns_ids_in_row_order(sm_config, empty_test_db):
+    with ConnectionPool(sm_config['db']):
+        db = DB()
+        db.alter(TABLE_CREATE)
+        rows = [(i, f'ds{i}') for i in range(2500)]
+
+        job_ids = db.insert_values(
+            'INSERT INTO job (moldb_id, ds_id) VALUES %s RETURNING id', rows, fetch=True
+        )
+
+        assert len(job_ids) == len(rows)
+        for (job_id,), row in zip(job_ids[::500], rows[::500]):
+            assert db.select_one(JOB_SEL, (job_id,)) == row
+
+
+def test_copy_df(sm_config, empty_test_db):
+    with ConnectionPool(sm_config['db']):
+        db = DB()
+        db.alter(
+            'CREATE TABLE copy_test (id int, name text, stats json, ids text[], scores real[])'
+        )
+        n_rows = COPY_CHUNK_ROWS + 2
+        df = pd.DataFrame(
+            {
+                'id': range(n_rows),
+                'name': ['', None, *(f'a,"b"\tc\nd{i}' for i in range(n_rows - 2))],
+                'stats': '{"x": [1, 2]}',
+                'ids': [['a', None, 'b,"c"'], None, *([[]] * (n_rows - 2))],
+                'scores': [[0.5, 1.25]] * n_rows,
+            }
+        )
+
+        db.copy_df('copy_test', df)
+
+        assert db.select_one('SELECT COUNT(*) FROM copy_test') == (n_rows,)
+        rows = db.select(
+            'SELECT id, name, stats, ids, scores FROM copy_test WHERE id < 3 ORDER BY id'
+        )
+        assert rows == [
+            (0, '', {'x': [1, 2]}, ['a', None, 'b,"c"'], [0.5, 1.25]),
+            (1, None, {'x': [1, 2]}, None, [0.5, 1.25]),
+            (2, 'a,"b"\tc\nd0', {'x': [1, 2]}, [], [0.5, 1.25]),
+        ]
+
+
+def test_iter_reader_reads_across_chunks():
+    reader = _IterReader(['ab\nc', '', 'de\n', 'fgh\ni'])
+
+    assert reader.read(2) == 'ab'
+    assert reader.readline() == '\n'
+    assert reader.read(3) == 'cde'
+    assert reader.readline(2) == '\n'
+    assert reader.readline() == 'fgh\n'
+    assert reader.read(5) == 'i'
+    assert reader.read(5) == ''
+    assert reader.readline() == ''
+
+    reader = _IterReader(['ab\nc', 'de'])
+    assert reader.read(1) == 'a'
+    assert reader.read() == 'b\ncde'
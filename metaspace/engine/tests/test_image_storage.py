@@ -6,6 +6,8 @@ import botocore.exceptions
 import pytest
 
 from sm.engine import image_storage
+from sm.engine.annotation.analysis_cube import AnalysisCubeWriter
+from sm.engine.annotation.png_generator import PngGenerator
 from sm.engine.storage import get_s3_bucket
 
 
@@ -54,3 +56,44 @@ def test_delete_image_success():
 
     # delete non-existing image should not raise exception
     image_storage.delete_image(image_storage.ISO, "ds-id", image_id)
+
+
+def test_get_ion_images_for_analysis_from_analysis_cube():
+    rng = np.random.default_rng(42)
+    mask = np.ones((10, 15), dtype=bool)
+    mask[:, :2] = False
+    imgs = rng.uniform(1, 100, (5, 10, 15)) * mask
+    png_generator = PngGenerator(mask)
+    image_ids = [
+        image_storage.post_image(image_storage.ISO, 'ds-id', png_generator.generate_png(img))
+        for img in imgs
+    ]
+    fp = io.BytesIO()
+    writer = AnalysisCubeWriter(fp, np.flatnonzero(mask), *mask.shape)
+    for image_id, img in zip(image_ids[:3], imgs[:3]):
+        writer.append(image_id, img[mask])
+    writer.finish()
+    fp.seek(0)
+    image_storage.post_analysis_cube('ds-id', 1, fp)
+
+    exp_value, exp_mask, exp_shape = image_storage.get_ion_images_for_analysis('ds-id', image_ids)
+    # The last 2 images aren't in the cube, so they should be read from their PNGs
+    value, mask, shape = image_storage.get_ion_images_for_analysis(
+        'ds-id', image_ids, job_ids=[1] * 5
+    )
+
+    assert shape == exp_shape == (10, 15)
+    assert np.array_equal(mask, exp_mask)
+    # PIL decodes the PNGs with 8 bits per channel, so the PNG values are slightly less precise
+    assert np.allclose(value, exp_value, atol=0.01)
+    assert np.array_equal(value[3:], exp_value[3:])
+    sparse_value, _, _ = image_storage.get_ion_images_for_analysis(
+        'ds-id', image_ids, max_mem_mb=0.001, job_ids=[1] * 5, sparse=True
+    )
+    assert np.array_equal(sparse_value.toarray(), value)
+    # Jobs without a cube fall back to PNGs
+    value, _, _ = image_storage.get_ion_images_for_analysis('ds-id', image_ids, job_ids=[2] * 5)
+    assert np.array_equal(value, exp_value)
+
+    image_storage.delete_analysis_cube('ds-id', 1)
+    assert image_storage._instance.get_analysis_cube('ds-id', 1) is None
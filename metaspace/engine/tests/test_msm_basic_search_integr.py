@@ -67,10 +67,10 @@ def make_formula_image_metrics_mock_side_effect():
 
 
 @patch('sm.engine.molecular_db.fetch_formulas', lambda moldb_id: ['H2O', 'C5H3O'])
-def test_compute_fdr(spark_context, ds_config):
+def test_compute_fdr(ds_config):
     moldb_fdr_list = init_fdr(ds_config, [MolecularDB(0, 'test_db', 'version')])
     _, fdr = moldb_fdr_list[0]
-    formula_map_df = collect_ion_formulas(spark_context, moldb_fdr_list).drop('moldb_id', axis=1)
+    formula_map_df = collect_ion_formulas(moldb_fdr_list).drop('moldb_id', axis=1)
 
     formula_metrics_df = pd.DataFrame(
         [(10, 'H3O', 0.99), (11, 'C5H4O', 0.5), (12, 'H2ONa', 0.1)],
@@ -10,7 +10,11 @@ from scipy.sparse import coo_matrix
 
 from sm.engine.db import DB
 from sm.engine.ion_mapping import ION_SEL
-from sm.engine.annotation_spark.search_results import SearchResults, METRICS_INS
+from sm.engine.annotation_spark.search_results import (
+    SearchResults,
+    METRICS_TABLE,
+    METRICS_COLUMNS,
+)
 
 db_mock = MagicMock(spec=DB)
 
@@ -22,6 +26,13 @@ def db_sel_side_effect(query, *args):
     raise ValueError(f'Unrecognized db.select: {query} {args}')
 
 
+def assert_copied_rows(exp_rows):
+    table, df = db_mock.copy_df.call_args[0]
+    assert table == METRICS_TABLE
+    assert list(df.columns) == METRICS_COLUMNS
+    assert list(df.itertuples(index=False, name=None)) == exp_rows
+
+
 @pytest.fixture
 def search_results():
     metrics = [
@@ -113,7 +124,7 @@ def test_save_ion_img_metrics_correct_db_call(search_results):
             123,
         )
     ]
-    db_mock.insert.assert_called_with(METRICS_INS, exp_rows)
+    assert_copied_rows(exp_rows)
 
 
 @unittest.mock.patch('sm.engine.image_storage.ImageStorage.post_image')
@@ -175,7 +186,7 @@ def test_non_native_python_number_types_handled(search_results):
                 123,
             )
         ]
-        db_mock.insert.assert_called_with(METRICS_INS, exp_rows)
+        assert_copied_rows(exp_rows)
 
 
 def test_save_ion_img_metrics_empty_call(search_results):
@@ -185,4 +196,4 @@ def test_save_ion_img_metrics_empty_call(search_results):
 
     search_results.store_ion_metrics(ion_metrics_df, ion_img_ids, db_mock)
 
-    db_mock.insert.assert_called_with(METRICS_INS, [])
+    assert_copied_rows([])
@@ -107,3 +107,18 @@ class TestSMDaemonDatasetManager:
 
         EsMock.return_value.delete_ds.assert_has_calls([call(ds_id)])
         assert db.select_one('SELECT * FROM dataset WHERE id = %s', params=(ds_id,)) == []
+
+    @patch('sm.engine.daemons.dataset_manager.Colocalization')
+    @patch('sm.engine.annotation.job.ESExporter', spec=ESExporter)
+    def test_delete_ds_when_coloc_cache_deletion_fails(self, EsMock, ColocalizationMock, fill_db):
+        ColocalizationMock.return_value.delete_cache.side_effect = Exception('Storage unavailable')
+        db = DB()
+        manager = create_daemon_man(db=db, es=EsMock())
+
+        ds_id = '2000-01-01'
+        ds = create_ds(ds_id=ds_id)
+
+        manager.delete(ds)
+
+        EsMock.return_value.delete_ds.assert_has_calls([call(ds_id)])
+        assert db.select_one('SELECT * FROM dataset WHERE id = %s', params=(ds_id,)) == []